@@ -0,0 +1,106 @@
+"""
+Benchmark for the Bleak GATTClient's native asyncio mode.
+
+Measures the per-op overhead of async_char_read, async_char_write and the
+blocking char_read, with the ops going through a QOpExecutor (the default)
+and through an AsyncQOpQueue on the BLE loop (nativeasync=True). The
+BleakClient is replaced by a fake that returns immediately, so the numbers
+are all queueing and thread hops.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_bleak_native.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, List
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from ble.bleak.gattclient import GATTClient
+from ble.bleops import ContextConverter, QOpExecutorFactory
+from ble.uuidtype import CHAR_UUID
+
+OPS = 2000
+WARMUP = 100
+UUID = CHAR_UUID("0000a002-0000-1000-8000-00805f9b34fb")
+
+
+class NoOpConverter(ContextConverter):
+    def convert(self, callback : Any) -> Any:
+        return callback
+
+
+class FakeBleakClient:
+    """
+    Answers reads and writes straight away.
+    """
+
+    def __init__(self, address : str):
+        self.address = address
+
+    async def read_gatt_char(self, uuid : str) -> bytearray:
+        return bytearray(b'\x01\x02')
+
+    async def write_gatt_char(self, uuid : str, data : bytes, response : bool = False) -> None:
+        return None
+
+
+def make_client(nativeasync : bool) -> GATTClient:
+    gc = GATTClient("00:00:00:00:00:01", QOpExecutorFactory().makeExecutor(), NoOpConverter(), nativeasync=nativeasync)
+    gc.BleakClient = FakeBleakClient(gc.MAC)  # type: ignore
+    return gc
+
+
+async def time_async(op : Callable[[], Any]) -> List[float]:
+    for _ in range(WARMUP):
+        await op()
+    times : List[float] = []
+    for _ in range(OPS):
+        start = time.perf_counter()
+        await op()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def time_sync(op : Callable[[], Any]) -> List[float]:
+    for _ in range(WARMUP):
+        op()
+    times : List[float] = []
+    for _ in range(OPS):
+        start = time.perf_counter()
+        op()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def percentile(values : List[float], pct : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def report(name : str, mode : str, times : List[float]):
+    print("%-18s %-8s %12.1f %12.1f %12.0f" % (
+        name, mode,
+        statistics.median(times) * 1e6,
+        percentile(times, 99) * 1e6,
+        len(times) / sum(times)))
+
+
+def main(args : Any = None):
+    print("%-18s %-8s %12s %12s %12s" % ("op", "mode", "p50 us", "p99 us", "ops/s"))
+    for nativeasync in (False, True):
+        mode = "native" if nativeasync else "qop"
+        gc = make_client(nativeasync)
+        report("async_char_read", mode, asyncio.run(time_async(lambda: gc.async_char_read(UUID))))
+        report("async_char_write", mode, asyncio.run(time_async(lambda: gc.async_char_write(UUID, b'\x00', True))))
+        report("char_read", mode, time_sync(lambda: gc.char_read(UUID)))
+        gc.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark for the WebSocket message codecs (codecs.py).
+
+Encodes and decodes a ScanResult, a GATTNotify carrying a 19 byte DE1 shot
+sample, and a ConnectionState, with each codec installed here. The old
+json.dumps(indent=2) with base64 done by hand is the baseline. Reports the
+message size and microseconds per encode and per decode.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_codecs.py
+"""
+import base64
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from ble.blescanresult import BLEScanResult
+from ble.gattclientinterface import GATTCState
+from wsserver.codecs import available_codecs
+from wsserver.jsondesc import make_ConnectionState, make_GATTNotify, make_update_from_blescanresult
+
+ROUNDS = 20000
+MAC = "D9:B2:48:AA:BB:CC"
+SHOT_SAMPLE = bytes(range(19))
+
+MESSAGES : Dict[str, Dict[str, Any]] = {
+    "ScanResult" : make_update_from_blescanresult(1, BLEScanResult(MAC, "DE1", ["0000a000-0000-1000-8000-00805f9b34fb"], -60, None)),
+    "GATTNotify" : make_GATTNotify(MAC, "0000a00d-0000-1000-8000-00805f9b34fb", SHOT_SAMPLE),
+    "ConnectionState" : make_ConnectionState(2, MAC, GATTCState.CONNECTED,
+        ["0000a0%02x-0000-1000-8000-00805f9b34fb" % (i,) for i in range(1, 0x13)]),
+}
+
+
+def per_call_us(fn : Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def old_json(ob : Any) -> Any:
+    # What the servers did by hand before codecs
+    if isinstance(ob, dict):
+        return {k : old_json(v) for k, v in ob.items()}
+    if isinstance(ob, bytes):
+        return base64.b64encode(ob).decode('ascii')
+    return ob
+
+
+def main(args : Any = None):
+    print("%-16s %-16s %8s %10s %10s" % ("message", "codec", "bytes", "enc us", "dec us"))
+    for name, ob in MESSAGES.items():
+        message = json.dumps(old_json(ob), indent=2)
+        print("%-16s %-16s %8d %10.2f %10.2f" % (
+            name, "json indent=2", len(message),
+            per_call_us(lambda: json.dumps(old_json(ob), indent=2)),
+            per_call_us(lambda: json.loads(message))))
+
+        for codec in available_codecs():
+            encoded = codec.encode(ob)
+            print("%-16s %-16s %8d %10.2f %10.2f" % (
+                name, codec.Name, len(encoded),
+                per_call_us(lambda: codec.encode(ob)),
+                per_call_us(lambda: codec.decode(encoded))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Throughput of WSBLEParser.parse_obj() on the requests a DE1 session sends
+most: GATTWrite, GATTRead and GATTSetNotify, plus a Scan and a GATTConnect.
+The messages are decoded JSON, as the servers hand them over.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_parser.py
+"""
+import json
+import os
+import sys
+import time
+from typing import Any, Dict
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from wsserver.jsondesc import WSBLEParser, make_GATTConnect, make_GATTRead, make_GATTWrite_as_JSON, make_req
+
+ROUNDS = 100000
+MAC = "D9:B2:48:AA:BB:CC"
+UUID = "0000a00d-0000-1000-8000-00805f9b34fb"
+
+MESSAGES : Dict[str, str] = {
+    "GATTWrite" : make_GATTWrite_as_JSON(1, MAC, UUID, bytes(range(19)), True),
+    "GATTRead" : json.dumps(make_GATTRead(2, MAC, UUID, 20)),
+    "GATTSetNotify" : json.dumps(make_req('GATTSetNotify', 3, {'MAC' : MAC, 'Char' : UUID, 'Enable' : True})),
+    "Scan" : json.dumps(make_req('Scan', 4, {'Timeout' : 10})),
+    "GATTConnect" : json.dumps(make_GATTConnect(5, MAC)),
+}
+
+
+def main(args : Any = None):
+    parser = WSBLEParser()
+    print("%-16s %12s %10s" % ("request", "parses/s", "us each"))
+    for name, text in MESSAGES.items():
+        # parse_obj() can add to what it is given, so each round gets a fresh message
+        obs = [json.loads(text) for _ in range(ROUNDS)]
+        start = time.perf_counter()
+        for ob in obs:
+            parser.parse_obj(ob)
+        elapsed = time.perf_counter() - start
+        print("%-16s %12.0f %10.2f" % (name, ROUNDS / elapsed, elapsed / ROUNDS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Throughput benchmark for the QOp concurrency policies.
+
+Simulates a DE1 with a long backlog of writes and a scale doing a handful of
+reads, on a backend where every op takes OP_SECONDS (roughly a BLE connection
+interval). Reports total throughput, and how long the scale's ops took to
+complete, for each policy.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_qop_policies.py
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from ble.bleops import (GlobalSerialPolicy, NInFlightPolicy, OpResult, PerDeviceSerialPolicy, QOp,
+                        QOpConcurrencyPolicy, QOpExecutorFactory, QOpManager)
+
+OP_SECONDS = 0.005
+DE1_WRITES = 200
+SCALE_READS = 20
+
+
+class SimDevice:
+    """
+    A device whose ops sleep for OP_SECONDS, like a BLE round trip.
+    """
+
+    def __init__(self, factory : QOpExecutorFactory, name : str):
+        self.Name = name
+        self.QOpExecutor = factory.makeExecutor()
+        self.QOpExecutor.startBackgroundProcessing()
+        self.Done : List[float] = []
+        self.Lock = threading.Lock()
+        self.AllDone = threading.Event()
+        self.Expected = 0
+
+    def _op(self, manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> None:
+        time.sleep(OP_SECONDS)
+
+    def _done(self, opr : OpResult[None]):
+        with self.Lock:
+            self.Done.append(time.perf_counter())
+            if len(self.Done) == self.Expected:
+                self.AllDone.set()
+
+    def issue(self, count : int):
+        self.Expected += count
+        for _ in range(count):
+            self.QOpExecutor.Manager.addFIFOOp(QOp(self._op, callback=self._done))
+
+
+def run_policy(policy : QOpConcurrencyPolicy) -> Tuple[float, float, float]:
+    factory = QOpExecutorFactory(policy)
+    de1 = SimDevice(factory, "DE1")
+    scale = SimDevice(factory, "Scale")
+
+    start = time.perf_counter()
+    de1.issue(DE1_WRITES)
+    scale.issue(SCALE_READS)
+    de1.AllDone.wait()
+    scale.AllDone.wait()
+    wall = time.perf_counter() - start
+
+    de1.QOpExecutor.shutdown()
+    scale.QOpExecutor.shutdown()
+
+    scalelatency = statistics.mean(t - start for t in scale.Done)
+    return ((DE1_WRITES + SCALE_READS) / wall, scalelatency, max(scale.Done) - start)
+
+
+def main():
+    policies : List[Tuple[str, QOpConcurrencyPolicy]] = [
+        ("global-serial", GlobalSerialPolicy()),
+        ("per-device-serial", PerDeviceSerialPolicy()),
+        ("2-in-flight", NInFlightPolicy(2)),
+        ("4-in-flight", NInFlightPolicy(4)),
+    ]
+    print("%-18s %10s %20s %20s" % ("policy", "ops/s", "scale mean done ms", "scale last done ms"))
+    for name, policy in policies:
+        throughput, meanlat, lastdone = run_policy(policy)
+        print("%-18s %10.0f %20.1f %20.1f" % (name, throughput, meanlat * 1e3, lastdone * 1e3))
+
+
+if __name__ == '__main__':
+    main()
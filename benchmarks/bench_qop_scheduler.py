@@ -0,0 +1,99 @@
+"""
+Benchmark for the QOp scheduler.
+
+Shows how much CPU the op queues burn while idle, and how long an op waits
+between being enqueued and starting, for 1, 4 and 16 simulated GATT clients.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_qop_scheduler.py
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import Any, List, Optional
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from ble.bleops import QOpExecutorFactory, QOpManager, wrap_into_QOp
+
+IDLE_SECONDS = 1.0
+OPS_PER_CLIENT = 200
+
+
+class SimGATTClient:
+    """
+    Just enough of a GATTClient to push ops through a QOpExecutor.
+    """
+
+    def __init__(self, factory : QOpExecutorFactory):
+        self.QOpExecutor = factory.makeExecutor()
+        self.QOpExecutor.startBackgroundProcessing()
+        self.QOpTimeout = 10
+        self.Latencies : List[float] = []
+
+    def _op(self, enqueued : float, manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> None:
+        self.Latencies.append(time.perf_counter() - enqueued)
+
+    @wrap_into_QOp(_op)
+    def op(self, enqueued : float) -> None:
+        pass
+
+
+def idle_cpu(clients : List[SimGATTClient]) -> float:
+    """
+    Returns the fraction of a core used by the process while nothing is queued.
+    """
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    time.sleep(IDLE_SECONDS)
+    return (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+def run_clients(clients : List[SimGATTClient]) -> float:
+    """
+    Each client issues OPS_PER_CLIENT blocking ops from its own thread. Returns wall time.
+    """
+    def worker(client : SimGATTClient):
+        for _ in range(OPS_PER_CLIENT):
+            client.op(time.perf_counter())
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def percentile(values : List[float], pct : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main(args : Any = None):
+    print("%8s %12s %14s %14s %12s" % ("clients", "idle CPU %", "p50 start us", "p99 start us", "ops/s"))
+    for count in (1, 4, 16):
+        factory = QOpExecutorFactory()
+        clients = [SimGATTClient(factory) for _ in range(count)]
+        cpu = idle_cpu(clients)
+        wall = run_clients(clients)
+        latencies : List[float] = []
+        for c in clients:
+            latencies.extend(c.Latencies)
+            c.QOpExecutor.shutdown()
+
+        print("%8d %12.2f %14.1f %14.1f %12.0f" % (
+            count,
+            cpu * 100.0,
+            statistics.median(latencies) * 1e6,
+            percentile(latencies, 99) * 1e6,
+            len(latencies) / wall))
+
+
+if __name__ == '__main__':
+    main()
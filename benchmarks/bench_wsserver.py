@@ -0,0 +1,138 @@
+"""
+Load test for the WebSocket servers: SyncWSServer (a pool of worker threads,
+see dispatcher.py) against AsyncWSServer (a task per message).
+
+A client keeps IN_FLIGHT GATTRead requests outstanding, spread over DEVICES
+fake devices, until REQUESTS have been answered. Each device takes
+OP_SECONDS per read, roughly a BLE round trip, and devices run in parallel
+(PerDeviceSerialPolicy). Reports requests/s, p50 and p99 latency, and the
+most threads seen in the process.
+
+Run from the top of the repository:
+
+    python benchmarks/bench_wsserver.py
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../../src')))
+
+from ble.bleops import PerDeviceSerialPolicy
+from wsserver.asyncserver import AsyncWSServer
+from wsserver.jsondesc import make_GATTRead
+from wsserver.server import SyncWSServer
+from wsserver.wsprotocol import connect
+
+OP_SECONDS = 0.005
+DEVICES = 4
+REQUESTS = 2000
+IN_FLIGHT = 64
+UUID = "0000a002-0000-1000-8000-00805f9b34fb"
+MACS = ["00:00:00:00:00:%02X" % (i + 1,) for i in range(DEVICES)]
+
+
+class FakeBleakClient:
+    """
+    Answers reads after OP_SECONDS.
+    """
+
+    def __init__(self, address : str):
+        self.address = address
+
+    async def read_gatt_char(self, uuid : str) -> bytearray:
+        await asyncio.sleep(OP_SECONDS)
+        return bytearray(b'\x01\x02')
+
+    def is_connected(self) -> bool:
+        return False
+
+
+class ThreadWatcher:
+    """
+    Samples threading.active_count() until stopped.
+    """
+
+    def __init__(self):
+        self.Peak = threading.active_count()
+        self.Done = threading.Event()
+        self.Thread = threading.Thread(name="ThreadWatcher", daemon=True, target=self._watch)
+        self.Thread.start()
+
+    def _watch(self):
+        while not self.Done.wait(0.005):
+            self.Peak = max(self.Peak, threading.active_count())
+
+    def stop(self) -> int:
+        self.Done.set()
+        self.Thread.join()
+        return self.Peak
+
+
+async def load(port : int) -> List[float]:
+    ws = await connect('127.0.0.1', port)
+    sent : Dict[int, float] = {}
+    latencies : List[float] = []
+    nextid = 1
+
+    async def send_one():
+        nonlocal nextid
+        rid = nextid
+        nextid += 1
+        sent[rid] = time.perf_counter()
+        await ws.send(json.dumps(make_GATTRead(rid, MACS[rid % DEVICES], UUID, 2)))
+
+    for _ in range(IN_FLIGHT):
+        await send_one()
+
+    while len(latencies) < REQUESTS:
+        msg : Any = json.loads(await ws.recv())
+        if msg['type'] != 'RESP':
+            raise RuntimeError("Unexpected message: %s" % (msg,))
+        latencies.append(time.perf_counter() - sent.pop(msg['id']))
+        if nextid <= REQUESTS:
+            await send_one()
+
+    await ws.close()
+    return latencies
+
+
+def percentile(values : List[float], pct : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(name : str, server : Any):
+    for mac in MACS:
+        server.BLE.getGATTClient(mac).BleakClient = FakeBleakClient(mac)
+
+    watcher = ThreadWatcher()
+    start = time.perf_counter()
+    latencies = asyncio.run(load(server.Port))
+    elapsed = time.perf_counter() - start
+    peak = watcher.stop()
+    server.shutdown()
+
+    print("%-14s %10.0f %10.1f %10.1f %10d" % (
+        name, len(latencies) / elapsed,
+        statistics.median(latencies) * 1e3,
+        percentile(latencies, 99) * 1e3,
+        peak))
+
+
+def main(args : Any = None):
+    logger = logging.getLogger("bench_wsserver")
+    print("%-14s %10s %10s %10s %10s" % ("server", "req/s", "p50 ms", "p99 ms", "threads"))
+    run("SyncWSServer", SyncWSServer(logger, qoppolicy=PerDeviceSerialPolicy(), host='127.0.0.1', port=0))
+    run("AsyncWSServer", AsyncWSServer(logger, qoppolicy=PerDeviceSerialPolicy(), host='127.0.0.1', port=0))
+
+
+if __name__ == '__main__':
+    main()
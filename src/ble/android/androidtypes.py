@@ -59,6 +59,7 @@ class T_ScanResult(T_JavaObject, Protocol):
     device : 'T_BluetoothDevice'
     def getDevice(self) -> 'T_BluetoothDevice': ...    
     def getScanRecord(self) -> T_ScanRecord: ...
+    def getRssi(self) -> int: ...
 
 class T_ScanCallback(T_JavaObject, Protocol):
     def onBatchScanResults(self, results: T_JavaListOf[T_ScanResult]) -> None: ...    
@@ -69,14 +70,23 @@ class T_ScanCallbackImpl(T_ScanCallback, Protocol):
     def __call__(self, *args: Any, **kwds: Any) -> 'T_ScanCallbackImpl': ...
     def setImpl(self, impl: T_PythonJavaClass) -> None: ...
 
+class T_ScanSettings(T_JavaObject, Protocol): ...
+
+class T_ScanSettingsBuilder(T_JavaObject, Protocol):
+    def __call__(self) -> 'T_ScanSettingsBuilder': ...
+    def setScanMode(self, scanmode : int) -> 'T_ScanSettingsBuilder': ...
+    def build(self) -> T_ScanSettings: ...
+
 class T_BluetoothLeScanner(T_JavaObject, Protocol):
-    def startScan(self, scancb : T_ScanCallback) -> None: ...    
+    def startScan(self, filters : Any, settings : T_ScanSettings, scancb : T_ScanCallback) -> None: ...    
     def stopScan(self, scancb : T_ScanCallback) -> None: ...
 
 class T_BluetoothGattCharacteristic(T_JavaObject, Protocol):
     WRITE_TYPE_NO_RESPONSE : int
     WRITE_TYPE_DEFAULT : int
     def getUuid(self) -> T_Java_UUID: ...
+    def getInstanceId(self) -> int: ...
+    def getProperties(self) -> int: ...
     def setValue(self, data: bytes) -> None: ...
     def setWriteType(self, type: int) -> None: ...
     def getDescriptor(self, uuid: T_Java_UUID) -> T_BluetoothGattDescriptor: ...
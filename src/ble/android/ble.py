@@ -10,6 +10,7 @@ from ble.android.androidtypes import T_BluetoothAdapter, T_BluetoothClassicAdapt
 
 from ble.android.blescanner import BLEScanTool
 from ble.android.gattclient import GATTClient
+from ble.deviceregistry import get_DeviceRegistry
 from ble.bleops import QOpExecutorFactory, ContextConverter
 from ble.bleinterface import BLEInterface
 from ble.blescantoolinterface import I_BLEScanTool
@@ -75,6 +76,7 @@ class BLE(BLEInterface):
         """Call to gracefully shut down BLE, as part of stopping the app"""
         Logger.debug("on_stop() in android BLE.py")
         self.disconnectAllClients()
+        get_DeviceRegistry().save()  # A scan may never have stopped to save it
 
     def isBLESupported(self):
         """Returns True if BLE is supported"""
@@ -1,17 +1,21 @@
 from kivy.logger import Logger
 from jnius import autoclass # type: ignore
 from collections import deque
+import threading
 import time
 
-from typing import Dict
-from ble.android.androidtypes import T_BluetoothAdapter, T_BluetoothLeScanner, T_ScanCallbackImpl
+from typing import Dict, Optional
+from ble.android.androidtypes import T_BluetoothAdapter, T_BluetoothLeScanner, T_ScanCallbackImpl, T_ScanSettings, T_ScanSettingsBuilder
 
 from ble.bleexceptions import BLEAlreadyScanning
 from ble.android.pyscancallback import PyScanCallback
 from ble.blescanresult import BLEScanResult
 from ble.blescantoolinterface import I_BLEScanTool
+from ble.deviceregistry import get_DeviceRegistry
+from ble.scansubscription import ScanCallback, ScanFilter, ScanMode, ScanPublisher, ScanResultIterator, ScanSubscription
 
 ScanCallbackImpl : T_ScanCallbackImpl = autoclass("org.decentespresso.cafehub.ScanCallbackImpl")
+ScanSettingsBuilder : T_ScanSettingsBuilder = autoclass("android.bluetooth.le.ScanSettings$Builder")
 PSCB = PyScanCallback()
 
 class BLEScanTool(I_BLEScanTool):
@@ -26,6 +30,11 @@ class BLEScanTool(I_BLEScanTool):
   updated in the context of the calling thread, from a threadsafe queue
   updated by callbacks.
 
+  There is one Android scan, running for as long as any subscription from
+  startSharedScan() (or a startScan()) wants it, with the highest ScanMode
+  any of them asks for. Android does the duty cycling. It can't scan
+  passively, so passive is ignored.
+
   Only one scantool object should be scanning at a time.
   """
   def __init__(self, BA: T_BluetoothAdapter):
@@ -36,6 +45,12 @@ class BLEScanTool(I_BLEScanTool):
     self.Duration = 0.0
     self.Scanning = False
     self.BLEAdapterClass = BA
+    self.Publisher = ScanPublisher(onchange=self._update)
+    self.Registry = get_DeviceRegistry()
+    self.OneShot : Optional[ScanSubscription] = None  # From startScan()
+    self.RadioLock = threading.RLock()
+    self.RadioMode : Optional[ScanMode] = None  # What Android is scanning with. None if it isn't.
+    self.ExpiryTimer : Optional[threading.Timer] = None  # Wakes _update() for the next subscription deadline
 
   def getSeenEntries(self) -> Dict[str, BLEScanResult]:
     """
@@ -59,7 +74,7 @@ class BLEScanTool(I_BLEScanTool):
 
     0.0 means scanning completed (or has never happened)
     """
-    if not self.isScanning():
+    if (self.OneShot is None) or not self.OneShot.Active:
       return 0.0
       
     left = self.Duration - (time.time() - self.StartTime)
@@ -80,12 +95,8 @@ class BLEScanTool(I_BLEScanTool):
     """
     Internalish call to add scanned entries
     """
-    self.ScanQ.append(entry)
-    tdelta = time.time() - self.StartTime
-    if tdelta > self.Duration:
-      # We have been scanning for long enough
-      self.stopScanning()
-      Logger.debug("Duration reached. Asking Android to stop scan.");
+    self.Registry.observe(entry)
+    self.Publisher.publish(entry)
 
   def _resetTimer(self):
     """
@@ -94,17 +105,35 @@ class BLEScanTool(I_BLEScanTool):
     self.StartTime = time.time()
 
   def stopScanning(self) -> None:
-      self.BLEScanner.stopScan(self.ScanCallback)
-      self.Scanning = False
+    """
+    Stop every scan, including other subscribers' shared scans
+    """
+    self.Publisher.stopAll()
+    self._update()
+
+  def subscribe(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None) -> ScanSubscription:
+    return self.Publisher.subscribe(callback, scanfilter)
+
+  def results(self, scanfilter : Optional[ScanFilter] = None) -> ScanResultIterator:
+    return ScanResultIterator(self, scanfilter)
+
+  def startSharedScan(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None, timeout : Optional[float] = None,
+                      mode : ScanMode = ScanMode.LOW_POWER, passive : bool = False) -> ScanSubscription:
+    """
+    See I_BLEScanTool
+    """
+    Logger.debug(f"BLEScanner: startSharedScan(timeout={timeout}, mode={mode})")
+    return self.Publisher.demand(callback, scanfilter, mode, timeout, passive)
 
   def startScan(self, duration: float):
     """
     Copy self.Seen to self.Previous and fill self.Seen with new entries for "duration" seconds.
 
-    Raises a BLEAlreadyScanning exception if a scan is already running.
+    Raises a BLEAlreadyScanning exception if a startScan() is already running.
+    Shared scans don't count.
     """
     Logger.debug(f"BLEScanner: startScan({duration})")
-    if self.isScanning():
+    if (self.OneShot is not None) and self.OneShot.Active:
       raise BLEAlreadyScanning("A BLE scan is already running")
 
     self.Duration = duration
@@ -112,7 +141,56 @@ class BLEScanTool(I_BLEScanTool):
       self.Previous[k] = self.Seen[k]
 
     self.Seen = {}
+    self._resetTimer()
+
+    def collect(item : Optional[BLEScanResult]):
+      if item is not None:
+        self.ScanQ.append(item)
+
+    self.OneShot = self.startSharedScan(collect, None, duration, ScanMode.LOW_LATENCY)
 
+  def _update(self) -> None:
+    """
+    Subscriptions have changed, or one is due to expire. Make the Android
+    scan match what they want.
+    """
+    with self.RadioLock:
+      if self.ExpiryTimer is not None:
+        self.ExpiryTimer.cancel()
+        self.ExpiryTimer = None
+
+      nextdeadline = self.Publisher.expire(time.monotonic())
+      settings = self.Publisher.radioSettings()
+      mode = settings[0] if settings is not None else None
+
+      if mode != self.RadioMode:
+        if mode is None:
+          self._radioStop()
+        elif self.RadioMode is None:
+          self._radioStart(mode)
+        else:
+          self._radioRestart(mode)
+
+      if nextdeadline is not None:
+        self.ExpiryTimer = threading.Timer(max(0.0, nextdeadline - time.monotonic()), self._update)
+        self.ExpiryTimer.daemon = True
+        self.ExpiryTimer.start()
+
+  def _radioStart(self, mode : ScanMode) -> None:
+    Logger.debug(f"BLEScanner: starting Android scan, mode {mode.name}")
+    self.Publisher.begin()
+    self._androidScan(mode)
+
+  def _radioRestart(self, mode : ScanMode) -> None:
+    """
+    Android can't change the mode of a running scan, so stop it and start
+    another. To subscribers it is still the same scan, so they aren't told.
+    """
+    Logger.debug(f"BLEScanner: restarting Android scan, mode {mode.name}")
+    self.BLEScanner.stopScan(self.ScanCallback)
+    self._androidScan(mode)
+
+  def _androidScan(self, mode : ScanMode) -> None:
     PSCB.setParent(self)
     pycallback = PSCB
 
@@ -127,8 +205,16 @@ class BLEScanTool(I_BLEScanTool):
 
     self.ScanCallbackRef = pycallback
 
+    settings : T_ScanSettings = ScanSettingsBuilder().setScanMode(int(mode)).build()
     self.BLEScanner : T_BluetoothLeScanner = self.BLEAdapterClass.getBluetoothLeScanner()
-    self.BLEScanner.stopScan(self.ScanCallback)
-    self.BLEScanner.startScan(self.ScanCallback)
+    self.BLEScanner.startScan(None, settings, self.ScanCallback)
+    self.RadioMode = mode
     self.Scanning = True
-    self._resetTimer()
+
+  def _radioStop(self) -> None:
+    Logger.debug("BLEScanner: stopping Android scan")
+    self.BLEScanner.stopScan(self.ScanCallback)
+    self.RadioMode = None
+    self.Scanning = False
+    self.Publisher.finish()
+    self.Registry.saveInBackground()
@@ -1,15 +1,21 @@
 import time
 from kivy.logger import Logger
 import threading
-from typing import Any, Callable, List, Optional, Tuple, Union
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from jnius import autoclass # type: ignore
 from ble.android.androidtypes import T_BluetoothAdapter, T_BluetoothGatt, T_BluetoothGattCallbackImpl, T_BluetoothGattCharacteristic, T_BluetoothGattDescriptor, T_Context, T_Java_UUID, T_PythonActivity 
 
 from ble.android.pybluetoothgattcallback import AndroidGATTStatus, PyBluetoothGattCallback
 from ble.bleexceptions import *
-from ble.bleops import ContextConverter, CountingSemaphore, OpResult, QOp, QOpExecutor, QOpManager, async_wrap_sync_into_QOp, synchronized_with_lock, wrap_into_QOp
+from ble.bletrace import TraceEvent, get_BLETrace, head
+from ble.connsupervisor import ConnectionSupervisor, ReconnectBackoff
+from ble.discoverycache import AttributeTable, get_DiscoveryCache, table_uuids
+from ble.bleops import ContextConverter, CountingSemaphore, OpResult, QOp, QOpExecutor, QOpHandle, QOpManager, async_wrap_sync_into_QOp, coalesce_key, synchronized_with_lock, wrap_into_QOp
 from ble.gattclientinterface import GATTClientInterface, GATTCState
+from ble.notifydispatch import NotifyDispatcher, NotifyOverflow
+from ble.readcache import GATTReadCache, read_through_cache
 from ble.uuidtype import CHAR_UUID, DESC_UUID
 
 # NB NB NB
@@ -29,6 +35,8 @@ BluetoothGattDescriptor : T_BluetoothGattDescriptor = autoclass("android.bluetoo
 BLE_UUID : T_Java_UUID = autoclass('java.util.UUID')
 BluetoothAdapter : T_BluetoothAdapter = autoclass('android.bluetooth.BluetoothAdapter')
 
+_Trace = get_BLETrace()  # Per-op events are traced rather than logged. See bletrace.py
+
 class GATTClient(GATTClientInterface):
     """
     A hopefully easy and convenient class to use to communicate with a GATT
@@ -59,6 +67,7 @@ class GATTClient(GATTClientInterface):
 
         self.State = GATTCState.INIT
         self.QOpExecutor = qopexecutor  # Holds a queue of operations that are run in their own thread
+        self.QOpExecutor.Manager.Label = macaddress  # Identifies our ops in metrics
         self.QOpExecutor.startBackgroundProcessing()
 
         self.CBConverter = contextconverter  # Used to convert callbacks out of the background thread
@@ -81,6 +90,7 @@ class GATTClient(GATTClientInterface):
         self.BluetoothDevice = adapter.getRemoteDevice(macaddressbytes)
         self.QOpTimeout = 30
         self.DisconnectionCallback : Union[Callable[[GATTCState], None], None] = None
+        self.Supervisor : Optional[ConnectionSupervisor] = None
 
         # self.Characteristics should only be written in the background thread.
         # Reading it in other threads is fine.
@@ -92,6 +102,11 @@ class GATTClient(GATTClientInterface):
         self.ConnectStatusThread.start()
 
         self.NotifyCallback : dict[str, Union[Callable[[CHAR_UUID, bytes], None], None]] = {}
+        self.ArmedNotifies : Dict[str, CHAR_UUID] = {}  # Notifies enabled on the device, for restore_notifies()
+        self.NotifyDispatcher = NotifyDispatcher()  # Buffers notifies, so a slow callback can't block _notify_monitor
+        self.ReadCache = GATTReadCache()  # Last value seen for each characteristic
+        self.DiscoveryCache = get_DiscoveryCache()
+        self.CachedTable : Optional[AttributeTable] = self.DiscoveryCache.load(macaddress)  # From an earlier connect, maybe in another process
         self.ConnLock = threading.RLock()
         self.ConnStatus : Tuple[AndroidGATTStatus, GATTCState] = (AndroidGATTStatus(0), GATTCState.INIT)
         self._ConnectedSema = CountingSemaphore(value=0)
@@ -104,8 +119,10 @@ class GATTClient(GATTClientInterface):
         while True:
             gc = self.GATTCallbackClass
             gc.SemaOnCharacteristicChanged.down()
-            Logger.debug("BLE: _notify_monitor: SemaOnCharacteristicChanged upped.")
             uuid, data = gc.QOnCharacteristicChanged.pop()
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.NOTIFY, _Trace.intern(uuid), head(data), len(data))
+            self.ReadCache.update(CHAR_UUID(uuid), data)
             if uuid in self.NotifyCallback:
                 cb = self.NotifyCallback[uuid]
                 if cb:
@@ -127,14 +144,57 @@ class GATTClient(GATTClientInterface):
     def set_disc_callback(self, callback: Callable[[GATTCState], None]):
         self.DisconnectionCallback = callback
 
+    def set_auto_reconnect(self, enable : bool, callback : Optional[Callable[[GATTCState], None]] = None, backoff : Optional[ReconnectBackoff] = None) -> None:
+        """
+        Reconnect after an unsolicited disconnect. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_auto_reconnect(%s, %s)" % (self.MAC, enable))
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
+            self.Supervisor = None
+
+        if enable:
+            self.Supervisor = ConnectionSupervisor(self, callback, backoff)
+            self.Supervisor.start()
+        else:
+            self.DisconnectionCallback = callback
+
     def shutdown(self) -> None:
         self.QOpExecutor.shutdown()
+        self.NotifyDispatcher.closeAll()
 
     def is_connected(self) -> bool:
         _, cstate = self._get_conn_info()
         return cstate == GATTCState.CONNECTED
 
+    def set_read_cache(self, uuid : CHAR_UUID, ttl : Optional[float]) -> None:
+        """
+        Serve reads of uuid from the cache for ttl seconds. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_read_cache(%s, %s)" % (uuid.AsString, ttl))
+        self.ReadCache.setTTL(uuid, ttl)
+
+    def set_notify_buffering(self, uuid : CHAR_UUID, capacity : int, policy : NotifyOverflow) -> None:
+        """
+        Size and overflow policy of the notify buffer for uuid. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_notify_buffering(%s, %s, %s)" % (uuid.AsString, capacity, policy))
+        self.NotifyDispatcher.configure(uuid, capacity, policy)
+
+    def get_notify_stats(self) -> Dict[str, Dict[str, int]]:
+        return self.NotifyDispatcher.stats()
+
+    def set_write_coalescing(self, uuid : CHAR_UUID, enable : bool) -> None:
+        """
+        Coalesce queued writes to this characteristic. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_write_coalescing(%s, %s)" % (uuid.AsString, enable))
+        self.QOpExecutor.Manager.setCoalescing(coalesce_key(GATTClient._char_write, uuid), enable)
+
     def getCharacteristicsUUIDs(self) -> List[str]:
+        if (len(self.Characteristics) == 0) and (self.CachedTable is not None):
+            # Discovery is still queued. See _connect()
+            return table_uuids(self.CachedTable)
         return list(self.Characteristics.keys())
 
     """
@@ -153,12 +213,25 @@ class GATTClient(GATTClientInterface):
     """
 
     def _set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID, bytes], None]], manager: Union[QOpManager, None] = None, reason: Union[str, None] = None):
-        Logger.debug("BLE: _set_notify(%s, %s, %s)" % (uuid.AsString, enable, notifycallback))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.SET_NOTIFY, _Trace.intern(uuid.AsString), 0, int(enable))
         if enable:
-            self.NotifyCallback[uuid.AsString] = notifycallback
+            if notifycallback is None:
+                raise BLENoCallbackProvided("No callback provided when attempting to enable a notify")
+            self.NotifyCallback[uuid.AsString] = self.NotifyDispatcher.subscribe(uuid, notifycallback)
         else:
             self.NotifyCallback[uuid.AsString] = None
+            self.NotifyDispatcher.unsubscribe(uuid)
+            self.ArmedNotifies.pop(uuid.AsString, None)
+
+        self._arm_notify(uuid, enable, manager)
+        if enable:
+            self.ArmedNotifies[uuid.AsString] = uuid
 
+    def _arm_notify(self, uuid : CHAR_UUID, enable : bool, manager: Union[QOpManager, None] = None) -> None:
+        """
+        The device end of _set_notify()
+        """
         char = self.Characteristics[uuid.AsString]
 
         if not self.BluetoothGatt:
@@ -174,6 +247,25 @@ class GATTClient(GATTClientInterface):
         else:
             self._desc_write(uuid, DESC_UUID("00002902-0000-1000-8000-00805f9b34fb"), BluetoothGattDescriptor.DISABLE_NOTIFICATION_VALUE, manager = manager)
 
+    def _restore_notifies(self, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> None:
+        """
+        Enable every notify in ArmedNotifies again, after a reconnect. The
+        callbacks are still in place, so only the device needs telling.
+
+        Android can only have one GATT operation in flight, so the descriptor
+        writes are still one at a time, but they are done in a single QOp rather
+        than one queued op (and one round trip to the caller) each.
+        """
+        if reason is not None:
+            # Reason being set means we are being asked to cancel
+            Logger.debug("BLE: _restore_notifies() cancelled before execution. Reason: %s" % (reason,))
+            raise BLEOperationNotIssued("Cancelled: %s" % (reason,))
+
+        for uuid in list(self.ArmedNotifies.values()):
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.SET_NOTIFY, _Trace.intern(uuid.AsString), 0, 1)
+            self._arm_notify(uuid, True, manager)
+
     # *** Internal functions. No touchy!
 
     def _procStateChange(self, manager : Union[QOpManager, None] = None, reason : Union[str, None] = None):
@@ -188,6 +280,7 @@ class GATTClient(GATTClientInterface):
             return
 
         self.Characteristics = {}
+        self.ReadCache.clear()
         status, connstate = self._get_conn_info()
             
         if self.DisconnectionCallback:
@@ -273,33 +366,90 @@ class GATTClient(GATTClientInterface):
 
         _, result = self._get_conn_info()
 
-        if (result == GATTCState.CONNECTED) and (len(self.getCharacteristicsUUIDs()) < 1):
-            # Discover our services on first connect. Remember them so we don't do this for reconnects.
-            issued = self.BluetoothGatt.discoverServices()
-            if not issued:
-                raise BLECouldntDiscoverServices("Could not start remote service discovery")
+        if (result == GATTCState.CONNECTED) and (len(self.Characteristics) < 1):
+            if (self.CachedTable is not None) and (manager is not None):
+                # We know the attribute table from last time, so report it now, and
+                # discover in the next op. Android needs discovery before any other op,
+                # and LIFO ops are served before every lane, so nothing can get ahead of it.
+                manager.addLIFOOp(QOp(self._discover, callback=self._deferred_discover_done))
+            else:
+                self._discover(manager)
+
+        return result
+
+    def _discover(self, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> None:
+        """
+        Discover services, and update the disk cache if the attribute table has changed.
+        """
+        if reason is not None:
+            # Cancelled, probably by a disconnect. The next connect will try again.
+            return
+
+        if not self.BluetoothGatt:
+            raise BLEOperationNotIssued("No self.BluetoothGatt")
 
-            # Wait for results
-            Logger.debug("BLE: _connect sleeping on SemaOnServicesDiscovered")
+        issued = self.BluetoothGatt.discoverServices()
+        if not issued:
+            raise BLECouldntDiscoverServices("Could not start remote service discovery")
+
+        # Wait for results
+        Logger.debug("BLE: _discover sleeping on SemaOnServicesDiscovered")
+        success = self.GATTCallbackClass.SemaOnServicesDiscovered.down(timeout=0.1)
+        while not success:
+            _, cstate = self._get_conn_info()
+            if (cstate != GATTCState.CONNECTED):
+                raise BLEConnectionError("Disconnection occurred while attempting to read available services on new GATT client")
             success = self.GATTCallbackClass.SemaOnServicesDiscovered.down(timeout=0.1)
-            while not success:
-                _, cstate = self._get_conn_info()
-                if (cstate != GATTCState.CONNECTED):
-                    raise BLEConnectionError("Disconnection occurred while attempting to read available services on new GATT client")
-                success = self.GATTCallbackClass.SemaOnServicesDiscovered.down(timeout=0.1)
-
-            Logger.debug("BLE: _connect woke up on SemaOnServicesDiscovered")
-            self.GATTCallbackClass.QOnServicesDiscovered.pop()
-            for serv in self.BluetoothGatt.getServices().toArray():
-                servuuid = serv.getUuid().toString()
-                for char in serv.getCharacteristics().toArray():
-                    uuidstr = char.getUuid().toString()
-                    self.Characteristics[uuidstr] = char
-                    Logger.debug("BLE: Service UUID (%s) %s = %s" % (servuuid, uuidstr, char))
-
-            # Logger.debug("BLE: connect() done")
 
-        return result
+        Logger.debug("BLE: _discover woke up on SemaOnServicesDiscovered")
+        self.GATTCallbackClass.QOnServicesDiscovered.pop()
+        table : AttributeTable = {}
+        for serv in self.BluetoothGatt.getServices().toArray():
+            servuuid = serv.getUuid().toString()
+            chars = []
+            for char in serv.getCharacteristics().toArray():
+                uuidstr = char.getUuid().toString()
+                self.Characteristics[uuidstr] = char
+                chars.append([uuidstr, char.getInstanceId(), char.getProperties()])
+                Logger.debug("BLE: Service UUID (%s) %s = %s" % (servuuid, uuidstr, char))
+            table[servuuid] = sorted(chars)
+
+        if table != self.CachedTable:
+            Logger.debug("BLE: Attribute table for %s differs from the cached one" % (self.MAC,))
+        self.CachedTable = table
+        self.DiscoveryCache.storeInBackground(self.MAC, table)
+
+    def _deferred_discover_done(self, opr : OpResult[None]) -> None:
+        """
+        Callback for the discovery _connect() queued after reporting CONNECTED
+        from the cached table. If it failed, the cached table can't be trusted
+        and no other op can work, so forget the table and drop the link.
+        """
+        try:
+            opr.getResult()
+            return
+        except Exception:
+            Logger.debug("BLE: Discovery after connecting to %s failed: %s" % (self.MAC, traceback.format_exc()))
+
+        self.CachedTable = None
+        self.DiscoveryCache.forget(self.MAC)
+        self.QOpExecutor.getManager().addLIFOOp(QOp(self._drop_link, callback=None))
+
+    def _drop_link(self, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> None:
+        """
+        Close the link, and report it like any other disconnect, so that a
+        ConnectionSupervisor can reconnect. Unlike _disconnect(), the armed
+        notifies are kept for restore_notifies().
+        """
+        if reason is not None:
+            return
+
+        if self.BluetoothGatt:
+            self.BluetoothGatt.disconnect()
+            self.BluetoothGatt.close()
+        self.BluetoothGatt = None
+        self._set_conn_info(AndroidGATTStatus(0), GATTCState.DISCONNECTED)
+        self._procStateChange(manager)
 
     def _disconnect(self, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> GATTCState:
         Logger.debug("BLE: _disconnect(manager=%s, reason=%s)" % (manager, reason))
@@ -310,6 +460,7 @@ class GATTClient(GATTClientInterface):
         
         # self._raise_if_disconnected()
         
+        self.ArmedNotifies = {}
         if self.BluetoothGatt:
             self.BluetoothGatt.disconnect()
             self.BluetoothGatt.close()
@@ -326,7 +477,8 @@ class GATTClient(GATTClientInterface):
         return GATTCState.DISCONNECTED
 
     def _char_read(self, uuid: CHAR_UUID, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> bytes:
-        Logger.debug("BLE: _char_read(%s, manager=%s, reason=%s)" % (uuid, manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_READ, _Trace.intern(uuid.AsString))
         
         if reason is not None:
             # Reason being set means we are being asked to cancel
@@ -354,14 +506,17 @@ class GATTClient(GATTClientInterface):
             # Sleep until there is a result
             self.GATTCallbackClass.SemaOnCharacteristicRead.down()
             result = self.GATTCallbackClass.QOnCharacteristicRead.pop()
-            Logger.debug("BLE: _char_read result: %s" % (result,))
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.CHAR_RESULT, _Trace.intern(result[0]), head(result[2]), len(result[2]))
+            self.ReadCache.update(uuid, result[2])
             return result[2]
         else:
             Logger.debug("BLE: Android would not issue read. Are you sure you have read permission on this characteristic?")
             raise BLEOperationNotIssued("Android refused to issue read. Are you sure you have read permission on this characteristic?")
 
     def _char_write(self, uuid: CHAR_UUID, data : bytes, requireresponse: bool, manager: Union[QOpManager, None] = None, reason: Union[str, None] = None) -> None:
-        Logger.debug("BLE: _char_write(%s, manager=%s, reason=%s)" % (uuid, manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_WRITE, _Trace.intern(uuid.AsString), head(data), len(data))
 
         if reason is not None:
             # Reason being set means we are being asked to cancel
@@ -378,6 +533,7 @@ class GATTClient(GATTClientInterface):
 
         # Logger.debug("BLE: known characteristics: %s" % (self.Characteristics,))
         char = self.Characteristics[uuid.AsString]
+        self.ReadCache.invalidate(uuid)
         char.setValue(data)
         if requireresponse:
             char.setWriteType(char.WRITE_TYPE_DEFAULT)
@@ -390,7 +546,9 @@ class GATTClient(GATTClientInterface):
             # Sleep until there is a result
             if self.GATTCallbackClass.SemaOnCharacteristicWrite.down(timeout=10):
                 result = self.GATTCallbackClass.QOnCharacteristicWrite.pop()
-                Logger.debug("BLE: _char_write result: %s" % (result,))
+                if _Trace.Enabled:
+                    _Trace.record(TraceEvent.CHAR_RESULT, _Trace.intern(result[0]), 0, int(result[1]))
+                self.ReadCache.invalidate(uuid)  # In case a notify arrived with the old value
                 return 
             else:
                 # The down timed out
@@ -403,7 +561,8 @@ class GATTClient(GATTClientInterface):
         """
         Write data to the given descriptor
         """
-        Logger.debug("BLE: _desc_write(%s, %s, manager=%s, reason=%s)" % (charuuid, descid, manager, reason))        
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.DESC_WRITE, _Trace.intern(charuuid.AsString), head(data), len(data))
 
         if reason is not None:
             # Reason being set means we are being asked to cancel
@@ -435,7 +594,6 @@ class GATTClient(GATTClientInterface):
 
         # Wait for a characteristic callback. It has to be this one,
         # as we only allow one transaction at a time.
-        Logger.debug("BLE: _desc_write: Sleeping on SemaOnDescriptorWrite")
         success = self.GATTCallbackClass.SemaOnDescriptorWrite.down(timeout=1)
         if not success:
             # Yay. Android sometimes doesn't call the callback when a descriptor write finishes. It looks like it silently succeeds.
@@ -444,7 +602,8 @@ class GATTClient(GATTClientInterface):
             raise BLEOperationTimedOut("Android reported initiating descriptor write, but then never reported success or failure")
         else:
             result = self.GATTCallbackClass.QOnDescriptorWrite.pop()
-            Logger.debug("BLE: _desc_write result: %s" % (result,))
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.CHAR_RESULT, _Trace.intern(result[0]), 0, int(result[1]))
 
         if result[0] != descid.AsString:
            raise BLEMismatchedOperation("Descriptor write we requested '%s' doesn't match the callback we received ('%s')" % (descid.AsString, result[0]))
@@ -465,20 +624,35 @@ class GATTClient(GATTClientInterface):
         Connect
         """
         Logger.debug("BLE: async_disconnect(%s)" % (self.MAC,))
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
 
+    @read_through_cache
     @async_wrap_sync_into_QOp(_char_read)
     async def async_char_read(self, uuid : CHAR_UUID):
         """
-        Write a characteristic in a background thread and return result when it is done.
+        Read a characteristic in a background thread and return result when it is done.
+
+        maxstaleness=seconds accepts a cached value up to that old. See set_read_cache().
         """
-        Logger.debug("BLE: async_char_read(%s)" % (uuid,))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_char_read"), _Trace.intern(uuid.AsString))
 
     @async_wrap_sync_into_QOp(_char_write)
     async def async_char_write(self, uuid: CHAR_UUID, data : bytes, requireresponse : bool):
         """
         Write a characteristic in a background thread and return result
         """
-        Logger.debug("BLE: async_char_write(%s, %s, %s)" % (uuid, data, requireresponse))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_char_write"), _Trace.intern(uuid.AsString))
+
+    @async_wrap_sync_into_QOp(_set_notify)
+    async def async_set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID, bytes], None]]) -> None:
+        """
+        Set notify on or off
+        """
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_set_notify"), _Trace.intern(uuid.AsString))
 
     # *** Synchronous interface
 
@@ -489,21 +663,28 @@ class GATTClient(GATTClientInterface):
     @wrap_into_QOp(_disconnect)
     def disconnect(self):
         Logger.debug("BLE: GATTClient.disconnect() from '%s'" % self.MAC)
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
 
     @wrap_into_QOp(_set_notify)
     def set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID,bytes], None]]):
         """
         Enables notifications for the given uuid.
         """
-        Logger.debug("BLE: set_notify(%s, %s, %s)" % (uuid.AsString, enable, notifycallback))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("set_notify"), _Trace.intern(uuid.AsString))
 
+    @read_through_cache
     @wrap_into_QOp(_char_read)
     def char_read(self, uuid: CHAR_UUID) -> None:
         """
         Synchronous read of a characteristic. Read occurs in a background thread,
         but the calling thread is made to wait until there is a result.
+
+        maxstaleness=seconds accepts a cached value up to that old. See set_read_cache().
         """
-        Logger.debug("BLE: char_read(%s)" % (uuid,))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("char_read"), _Trace.intern(uuid.AsString))
 
     @wrap_into_QOp(_char_write)
     def char_write(self, uuid: CHAR_UUID, data: bytes, requireresponse : bool) -> None:
@@ -511,7 +692,15 @@ class GATTClient(GATTClientInterface):
         Synchronous write to device. Write occurs in a background thread,
         but the calling thread is made to wait until there is a result.
         """
-        Logger.debug("BLE: char_write(%s, %s, %s)" % (uuid, data, requireresponse))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("char_write"), _Trace.intern(uuid.AsString))
+
+    @wrap_into_QOp(_restore_notifies)
+    def restore_notifies(self) -> None:
+        """
+        Enables every notify that was enabled before a disconnect.
+        """
+        Logger.debug("BLE: restore_notifies(%s) %d notifies" % (self.MAC, len(self.ArmedNotifies)))
 
     @wrap_into_QOp(_desc_write)
     def descriptor_write(self, charuuid: CHAR_UUID, descid : DESC_UUID, data : bytes):
@@ -519,7 +708,8 @@ class GATTClient(GATTClientInterface):
         Synchronous write to a descriptor. Write occurs in a background thread,
         but the calling thread is made to wait until there is a result.
         """
-        Logger.debug("BLE: descriptor_write(%s, %s, %s)" % (charuuid, descid, data))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("descriptor_write"), _Trace.intern(charuuid.AsString))
 
     def get_name(self) -> Optional[str]:
         Logger.debug("BLE: get_name()")
@@ -527,23 +717,25 @@ class GATTClient(GATTClientInterface):
 
     # *** Callback interface
 
-    def callback_char_read(self, uuid: CHAR_UUID, callback : Callable[ [OpResult[bytes]], None ]):
+    def callback_char_read(self, uuid: CHAR_UUID, callback : Callable[ [OpResult[bytes]], None ]) -> QOpHandle:
         """
         Read a characteristic in a background thread and call back with
         an OpResult, which will contain a 'bytes' object.
         """
-        Logger.debug("BLE: callback_char_read(%s, %s)" % (uuid, callback))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("callback_char_read"), _Trace.intern(uuid.AsString))
         op = QOp(self._char_read, uuid, callback=self.CBConverter.convert(callback))
-        self.QOpExecutor.Manager.addFIFOOp(op)
+        return self.QOpExecutor.Manager.addFIFOOp(op)
 
-    def callback_char_write(self, uuid: CHAR_UUID, data : bytes, requireresponse : bool, callback : Optional[ Callable[[OpResult[None]], None]] = None):
+    def callback_char_write(self, uuid: CHAR_UUID, data : bytes, requireresponse : bool, callback : Optional[ Callable[[OpResult[None]], None]] = None) -> QOpHandle:
         """
         Write a characteristic in a background thread and call back with
         an OpResult.
         """
-        Logger.debug("BLE: callback_char_write(%s, %s, %s)" % (uuid, data, requireresponse))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("callback_char_write"), _Trace.intern(uuid.AsString))
         op : QOp[None] = QOp(self._char_write, uuid, data, callback=self.CBConverter.convert(callback))
-        self.QOpExecutor.Manager.addFIFOOp(op)
+        return self.QOpExecutor.Manager.addFIFOOp(op)
 
 
     def descriptorRead(self, uuid: CHAR_UUID):
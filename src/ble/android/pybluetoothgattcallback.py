@@ -6,8 +6,11 @@ from jnius import PythonJavaClass, java_method  # type: ignore
 from kivy.logger import Logger
 
 from ble.bleops import CountingSemaphore
+from ble.bletrace import TraceEvent, get_BLETrace
 from ble.gattclientinterface import GATTCState
 
+_Trace = get_BLETrace()
+
 @enum.unique
 class AndroidGATTStatus(enum.IntEnum):
     GATT_SUCCESS = 0
@@ -101,7 +104,8 @@ class PyBluetoothGattCallback(PythonJavaClass):
     @java_method("(Ljava/lang/String;[B)V")
     def onCharacteristicChanged(self, uuid : str, value : Iterable[int]) -> None:
         value = bytearray(value)
-        Logger.debug("BLE: onCharacteristicChanged(%s, %s)" % (uuid, value))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.GATT_CALLBACK, _Trace.intern("onCharacteristicChanged"), _Trace.intern(uuid), len(value))
 
         self.QOnCharacteristicChanged.appendleft((uuid, value))
         self.SemaOnCharacteristicChanged.up()
@@ -110,7 +114,8 @@ class PyBluetoothGattCallback(PythonJavaClass):
     def onCharacteristicRead(self, uuid : str, status : int, value : Iterable[int]) -> None:
         status = AndroidGATTStatus(status)
         value = bytearray(value)
-        Logger.debug("BLE: onCharacteristicRead(%s, %s, %s)" % (uuid, status, value.hex().upper()))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.GATT_CALLBACK, _Trace.intern("onCharacteristicRead"), _Trace.intern(uuid), status)
 
         self.QOnCharacteristicRead.appendleft((uuid, status, value))
         self.SemaOnCharacteristicRead.up()
@@ -118,7 +123,8 @@ class PyBluetoothGattCallback(PythonJavaClass):
     @java_method("(Ljava/lang/String;I)V")
     def onCharacteristicWrite(self, uuid : str, status : int) -> None:
         status = AndroidGATTStatus(status)
-        Logger.debug("BLE: onCharacteristicWrite(%s, %s)" % (uuid, status))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.GATT_CALLBACK, _Trace.intern("onCharacteristicWrite"), _Trace.intern(uuid), status)
 
         self.QOnCharacteristicWrite.appendleft((uuid, status))
         self.SemaOnCharacteristicWrite.up()
@@ -135,7 +141,8 @@ class PyBluetoothGattCallback(PythonJavaClass):
     @java_method("(Ljava/lang/String;I)V")
     def onDescriptorWrite(self, uuid : str, status : int) -> None:
         status = AndroidGATTStatus(status)
-        Logger.debug("BLE: onDescriptorWrite(%s, %s)" % (uuid, status))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.GATT_CALLBACK, _Trace.intern("onDescriptorWrite"), _Trace.intern(uuid), status)
 
         self.QOnDescriptorWrite.appendleft((uuid, status))
         self.SemaOnDescriptorWrite.up()
@@ -57,7 +57,7 @@ class PyScanCallback(PythonJavaClass):
     Logger.debug(f"BLE: onScanResult: Device MAC: {macaddress}")
     Logger.debug(f"BLE: onScanResult: UUIDs: {uuids}")
 
-    res = BLEScanResult(macaddress, name, uuids, result.getDevice(), record)
+    res = BLEScanResult(macaddress, name, uuids, result.getDevice(), record, result.getRssi())
 
     # 0000ffff-0000-1000-8000-00805f9b34fb
     self.Parent.addEntry(res)
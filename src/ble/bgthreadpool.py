@@ -8,11 +8,15 @@ from typing import Any, Callable, Tuple
 
 from kivy.logger import Logger
 
+from ble.bletrace import TraceEvent, get_BLETrace
+
+_Trace = get_BLETrace()
+
 
 class SingleThreader:
-    def __init__(self):
+    def __init__(self, name : str = 'SingleThread'):
         self.SubmitQ : queue.Queue[Tuple[Callable[..., Any], Any, Any]] = queue.Queue()
-        self.SingleThread = threading.Thread(name='SingleThread', daemon=True, target=self._bgloop)
+        self.SingleThread = threading.Thread(name=name, daemon=True, target=self._bgloop)
         self.Running = True
         self.SingleThread.start()
 
@@ -32,6 +36,29 @@ class SingleThreader:
                 Logger.debug("BLE: EXCEPTION: %s" % (traceback.format_exc(),))
 
 
+class WorkerPool(SingleThreader):
+    """
+    Like SingleThreader, but with "count" threads taking work from the same queue.
+
+    Work is started in the order it was submitted, but can run in parallel.
+    """
+    def __init__(self, count : int, name : str = 'WorkerPool'):
+        super().__init__(name="%s-0" % (name,))
+        self.Threads = [self.SingleThread]
+        for i in range(1, count):
+            t = threading.Thread(name="%s-%d" % (name, i), daemon=True, target=self._bgloop)
+            t.start()
+            self.Threads.append(t)
+
+    def shutdown(self):
+        self.Running = False
+        for t in self.Threads:
+            # Wake each thread up so it notices that we are no longer running
+            self.SubmitQ.put((lambda: None, (), {}))
+        for t in self.Threads:
+            t.join()
+
+
 __ST = SingleThreader()
 
 
@@ -48,5 +75,6 @@ def submit(fn : Callable[..., Any], /, *args : Any, **kwargs : Any):
 
     Couldn't use a ThreadPoolExecutor, because it would insist on waiting on subthreads to finish execution.
     """
-    Logger.debug("Submitted: %s" % (repr(fn),))
+    if _Trace.Enabled:
+        _Trace.record(TraceEvent.SUBMIT, _Trace.intern(getattr(fn, '__qualname__', 'fn')))
     __ST.submit(fn, *args, **kwargs)
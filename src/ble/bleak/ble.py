@@ -8,6 +8,7 @@ from ble.android.androidtypes import T_Context, T_Intent
 
 from ble.bleak.blescanner import BLEScanTool
 from ble.bleak.gattclient import GATTClient
+from ble.deviceregistry import get_DeviceRegistry
 from ble.bleexceptions import BLEException
 from ble.bleinterface import BLEInterface
 from ble.bleops import ContextConverter, QOpExecutorFactory
@@ -20,7 +21,10 @@ class BLE(BLEInterface):
     This is the BLEAK specific BLE module.
     """
 
-    def __init__(self, executorfactory: QOpExecutorFactory, contextconverter: ContextConverter, androidcontext : Any = None):
+    def __init__(self, executorfactory: QOpExecutorFactory, contextconverter: ContextConverter, androidcontext : Any = None, nativeasync : bool = False):
+        """
+        nativeasync makes GATTClients run their ops directly on the BLE asyncio loop. See GATTClient.
+        """
         Logger.info("UI: BLE.__init__()")
 
         print("BLE(__init__) current thread", threading.current_thread().name)
@@ -28,6 +32,7 @@ class BLE(BLEInterface):
         self.QOpExecutorFactory = executorfactory
         self.ContextConverter = contextconverter
         self.BLEScanTool : Union[I_BLEScanTool, None] = None
+        self.NativeAsync = nativeasync
 
         self.ConnectLock = threading.RLock()
         self.GATTClients : Dict[str, GATTClientInterface] = {}
@@ -56,6 +61,7 @@ class BLE(BLEInterface):
         """Call when app is stopped"""
         Logger.debug("BLE on_stop()")
         self.disconnectAllClients()
+        get_DeviceRegistry().save()  # A scan may never have stopped to save it
 
     def isBLESupported(self) -> bool:
         """Returns True if BLE is supported"""
@@ -138,7 +144,7 @@ class BLE(BLEInterface):
         if macaddress in self.GATTClients:
             return self.GATTClients[macaddress]
 
-        gc = GATTClient(macaddress, self.QOpExecutorFactory.makeExecutor(), self.ContextConverter)
+        gc = GATTClient(macaddress, self.QOpExecutorFactory.makeExecutor(), self.ContextConverter, nativeasync=self.NativeAsync)
 
         self.GATTClients[macaddress] = gc
         return gc
@@ -1,8 +1,8 @@
 import asyncio
-import threading
 import time
+import traceback
 from collections import deque
-from typing import Dict
+from typing import Dict, Optional
 
 from bleak import BleakScanner # type: ignore
 from bleak.backends.device import BLEDevice
@@ -11,8 +11,10 @@ from kivy.logger import Logger
 
 from ble.bleexceptions import BLEAlreadyScanning
 from ble.blescanresult import BLEScanResult
-from ble.bgasyncthread import run_coroutine_threadsafe
+from ble.bgasyncthread import get_BGAsyncLoop
 from ble.blescantoolinterface import I_BLEScanTool
+from ble.deviceregistry import get_DeviceRegistry
+from ble.scansubscription import DUTY_CYCLES, ScanCallback, ScanFilter, ScanMode, ScanPublisher, ScanResultIterator, ScanSubscription
 
 
 class BLEScanTool(I_BLEScanTool):
@@ -27,6 +29,11 @@ class BLEScanTool(I_BLEScanTool):
     updated in the context of the calling thread, from a threadsafe queue
     updated by callbacks.
 
+    There is one radio scan, run by _radio() on the BLE loop for as long as any
+    subscription from startSharedScan() (or a startScan()) wants it. Bleak
+    can't set the radio's duty cycle, so the lower ScanModes are done by
+    starting and stopping the scanner on a fixed schedule. See DUTY_CYCLES.
+
     Only one scantool object should be scanning at a time.
     """
 
@@ -37,8 +44,11 @@ class BLEScanTool(I_BLEScanTool):
         self.StartTime = time.time()
         self.Duration = 0.0
         self.Scanning = False
-        self.RequestStop = False
-        self.Thread = threading.Thread(name='BleakScanner', daemon=True, target=self._bgScanThread)
+        self.Publisher = ScanPublisher(onchange=self._kick)
+        self.Registry = get_DeviceRegistry()
+        self.OneShot : Optional[ScanSubscription] = None  # From startScan()
+        self.RadioTask : Optional[asyncio.Task[None]] = None  # Only touched on the BLE loop
+        self.Wake : Optional[asyncio.Event] = None  # Wakes _radio() when subscriptions change
 
     def getSeenEntries(self) -> Dict[str, BLEScanResult]:
         """
@@ -55,7 +65,26 @@ class BLEScanTool(I_BLEScanTool):
         return self.Seen
 
     def stopScanning(self):
-        self.RequestStop = True
+        """
+        Stop every scan, including other subscribers' shared scans
+        """
+        self.Publisher.stopAll()
+        self._kick()
+
+    def subscribe(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None) -> ScanSubscription:
+        return self.Publisher.subscribe(callback, scanfilter)
+
+    def results(self, scanfilter : Optional[ScanFilter] = None) -> ScanResultIterator:
+        return ScanResultIterator(self, scanfilter)
+
+    def startSharedScan(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None, timeout : Optional[float] = None,
+                        mode : ScanMode = ScanMode.LOW_POWER, passive : bool = False) -> ScanSubscription:
+        """
+        See I_BLEScanTool
+        """
+        Logger.debug("BLE: startSharedScan(timeout=%s, mode=%s, passive=%s)" % (timeout, mode, passive))
+        self.Scanning = True
+        return self.Publisher.demand(callback, scanfilter, mode, timeout, passive)
 
     def isScanning(self):
         return self.Scanning
@@ -66,7 +95,7 @@ class BLEScanTool(I_BLEScanTool):
 
         0.0 means scanning completed (or has never happened)
         """
-        if not self.isScanning():
+        if (self.OneShot is None) or not self.OneShot.Active:
             return 0.0
       
         left = self.Duration - (time.time() - self.StartTime)
@@ -87,11 +116,8 @@ class BLEScanTool(I_BLEScanTool):
         """
         Internal call to add scanned entries
         """
-        self.ScanQ.append(entry)
-        tdelta = time.time() - self.StartTime
-        if tdelta > self.Duration:
-            # We have been scanning for long enough
-            self.RequestStop = True
+        self.Registry.observe(entry)
+        self.Publisher.publish(entry)
 
     def _resetTimer(self):
         """
@@ -103,55 +129,124 @@ class BLEScanTool(I_BLEScanTool):
         """
         Copy self.Seen to self.Previous and fill self.Seen with new entries for "duration" seconds.
 
-        Raises a BLEAlreadyScanning exception if a scan is already running.
+        Raises a BLEAlreadyScanning exception if a startScan() is already running.
+        Shared scans don't count.
         """
-        if self.isScanning():
+        if (self.OneShot is not None) and self.OneShot.Active:
             raise BLEAlreadyScanning("A BLE scan is already running")
 
-        self.Scanning = False
-        self.RequestStop = False
-
-        if self.Thread.is_alive():
-            # In case thread hasn't terminated gracefully yet
-            self.Thread.join()
-
-        self.Thread = threading.Thread(name='BleakScanner', daemon=True, target=self._bgScanThread)
-
-        self.Thread.start()
-
         self.Duration = duration
         for k in self.Seen.keys():
             self.Previous[k] = self.Seen[k]
 
         self.Seen = {}
-        self.Scanning = True
         self._resetTimer()
 
-    def _bgScanThread(self):
-        Logger.debug("starting _bgScanThread()")
-        run_coroutine_threadsafe(self._bgScan())
-        Logger.info("Exiting _bgScanThread")
+        def collect(item : Optional[BLEScanResult]):
+            if item is not None:
+                self.ScanQ.append(item)
 
-    async def _bgScan(self):
+        self.OneShot = self.startSharedScan(collect, None, duration, ScanMode.LOW_LATENCY)
+
+    def _kick(self):
+        """
+        Subscriptions have changed. Start _radio(), or wake it up to look at them.
+        """
+        get_BGAsyncLoop().call_soon_threadsafe(self._kickOnLoop)
+
+    def _kickOnLoop(self):
+        if self.RadioTask is None:
+            if self.Publisher.radioSettings() is None:
+                return
+            self.Wake = asyncio.Event()
+            self.RadioTask = asyncio.get_running_loop().create_task(self._radio())
+        elif self.Wake is not None:
+            self.Wake.set()
+
+    async def _sleep(self, deadline : Optional[float], delay : Optional[float]) -> bool:
+        """
+        Sleep for delay seconds, but no later than deadline, and wake up early
+        if kicked. Returns True if the whole delay passed.
+        """
+        timeout = delay
+        if deadline is not None:
+            untildeadline = max(0.0, deadline - time.monotonic())
+            if (timeout is None) or (untildeadline < timeout):
+                timeout = untildeadline
+        try:
+            await asyncio.wait_for(self.Wake.wait(), timeout=timeout)  # type: ignore
+            return False
+        except asyncio.TimeoutError:
+            return timeout == delay
+
+    def _makeScanner(self, passive : bool) -> BaseBleakScanner:
+        if passive:
+            try:
+                scanner = BleakScanner(scanning_mode="passive")
+            except Exception:
+                # BlueZ wants passive scan filters, and some older backends don't do passive at all
+                Logger.debug("BLE: Passive scanning not available. Scanning actively.")
+                scanner = BleakScanner()
+        else:
+            scanner = BleakScanner()
+        scanner.register_detection_callback(self.detection_callback)
+        return scanner
+
+    async def _radio(self):
         Logger.debug("Bleak scanner starting")
-        self.BLEScanner : BaseBleakScanner = BleakScanner()
-        self.BLEScanner.register_detection_callback(self.detection_callback)
-        await self.BLEScanner.start()
-        Logger.debug("Bleak scanner started")
-
-        while True:
-            if (self.scanTimeLeft() == 0.0) or self.RequestStop:
-                # Stop scanning
-                await self.BLEScanner.stop()
+        scanner : Optional[BaseBleakScanner] = None
+        scannerpassive = False
+        ended = False
+        self.Publisher.begin()
+        try:
+            while True:
+                nextdeadline = self.Publisher.expire(time.monotonic())
+                settings = self.Publisher.radioSettings()
+                if settings is None:
+                    self.RadioTask = None  # Before any await, so the next kick starts a new _radio()
+                    ended = True
+                    break
+                mode, passive = settings
+                self.Wake.clear()  # type: ignore
+
+                if (scanner is not None) and (passive != scannerpassive):
+                    await scanner.stop()
+                    scanner = None
+                if scanner is None:
+                    self.Scanning = True
+                    scanner = self._makeScanner(passive)
+                    scannerpassive = passive
+                    await scanner.start()
+
+                duty = DUTY_CYCLES[mode]
+                if duty is None:
+                    await self._sleep(nextdeadline, None)
+                else:
+                    window, interval = duty
+                    if await self._sleep(nextdeadline, window):
+                        await scanner.stop()
+                        scanner = None
+                        await self._sleep(nextdeadline, interval - window)
+        except Exception:
+            Logger.debug("BLE: Bleak scanner failed: %s" % (traceback.format_exc(),))
+        finally:
+            if scanner is not None:
+                await scanner.stop()
+            if not ended:
+                # Something went wrong with the scanner. End everything, and let the next kick have another go.
+                self.RadioTask = None
+                self.Publisher.stopAll()
+            if self.RadioTask is None:
                 self.Scanning = False
-                self.RequestStop = False
-                Logger.info("Exiting _bgScan")
-                return
-            else:
-                await asyncio.sleep(0.25)
+                self.Publisher.finish()
+                self.Registry.saveInBackground()
+            Logger.info("Exiting _radio")
 
     # Callable[[BLEDevice, AdvertisementData], Optional[Awaitable[None]]]
     def detection_callback(self, device : BLEDevice, advertisement_data : AdvertisementData):
         Logger.debug("BLE: Bleak BLE Scanner detection_callback(%s, %s)" % (device, advertisement_data))
-        item = BLEScanResult(device.address, device.name, advertisement_data.service_uuids, None, None)
+        rssi = getattr(advertisement_data, 'rssi', None)  # Older Bleak only has it on the device
+        if rssi is None:
+            rssi = getattr(device, 'rssi', None)
+        item = BLEScanResult(device.address, device.name, advertisement_data.service_uuids, None, None, rssi)
         self.addEntry(item)
@@ -1,4 +1,5 @@
-from typing import Callable, List, Optional
+import asyncio
+from typing import Callable, Dict, List, Optional, Union
 
 from bleak import BleakClient  # type: ignore
 from bleak.exc import BleakError
@@ -7,11 +8,18 @@ from bleak.backends.client import BaseBleakClient
 from bleak.backends.service import BleakGATTServiceCollection
 from kivy.logger import Logger
 
-from ble.bleops import ContextConverter, OpResult, QOp, QOpExecutor, QOpManager, async_wrap_async_into_QOp, wrap_into_QOp
+from ble.connsupervisor import ConnectionSupervisor, ReconnectBackoff
+from ble.bleops import AsyncQOpHandle, AsyncQOpQueue, ContextConverter, OpResult, QOp, QOpExecutor, QOpHandle, QOpManager, async_wrap_async_into_QOp, coalesce_key, wrap_into_QOp
 from ble.gattclientinterface import GATTClientInterface, GATTCState
+from ble.notifydispatch import NotifyDispatcher, NotifyOverflow
+from ble.readcache import GATTReadCache, read_through_cache
 from ble.bleexceptions import *
+from ble.bletrace import TraceEvent, get_BLETrace, head
+from ble.discoverycache import AttributeTable, get_DiscoveryCache, table_uuids
 from ble.uuidtype import CHAR_UUID, DESC_UUID
 
+_Trace = get_BLETrace()  # Per-op events are traced rather than logged. See bletrace.py
+
 
 class GATTClient(GATTClientInterface):
     """
@@ -32,30 +40,47 @@ class GATTClient(GATTClientInterface):
       DescriptorRead
       MtuRequest
 
+    If nativeasync is True, ops are queued on an AsyncQOpQueue on the BLE
+    asyncio loop rather than on the QOpExecutor, which saves a couple of
+    thread hops per op. Priorities and write coalescing are not available
+    in this mode.
     """
 
-    def __init__(self, macaddress: str, qopexecutor: QOpExecutor, contextconverter: ContextConverter):
-        Logger.debug("BLE: ble.bleak.GATTClient.__init__(%s, %s, %s)" % (macaddress, qopexecutor, contextconverter))
+    def __init__(self, macaddress: str, qopexecutor: QOpExecutor, contextconverter: ContextConverter, nativeasync : bool = False):
+        Logger.debug("BLE: ble.bleak.GATTClient.__init__(%s, %s, %s, nativeasync=%s)" % (macaddress, qopexecutor, contextconverter, nativeasync))
         self.MAC = macaddress
         self.BleakClient : BaseBleakClient = BleakClient(self.MAC)
 
         self.State = GATTCState.INIT
         self.QOpExecutor = qopexecutor  # Holds a queue of operations that are run in their own thread
+        self.QOpExecutor.Manager.Label = macaddress  # Identifies our ops in metrics
         self.QOpExecutor.startBackgroundProcessing()
+        self.NativeQueue : Optional[AsyncQOpQueue] = AsyncQOpQueue(label=macaddress) if nativeasync else None
 
         self.CBConverter = contextconverter  # Used to convert callbacks out of the background thread
+        self.NotifyDispatcher = NotifyDispatcher()  # Buffers notifies, so callbacks don't run on the Bleak loop
+        self.ReadCache = GATTReadCache()  # Last value seen for each characteristic
+        self.DiscoveryCache = get_DiscoveryCache()
+        self.CachedTable : Optional[AttributeTable] = self.DiscoveryCache.load(self.MAC)  # From an earlier connect, maybe in another process
 
         self.QOpTimeout = 10
         self.ConnCallback = None
+        self.Supervisor : Optional[ConnectionSupervisor] = None
+        self.ArmedNotifies : Dict[str, Callable[[int, bytearray], None]] = {}  # UUID -> Bleak callback, for restore_notifies()
 
     def __del__(self):
         Logger.debug("BLE: __del__() on bleak variant of GATTClient %s" % (self.MAC,))
 
     def shutdown(self):
         self.QOpExecutor.shutdown()
+        self.NotifyDispatcher.closeAll()
 
     def getCharacteristicsUUIDs(self) -> List[str]:
-        return list(self.Characteristics.keys())
+        if hasattr(self, "Characteristics"):
+            return list(self.Characteristics.keys())
+        if self.CachedTable is not None:
+            return table_uuids(self.CachedTable)
+        return []
 
     def set_disc_callback(self, callback: Callable[[GATTCState], None]):
         """
@@ -70,11 +95,27 @@ class GATTClient(GATTClientInterface):
         def disc_cb(client : BaseBleakClient) -> None:
             # Called by BLEAK when a disconnect occurs
             Logger.debug("BLE: Unsolicited disconnect from %s" % (client.address,))
+            self.ReadCache.clear()
             if self.ConnCallback:
                 self.ConnCallback(GATTCState.DISCONNECTED)
 
         self.BleakClient.set_disconnected_callback(disc_cb)
 
+    def set_auto_reconnect(self, enable : bool, callback : Optional[Callable[[GATTCState], None]] = None, backoff : Optional[ReconnectBackoff] = None) -> None:
+        """
+        Reconnect after an unsolicited disconnect. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_auto_reconnect(%s, %s)" % (self.MAC, enable))
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
+            self.Supervisor = None
+
+        if enable:
+            self.Supervisor = ConnectionSupervisor(self, callback, backoff)
+            self.Supervisor.start()
+        else:
+            self.set_disc_callback(callback)  # type: ignore
+
     # Most operations are available in 3 different flavours:
     # asynchronous, callback, and synchronous. All operations are run on
     # a background thread. My personal preference is to use the
@@ -99,7 +140,9 @@ class GATTClient(GATTClientInterface):
             # that complain that the list already has entries.
             self.BleakClient.services = BleakGATTServiceCollection()
 
-            connected = await self.BleakClient.connect()
+            # If we've connected before, let BlueZ use its cached services rather than waiting for
+            # them to be resolved again. Other backends ignore this. We check the table below.
+            connected = await self.BleakClient.connect(dangerous_use_bleak_cache=self.CachedTable is not None)
         except BleakError as be:
             Logger.debug("BLE: Exception while attempting to connect")
             raise BLEConnectionError(getattr(be, 'message', repr(be)))
@@ -109,22 +152,31 @@ class GATTClient(GATTClientInterface):
 
         if not hasattr(self, "Characteristics"):
             # Discover our services on first connect. Remember them so we don't do this for reconnects.
-            self.BleakGATTServiceCollection = await self.BleakClient.get_services()
+            # Bleak has already resolved them as part of connect().
+            self.BleakGATTServiceCollection = self.BleakClient.services
 
             self.Characteristics : dict[str, BleakGATTCharacteristic] = {}
+            table : AttributeTable = {}
             for serv in self.BleakGATTServiceCollection:
+                table[serv.uuid] = sorted([char.uuid, char.handle, sorted(char.properties)] for char in serv.characteristics)
                 for char in serv.characteristics:
                     uuidstr = char.uuid
                     self.Characteristics[uuidstr] = char
                     Logger.debug("BLE: Service UUID %s = %s" % (uuidstr, char))
 
+            # Revalidate the disk cache. This only writes if the table has changed.
+            self.CachedTable = table
+            self.DiscoveryCache.storeInBackground(self.MAC, table)
+
         return GATTCState.CONNECTED
 
-    async def _disconnect(self, manager: Optional[QOpManager], reason: Optional[str]) -> GATTCState:
+    async def _disconnect(self, manager: Optional[QOpManager] = None, reason: Optional[str] = None) -> GATTCState:
         if reason is not None:
             # We've been told to cancel, so do nothing
             return GATTCState.CANCELLED
 
+        self.ReadCache.clear()
+        self.ArmedNotifies = {}
         boolresult = await self.BleakClient.disconnect()
         if boolresult:
             # API doc is unclear. I think True = Disconnect succeeded (Docs say it's the connection state)
@@ -133,29 +185,37 @@ class GATTClient(GATTClientInterface):
             return GATTCState.CONNECTED
 
     async def _char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool, manager: Optional[QOpManager] = None, reason: Optional[str] = None):
-        Logger.debug("BLE: _char_writed(%s, %s, manager=%s, reason=%s)" % (uuid, data.hex(), manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_WRITE, _Trace.intern(uuid.AsString), head(data), len(data))
 
         if reason is not None:
             # Reason being set means we are being asked to cancel
             Logger.debug("BLE: _char_write() cancelled before execution. Reason: %s" % (reason,))
 
+        self.ReadCache.invalidate(uuid)
         r = await self.BleakClient.write_gatt_char(uuid.AsString, data, response=requireresponse)
-        Logger.debug("BLE: _char_write result: %s" % (r,))
+        self.ReadCache.invalidate(uuid)  # In case a notify arrived with the old value
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_RESULT, _Trace.intern(uuid.AsString))
         return r
 
     async def _char_read(self, uuid : CHAR_UUID,  manager: Optional[QOpManager] = None, reason: Optional[str] = None) -> bytearray:
-        Logger.debug("BLE: _char_read(%s, manager=%s, reason=%s)" % (uuid, manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_READ, _Trace.intern(uuid.AsString))
 
         if reason is not None:
             # Reason being set means we are being asked to cancel
             Logger.debug("BLE: _char_read() cancelled before execution. Reason: %s" % (reason,))
 
         r = await self.BleakClient.read_gatt_char(uuid.AsString)
-        Logger.debug("BLE: _char_read result: %s" % (r,))
+        self.ReadCache.update(uuid, r)
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CHAR_RESULT, _Trace.intern(uuid.AsString), head(r), len(r))
         return r
 
     async def _set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID, bytes], None]], manager: Optional[QOpManager] = None, reason: Optional[str] = None) -> None:
-        Logger.debug("BLE: _set_notify(%s, %s, %s, %s, %s)" % (uuid, enable, notifycallback, manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.SET_NOTIFY, _Trace.intern(uuid.AsString), 0, int(enable))
 
         if reason is not None:
             # Reason being set means we are being asked to cancel
@@ -165,15 +225,39 @@ class GATTClient(GATTClientInterface):
             if notifycallback is None:
                 raise BLENoCallbackProvided("No callback provided when attempting to enable a notify")
 
+            push = self.NotifyDispatcher.subscribe(uuid, notifycallback)
+
             def do_cb(sender: int, data: bytearray):
-                # We want our callback to work with anything, not just bleak, so pass back the original UUID
-                notifycallback(uuid, data)
+                # We want our callback to work with anything, not just bleak, so pass back the original UUID.
+                # This runs on the Bleak loop, so just buffer it. The callback runs on the subscription's thread.
+                if _Trace.Enabled:
+                    _Trace.record(TraceEvent.NOTIFY, _Trace.intern(uuid.AsString), head(data), len(data))
+                self.ReadCache.update(uuid, data)
+                push(uuid, data)
 
             await self.BleakClient.start_notify(uuid.AsString, do_cb)
+            self.ArmedNotifies[uuid.AsString] = do_cb
             
         else:
+            self.ArmedNotifies.pop(uuid.AsString, None)
+            self.NotifyDispatcher.unsubscribe(uuid)
             await self.BleakClient.stop_notify(uuid.AsString)
 
+    async def _restore_notifies(self, manager: Optional[QOpManager] = None, reason: Optional[str] = None) -> None:
+        if reason is not None:
+            # Reason being set means we are being asked to cancel
+            Logger.debug("BLE: _restore_notifies() cancelled before execution. Reason: %s" % (reason,))
+            return
+
+        # The subscriptions survive a disconnect, so only the device end needs setting up.
+        # Issue them all together. Bleak's backends queue them, so this saves a round trip
+        # through our queue for each one.
+        armed = list(self.ArmedNotifies.items())
+        if _Trace.Enabled:
+            for uuidstr, _ in armed:
+                _Trace.record(TraceEvent.SET_NOTIFY, _Trace.intern(uuidstr), 0, 1)
+        await asyncio.gather(*[self.BleakClient.start_notify(uuidstr, cb) for uuidstr, cb in armed])
+
 
         
 
@@ -186,7 +270,8 @@ class GATTClient(GATTClientInterface):
         """
         Set notify on or off
         """
-        Logger.debug("BLE: async_set_notify")
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_set_notify"), _Trace.intern(uuid.AsString))
 
     @async_wrap_async_into_QOp(_connect)
     async def async_connect(self):
@@ -202,20 +287,27 @@ class GATTClient(GATTClientInterface):
         Disconnect
         """
         Logger.debug("BLE: async_disconnect(%s)" % (self.MAC,))
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
 
+    @read_through_cache
     @async_wrap_async_into_QOp(_char_read)
     async def async_char_read(self, uuid : CHAR_UUID):
         """
-        Write a characteristic in a background thread and return result when it is done.
+        Read a characteristic in a background thread and return result when it is done.
+
+        maxstaleness=seconds accepts a cached value up to that old. See set_read_cache().
         """
-        Logger.debug("BLE: async_char_read(%s)" % (uuid,))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_char_read"), _Trace.intern(uuid.AsString))
 
     @async_wrap_async_into_QOp(_char_write)
     async def async_char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool):
         """
         Write a characteristic in a background thread and return result
         """
-        Logger.debug("BLE: async_char_write(%s, %s, %s)" % (uuid, data, requireresponse))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("async_char_write"), _Trace.intern(uuid.AsString))
 
     # *** Synchronous interface
 
@@ -233,6 +325,8 @@ class GATTClient(GATTClientInterface):
         Blocking disconnect
         """
         Logger.debug("BLE: disconnect from %s" % (self.MAC,))
+        if self.Supervisor is not None:
+            self.Supervisor.stop()
 
     def get_name(self) -> Optional[str]:
         try:
@@ -241,13 +335,17 @@ class GATTClient(GATTClientInterface):
             retval = None
         return retval
 
+    @read_through_cache
     @wrap_into_QOp(_char_read)
     def char_read(self, uuid : CHAR_UUID):
         """
         Synchronous read of a characteristic. Read occurs in a background thread,
         but the calling thread is made to wait until there is a result.
+
+        maxstaleness=seconds accepts a cached value up to that old. See set_read_cache().
         """
-        Logger.debug("BLE: char_read(%s)" % (uuid,))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("char_read"), _Trace.intern(uuid.AsString))
 
     @wrap_into_QOp(_char_write)
     def char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool) -> None:
@@ -256,14 +354,23 @@ class GATTClient(GATTClientInterface):
         occurs in a background thread, but the calling thread is made to
         wait until there is a result.
         """
-        Logger.debug("BLE: char_write(%s, %s)" % (uuid, data))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("char_write"), _Trace.intern(uuid.AsString))
 
     @wrap_into_QOp(_set_notify)
     def set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID,bytes], None]]) -> None:
         """
         Synchronous request to enable/disable notifies on a characteristic.
         """
-        Logger.debug("BLE: set_notify(%s, %s, %s)" % (uuid, enable, notifycallback))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("set_notify"), _Trace.intern(uuid.AsString))
+
+    @wrap_into_QOp(_restore_notifies)
+    def restore_notifies(self) -> None:
+        """
+        Synchronous request to enable every notify that was enabled before a disconnect.
+        """
+        Logger.debug("BLE: restore_notifies(%s) %d notifies" % (self.MAC, len(self.ArmedNotifies)))
 
     def descriptor_write(self, charuiid: CHAR_UUID, descuuid: DESC_UUID, data : bytes) -> None:
         """
@@ -274,23 +381,53 @@ class GATTClient(GATTClientInterface):
 
     # *** Callback interface
 
-    def callback_char_read(self, uuid : CHAR_UUID, callback : Callable[ [OpResult[bytes]], None] ):
+    def callback_char_read(self, uuid : CHAR_UUID, callback : Callable[ [OpResult[bytes]], None] ) -> Union[QOpHandle, AsyncQOpHandle]:
         """
         Read a characteristic in a background thread and call back with
         an OpResult, which will contain a bytearray.
         """
-        Logger.debug("BLE: callback_char_read(%s, %s)" % (uuid, callback))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("callback_char_read"), _Trace.intern(uuid.AsString))
+        if self.NativeQueue is not None:
+            return self.NativeQueue.submitWithCallback(GATTClient._char_read, self, (uuid,), self.CBConverter.convert(callback))
         op = QOp(self._char_read, uuid, callback=self.CBConverter.convert(callback))
-        self.QOpExecutor.Manager.addFIFOOp(op)
+        return self.QOpExecutor.Manager.addFIFOOp(op)
 
-    def callback_char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool, callback: Optional[ Callable[[OpResult[None]], None] ] = None):
+    def callback_char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool, callback: Optional[ Callable[[OpResult[None]], None] ] = None) -> Union[QOpHandle, AsyncQOpHandle]:
         """
         Write a characteristic in a background thread and call back with
         an OpResult.
         """
-        Logger.debug("BLE: callback_char_write(%s, %s)" % (uuid, data))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CALL, _Trace.intern("callback_char_write"), _Trace.intern(uuid.AsString))
+        if self.NativeQueue is not None:
+            return self.NativeQueue.submitWithCallback(GATTClient._char_write, self, (uuid, data, requireresponse), self.CBConverter.convert(callback))
         op = QOp(self._char_write, uuid, data, requireresponse, callback=self.CBConverter.convert(callback))
-        self.QOpExecutor.Manager.addFIFOOp(op)
+        return self.QOpExecutor.Manager.addFIFOOp(op)
+
+    def set_write_coalescing(self, uuid : CHAR_UUID, enable : bool) -> None:
+        """
+        Coalesce queued writes to this characteristic. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_write_coalescing(%s, %s)" % (uuid.AsString, enable))
+        self.QOpExecutor.Manager.setCoalescing(coalesce_key(GATTClient._char_write, uuid), enable)
+
+    def set_read_cache(self, uuid : CHAR_UUID, ttl : Optional[float]) -> None:
+        """
+        Serve reads of uuid from the cache for ttl seconds. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_read_cache(%s, %s)" % (uuid.AsString, ttl))
+        self.ReadCache.setTTL(uuid, ttl)
+
+    def set_notify_buffering(self, uuid : CHAR_UUID, capacity : int, policy : NotifyOverflow) -> None:
+        """
+        Size and overflow policy of the notify buffer for uuid. See GATTClientInterface.
+        """
+        Logger.debug("BLE: set_notify_buffering(%s, %s, %s)" % (uuid.AsString, capacity, policy))
+        self.NotifyDispatcher.configure(uuid, capacity, policy)
+
+    def get_notify_stats(self) -> Dict[str, Dict[str, int]]:
+        return self.NotifyDispatcher.stats()
 
     def is_connected(self) -> bool:
         return self.BleakClient.is_connected()
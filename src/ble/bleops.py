@@ -1,21 +1,29 @@
 import abc
 import asyncio
 import collections
+import concurrent.futures
+import enum
 import functools
 import inspect
 import queue
 import threading
+import time
 import traceback
-from typing import Any, Awaitable, Callable, Coroutine, Deque, Generic, Optional, TypeVar, Union
+from typing import Any, Awaitable, Callable, Coroutine, Deque, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar, Union
 
 from kivy.logger import Logger
 
-from ble.bgasyncthread import run_coroutine_threadsafe
+from ble.bgasyncthread import get_BGAsyncLoop, run_coroutine_threadsafe
 from ble.bleexceptions import *
+from ble.bletrace import TraceEvent, get_BLETrace
+from ble.qopmetrics import get_QOpMetrics
 
 import ble.bgthreadpool
 from queue import Empty
 
+_Metrics = get_QOpMetrics()  # Only records anything if enabled
+_Trace = get_BLETrace()  # Hot paths record here instead of building debug strings. See bletrace.py
+
 T = TypeVar('T')
 class OpResult(Generic[T]):
     def getResult(self) -> T:
@@ -37,6 +45,25 @@ class OpResult(Generic[T]):
         self.Result = r
 
 
+@enum.unique
+class QOpPriority(enum.IntEnum):
+    """
+    The lane an op is queued in. Lower values are served first.
+    """
+    INTERACTIVE = 0  # Latency critical. eg. A state change the user is waiting on.
+    BULK = 1         # Normal traffic. eg. Profile uploads, MMR reads.
+    BACKGROUND = 2   # Whenever there is nothing else to do.
+
+
+@enum.unique
+class QOpState(enum.Enum):
+    NEW = 0        # Not queued yet
+    QUEUED = 1     # Waiting in a QOpManager
+    MERGED = 2     # Coalesced into another queued op, which will deliver our result
+    STARTED = 3    # Taken off the queue to run (or to expire)
+    WITHDRAWN = 4  # Cancelled through its QOpHandle before it started
+
+
 QOpMethod = Union[Callable[..., T], Callable[..., Awaitable[T]]];
 class QOp(Generic[T]):
     def __init__(self, op : QOpMethod[T], *args : Any, **kwargs : Any):
@@ -45,20 +72,77 @@ class QOp(Generic[T]):
 
         When do() is called, Op will be called with manager, args and kwargs.
         If callback is set, then results will be passed to the callback
+
+        These keywords are taken out of kwargs and used by the queue:
+            priority : QOpPriority lane to queue in. Defaults to BULK.
+            deadline : Seconds from now. If the op hasn't started by then, it
+                       fails with BLEOperationTimedOut without being run.
+            coalescekey : If set, and an op with the same key is still waiting
+                       in the queue, this op replaces its arguments instead of
+                       being queued. See QOpManager.addFIFOOp().
         """
         self.Op : QOpMethod[T] = op
         self.Args = args
+        self.Callback = kwargs.pop('callback', None)
+        self.MergedCallbacks : List[Callable[[OpResult[T]], None]] = []  # Callbacks of ops coalesced into this one
+        self.Absorbed = 0  # How many ops were coalesced into this one, with or without callbacks
+        self.Priority = QOpPriority(kwargs.pop('priority', QOpPriority.BULK))
+        deadline : Optional[float] = kwargs.pop('deadline', None)
+        self.Deadline = None if deadline is None else time.monotonic() + deadline
+        self.CoalesceKey : Optional[Hashable] = kwargs.pop('coalescekey', None)
         self.KwArgs = kwargs
-        try:
-            self.Callback = kwargs['callback']
-            del kwargs['callback']
-        except IndexError:
-            self.Callback = None
+        self.State = QOpState.NEW
+        self.TEnqueued : Optional[float] = None  # time.perf_counter() when queued, if metrics are enabled
+
+    def name(self) -> str:
+        return getattr(self.Op, '__name__', 'op').lstrip('_')
+
+    def absorb(self, newer : 'QOp[T]'):
+        """
+        Take over a newer op that targets the same thing. This op keeps its
+        place in the queue but runs with the newer arguments, and the newer
+        op's callback gets the same result.
+        """
+        self.Args = newer.Args
+        self.KwArgs = newer.KwArgs
+        self.Deadline = newer.Deadline
+        if callable(newer.Callback):
+            self.MergedCallbacks.append(newer.Callback)
+        self.MergedCallbacks.extend(newer.MergedCallbacks)
+        self.Absorbed += 1 + newer.Absorbed
+        newer.State = QOpState.MERGED
+
+    def _deliver(self, opr : OpResult[T]):
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_DELIVER, _Trace.intern(self.name()), id(self), len(self.MergedCallbacks))
+        if callable(self.Callback):
+            self.Callback(opr)
+        for cb in self.MergedCallbacks:
+            cb(opr)
+
+    def isExpired(self, now : float) -> bool:
+        return (self.Deadline is not None) and (now > self.Deadline)
+
+    def expire(self, manager : 'QOpManager'):
+        """
+        Fail the op because it missed its deadline. The op is never run.
+        """
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_EXPIRED, _Trace.intern(self.name()), id(self))
+        opr : OpResult[T] = OpResult()
+        opr.setException(BLEOperationTimedOut("%s missed its deadline before it could be issued" % (getattr(self.Op, '__name__', repr(self.Op)),)))
+        self._deliver(opr)
+        if self.TEnqueued is not None:
+            _Metrics.recordOutcome(manager.Label, self.name(), 'expired')
 
     def do(self, manager : 'QOpManager'):
         opr : OpResult[T] = OpResult()
+        timed = self.TEnqueued is not None
+        if timed:
+            tdispatched = time.perf_counter()
         try:
-            Logger.debug("BLE: do() %s" % (repr(self.Op)))
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.OP_DO, _Trace.intern(self.name()), id(self))
             res = self.Op(*self.Args, **self.KwArgs, manager=manager) # type: ignore
             if inspect.isawaitable(res):
                 # We might have been passed an async function or method, which means
@@ -70,16 +154,22 @@ class QOp(Generic[T]):
             Logger.debug("EXCEPTION: do(): %s" % (traceback.format_exc(),))
             opr.setException(e)
         finally:
+            if timed:
+                tcompleted = time.perf_counter()
             manager.signalOpIsDone()
 
-        if callable(self.Callback):
-            Logger.debug("BLE: Calling %s" % (repr(self.Callback),))
-            self.Callback(opr)
+        self._deliver(opr)
 
-        Logger.debug("BLE: do() done")
+        if timed:
+            _Metrics.recordOp(manager.Label, self.name(), self.TEnqueued, tdispatched, tcompleted, time.perf_counter(),  # type: ignore
+                              'error' if hasattr(opr, 'Exception') else 'ok')
+
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_DONE, _Trace.intern(self.name()), id(self), int(hasattr(opr, 'Exception')))
 
     def cancel(self, manager : 'QOpManager', reason : str):
-        Logger.debug("BLE: cancel() %s %s" % (manager, reason))
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_CANCEL, _Trace.intern(self.name()), id(self))
         opr : OpResult[T] = OpResult()
 
         try:
@@ -94,9 +184,41 @@ class QOp(Generic[T]):
             Logger.debug("EXCEPTION: cancel(): %s" % (traceback.format_exc(),))
             opr.setException(e)
 
-        manager.signalOpIsDone()
-        if callable(self.Callback):
-            self.Callback(opr)
+        # NB: Don't signal the manager here. Cancelled ops never started, so
+        # the op that is actually running (usually the one that called
+        # cancelQ()) is the one that will signal that it is done.
+        self._deliver(opr)
+        if self.TEnqueued is not None:
+            _Metrics.recordOutcome(manager.Label, self.name(), 'cancelled')
+
+
+class QOpHandle:
+    """
+    Returned when an op is queued. Lets the caller withdraw the op if it
+    hasn't started yet.
+    """
+
+    def __init__(self, manager : 'QOpManager', op : QOp[Any]):
+        self.Manager = manager
+        self.Op = op
+        self.Withdrawn = False
+
+    def cancel(self) -> bool:
+        """
+        Withdraw the op from the queue. Its callback will never be called.
+
+        Returns True if the op was withdrawn, or False if it had already
+        started (or was merged into another op) and will run anyway, or if
+        this handle already withdrew it. If other ops were merged into this
+        one, it still runs for them, but this caller's callback isn't called.
+        """
+        if self.Withdrawn:
+            return False
+        self.Withdrawn = self.Manager.withdraw(self.Op)
+        return self.Withdrawn
+
+    def isStarted(self) -> bool:
+        return self.Op.State == QOpState.STARTED
 
 
 class CountingSemaphore(threading.Semaphore):
@@ -119,12 +241,14 @@ def synchronized_with_lock(lock_name : str) -> Callable[ [Callable[..., T]], Cal
 
     def decorator(method : Callable[..., T]) -> Callable[..., T]:
         def synced_method(self : Any, *args : Any, **kwargs : Any) -> T:
-            Logger.debug("BLE: Entering %s" % (method.__name__,))
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.LOCK_ENTER, _Trace.intern(method.__name__), id(self))
             lock = getattr(self, lock_name)
             with lock:
                 result = method(self, *args, **kwargs)
-            
-            Logger.debug("BLE: Leaving %s" % (method.__name__,))                
+
+            if _Trace.Enabled:
+                _Trace.record(TraceEvent.LOCK_LEAVE, _Trace.intern(method.__name__), id(self))
             return result
 
         return synced_method
@@ -132,26 +256,148 @@ def synchronized_with_lock(lock_name : str) -> Callable[ [Callable[..., T]], Cal
     return decorator
 
 
+class QOpScheduler:
+    """
+    Hands ready QOps from QOpManagers to the background thread.
+
+    Nothing polls. A QOpManager tells the scheduler when it goes from idle to
+    having work, and the scheduler submits exactly one doNextOp() for that
+    manager to the background thread. The manager asks again once that op is
+    done, if it still has work. So each device has at most one op submitted
+    at a time, and an idle device uses no CPU at all.
+
+    If maxinflight is set, at most that many ops (across all managers using
+    this scheduler) are handed over at once. Managers that are ready while all
+    slots are taken wait their turn, in the order they became ready.
+    """
+
+    def __init__(self, submit : Optional[Callable[..., Any]] = None, maxinflight : Optional[int] = None):
+        # submit is the function used to hand work to the background thread.
+        self.Submit : Callable[..., Any] = submit if submit is not None else ble.bgthreadpool.submit
+        self.MaxInFlight = maxinflight
+        self.SchedLock = threading.Lock()
+        self.InFlight = 0
+        self.Waiting : Deque['QOpManager'] = collections.deque()
+
+    def opReady(self, manager : 'QOpManager') -> None:
+        """
+        Called by a manager that has work and no op in flight.
+        """
+        with self.SchedLock:
+            if (self.MaxInFlight is not None) and (self.InFlight >= self.MaxInFlight):
+                self.Waiting.append(manager)
+                return
+            self.InFlight += 1
+
+        self.Submit(manager.doNextOp)
+
+    def opFinished(self, manager : 'QOpManager') -> None:
+        """
+        Called by a manager when the op it was given a slot for is done. The
+        slot goes to the longest waiting manager, if there is one.
+        """
+        with self.SchedLock:
+            if len(self.Waiting) == 0:
+                self.InFlight -= 1
+                return
+            nextmanager = self.Waiting.popleft()
+
+        self.Submit(nextmanager.doNextOp)
+
+
+class QOpConcurrencyPolicy(metaclass=abc.ABCMeta):
+    """
+    Decides how ops for different devices on one adapter may overlap.
+
+    Ops for a single device are always run one at a time, in order.
+    """
+
+    @abc.abstractmethod
+    def schedulerForDevice(self) -> QOpScheduler:
+        """
+        Return the scheduler that a new device's queue should use.
+        """
+
+
+class GlobalSerialPolicy(QOpConcurrencyPolicy):
+    """
+    One op at a time, in total, on the singleton background thread.
+
+    This is the conservative default, and the only safe choice on Android.
+    """
+
+    def __init__(self):
+        self.Scheduler = QOpScheduler()
+
+    def schedulerForDevice(self) -> QOpScheduler:
+        return self.Scheduler
+
+
+class PerDeviceSerialPolicy(QOpConcurrencyPolicy):
+    """
+    One op at a time per device, but devices run in parallel. Each device gets
+    its own background thread.
+    """
+
+    def schedulerForDevice(self) -> QOpScheduler:
+        return QOpScheduler(submit=ble.bgthreadpool.SingleThreader(name='QOpDeviceThread').submit)
+
+
+class NInFlightPolicy(QOpConcurrencyPolicy):
+    """
+    Up to "count" ops in flight across all devices on the adapter, still one
+    at a time per device.
+    """
+
+    def __init__(self, count : int):
+        if count < 1:
+            raise ValueError("NInFlightPolicy needs at least one op in flight")
+        self.Pool = ble.bgthreadpool.WorkerPool(count, name='QOpWorker')
+        self.Scheduler = QOpScheduler(submit=self.Pool.submit, maxinflight=count)
+
+    def schedulerForDevice(self) -> QOpScheduler:
+        return self.Scheduler
+
+
 class QOpManager:
     """
-    Operations (QOps)can be added to a queue, and will be executed in their own
-    thread.
+    Operations (QOps)can be added to a queue, and will be executed in the
+    background.
+
+    The manager doesn't run anything itself. When it has work and no operation
+    in flight, it asks its QOpScheduler to run doNextOp() on the background
+    thread. When that op is done, it asks again if there is more work.
+
+    The queue has one lane per QOpPriority. The highest priority lane with
+    work is served first, but a lane that has been passed over StarvationLimit
+    times in a row gets the next turn, so bulk traffic keeps moving during a
+    burst of interactive ops. Ops that have missed their deadline are failed
+    when they reach the front, and never get to the BLE stack.
 
-    doNextOp() is a blocking operation that should be called over and over,
-    probably in its own thread.
+    addLIFOOp() ops skip the lanes altogether: they wait in a queue of their
+    own that is always served first, so starvation can't put anything ahead
+    of them.
 
-    For BLE operations we'll have a singleton of this being called for all ops,
-    so that BLE operations are explicitely single threaded and running in the
+    Adding an op returns a QOpHandle that can withdraw it. Withdrawn ops are
+    just marked and skipped when they reach the front, so withdrawing is O(1).
+
+    For BLE operations each device has one of these, so that BLE operations
+    for a device are explicitely single threaded and running in the
     background.
     """
 
+    StarvationLimit = 4
+
     def __init__(self):
         Logger.debug("BLE: CREATED QOpManager")
         self.QLock = threading.RLock()
-        self.OpCount = CountingSemaphore(value=0)
-        self.OpDone = threading.Event()
-        self.OpDone.set()  # There is no outstanding operation. It is "done".
+        self.Scheduler : Optional[QOpScheduler] = None
+        self.OpInFlight = False  # True from when an op is handed to the scheduler until it is done
+        self.DispatchedTo : Optional[QOpScheduler] = None  # Scheduler holding our in-flight op
+        self.CoalesceAlways : set[Hashable] = set()  # Keys of ops that are coalesced even if not requested
+        self.Label = ''  # Names this queue in metrics. GATTClients set it to their MAC.
         self._dumpQ()
+        _Metrics.watch(self)
 
     @synchronized_with_lock("QLock")
     def _dumpQ(self):
@@ -160,7 +406,125 @@ class QOpManager:
         Probably not what you want (unless, you know, it is).
         """
         Logger.debug("BLE: _dumpQ")
-        self.Q : Deque[QOp[Any]] = collections.deque()
+        # Each lane is popped from the right. FIFO ops are added on the left.
+        self.Lanes : Dict[QOpPriority, Deque[QOp[Any]]] = { p : collections.deque() for p in QOpPriority }
+        self.PassedOver : Dict[QOpPriority, int] = { p : 0 for p in QOpPriority }
+        self.Next : Deque[QOp[Any]] = collections.deque()  # addLIFOOp() ops, popped from the right too
+        self.Coalescable : Dict[Hashable, QOp[Any]] = {}  # Queued ops that later ops can be merged into, by key
+        self.Queued = 0  # Number of queued ops, not counting withdrawn ones still sitting in a lane
+
+    def queuedCount(self) -> int:
+        return self.Queued
+
+    def _add(self, op : QOp[Any], front : bool) -> QOpHandle:
+        """
+        Put op at the back of its lane, or with front, at the front of everything. Call with QLock held.
+        """
+        op.State = QOpState.QUEUED
+        if _Metrics.Enabled:
+            op.TEnqueued = time.perf_counter()
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_QUEUED, _Trace.intern(op.name()), id(op), int(op.Priority))
+        self.Queued += 1
+        if front:
+            self.Next.append(op)
+        else:
+            self.Lanes[op.Priority].appendleft(op)
+        self._kick()
+        return QOpHandle(self, op)
+
+    @synchronized_with_lock("QLock")
+    def withdraw(self, op : QOp[Any]) -> bool:
+        """
+        Withdraw a queued op that hasn't started. See QOpHandle.cancel().
+
+        If newer ops were coalesced into it, they still want it to run with
+        their arguments, so only the withdrawing caller's callback is dropped,
+        and the op keeps its place.
+        """
+        if op.State != QOpState.QUEUED:
+            return False
+
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.OP_WITHDRAWN, _Trace.intern(op.name()), id(op))
+        if op.TEnqueued is not None:
+            _Metrics.recordOutcome(self.Label, op.name(), 'withdrawn')
+        if op.Absorbed:
+            op.Absorbed -= 1
+            op.Callback = op.MergedCallbacks.pop(0) if op.MergedCallbacks else None
+            return True
+
+        op.State = QOpState.WITHDRAWN
+        self.Queued -= 1
+        if (op.CoalesceKey is not None) and (self.Coalescable.get(op.CoalesceKey) is op):
+            del self.Coalescable[op.CoalesceKey]
+        return True
+
+    @synchronized_with_lock("QLock")
+    def setScheduler(self, scheduler : Optional[QOpScheduler]):
+        """
+        Start (or with None, stop) handing our ops to a scheduler.
+        """
+        self.Scheduler = scheduler
+        self._kick()
+
+    def _kick(self):
+        """
+        Ask the scheduler to run our next op, if we have one and nothing is in
+        flight. Call with QLock held.
+        """
+        if self.OpInFlight or (self.queuedCount() == 0) or (self.Scheduler is None):
+            return
+
+        self.OpInFlight = True
+        self.DispatchedTo = self.Scheduler
+        self.Scheduler.opReady(self)
+
+    def _chooseLane(self) -> Optional[QOpPriority]:
+        """
+        Pick the lane to serve next, and update the starvation counts. Call with QLock held.
+        """
+        waiting = [p for p in QOpPriority if len(self.Lanes[p]) > 0]
+        if len(waiting) == 0:
+            return None
+
+        starved = [p for p in waiting if self.PassedOver[p] >= self.StarvationLimit]
+        chosen = starved[0] if len(starved) > 0 else waiting[0]
+
+        for p in waiting:
+            if p == chosen:
+                self.PassedOver[p] = 0
+            else:
+                self.PassedOver[p] += 1
+
+        return chosen
+
+    def _popNext(self) -> Tuple[Optional[QOp[Any]], List[QOp[Any]]]:
+        """
+        Returns the next op to run (or None), and a list of ops that expired
+        on the way. Call with QLock held.
+        """
+        expired : List[QOp[Any]] = []
+        now = time.monotonic()
+        while True:
+            if len(self.Next) > 0:
+                op = self.Next.pop()
+            else:
+                lane = self._chooseLane()
+                if lane is None:
+                    return (None, expired)
+                op = self.Lanes[lane].pop()
+            if op.State == QOpState.WITHDRAWN:
+                continue
+
+            self.Queued -= 1
+            op.State = QOpState.STARTED
+            if (op.CoalesceKey is not None) and (self.Coalescable.get(op.CoalesceKey) is op):
+                # It's about to start, so nothing more can be merged into it
+                del self.Coalescable[op.CoalesceKey]
+            if not op.isExpired(now):
+                return (op, expired)
+            expired.append(op)
 
     @synchronized_with_lock("QLock")
     def cancelQ(self, reason : str):
@@ -172,115 +536,307 @@ class QOpManager:
         executed once the current cancelled items have all been dealt with.
         """
         Logger.debug("BLE: cancelQ() %s" % (reason,))
-        cancelleditems = self.Q
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.CANCELQ, _Trace.intern(reason))
+        cancelleditems = [op for q in [self.Next] + [self.Lanes[p] for p in QOpPriority] for op in reversed(q) if op.State == QOpState.QUEUED]
         self._dumpQ()
 
         for i in cancelleditems:
-            # Number of cancelled items will be <= OpCount.
-            # So this can't lock up
+            i.State = QOpState.STARTED
+
+        for i in cancelleditems:
             i.cancel(self, reason)
-            self.OpCount.down()
 
     @synchronized_with_lock("QLock")
-    def addFIFOOp(self, op: QOp[Any]):
+    def addFIFOOp(self, op: QOp[Any]) -> QOpHandle:
         """
-        Add an item to the back of the queue
+        Add an item to the back of the queue for its priority
+
+        If the op has a CoalesceKey, and an op with the same key and priority
+        is still waiting to start, the waiting op absorbs this one instead.
+        That means a burst of writes to one characteristic only goes out once,
+        with the last value, and every caller gets that result.
+        """
+        if op.CoalesceKey is not None:
+            queued = self.Coalescable.get(op.CoalesceKey)
+            if (queued is not None) and (queued.Priority == op.Priority):
+                queued.absorb(op)
+                if _Trace.Enabled:
+                    _Trace.record(TraceEvent.OP_MERGED, _Trace.intern(op.name()), id(queued))
+                if _Metrics.Enabled:
+                    _Metrics.recordOutcome(self.Label, op.name(), 'merged')
+                return QOpHandle(self, op)
+            self.Coalescable[op.CoalesceKey] = op
+
+        return self._add(op, False)
+
+    @synchronized_with_lock("QLock")
+    def setCoalescing(self, key : Hashable, enable : bool):
+        """
+        Always coalesce ops with the given key, even if the caller didn't ask
+        for it. See coalesce_key().
         """
-        #  Logger.debug("BLE: addFIFOOp: %s %s %s" % (self.QLock, self.OpCount._value, self.OpDone.is_set()))
-        self.Q.appendleft(op)
-        self.OpCount.up()  # Increment count of things to do
-        Logger.debug("BLE: End of addFIFIOp")
+        if enable:
+            self.CoalesceAlways.add(key)
+        else:
+            self.CoalesceAlways.discard(key)
 
     @synchronized_with_lock("QLock")
-    def addLIFOOp(self, op: QOp[Any]):
+    def addLIFOOp(self, op: QOp[Any]) -> QOpHandle:
         """
-        Add an item that will be the next thing to be executed
+        Add an item that will be the next thing to be executed, whatever its
+        priority, and however long the other lanes have been waiting.
         """
-        self.Q.append(op)
-        self.OpCount.up()  # Increment count of things to do
+        return self._add(op, True)
 
+    @synchronized_with_lock("QLock")
     def signalOpIsDone(self):
         """
         Called after the current op to signal that it is done, by the op. Don't use.
         i.e. Don't call this from a callback.
         """
-        Logger.debug("BLE: signalOpIsDone()")
-        self.OpDone.set()  # Operation is now "done"
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.SIGNAL_DONE, _Trace.intern(self.Label))
+        self._releaseSlot()
+        self._kick()
 
-    def waitUntilReady(self, timeout : Union[float, None] = None):
-        self.OpDone.wait(timeout=timeout)
+    def _releaseSlot(self):
+        """
+        Give our slot back to the scheduler. Call with QLock held.
+        """
+        self.OpInFlight = False
+        if self.DispatchedTo is not None:
+            self.DispatchedTo.opFinished(self)
+            self.DispatchedTo = None
 
     def doNextOp(self):
-        Logger.debug("BLE: doNextOp() %s %s %s" % (self.QLock, self.OpCount._value, self.OpDone.is_set()))  # type: ignore
-        self.OpDone.wait()  # Wait until any pending operation is done (set)
-        self.OpDone.clear()  # Just about to start new op. Mark it not done (ie. clear)
+        """
+        Run the next op. Called on the background thread by the scheduler.
+        """
+        if _Trace.Enabled:
+            _Trace.record(TraceEvent.DO_NEXT_OP, _Trace.intern(self.Label), 0, self.Queued)
+
+        with self.QLock:
+            op, expired = self._popNext()
+            if op is None:
+                # Queue was dumped after we were scheduled, or everything expired
+                self._releaseSlot()
 
-        Logger.debug("BLE: Sleeping on OpCount")
-        self.OpCount.down()  # Sleep until there is something to do
-        Logger.debug("BLE: Woke on OpCount")
+        for e in expired:
+            try:
+                e.expire(self)
+            except:
+                Logger.debug("Exception catchall in doNextOp while expiring")
+
+        if op is None:
+            return
 
         # do operation
         try:
-            self.Q.pop().do(manager=self)
+            op.do(manager=self)
         except:
             Logger.debug("Exception catchall in doNextOp")
 
-        Logger.debug("BLE: doNextOp() is done")
-
 
 class QOpExecutor:
     """
-    A QOpExecutor provides the threadpool for a manager.
-    
-    This was originally just a thread, but I am concerned about submitting more
-    than one task at a time to the android stack, so now this thread submits work
-    to a singleton background thread.
+    A QOpExecutor connects a manager to the scheduler that runs its ops.
+
+    This was originally a thread per device that spun submitting work to a
+    singleton background thread. Now the manager only wakes the scheduler when
+    it has work, so there is no thread per device at all.
     """
 
-    def __init__(self, qopmanager: QOpManager):
+    def __init__(self, qopmanager: QOpManager, scheduler : Optional[QOpScheduler] = None):
         self.Manager = qopmanager
-        self.TimeToExit = False
-        self.Thread = threading.Thread(name='QOpExecutorThread', daemon=True, target=self._bgLoop)
+        self.Scheduler = scheduler if scheduler is not None else QOpScheduler()
 
     def getManager(self):
         return self.Manager
 
     def shutdown(self):
+        """
+        Stop running ops. Anything still queued stays queued.
+        """
         Logger.debug("BLE: QOpExecutor shutdown()")
-        self.TimeToExit = True
-
-    def _bgLoop(self):
-        while not self.TimeToExit:
-            Logger.debug("BLE: Loop!")
-            try:
-                # Submit to our background single thread
-                self.Manager.waitUntilReady()
-                ble.bgthreadpool.submit(self.Manager.doNextOp)
-            except Exception:
-                Logger.debug("BLE: EXCEPTION: %s" % (traceback.format_exc(),))
-        Logger.debug("QOpExecutor: Exited _bgLoop")
+        self.Manager.setScheduler(None)
 
     def startBackgroundProcessing(self):
         """
-        Run our ops on our background thread.
+        Start running our ops in the background.
         """
         Logger.debug("BLE: startBackgroundProcessing()")
-        self.Thread.start()
+        self.Manager.setScheduler(self.Scheduler)
 
 
 class QOpExecutorFactory:
     """
     A class that makes a QOpManager and QOpExecutor pair.
 
-    Each BLE device gets its own thread. An executor monitors a queue of QOps
-    and executes them.
+    Each BLE device gets its own queue. How the queues made by a factory share
+    the background is decided by its QOpConcurrencyPolicy. By default, they all
+    feed the singleton background thread (GlobalSerialPolicy).
     """
 
+    def __init__(self, policy : Optional[QOpConcurrencyPolicy] = None):
+        self.Policy = policy if policy is not None else GlobalSerialPolicy()
+
     def makeExecutor(self) -> QOpExecutor:
-        qope = QOpExecutor(QOpManager())
+        qope = QOpExecutor(QOpManager(), self.Policy.schedulerForDevice())
         return qope
 
 
+class AsyncQOpHandle:
+    """
+    Returned when an op is submitted to an AsyncQOpQueue. Works like a
+    QOpHandle. Future holds the result.
+    """
+
+    def __init__(self):
+        self.StateLock = threading.Lock()
+        self.State = QOpState.QUEUED
+        self.Future : Optional[Union[concurrent.futures.Future[Any], asyncio.Future[Any]]] = None
+
+    def _start(self) -> bool:
+        with self.StateLock:
+            if self.State != QOpState.QUEUED:
+                return False
+            self.State = QOpState.STARTED
+            return True
+
+    def cancel(self) -> bool:
+        """
+        Withdraw the op if it hasn't started. Returns True if it was withdrawn.
+        """
+        with self.StateLock:
+            if self.State != QOpState.QUEUED:
+                return False
+            self.State = QOpState.WITHDRAWN
+
+        if self.Future is not None:
+            # Wakes the waiting task so it leaves the queue
+            self.Future.cancel()
+        return True
+
+    def isStarted(self) -> bool:
+        return self.State == QOpState.STARTED
+
+
+class AsyncQOpQueue:
+    """
+    An asyncio-native op queue for backends whose ops are coroutines (ie. Bleak).
+
+    The queue lives on the BLE asyncio loop (GlobalBGAsyncThread), and ops run
+    directly on that loop, one at a time per queue, in the order they were
+    submitted. There are no threads in between, so an async caller on another
+    loop costs one hop onto the BLE loop and one hop back. A caller already on
+    the BLE loop costs no hops at all.
+
+    The deadline and timeout QOp options are supported. Priorities and
+    coalescing need a QOpManager, and are ignored here.
+    """
+
+    def __init__(self, loop : Optional[asyncio.AbstractEventLoop] = None, label : str = ''):
+        self.Loop : asyncio.AbstractEventLoop = loop if loop is not None else get_BGAsyncLoop()  # type: ignore
+        self.Lock = asyncio.Lock()  # Held by the running op. Waiters queue up on it in order.
+        self.Label = label  # Names this queue in metrics
+
+    async def _run(self, handle : AsyncQOpHandle, method : Callable[..., Any], obj : Any, args : Tuple[Any, ...], kwargs : Dict[str, Any], deadline : Optional[float], enqueued : Optional[float]) -> Any:
+        async with self.Lock:
+            if not handle._start():
+                raise asyncio.CancelledError()
+            if (deadline is not None) and (time.monotonic() > deadline):
+                raise BLEOperationTimedOut("%s missed its deadline before it could be issued" % (method.__name__,))
+            if enqueued is None:
+                res = method(obj, *args, **kwargs, manager=None)
+                if inspect.isawaitable(res):
+                    res = await res
+                return res
+
+            # Delivery to the caller happens after we return, so isn't included
+            dispatched = time.perf_counter()
+            outcome = 'error'
+            try:
+                res = method(obj, *args, **kwargs, manager=None)
+                if inspect.isawaitable(res):
+                    res = await res
+                outcome = 'ok'
+                return res
+            finally:
+                completed = time.perf_counter()
+                _Metrics.recordOp(self.Label, method.__name__.lstrip('_'), enqueued, dispatched, completed, completed, outcome)
+
+    def submit(self, method : Callable[..., Any], obj : Any, args : Tuple[Any, ...], kwargs : Dict[str, Any], qopoptions : Dict[str, Any]) -> AsyncQOpHandle:
+        """
+        Queue method(obj, *args, **kwargs) from any thread.
+        """
+        handle = AsyncQOpHandle()
+        deadline = qopoptions.get('deadline')
+        if deadline is not None:
+            deadline = time.monotonic() + deadline
+        enqueued = time.perf_counter() if _Metrics.Enabled else None
+        coro = self._run(handle, method, obj, args, kwargs, deadline, enqueued)
+
+        try:
+            onourloop = asyncio.get_running_loop() is self.Loop
+        except RuntimeError:
+            onourloop = False
+
+        if onourloop:
+            handle.Future = self.Loop.create_task(coro)
+        else:
+            handle.Future = asyncio.run_coroutine_threadsafe(coro, self.Loop)
+        return handle
+
+    async def call(self, method : Callable[..., Any], obj : Any, args : Tuple[Any, ...], kwargs : Dict[str, Any], qopoptions : Dict[str, Any], timeout : float) -> Any:
+        """
+        Queue an op and await its result, from any asyncio loop.
+        """
+        handle = self.submit(method, obj, args, kwargs, qopoptions)
+        assert handle.Future is not None
+        fut = asyncio.wrap_future(handle.Future)
+        try:
+            # Shielded, so timing out withdraws a waiting op but doesn't interrupt a running one
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            raise timed_out(method, handle, timeout)
+        except asyncio.CancelledError:
+            handle.cancel()
+            raise
+
+    def callSync(self, method : Callable[..., Any], obj : Any, args : Tuple[Any, ...], kwargs : Dict[str, Any], qopoptions : Dict[str, Any], timeout : float) -> Any:
+        """
+        Queue an op and block until its result arrives. Don't call this from the BLE loop.
+        """
+        handle = self.submit(method, obj, args, kwargs, qopoptions)
+        assert isinstance(handle.Future, concurrent.futures.Future)
+        try:
+            return handle.Future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise timed_out(method, handle, timeout)
+
+    def submitWithCallback(self, method : Callable[..., Any], obj : Any, args : Tuple[Any, ...], callback : Optional[Callable[[OpResult[Any]], None]]) -> AsyncQOpHandle:
+        """
+        Queue an op, and pass its result to callback as an OpResult.
+        """
+        handle = self.submit(method, obj, args, {}, {})
+
+        def done(f : Any):
+            if f.cancelled() or not callable(callback):
+                return
+            opr : OpResult[Any] = OpResult()
+            e = f.exception()
+            if e is not None:
+                opr.setException(e)
+            else:
+                opr.setResult(f.result())
+            callback(opr)
+
+        assert handle.Future is not None
+        handle.Future.add_done_callback(done)
+        return handle
+
+
 class ContextConverter(metaclass=abc.ABCMeta):
     """
     Callbacks are called in the thread context of the BLE stack. This
@@ -352,10 +908,59 @@ AsyncFuncType = Callable[..., Coroutine[Any, Any, T]]
 #             op = QOp(method, *args, **kwargs, callback=convertedcallback)
 #             self.QOpManager.addFIFOOp(op)
 
+# Keywords that can be given to any wrapped method to control how its QOp is
+# queued, rather than being passed on. See QOp.__init__(). "coalesce" is a bool
+# that is turned into a coalescekey by make_wrapped_QOp(). "timeout" is how
+# long the wrapper waits for a result, overriding the client's QOpTimeout.
+QOP_OPTIONS = ('priority', 'deadline', 'coalesce', 'timeout')
+
+def take_QOp_options(kwargs : Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Remove the QOp queueing options from kwargs, and return them.
+    """
+    return { k : kwargs.pop(k) for k in QOP_OPTIONS if k in kwargs }
+
+def coalesce_key(actualmethod : Callable[..., Any], target : Any) -> Hashable:
+    """
+    Ops are coalesced if they run the same method on the same target, which is
+    the first argument after self. eg. _char_write on the same CHAR_UUID.
+    """
+    return (actualmethod.__name__, getattr(target, 'AsString', target))
+
+def timed_out(actualmethod : Callable[..., Any], handle : Union[QOpHandle, AsyncQOpHandle], timeout : float) -> BLEOperationTimedOut:
+    """
+    Withdraw an op that a wrapper gave up waiting for, and make the exception to raise.
+    """
+    if handle.cancel():
+        return BLEOperationTimedOut(
+            "Issued %s returned no results in %s seconds. It was withdrawn before being issued." % (actualmethod.__name__, timeout))
+    return BLEOperationTimedOut(
+        "Issued %s returned no results in %s seconds" % (actualmethod.__name__, timeout))
+
+def make_wrapped_QOp(actualmethod : Callable[..., Any], obj : Any, args : Tuple[Any, ...], kwargs : Dict[str, Any], callback : Callable[..., None], qopoptions : Dict[str, Any]) -> QOp[Any]:
+    """
+    Make the QOp for a call to a wrapped method of obj, which has a QOpExecutor.
+    """
+    manager : QOpManager = obj.QOpExecutor.Manager
+    qopoptions.pop('timeout', None)
+    coalesce = qopoptions.pop('coalesce', False)
+    if (len(args) > 0) and (coalesce or (len(manager.CoalesceAlways) > 0)):
+        key = coalesce_key(actualmethod, args[0])
+        if coalesce or (key in manager.CoalesceAlways):
+            qopoptions['coalescekey'] = key
+
+    return QOp(actualmethod, obj, *args, **kwargs, callback=callback, **qopoptions)
+
 def wrap_into_QOp(actualmethod : Callable[..., Union[Awaitable[T], T]]) -> Callable[[Callable[..., Any]], Callable[..., T]]:
     """
     Wraps an existing method into a method
     that runs on a background QOp queue
+
+    The new method also accepts the QOP_OPTIONS keywords, so callers can
+    write things like gc.char_write(uuid, data, True, priority=QOpPriority.INTERACTIVE)
+
+    If no result arrives within the timeout, the op is withdrawn from the
+    queue (if it hasn't started) and BLEOperationTimedOut is raised.
     """
 
     # def decorator(newmethod : Callable[P, None]) -> Callable[P, T]:
@@ -366,7 +971,13 @@ def wrap_into_QOp(actualmethod : Callable[..., Union[Awaitable[T], T]]) -> Calla
         @functools.wraps(wrappedmethod)  # wrappedmethod is the decorated method
         def wrappedmethodwrapper(self : Any, *args : Any, **kwargs: Any) -> T:
 
+            qopoptions = take_QOp_options(kwargs)
             wrappedmethod(self, *args, **kwargs)
+
+            native : Optional[AsyncQOpQueue] = getattr(self, 'NativeQueue', None)
+            if native is not None:
+                return native.callSync(actualmethod, self, args, {}, qopoptions, qopoptions.get('timeout', self.QOpTimeout))
+
             res : queue.SimpleQueue[OpResult[T]] = queue.SimpleQueue()
 
             # print("Wrapped", wrappedmethod.__name__)
@@ -374,15 +985,14 @@ def wrap_into_QOp(actualmethod : Callable[..., Union[Awaitable[T], T]]) -> Calla
             def cb_wrapper(opr: OpResult[T]):
                 res.put(opr, block=False)
 
-            op = QOp(actualmethod, self, *args, callback=cb_wrapper)
-            self.QOpExecutor.Manager.addFIFOOp(op)
+            timeout = qopoptions.get('timeout', self.QOpTimeout)
+            op = make_wrapped_QOp(actualmethod, self, args, {}, cb_wrapper, qopoptions)
+            handle = self.QOpExecutor.Manager.addFIFOOp(op)
 
             try:
-                r = res.get(block=True, timeout=self.QOpTimeout)
+                r = res.get(block=True, timeout=timeout)
             except Empty:
-                raise BLEOperationTimedOut(
-                    "Issued %s returned no results in %s seconds" % (actualmethod.__name__, self.QOpTimeout)
-                )
+                raise timed_out(actualmethod, handle, timeout)
 
             return r.getResult()
 
@@ -409,7 +1019,7 @@ def async_wrap_sync_into_QOp(actualmethod : Callable[..., T]) -> Callable[ [ Asy
         Then a QOP is created and passed to the background thread that runs sync operations.
         Then it waits for a result, and either times out, or returns the result.
         The result is passed back via a callback which, in a threadsafe way, pushes the result
-        back to the wrapper.
+        back to the wrapper. The calling loop isn't blocked while it waits.
     """
     def decorator(decomethod : AsyncFuncType[Optional[T]]) -> AsyncFuncType[T]:
         # print("wiQ: decorator: ", actualmethod, decomethod)
@@ -417,23 +1027,33 @@ def async_wrap_sync_into_QOp(actualmethod : Callable[..., T]) -> Callable[ [ Asy
         @functools.wraps(decomethod)  # decomethod is the decorated method
         async def decomethodwrapper(self : Any, *args : Any, **kwargs: Any) -> T:
 
+            qopoptions = take_QOp_options(kwargs)
             await decomethod(self, *args, **kwargs)
-            res : queue.SimpleQueue[OpResult[T]] = queue.SimpleQueue()
+            loop = asyncio.get_running_loop()
+            callfuture : asyncio.Future[OpResult[T]] = loop.create_future()
 
             # print("Wrapped", decomethod.__name__)
 
+            def set_result(opr: OpResult[T]) -> None:
+                if not callfuture.done():
+                    # The future is cancelled if we already gave up waiting
+                    callfuture.set_result(opr)
+
             def cb_wrapper(opr: OpResult[T]):
-                res.put(opr, block=False)
+                loop.call_soon_threadsafe(set_result, opr)
 
-            op = QOp(actualmethod, self, *args, callback=cb_wrapper)
-            self.QOpExecutor.Manager.addFIFOOp(op)
+            timeout = qopoptions.get('timeout', self.QOpTimeout)
+            op = make_wrapped_QOp(actualmethod, self, args, {}, cb_wrapper, qopoptions)
+            handle = self.QOpExecutor.Manager.addFIFOOp(op)
 
             try:
-                r = res.get(block=True, timeout=self.QOpTimeout)
-            except Empty:
-                raise BLEOperationTimedOut(
-                    "Issued %s returned no results in %s seconds" % (actualmethod.__name__, self.QOpTimeout)
-                )
+                r = await asyncio.wait_for(callfuture, timeout)
+            except asyncio.TimeoutError:
+                raise timed_out(actualmethod, handle, timeout)
+            except asyncio.CancelledError:
+                # Our caller gave up, so don't leave the op in the queue
+                handle.cancel()
+                raise
 
             return r.getResult()
 
@@ -462,13 +1082,22 @@ def async_wrap_async_into_QOp(actualmethod : AsyncFuncType[T]) -> Callable[ [Asy
         Then it waits for a result, and either times out, or returns the result.
         The result is passed back via a callback which, in a threadsafe way, pushes the result
         back to the wrapper.
+
+        If the object has a NativeQueue (an AsyncQOpQueue), the op is run on that instead.
     """
     def decorator(decomethod : AsyncFuncType[Optional[T]]) -> AsyncFuncType[T]:
 
         @functools.wraps(decomethod)  # decomethod is the decorated method
         async def decomethodwrapper(self : Any, *args : Any, **kwargs : Any) -> T:
             try:
+                qopoptions = take_QOp_options(kwargs)
                 await decomethod(self, *args, **kwargs)
+
+                native : Optional[AsyncQOpQueue] = getattr(self, 'NativeQueue', None)
+                if native is not None:
+                    # Skip the QOpManager and its threads entirely
+                    return await native.call(actualmethod, self, args, kwargs, qopoptions, qopoptions.get('timeout', self.QOpTimeout))
+
                 loop = asyncio.get_running_loop()
                 callfuture : asyncio.Future[OpResult[T]] = loop.create_future()
 
@@ -477,20 +1106,26 @@ def async_wrap_async_into_QOp(actualmethod : AsyncFuncType[T]) -> Callable[ [Asy
                 def cb_wrapper(opr: OpResult[T]) -> None:
                     # Convert the callback from the QOp to the local thread
                     async def set_result():
-                        callfuture.set_result(opr)
+                        if not callfuture.done():
+                            # The future is cancelled if we already gave up waiting
+                            callfuture.set_result(opr)
 
                     # print("cb_wrapper() thread: ", threading.current_thread().name)
                     asyncio.run_coroutine_threadsafe(set_result(), loop)
 
-                op = QOp(actualmethod, self, *args, **kwargs, callback=cb_wrapper)
-                self.QOpExecutor.Manager.addFIFOOp(op)
+                timeout = qopoptions.get('timeout', self.QOpTimeout)
+                op = make_wrapped_QOp(actualmethod, self, args, kwargs, cb_wrapper, qopoptions)
+                handle = self.QOpExecutor.Manager.addFIFOOp(op)
 
                 try:
-                    r = await asyncio.wait_for(callfuture, self.QOpTimeout)
+                    r = await asyncio.wait_for(callfuture, timeout)
                     # print("Finished waiting for future")
                 except asyncio.TimeoutError:
-                    raise BLEOperationTimedOut(
-                        "Issued %s returned no results in %s seconds" % (actualmethod.__name__, self.QOpTimeout))
+                    raise timed_out(actualmethod, handle, timeout)
+                except asyncio.CancelledError:
+                    # Our caller gave up, so don't leave the op in the queue
+                    handle.cancel()
+                    raise
 
                 return r.getResult()
             except Exception:
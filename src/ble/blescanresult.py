@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, List, Union
+from typing import Any, List, Optional, Union
 
 
 @dataclass
@@ -9,3 +9,4 @@ class BLEScanResult:
     uuids: List[str]
     device: Any  # Used by platform specific code, if it needs to store more info
     record: Any  # Used by platform specific code, if it needs to store more info
+    rssi: Optional[int] = None  # dBm, of this advertisement
@@ -1,7 +1,8 @@
 import abc
-from typing import Dict
+from typing import Dict, Optional
 
 from ble.blescanresult import BLEScanResult
+from ble.scansubscription import ScanCallback, ScanFilter, ScanMode, ScanResultIterator, ScanSubscription
 
 class I_BLEScanTool(metaclass=abc.ABCMeta):
   """
@@ -51,13 +52,14 @@ class I_BLEScanTool(metaclass=abc.ABCMeta):
     """
     Copy self.Seen to self.Previous and fill self.Seen with new entries for "duration" seconds.
 
-    Raises a BLEAlreadyScanning exception if a scan is already running.
+    Raises a BLEAlreadyScanning exception if a startScan() is already running.
+    It shares the radio with any startSharedScan()s.
     """
 
   @abc.abstractmethod
   def stopScanning(self) -> None:
     """
-    Tell the scanner to stop scanning
+    Tell the scanner to stop scanning. This ends every shared scan too.
     """
 
   @abc.abstractmethod
@@ -65,3 +67,35 @@ class I_BLEScanTool(metaclass=abc.ABCMeta):
     """
     Add an entry to the seen list.
     """
+
+  @abc.abstractmethod
+  def subscribe(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None) -> ScanSubscription:
+    """
+    Call callback with each result as soon as the backend reports it, if the
+    device is new to this scan or its name or UUIDs changed. callback(None)
+    means the scan has ended. Runs in the backend's thread, so be quick.
+
+    If scanfilter is given, only devices that match it are passed on.
+
+    Call close() on the returned subscription to stop.
+    """
+
+  @abc.abstractmethod
+  def results(self, scanfilter : Optional[ScanFilter] = None) -> ScanResultIterator:
+    """
+    The same results as subscribe(), as an async iterator that ends with the
+    scan. Call from the async loop that will iterate, before startScan().
+    """
+
+  @abc.abstractmethod
+  def startSharedScan(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None, timeout : Optional[float] = None,
+                      mode : ScanMode = ScanMode.LOW_POWER, passive : bool = False) -> ScanSubscription:
+    """
+    Scan for timeout seconds, or until the subscription is closed if timeout
+    is None. callback gets results as with subscribe(), then None at the end.
+
+    Any number of these can run at once, from one radio scan. The radio scans
+    at the highest mode any of them asks for, and stops when the last one
+    ends. passive (no scan requests, so fewer names) is only used if every
+    subscription asks for it, and only where the platform supports it.
+    """
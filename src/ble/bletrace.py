@@ -0,0 +1,215 @@
+"""
+A cheap binary trace of what the BLE layer is doing.
+
+Hot paths (running ops, taking locks, reads, writes and notifies) used to
+build debug strings for every op, with repr()s and hex dumps, even when debug
+logging was off. Now they record fixed size events into a preallocated ring
+buffer instead:
+
+    if _Trace.Enabled:
+        _Trace.record(TraceEvent.OP_DO, _Trace.intern(op.name()), id(op))
+
+Each event is 32 bytes: a time.monotonic_ns() timestamp, the event type, a
+16 bit "small" field (usually a length or status), the thread, and two 64 bit
+arguments. Strings like op names and UUIDs are interned into a table, and the
+event holds their index. Data is recorded as its length and first 8 bytes.
+
+Tracing is off unless enabled with get_BLETrace().enable() or CAFEHUB_TRACE=1.
+When it is off the cost is checking Enabled. The buffer can be read with
+toText(), or dump()ed in binary and turned back into events with decode().
+"""
+import enum
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class TraceEvent(enum.IntEnum):
+    # QOp queueing. a = op name, b = id(op)
+    OP_QUEUED = 1
+    OP_WITHDRAWN = 2
+    OP_MERGED = 3
+    OP_EXPIRED = 4
+    OP_DO = 5
+    OP_DONE = 6       # small = 1 if the op raised
+    OP_DELIVER = 7
+    OP_CANCEL = 8
+    CANCELQ = 9       # a = reason
+    SIGNAL_DONE = 10  # a = manager label
+    DO_NEXT_OP = 11   # a = manager label, small = queued count
+    LOCK_ENTER = 12   # a = method name, b = id(self)
+    LOCK_LEAVE = 13
+    SUBMIT = 14       # a = function name
+
+    # GATT. a = characteristic UUID, small = data length, b = first 8 bytes of data
+    CALL = 20         # API entry. a = method name, b = UUID index
+    CHAR_WRITE = 21
+    CHAR_READ = 22
+    CHAR_RESULT = 23
+    DESC_WRITE = 24
+    SET_NOTIFY = 25   # small = enable
+    NOTIFY = 26
+    GATT_CALLBACK = 27  # Android callback. a = callback name, b = UUID index, small = status
+    OP_CANCELLED = 28   # Backend op called with a cancel reason. a = op name
+    CACHE_HIT = 29      # A read answered from the GATTReadCache
+
+
+class TraceRecord(NamedTuple):
+    Time : int  # ns, from time.monotonic_ns()
+    Event : TraceEvent
+    Small : int
+    Thread : int
+    A : int
+    B : int
+
+
+RECORD = struct.Struct('<QHHIQQ')
+HEADER = struct.Struct('<4sHHII')  # magic, version, record size, record count, string table length
+MAGIC = b'CHTR'
+VERSION = 1
+
+# A is always an interned string. These events have one in B too.
+_STRING_B = { TraceEvent.CALL, TraceEvent.GATT_CALLBACK }
+
+
+def head(data : bytes) -> int:
+    """
+    The first 8 bytes of data as an int, for recording.
+    """
+    return int.from_bytes(bytes(data[:8]), 'little')
+
+
+class BLETrace:
+    """
+    A ring buffer of TraceRecords. There is one of these per process. See get_BLETrace().
+
+    Writers don't take a lock. Each gets its own slot from an itertools.count,
+    which is atomic in CPython.
+    """
+
+    def __init__(self, capacity : int = 16384):
+        self.Enabled = os.environ.get('CAFEHUB_TRACE', '0') not in ('', '0')
+        self.Capacity = capacity
+        self.Buffer = bytearray(RECORD.size * capacity)
+        self.StringLock = threading.Lock()
+        self.Strings : List[str] = ['']  # So A = 0 means nothing
+        self.StringIndex : Dict[str, int] = { '' : 0 }
+        self.clear()
+
+    def enable(self, enabled : bool = True) -> None:
+        self.Enabled = enabled
+
+    def clear(self) -> None:
+        self.Counter = itertools.count()
+        self.Head = 0  # Number of records written
+
+    def intern(self, s : str) -> int:
+        i = self.StringIndex.get(s)
+        if i is None:
+            with self.StringLock:
+                i = self.StringIndex.get(s)
+                if i is None:
+                    i = len(self.Strings)
+                    self.Strings.append(s)
+                    self.StringIndex[s] = i
+        return i
+
+    def record(self, event : TraceEvent, a : int = 0, b : int = 0, small : int = 0) -> None:
+        i = next(self.Counter)
+        RECORD.pack_into(self.Buffer, (i % self.Capacity) * RECORD.size,
+            time.monotonic_ns(), event, small & 0xFFFF, threading.get_ident() & 0xFFFFFFFF, a & 0xFFFFFFFFFFFFFFFF, b & 0xFFFFFFFFFFFFFFFF)
+        if i >= self.Head:
+            self.Head = i + 1
+
+    def records(self) -> List[TraceRecord]:
+        """
+        The records in the buffer, oldest first.
+        """
+        end = self.Head
+        start = max(0, end - self.Capacity)
+        result : List[TraceRecord] = []
+        for i in range(start, end):
+            t, ev, small, thread, a, b = RECORD.unpack_from(self.Buffer, (i % self.Capacity) * RECORD.size)
+            if ev == 0:
+                continue  # Slot claimed but not written yet
+            result.append(TraceRecord(t, TraceEvent(ev), small, thread, a, b))
+        return result
+
+    def dump(self) -> bytes:
+        """
+        The buffer in binary, oldest record first. See decode().
+        """
+        recs = self.records()
+        strings = json.dumps(self.Strings).encode()
+        body = b''.join(RECORD.pack(*r) for r in recs)
+        return HEADER.pack(MAGIC, VERSION, RECORD.size, len(recs), len(strings)) + body + strings
+
+    def toText(self) -> str:
+        return format_records(self.records(), self.Strings)
+
+
+def decode(dump : bytes) -> Tuple[List[TraceRecord], List[str]]:
+    """
+    Turn the output of BLETrace.dump() back into records and the string table.
+    """
+    magic, version, size, count, slen = HEADER.unpack_from(dump, 0)
+    if (magic != MAGIC) or (version != VERSION) or (size != RECORD.size):
+        raise ValueError("Not a version %d BLE trace" % (VERSION,))
+
+    offset = HEADER.size
+    recs : List[TraceRecord] = []
+    for _ in range(count):
+        t, ev, small, thread, a, b = RECORD.unpack_from(dump, offset)
+        recs.append(TraceRecord(t, TraceEvent(ev), small, thread, a, b))
+        offset += RECORD.size
+    strings = json.loads(dump[offset:offset + slen].decode())
+    return recs, strings
+
+
+def format_records(recs : List[TraceRecord], strings : List[str]) -> str:
+    def s(i : int) -> str:
+        return strings[i] if i < len(strings) else '#%d' % (i,)
+
+    if not recs:
+        return ''
+    t0 = recs[0].Time
+    lines : List[str] = []
+    for r in recs:
+        a = s(r.A)
+        b = s(r.B) if r.Event in _STRING_B else '0x%x' % (r.B,)
+        lines.append("%12.6f %08x %-14s %-40s %-24s %d" % ((r.Time - t0) / 1e9, r.Thread, r.Event.name, a, b, r.Small))
+    return '\n'.join(lines) + '\n'
+
+
+def trace_command(command : str, path : str = 'bletrace.bin') -> str:
+    """
+    Handle a trace control message, eg. from OSC. The command is "on", "off",
+    "clear" or "dump". A dump is written to path. Returns a message to show.
+    """
+    trace = get_BLETrace()
+    if command == 'on':
+        trace.enable()
+    elif command == 'off':
+        trace.enable(False)
+    elif command == 'clear':
+        trace.clear()
+    elif command == 'dump':
+        data = trace.dump()
+        with open(path, 'wb') as f:
+            f.write(data)
+        return "BLE trace: wrote %d records to %s" % (len(trace.records()), os.path.abspath(path))
+    else:
+        return "BLE trace: unknown command '%s'" % (command,)
+
+    return "BLE trace: %s" % ("on" if trace.Enabled else "off",)
+
+
+_Trace = BLETrace()
+
+
+def get_BLETrace() -> BLETrace:
+    return _Trace
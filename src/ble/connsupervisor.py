@@ -0,0 +1,142 @@
+import random
+import threading
+import traceback
+from typing import Any, Callable, Optional
+
+from kivy.logger import Logger
+
+from ble.gattclientinterface import GATTCState
+
+
+class ReconnectBackoff:
+    """
+    How long to wait before each reconnect attempt.
+
+    Exponential backoff with "full jitter": attempt n waits a random time
+    between 0 and min(maximum, initial * multiplier**n). The randomness stops a
+    device and its clients from falling into step with each other.
+    """
+
+    def __init__(self, initial : float = 0.5, maximum : float = 30.0, multiplier : float = 2.0, rng : Optional[random.Random] = None):
+        self.Initial = initial
+        self.Maximum = maximum
+        self.Multiplier = multiplier
+        self.RNG = rng if rng is not None else random.Random()
+
+    def ceiling(self, attempt : int) -> float:
+        return min(self.Maximum, self.Initial * (self.Multiplier ** min(attempt, 64)))
+
+    def delay(self, attempt : int) -> float:
+        return self.RNG.uniform(0, self.ceiling(attempt))
+
+
+class ConnectionSupervisor:
+    """
+    Reconnects a GATTClient after an unsolicited disconnect.
+
+    Sits on the GATTClient's disconnect callback. When the link drops, the drop
+    is reported to the callback as usual, then a thread tries to connect again,
+    waiting ReconnectBackoff.delay() before each attempt. Once connected, the
+    notifies that were enabled are re-armed in one go, and the callback gets a
+    single CONNECTED.
+
+    Any error while reconnecting counts as a failed attempt. If the link came
+    up but re-arming the notifies failed, the next attempt only re-arms them.
+    With maxattempts set, the supervisor gives up after that many, and reports
+    DISCONNECTED. A link it brought up but didn't report is disconnected again.
+
+    stop() ends supervision, eg. because the user asked to disconnect.
+    """
+
+    def __init__(self, gattclient : Any, callback : Optional[Callable[[GATTCState], None]], backoff : Optional[ReconnectBackoff] = None,
+                 maxattempts : Optional[int] = None):
+        self.GATTClient = gattclient
+        self.Callback = callback
+        self.Backoff = backoff if backoff is not None else ReconnectBackoff()
+        self.MaxAttempts = maxattempts
+        self.Lock = threading.Lock()
+        self.StopEvent = threading.Event()
+        self.Thread : Optional[threading.Thread] = None
+        self.Attempts = 0      # In the current outage
+        self.LinkUp = False    # We have connected in this outage, but not reported it yet
+        self.Reconnects = 0    # Successful ones, in total
+
+    def start(self) -> None:
+        self.StopEvent.clear()
+        self.GATTClient.set_disc_callback(self._on_disconnect)
+
+    def stop(self) -> None:
+        self.StopEvent.set()
+
+    def is_running(self) -> bool:
+        return not self.StopEvent.is_set()
+
+    def _report(self, state : GATTCState) -> None:
+        if self.Callback is not None:
+            try:
+                self.Callback(state)
+            except Exception:
+                Logger.debug("BLE: EXCEPTION in connection callback: %s" % (traceback.format_exc(),))
+
+    def _on_disconnect(self, state : GATTCState) -> None:
+        # Called by the GATTClient, maybe on the BLE thread, so don't block
+        self._report(state)
+        if (state != GATTCState.DISCONNECTED) or self.StopEvent.is_set():
+            return
+
+        with self.Lock:
+            if (self.Thread is not None) and self.Thread.is_alive():
+                return
+            self.Thread = threading.Thread(name="Reconnect-%s" % (self.GATTClient.MAC,), daemon=True, target=self._reconnect)
+            self.Thread.start()
+
+    def _reconnect(self) -> None:
+        try:
+            reconnected = self._try_reconnect()
+        except Exception:
+            Logger.debug("BLE: EXCEPTION in reconnect to %s: %s" % (self.GATTClient.MAC, traceback.format_exc()))
+            reconnected = False
+
+        if reconnected:
+            self.Reconnects += 1
+            Logger.debug("BLE: Reconnected to %s after %d attempts" % (self.GATTClient.MAC, self.Attempts))
+            self._report(GATTCState.CONNECTED)
+            return
+
+        gaveup = not self.StopEvent.is_set()  # Before disconnect() stops us
+        if self.LinkUp:
+            # Connected, but stopped or failed before it was reported. Don't leave it up.
+            self.LinkUp = False
+            try:
+                self.GATTClient.disconnect()
+            except Exception:
+                Logger.debug("BLE: EXCEPTION disconnecting from %s: %s" % (self.GATTClient.MAC, traceback.format_exc()))
+        if gaveup:
+            Logger.debug("BLE: Gave up reconnecting to %s after %d attempts" % (self.GATTClient.MAC, self.Attempts))
+            self._report(GATTCState.DISCONNECTED)
+
+    def _try_reconnect(self) -> bool:
+        self.Attempts = 0
+        self.LinkUp = False
+        while (self.MaxAttempts is None) or (self.Attempts < self.MaxAttempts):
+            delay = self.Backoff.delay(self.Attempts)
+            Logger.debug("BLE: Reconnecting to %s in %.2fs (attempt %d)" % (self.GATTClient.MAC, delay, self.Attempts + 1))
+            if self.StopEvent.wait(delay):
+                return False
+
+            self.Attempts += 1
+            try:
+                if not self.LinkUp:
+                    self.LinkUp = self.GATTClient.connect() == GATTCState.CONNECTED
+                if self.LinkUp:
+                    if self.StopEvent.is_set():
+                        return False
+                    self.GATTClient.restore_notifies()
+                    self.LinkUp = False
+                    return True
+            except Exception:
+                # Not only BLEExceptions: Bleak, asyncio and the OS raise their own
+                Logger.debug("BLE: Reconnect to %s failed: %s" % (self.GATTClient.MAC, traceback.format_exc()))
+                if self.LinkUp and not self.GATTClient.is_connected():
+                    self.LinkUp = False  # Dropped while restoring, so connect again
+        return False
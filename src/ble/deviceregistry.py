@@ -0,0 +1,177 @@
+import dataclasses
+import json
+import os
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from kivy.logger import Logger
+
+from ble.blescanresult import BLEScanResult
+from ble.scansubscription import ScanFilter, normalize_service_uuid
+
+
+@dataclass
+class DeviceRecord:
+    MAC : str
+    Name : Optional[str] = None
+    UUIDs : List[str] = field(default_factory=list)  # Every service UUID it has advertised
+    RSSI : Optional[float] = None  # Smoothed. See DeviceRegistry.
+    FirstSeen : float = 0.0  # time.time()
+    LastSeen : float = 0.0
+    Adverts : int = 0  # Advertisements seen
+
+
+class DeviceRegistry:
+    """
+    Everything learnt about devices from their advertisements, kept across
+    restarts so a client can find a DE1 without scanning first.
+
+    RSSI jumps around a lot from one advertisement to the next, so it is
+    smoothed with an exponentially weighted moving average:
+
+        RSSI = Alpha * new + (1 - Alpha) * RSSI
+
+    Records not seen for Expiry seconds are dropped when saving.
+
+    The scan tools save when the radio stops, but a scan can run for as long
+    as the app does, so observe() also saves every SaveInterval seconds while
+    there are changes. BLE.on_stop() saves whatever is left.
+    """
+
+    Version = 1
+
+    def __init__(self, path : Optional[str] = None, alpha : float = 0.25, expiry : float = 30 * 24 * 3600, saveinterval : float = 60.0):
+        if path is None:
+            path = os.environ.get('CAFEHUB_DEVICE_REGISTRY', os.path.join(os.path.expanduser('~'), '.cafehub', 'devices.json'))
+        self.Path = path
+        self.Alpha = alpha
+        self.Expiry = expiry
+        self.SaveInterval = saveinterval
+        self.LastSave = time.monotonic()  # Or the last time observe() asked for one
+        self.Lock = threading.Lock()
+        self.SaveLock = threading.Lock()
+        self.Devices : Dict[str, DeviceRecord] = {}
+        self.Dirty = False
+        self.load()
+
+    def observe(self, result : BLEScanResult, now : Optional[float] = None) -> DeviceRecord:
+        """
+        Record an advertisement. Called by the scan tools for every one they get.
+        """
+        if now is None:
+            now = time.time()
+        with self.Lock:
+            rec = self.Devices.get(result.MAC)
+            if rec is None:
+                rec = self.Devices[result.MAC] = DeviceRecord(result.MAC, FirstSeen=now)
+            if result.name:
+                rec.Name = result.name  # Not every advertisement has the name in it
+            for uuid in result.uuids:
+                uuid = normalize_service_uuid(uuid)
+                if uuid not in rec.UUIDs:
+                    rec.UUIDs.append(uuid)
+            if result.rssi is not None:
+                if rec.RSSI is None:
+                    rec.RSSI = float(result.rssi)
+                else:
+                    rec.RSSI = self.Alpha * result.rssi + (1.0 - self.Alpha) * rec.RSSI
+            rec.LastSeen = now
+            rec.Adverts += 1
+            self.Dirty = True
+            rec = dataclasses.replace(rec, UUIDs=list(rec.UUIDs))
+            due = time.monotonic() - self.LastSave >= self.SaveInterval
+            if due:
+                self.LastSave = time.monotonic()
+
+        if due:
+            self.saveInBackground()
+        return rec
+
+    def get(self, mac : str) -> Optional[DeviceRecord]:
+        with self.Lock:
+            rec = self.Devices.get(mac)
+            return dataclasses.replace(rec, UUIDs=list(rec.UUIDs)) if rec is not None else None
+
+    def devices(self, scanfilter : Optional[ScanFilter] = None, maxage : Optional[float] = None) -> List[DeviceRecord]:
+        """
+        Copies of the records that match scanfilter (using the smoothed RSSI),
+        and were seen in the last maxage seconds. Most recently seen first.
+        """
+        now = time.time()
+        with self.Lock:
+            recs = [dataclasses.replace(r, UUIDs=list(r.UUIDs)) for r in self.Devices.values()]
+        if maxage is not None:
+            recs = [r for r in recs if now - r.LastSeen <= maxage]
+        if scanfilter is not None:
+            recs = [r for r in recs if scanfilter.matches(r.Name, r.UUIDs, r.RSSI)]
+        recs.sort(key=lambda r: r.LastSeen, reverse=True)
+        return recs
+
+    def forget(self, mac : str) -> None:
+        with self.Lock:
+            if self.Devices.pop(mac, None) is not None:
+                self.Dirty = True
+
+    def load(self) -> None:
+        try:
+            with open(self.Path, 'r') as f:
+                entry = json.load(f)
+            if entry.get('Version') != self.Version:
+                Logger.debug("BLE: Device registry %s is version %s. Ignoring it." % (self.Path, entry.get('Version')))
+                return
+            devices = { d['MAC'] : DeviceRecord(**d) for d in entry['Devices'] }
+        except FileNotFoundError:
+            return
+        except Exception:
+            Logger.debug("BLE: Couldn't read device registry %s: %s" % (self.Path, traceback.format_exc()))
+            return
+
+        with self.Lock:
+            self.Devices = devices
+            self.Dirty = False
+
+    def save(self) -> bool:
+        """
+        Write the registry, if anything has changed. Returns True if it was written.
+        """
+        with self.SaveLock:
+            with self.Lock:
+                if not self.Dirty:
+                    return False
+                cutoff = time.time() - self.Expiry
+                self.Devices = { mac : r for mac, r in self.Devices.items() if r.LastSeen >= cutoff }
+                entry : Dict[str, Any] = { 'Version' : self.Version, 'Devices' : [dataclasses.asdict(r) for r in self.Devices.values()] }
+                self.Dirty = False
+                self.LastSave = time.monotonic()
+
+            try:
+                os.makedirs(os.path.dirname(self.Path) or '.', exist_ok=True)
+                tmppath = self.Path + '.tmp'
+                with open(tmppath, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(tmppath, self.Path)  # Atomic, so a crash can't leave half a file
+                return True
+            except Exception:
+                Logger.debug("BLE: Couldn't write device registry %s: %s" % (self.Path, traceback.format_exc()))
+                self.Dirty = True
+                return False
+
+    def saveInBackground(self) -> None:
+        """
+        save() on a thread of its own, so the BLE thread doesn't wait on the disk.
+        """
+        if self.Dirty:
+            threading.Thread(name='DeviceRegistrySave', daemon=True, target=self.save).start()
+
+
+_Registry : Optional[DeviceRegistry] = None
+
+
+def get_DeviceRegistry() -> DeviceRegistry:
+    global _Registry
+    if _Registry is None:
+        _Registry = DeviceRegistry()
+    return _Registry
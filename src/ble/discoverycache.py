@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import threading
+import traceback
+from typing import Any, Dict, List, Optional
+
+from kivy.logger import Logger
+
+# Service UUID -> list of [characteristic UUID, handle, [properties]], sorted
+AttributeTable = Dict[str, List[List[Any]]]
+
+
+def table_hash(table : AttributeTable) -> str:
+    """
+    A hash of everything in the table, so a changed attribute table is easy to spot.
+    """
+    return hashlib.sha256(json.dumps(table, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def table_uuids(table : AttributeTable) -> List[str]:
+    """
+    All the characteristic UUIDs in the table.
+    """
+    return [char[0] for chars in table.values() for char in chars]
+
+
+class DiscoveryCache:
+    """
+    Remembers the attribute table discovered for each MAC, on disk, so the
+    next connect (even from a fresh process) can use it straight away and
+    check it in the background.
+
+    Each MAC gets a JSON file holding the table and its hash.
+    """
+
+    def __init__(self, directory : Optional[str] = None):
+        if directory is None:
+            directory = os.environ.get('CAFEHUB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cafehub', 'gattcache'))
+        self.Directory = directory
+        self.Lock = threading.Lock()
+
+    def _path(self, mac : str) -> str:
+        return os.path.join(self.Directory, mac.replace(':', '').upper() + '.json')
+
+    def load(self, mac : str) -> Optional[AttributeTable]:
+        """
+        Returns the cached table for mac, or None if there isn't a good one.
+        """
+        try:
+            with self.Lock, open(self._path(mac), 'r') as f:
+                entry = json.load(f)
+            table : AttributeTable = entry['Table']
+            if table_hash(table) != entry['Hash']:
+                Logger.debug("BLE: Discovery cache for %s is corrupt. Ignoring it." % (mac,))
+                return None
+            return table
+        except FileNotFoundError:
+            return None
+        except Exception:
+            Logger.debug("BLE: Couldn't read discovery cache for %s: %s" % (mac, traceback.format_exc()))
+            return None
+
+    def store(self, mac : str, table : AttributeTable) -> bool:
+        """
+        Save table for mac, if it differs from what is cached. Returns True if it was written.
+        """
+        thash = table_hash(table)
+        path = self._path(mac)
+        try:
+            with self.Lock:
+                try:
+                    with open(path, 'r') as f:
+                        if json.load(f).get('Hash') == thash:
+                            return False
+                except (FileNotFoundError, ValueError):
+                    pass
+
+                os.makedirs(self.Directory, exist_ok=True)
+                tmppath = path + '.tmp'
+                with open(tmppath, 'w') as f:
+                    json.dump({ 'MAC' : mac, 'Hash' : thash, 'Table' : table }, f)
+                os.replace(tmppath, path)  # Atomic, so a crash can't leave half a file
+            Logger.debug("BLE: Discovery cache for %s updated (%s)" % (mac, thash[:12]))
+            return True
+        except Exception:
+            Logger.debug("BLE: Couldn't write discovery cache for %s: %s" % (mac, traceback.format_exc()))
+            return False
+
+    def storeInBackground(self, mac : str, table : AttributeTable) -> None:
+        """
+        store() on a thread of its own, so the BLE thread doesn't wait on the disk.
+        """
+        threading.Thread(name='DiscoveryCacheStore', daemon=True, target=self.store, args=(mac, table)).start()
+
+    def forget(self, mac : str) -> None:
+        with self.Lock:
+            try:
+                os.remove(self._path(mac))
+            except FileNotFoundError:
+                pass
+
+
+_Cache : Optional[DiscoveryCache] = None
+
+
+def get_DiscoveryCache() -> DiscoveryCache:
+    global _Cache
+    if _Cache is None:
+        _Cache = DiscoveryCache()
+    return _Cache
@@ -1,14 +1,18 @@
 from abc import ABC, abstractmethod
 import enum
-from typing import Callable, List, Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
 from ble.android.androidtypes import T_Context
 
-from ble.bleops import ContextConverter, OpResult, QOpManager
+from ble.bleops import AsyncQOpHandle, ContextConverter, OpResult, QOpHandle, QOpManager
+from ble.notifydispatch import NotifyOverflow
 
 from enum import Enum
 
 from ble.uuidtype import CHAR_UUID, DESC_UUID
 
+if TYPE_CHECKING:
+    from ble.connsupervisor import ReconnectBackoff  # It needs GATTCState from here
+
 class GATTCState(Enum):
     INIT = 0
     CONNECTED = 1
@@ -105,6 +109,14 @@ class GATTClientInterface(ABC):
         Write a characteristic in a background thread and return result
         """
 
+    @abstractmethod
+    async def async_set_notify(self, uuid : CHAR_UUID, enable : bool, notifycallback : Optional[Callable[[CHAR_UUID,bytes], None]]) -> None:
+        """
+        Enable/disable notifies on a characteristic, without blocking the loop.
+
+        The callback will be called, in the BLE thread, when a notification arrives.
+        """
+
     # *** Synchronous interface
 
     @abstractmethod
@@ -158,17 +170,78 @@ class GATTClientInterface(ABC):
         """
 
     @abstractmethod
-    def callback_char_read(self, uuid : CHAR_UUID, callback : Callable[ [OpResult[bytes]], None ]):
+    def callback_char_read(self, uuid : CHAR_UUID, callback : Callable[ [OpResult[bytes]], None ]) -> Union[QOpHandle, AsyncQOpHandle]:
         """
         Read a characteristic in a background thread and call back with
         an OpResult, which will contain a 'bytes' object.
+
+        Returns a handle that can withdraw the read if it hasn't started.
         """
 
     @abstractmethod
-    def callback_char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool, callback: Optional[ Callable[[OpResult[None]], None]] = None):
+    def callback_char_write(self, uuid : CHAR_UUID, data : bytes, requireresponse : bool, callback: Optional[ Callable[[OpResult[None]], None]] = None) -> Union[QOpHandle, AsyncQOpHandle]:
         """
         Write a characteristic in a background thread and call back with
         an OpResult.
+
+        Returns a handle that can withdraw the write if it hasn't started.
+        """
+
+    @abstractmethod
+    def set_write_coalescing(self, uuid : CHAR_UUID, enable : bool) -> None:
+        """
+        If enabled, a write to this characteristic that is still waiting in
+        the queue is replaced by any newer write to it. Only the last value is
+        sent, and every caller gets its result.
+
+        Individual writes can also ask for this with coalesce=True.
+        """
+
+    @abstractmethod
+    def set_read_cache(self, uuid : CHAR_UUID, ttl : Optional[float]) -> None:
+        """
+        Let char_read() and async_char_read() answer from a cache for uuid, if
+        the last value seen is under ttl seconds old. Reads and notifies update
+        the cache, and writes invalidate it. None turns it off.
+
+        A single read can also take maxstaleness=seconds, which overrides the
+        TTL. A cache hit doesn't queue an op at all.
+        """
+
+    @abstractmethod
+    def set_notify_buffering(self, uuid : CHAR_UUID, capacity : int, policy : NotifyOverflow) -> None:
+        """
+        Notifications are buffered and delivered to the callback on a thread
+        of their own, so a slow callback can't hold up the BLE stack. This sets
+        how many notifications for uuid can wait, and what happens to new ones
+        when the buffer is full. Takes effect the next time notifies are enabled.
+        """
+
+    @abstractmethod
+    def get_notify_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Returns the Received, Delivered, Dropped and Queued counts for each
+        characteristic with notifies enabled, keyed by UUID string.
+        """
+
+    @abstractmethod
+    def set_auto_reconnect(self, enable : bool, callback : Optional[Callable[[GATTCState], None]] = None, backoff : Optional['ReconnectBackoff'] = None) -> None:
+        """
+        If enabled, an unsolicited disconnect is reported to callback, and then
+        the client reconnects by itself, waiting a jittered, exponentially
+        growing time between attempts. Once connected, the notifies that were
+        enabled are restored together, and callback gets GATTCState.CONNECTED.
+
+        Replaces any callback given to set_disc_callback(). Calling disconnect()
+        stops reconnecting. If disabled, callback goes back to being a plain
+        disconnect callback.
+        """
+
+    @abstractmethod
+    def restore_notifies(self) -> None:
+        """
+        Enable every notify that was enabled before an unsolicited disconnect,
+        in one operation. The notify callbacks stay the same.
         """
 
     @abstractmethod
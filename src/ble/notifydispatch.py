@@ -0,0 +1,159 @@
+import collections
+import enum
+import threading
+import traceback
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from kivy.logger import Logger
+
+from ble.uuidtype import CHAR_UUID
+
+NotifyCallback = Callable[[CHAR_UUID, bytes], None]
+
+
+class NotifyOverflow(enum.Enum):
+    """
+    What a subscription does with a notification that arrives when its buffer is full.
+    """
+    DROP_OLDEST = enum.auto()   # Throw away the oldest queued notification to make room
+    DROP_NEWEST = enum.auto()   # Throw away the notification that just arrived
+    KEEP_LATEST = enum.auto()   # Only ever hold the most recent notification
+
+
+class NotifySubscription:
+    """
+    A bounded buffer of notifications for one characteristic, and a thread
+    that delivers them to the user's callback.
+
+    push() never blocks, so it is safe to call from the BLE thread or the
+    Bleak event loop. A slow callback only delays its own notifications.
+    """
+
+    def __init__(self, uuid : CHAR_UUID, callback : NotifyCallback, capacity : int = 64, policy : NotifyOverflow = NotifyOverflow.DROP_OLDEST):
+        if capacity < 1:
+            raise ValueError("A notify buffer needs room for at least one notification")
+
+        self.UUID = uuid
+        self.Callback = callback
+        self.Policy = policy
+        self.Capacity = 1 if policy == NotifyOverflow.KEEP_LATEST else capacity
+        self.Buffer : Deque[bytes] = collections.deque()
+        self.Cond = threading.Condition()
+        self.Running = True
+
+        # Counters. Only changed while holding Cond.
+        self.Received = 0
+        self.Delivered = 0
+        self.Dropped = 0
+
+        self.Worker = threading.Thread(name="Notify-%s" % (uuid.AsString,), daemon=True, target=self._deliver)
+        self.Worker.start()
+
+    def push(self, uuid : CHAR_UUID, data : bytes) -> None:
+        with self.Cond:
+            if not self.Running:
+                return
+            self.Received += 1
+            if len(self.Buffer) >= self.Capacity:
+                self.Dropped += 1
+                if self.Policy == NotifyOverflow.DROP_NEWEST:
+                    return
+                self.Buffer.popleft()
+            self.Buffer.append(bytes(data))
+            self.Cond.notify()
+
+    def close(self) -> None:
+        """
+        Stop delivering. Anything still in the buffer is thrown away. Doesn't
+        wait for a callback that is already running, so it won't block the BLE thread.
+        """
+        with self.Cond:
+            self.Running = False
+            self.Buffer.clear()
+            self.Cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self.Cond:
+            return {
+                'Received' : self.Received,
+                'Delivered' : self.Delivered,
+                'Dropped' : self.Dropped,
+                'Queued' : len(self.Buffer),
+            }
+
+    def _deliver(self) -> None:
+        while True:
+            with self.Cond:
+                while self.Running and not self.Buffer:
+                    self.Cond.wait()
+                if not self.Running:
+                    return
+                data = self.Buffer.popleft()
+
+            try:
+                self.Callback(self.UUID, data)
+            except Exception:
+                Logger.debug("BLE: EXCEPTION in notify callback for %s: %s" % (self.UUID.AsString, traceback.format_exc()))
+
+            with self.Cond:
+                self.Delivered += 1
+
+
+class NotifyDispatcher:
+    """
+    Sits between a GATTClient's _set_notify and the user's callbacks. Each
+    characteristic with notifies enabled gets its own NotifySubscription.
+    """
+
+    def __init__(self, capacity : int = 64, policy : NotifyOverflow = NotifyOverflow.DROP_OLDEST):
+        self.DefaultCapacity = capacity
+        self.DefaultPolicy = policy
+        self.Lock = threading.Lock()
+        self.Subscriptions : Dict[str, NotifySubscription] = {}
+        self.Settings : Dict[str, Tuple[int, NotifyOverflow]] = {}
+
+    def configure(self, uuid : CHAR_UUID, capacity : Optional[int] = None, policy : Optional[NotifyOverflow] = None) -> None:
+        """
+        Set the buffer size and overflow policy for one characteristic. Takes
+        effect the next time notifies are enabled on it.
+        """
+        with self.Lock:
+            self.Settings[uuid.AsString] = (
+                capacity if capacity is not None else self.DefaultCapacity,
+                policy if policy is not None else self.DefaultPolicy)
+
+    def subscribe(self, uuid : CHAR_UUID, callback : NotifyCallback) -> NotifyCallback:
+        """
+        Start buffering notifications for uuid. Returns the function the BLE
+        stack should call when a notification arrives.
+        """
+        with self.Lock:
+            old = self.Subscriptions.pop(uuid.AsString, None)
+            capacity, policy = self.Settings.get(uuid.AsString, (self.DefaultCapacity, self.DefaultPolicy))
+            sub = NotifySubscription(uuid, callback, capacity, policy)
+            self.Subscriptions[uuid.AsString] = sub
+
+        if old is not None:
+            old.close()
+        return sub.push
+
+    def unsubscribe(self, uuid : CHAR_UUID) -> None:
+        with self.Lock:
+            sub = self.Subscriptions.pop(uuid.AsString, None)
+        if sub is not None:
+            sub.close()
+
+    def closeAll(self) -> None:
+        with self.Lock:
+            subs = list(self.Subscriptions.values())
+            self.Subscriptions = {}
+        for sub in subs:
+            sub.close()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Counters for each active subscription, keyed by characteristic UUID string.
+        """
+        with self.Lock:
+            subs = list(self.Subscriptions.items())
+        return { uuid : sub.stats() for uuid, sub in subs }
@@ -0,0 +1,253 @@
+"""
+Latency histograms and queue gauges for QOps.
+
+Each QOp is timestamped when it is queued, when it is dispatched to the
+backend, when the backend completes it and when its callback has been called.
+The gaps between these feed a histogram per (MAC, op, stage):
+
+    queue    : enqueued -> dispatched. Time spent waiting behind other ops.
+    backend  : dispatched -> completed. Time spent in the BLE stack.
+    delivery : completed -> callback returned.
+    total    : enqueued -> callback returned.
+
+Recording is off unless enabled, either with get_QOpMetrics().enable() or by
+setting CAFEHUB_METRICS=1 in the environment. When off, the only cost on the
+hot path is checking the Enabled flag.
+
+The WebSocket servers' per-client send queues (wsserver/sendqueue.py) are
+reported here too, whether or not recording is enabled, as they keep their
+own counts.
+"""
+import json
+import os
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+STAGES = ('queue', 'backend', 'delivery', 'total')
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """
+    A log-linear histogram of microsecond values, in the style of HdrHistogram.
+
+    Values below 2**PrecisionBits get a bucket each. Above that, each power of
+    two is split into 2**(PrecisionBits-1) buckets, so a value is reported to
+    within about 3%. Recording is an index calculation and an increment.
+    """
+
+    PrecisionBits = 6
+    MaxExponent = 32  # Values above about 2**38us (76 hours) land in the top bucket
+
+    def __init__(self):
+        self.Linear = 1 << self.PrecisionBits
+        self.Half = self.Linear >> 1
+        self.Counts : List[int] = [0] * (self.Linear + self.MaxExponent * self.Half)
+        self.Count = 0
+        self.Sum = 0
+        self.Min : Optional[int] = None
+        self.Max = 0
+
+    def _index(self, value : int) -> int:
+        if value < self.Linear:
+            return value
+        exp = value.bit_length() - self.PrecisionBits
+        if exp > self.MaxExponent:
+            return len(self.Counts) - 1
+        return self.Linear + (exp - 1) * self.Half + (value >> exp) - self.Half
+
+    def _highestEquivalent(self, index : int) -> int:
+        """
+        The largest value that would be counted in bucket index.
+        """
+        if index < self.Linear:
+            return index
+        exp, sub = divmod(index - self.Linear, self.Half)
+        exp += 1
+        return ((sub + self.Half + 1) << exp) - 1
+
+    def record(self, value : int) -> None:
+        value = max(0, value)
+        self.Counts[self._index(value)] += 1
+        self.Count += 1
+        self.Sum += value
+        if (self.Min is None) or (value < self.Min):
+            self.Min = value
+        if value > self.Max:
+            self.Max = value
+
+    def percentile(self, quantile : float) -> int:
+        if self.Count == 0:
+            return 0
+        target = max(1, int(quantile * self.Count + 0.5))
+        seen = 0
+        for i, c in enumerate(self.Counts):
+            seen += c
+            if seen >= target:
+                return min(self._highestEquivalent(i), self.Max)
+        return self.Max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'count' : self.Count,
+            'sum_us' : self.Sum,
+            'min_us' : self.Min if self.Min is not None else 0,
+            'max_us' : self.Max,
+            'quantiles_us' : { str(q) : self.percentile(q) for q in QUANTILES },
+        }
+
+
+class QOpMetrics:
+    """
+    Collects QOp latencies and queue gauges. There is one of these per
+    process. See get_QOpMetrics().
+    """
+
+    def __init__(self):
+        self.Enabled = os.environ.get('CAFEHUB_METRICS', '0') not in ('', '0')
+        self.Lock = threading.Lock()
+        self.reset()
+        # Anything with a Label and queuedCount(), ie. QOpManagers. Read when metrics are collected.
+        self.Queues : 'weakref.WeakSet[Any]' = weakref.WeakSet()
+        # SendQueues, with a Label and stats(). Also read when metrics are collected.
+        self.SendQueues : 'weakref.WeakSet[Any]' = weakref.WeakSet()
+
+    def enable(self, enabled : bool = True) -> None:
+        self.Enabled = enabled
+
+    def reset(self) -> None:
+        with self.Lock:
+            self.Histograms : Dict[Tuple[str, str, str], LatencyHistogram] = {}
+            self.Outcomes : Dict[Tuple[str, str, str], int] = {}
+
+    def watch(self, queue : Any) -> None:
+        """
+        Report the depth of queue as a gauge. Only a weak reference is kept.
+        """
+        self.Queues.add(queue)
+
+    def watchSendQueue(self, queue : Any) -> None:
+        """
+        Report a WebSocket client's send queue. Only a weak reference is kept.
+        """
+        self.SendQueues.add(queue)
+
+    def _hist(self, key : Tuple[str, str, str]) -> LatencyHistogram:
+        h = self.Histograms.get(key)
+        if h is None:
+            h = self.Histograms[key] = LatencyHistogram()
+        return h
+
+    def recordOp(self, label : str, opname : str, enqueued : float, dispatched : float, completed : float, delivered : float, outcome : str) -> None:
+        """
+        Record the timestamps (from time.perf_counter()) of an op that was run.
+        """
+        times = (
+            dispatched - enqueued,
+            completed - dispatched,
+            delivered - completed,
+            delivered - enqueued,
+        )
+        with self.Lock:
+            for stage, t in zip(STAGES, times):
+                self._hist((label, opname, stage)).record(int(t * 1e6))
+            key = (label, opname, outcome)
+            self.Outcomes[key] = self.Outcomes.get(key, 0) + 1
+
+    def recordOutcome(self, label : str, opname : str, outcome : str) -> None:
+        """
+        Count an op that never ran, eg. because it expired or was withdrawn.
+        """
+        with self.Lock:
+            key = (label, opname, outcome)
+            self.Outcomes[key] = self.Outcomes.get(key, 0) + 1
+
+    def gauges(self) -> Dict[str, Dict[str, int]]:
+        result : Dict[str, Dict[str, int]] = {}
+        for q in list(self.Queues):
+            label = getattr(q, 'Label', '') or repr(q)
+            result[label] = {
+                'queued' : q.queuedCount(),
+                'in_flight' : 1 if getattr(q, 'OpInFlight', False) else 0,
+            }
+        return result
+
+    def sendQueues(self) -> Dict[str, Dict[str, Any]]:
+        return { q.Label : q.stats() for q in list(self.SendQueues) if not q.Closed }
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.Lock:
+            latencies = [
+                dict(mac=label, op=opname, stage=stage, **h.summary())
+                for (label, opname, stage), h in sorted(self.Histograms.items())]
+            outcomes = [
+                { 'mac' : label, 'op' : opname, 'outcome' : outcome, 'count' : count }
+                for (label, opname, outcome), count in sorted(self.Outcomes.items())]
+
+        return {
+            'enabled' : self.Enabled,
+            'latencies' : latencies,
+            'outcomes' : outcomes,
+            'queues' : self.gauges(),
+            'send_queues' : self.sendQueues(),
+        }
+
+    def toJSON(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def toPrometheus(self) -> str:
+        """
+        The Prometheus text exposition format.
+        """
+        snap = self.snapshot()
+        lines = [
+            '# HELP cafehub_qop_latency_seconds Time spent by QOps in each stage',
+            '# TYPE cafehub_qop_latency_seconds summary',
+        ]
+        for l in snap['latencies']:
+            labels = 'mac="%s",op="%s",stage="%s"' % (l['mac'], l['op'], l['stage'])
+            for q, v in l['quantiles_us'].items():
+                lines.append('cafehub_qop_latency_seconds{%s,quantile="%s"} %.6f' % (labels, q, v / 1e6))
+            lines.append('cafehub_qop_latency_seconds_sum{%s} %.6f' % (labels, l['sum_us'] / 1e6))
+            lines.append('cafehub_qop_latency_seconds_count{%s} %d' % (labels, l['count']))
+
+        lines.append('# HELP cafehub_qop_ops_total QOps by outcome')
+        lines.append('# TYPE cafehub_qop_ops_total counter')
+        for o in snap['outcomes']:
+            lines.append('cafehub_qop_ops_total{mac="%s",op="%s",outcome="%s"} %d' % (o['mac'], o['op'], o['outcome'], o['count']))
+
+        lines.append('# HELP cafehub_qop_queue_depth QOps waiting to run')
+        lines.append('# TYPE cafehub_qop_queue_depth gauge')
+        for label, g in sorted(snap['queues'].items()):
+            lines.append('cafehub_qop_queue_depth{mac="%s"} %d' % (label, g['queued']))
+
+        lines.append('# HELP cafehub_qop_in_flight QOps running')
+        lines.append('# TYPE cafehub_qop_in_flight gauge')
+        for label, g in sorted(snap['queues'].items()):
+            lines.append('cafehub_qop_in_flight{mac="%s"} %d' % (label, g['in_flight']))
+
+        lines.append('# HELP cafehub_ws_send_queue_depth Messages waiting to be sent to a WebSocket client')
+        lines.append('# TYPE cafehub_ws_send_queue_depth gauge')
+        for label, sq in sorted(snap['send_queues'].items()):
+            lines.append('cafehub_ws_send_queue_depth{client="%s"} %d' % (label, sq['queued']))
+
+        lines.append('# HELP cafehub_ws_send_lag_seconds How long the oldest waiting message has waited')
+        lines.append('# TYPE cafehub_ws_send_lag_seconds gauge')
+        for label, sq in sorted(snap['send_queues'].items()):
+            lines.append('cafehub_ws_send_lag_seconds{client="%s"} %.6f' % (label, sq['lag_s']))
+
+        lines.append('# HELP cafehub_ws_send_messages_total Messages for a WebSocket client, by what happened to them')
+        lines.append('# TYPE cafehub_ws_send_messages_total counter')
+        for label, sq in sorted(snap['send_queues'].items()):
+            for outcome in ('sent', 'dropped', 'merged'):
+                lines.append('cafehub_ws_send_messages_total{client="%s",outcome="%s"} %d' % (label, outcome, sq[outcome]))
+
+        return '\n'.join(lines) + '\n'
+
+
+_Metrics = QOpMetrics()
+
+
+def get_QOpMetrics() -> QOpMetrics:
+    return _Metrics
@@ -0,0 +1,100 @@
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from ble.bletrace import TraceEvent, get_BLETrace
+from ble.uuidtype import CHAR_UUID
+
+_Trace = get_BLETrace()
+
+
+class GATTReadCache:
+    """
+    Remembers the last value seen for each characteristic of one device, from
+    reads and notifications. Writes invalidate it.
+
+    A cached value is only returned if it is young enough. How young is either
+    the TTL set for the characteristic with setTTL(), or the maxstaleness of a
+    particular read. With neither, every read goes to the device.
+    """
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Values : Dict[str, Tuple[float, bytes]] = {}  # UUID -> (time.monotonic() when seen, value)
+        self.TTLs : Dict[str, float] = {}
+        self.Hits = 0
+        self.Misses = 0
+
+    def setTTL(self, uuid : CHAR_UUID, ttl : Optional[float]) -> None:
+        """
+        Seconds that a value for uuid can be served from the cache. None turns it off.
+        """
+        with self.Lock:
+            if ttl is None:
+                self.TTLs.pop(uuid.AsString, None)
+            else:
+                self.TTLs[uuid.AsString] = ttl
+
+    def get(self, uuid : CHAR_UUID, maxstaleness : Optional[float] = None) -> Optional[bytes]:
+        with self.Lock:
+            limit = maxstaleness if maxstaleness is not None else self.TTLs.get(uuid.AsString)
+            entry = self.Values.get(uuid.AsString)
+            if (limit is None) or (entry is None) or (time.monotonic() - entry[0] > limit):
+                self.Misses += 1
+                return None
+            self.Hits += 1
+            return entry[1]
+
+    def update(self, uuid : CHAR_UUID, value : bytes) -> None:
+        with self.Lock:
+            self.Values[uuid.AsString] = (time.monotonic(), bytes(value))
+
+    def invalidate(self, uuid : CHAR_UUID) -> None:
+        with self.Lock:
+            self.Values.pop(uuid.AsString, None)
+
+    def clear(self) -> None:
+        """
+        Forget all values, eg. on disconnect. TTLs are kept.
+        """
+        with self.Lock:
+            self.Values = {}
+
+    def stats(self) -> Dict[str, int]:
+        with self.Lock:
+            return { 'Hits' : self.Hits, 'Misses' : self.Misses, 'Cached' : len(self.Values) }
+
+
+def read_through_cache(method : Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Put in front of a wrapped read method, like char_read(self, uuid). The
+    method then also takes maxstaleness=seconds, and returns a young enough
+    value from self.ReadCache without queueing a QOp. Works on sync and async
+    methods.
+    """
+    def lookup(self : Any, uuid : CHAR_UUID, kwargs : Dict[str, Any]) -> Optional[bytes]:
+        value = self.ReadCache.get(uuid, kwargs.pop('maxstaleness', None))
+        if (value is not None) and _Trace.Enabled:
+            _Trace.record(TraceEvent.CACHE_HIT, _Trace.intern(uuid.AsString), 0, len(value))
+        return value
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_cached(self : Any, uuid : CHAR_UUID, *args : Any, **kwargs : Any) -> Any:
+            value = lookup(self, uuid, kwargs)
+            if value is not None:
+                return value
+            return await method(self, uuid, *args, **kwargs)
+
+        return async_cached
+
+    @functools.wraps(method)
+    def cached(self : Any, uuid : CHAR_UUID, *args : Any, **kwargs : Any) -> Any:
+        value = lookup(self, uuid, kwargs)
+        if value is not None:
+            return value
+        return method(self, uuid, *args, **kwargs)
+
+    return cached
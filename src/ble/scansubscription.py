@@ -0,0 +1,266 @@
+import asyncio
+import enum
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from kivy.logger import Logger
+
+from ble.blescanresult import BLEScanResult
+
+# Called with each new or changed result, and with None when the scan ends
+ScanCallback = Callable[[Optional[BLEScanResult]], None]
+
+
+BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+
+
+def normalize_service_uuid(uuid : str) -> str:
+    """
+    Lower case, with 16 and 32 bit UUIDs expanded using the Bluetooth base UUID.
+    """
+    uuid = uuid.lower()
+    if len(uuid) == 4:
+        return "0000" + uuid + BASE_UUID_SUFFIX
+    if len(uuid) == 8:
+        return uuid + BASE_UUID_SUFFIX
+    return uuid
+
+
+class ScanFilter:
+    """
+    Which devices a scan subscriber wants. A device matches if it advertises
+    any of ServiceUUIDs, its name starts with NamePrefix, and its RSSI is at
+    least MinRSSI. Anything left as None isn't checked.
+
+    A device with no known RSSI doesn't pass a MinRSSI check.
+    """
+
+    def __init__(self, serviceuuids : Optional[List[str]] = None, nameprefix : Optional[str] = None, minrssi : Optional[float] = None):
+        self.ServiceUUIDs = { normalize_service_uuid(u) for u in serviceuuids } if serviceuuids else None
+        self.NamePrefix = nameprefix
+        self.MinRSSI = minrssi
+
+    def matches(self, name : Optional[str], uuids : List[str], rssi : Optional[float]) -> bool:
+        if self.ServiceUUIDs is not None:
+            if not any(normalize_service_uuid(u) in self.ServiceUUIDs for u in uuids):
+                return False
+        if self.NamePrefix is not None:
+            if (name is None) or not name.startswith(self.NamePrefix):
+                return False
+        if self.MinRSSI is not None:
+            if (rssi is None) or (rssi < self.MinRSSI):
+                return False
+        return True
+
+    def matchesResult(self, result : BLEScanResult) -> bool:
+        return self.matches(result.name, result.uuids, result.rssi)
+
+
+class ScanMode(enum.IntEnum):
+    """
+    How hard to scan. Higher is more often. The values are Android's
+    ScanSettings.SCAN_MODE_* constants.
+    """
+    LOW_POWER = 0
+    BALANCED = 1
+    LOW_LATENCY = 2
+
+
+# (window, interval) in seconds, for backends that have to duty cycle the radio
+# themselves. Android's own figures. LOW_LATENCY scans all the time.
+DUTY_CYCLES : Dict[ScanMode, Optional[Tuple[float, float]]] = {
+    ScanMode.LOW_POWER : (0.512, 5.12),
+    ScanMode.BALANCED : (1.024, 4.096),
+    ScanMode.LOW_LATENCY : None,
+}
+
+
+class ScanSubscription:
+    """
+    Returned by I_BLEScanTool.subscribe() and startSharedScan(). close() stops
+    the callbacks.
+
+    Remembers what it has passed on, so each subscriber gets a device again
+    only if its name or service UUIDs change.
+
+    A subscription from startSharedScan() has a Mode, and keeps the radio
+    scanning until it is closed or its Deadline (time.monotonic()) passes.
+    One from subscribe() only listens to scans that something else started.
+    """
+
+    def __init__(self, publisher : 'ScanPublisher', callback : ScanCallback, scanfilter : Optional[ScanFilter] = None,
+                 mode : Optional[ScanMode] = None, deadline : Optional[float] = None, passive : bool = False):
+        self.Publisher = publisher
+        self.Callback = callback
+        self.Filter = scanfilter
+        self.Mode = mode
+        self.Deadline = deadline
+        self.Passive = passive
+        self.Active = True
+        self.Reported : Dict[str, Tuple[Optional[str], Tuple[str, ...]]] = {}  # Only touched by the backend's callback thread
+
+    def offer(self, result : BLEScanResult) -> bool:
+        """
+        True if result should be passed on to this subscriber.
+        """
+        if (self.Filter is not None) and not self.Filter.matchesResult(result):
+            return False
+        key = (result.name, tuple(result.uuids))
+        if self.Reported.get(result.MAC) == key:
+            return False
+        self.Reported[result.MAC] = key
+        return True
+
+    def close(self) -> None:
+        self.Publisher.unsubscribe(self)
+
+    def __enter__(self) -> 'ScanSubscription':
+        return self
+
+    def __exit__(self, *args : Any) -> None:
+        self.close()
+
+
+class ScanPublisher:
+    """
+    Used by the scan tools to push results to subscribers as the backend
+    reports them, and to work out how the radio should be scanning for
+    everyone. See radioSettings().
+
+    Callbacks run in the backend's callback thread (or on the Bleak loop), so
+    they should be quick. Handing the result to a queue is the usual thing to do.
+
+    onchange is called, from whichever thread, when a subscription that wants
+    the radio is added or closed.
+    """
+
+    def __init__(self, onchange : Optional[Callable[[], None]] = None):
+        self.Lock = threading.Lock()
+        self.Subscriptions : List[ScanSubscription] = []
+        self.OnChange = onchange
+
+    def subscribe(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None) -> ScanSubscription:
+        sub = ScanSubscription(self, callback, scanfilter)
+        self._add(sub)
+        return sub
+
+    def demand(self, callback : ScanCallback, scanfilter : Optional[ScanFilter] = None, mode : ScanMode = ScanMode.LOW_POWER,
+               timeout : Optional[float] = None, passive : bool = False) -> ScanSubscription:
+        """
+        A subscription that wants the radio on, for timeout seconds or until closed.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        sub = ScanSubscription(self, callback, scanfilter, mode, deadline, passive)
+        self._add(sub)
+        if self.OnChange is not None:
+            self.OnChange()
+        return sub
+
+    def _add(self, sub : ScanSubscription) -> None:
+        with self.Lock:
+            self.Subscriptions = self.Subscriptions + [sub]  # Copy, so publish() needn't take the lock
+
+    def _remove(self, sub : ScanSubscription) -> bool:
+        with self.Lock:
+            if not sub.Active:
+                return False
+            sub.Active = False
+            self.Subscriptions = [s for s in self.Subscriptions if s is not sub]
+            return True
+
+    def unsubscribe(self, sub : ScanSubscription) -> None:
+        if self._remove(sub) and (sub.Mode is not None) and (self.OnChange is not None):
+            self.OnChange()
+
+    def expire(self, now : float) -> Optional[float]:
+        """
+        End the subscriptions whose deadline has passed. They get None. Returns
+        the next deadline, if there is one.
+        """
+        nextdeadline : Optional[float] = None
+        for sub in self.Subscriptions:
+            if sub.Deadline is None:
+                continue
+            if sub.Deadline <= now:
+                if self._remove(sub):
+                    self._call(sub, None)
+            elif (nextdeadline is None) or (sub.Deadline < nextdeadline):
+                nextdeadline = sub.Deadline
+        return nextdeadline
+
+    def stopAll(self) -> None:
+        """
+        End every subscription that wants the radio. They get None.
+        """
+        for sub in self.Subscriptions:
+            if (sub.Mode is not None) and self._remove(sub):
+                self._call(sub, None)
+
+    def radioSettings(self) -> Optional[Tuple[ScanMode, bool]]:
+        """
+        How the radio should scan: the highest mode any subscription wants,
+        and passive only if they all want passive. None means it can stop.
+        """
+        modes = [(s.Mode, s.Passive) for s in self.Subscriptions if s.Mode is not None]
+        if not modes:
+            return None
+        return max(m for m, _ in modes), all(p for _, p in modes)
+
+    def begin(self) -> None:
+        """
+        The radio is starting. Listeners count everything as new again.
+        """
+        for sub in self.Subscriptions:
+            if sub.Mode is None:
+                sub.Reported = {}
+
+    def publish(self, result : BLEScanResult) -> None:
+        for sub in self.Subscriptions:
+            if sub.offer(result):
+                self._call(sub, result)
+
+    def finish(self) -> None:
+        """
+        The radio has stopped. Listeners get None.
+        """
+        for sub in self.Subscriptions:
+            if sub.Mode is None:
+                self._call(sub, None)
+
+    def _call(self, sub : ScanSubscription, result : Optional[BLEScanResult]) -> None:
+        try:
+            sub.Callback(result)
+        except Exception:
+            Logger.debug("BLE: EXCEPTION in scan callback: %s" % (traceback.format_exc(),))
+
+
+class ScanResultIterator:
+    """
+    An async iterator over results from tool.subscribe(), which ends with the
+    scan. It subscribes when it is made, so make it before starting the scan
+    and nothing will be missed. Must be made in the async loop that will use it.
+
+        results = ScanResultIterator(tool)
+        tool.startScan(5.0)
+        async for result in results: ...
+    """
+
+    def __init__(self, tool : Any, scanfilter : Optional[ScanFilter] = None):
+        loop = asyncio.get_running_loop()
+        self.Queue : asyncio.Queue[Optional[BLEScanResult]] = asyncio.Queue()
+        self.Subscription = tool.subscribe(lambda result: loop.call_soon_threadsafe(self.Queue.put_nowait, result), scanfilter)
+
+    def __aiter__(self) -> 'ScanResultIterator':
+        return self
+
+    async def __anext__(self) -> BLEScanResult:
+        result = await self.Queue.get()
+        if result is None:
+            self.close()
+            raise StopAsyncIteration
+        return result
+
+    def close(self) -> None:
+        self.Subscription.close()
@@ -1,15 +1,17 @@
 from random import sample, randint
 from string import ascii_letters
+import os
 import threading
 import logging
 from time import localtime, asctime, sleep
-from typing import Optional
+from typing import Any, Optional, Union
 
 from oscpy.server import OSCThreadServer
 from oscpy.client import OSCClient
 
 from kivy.logger import Logger, LOG_LEVELS
 from MsgHandler import MsgHandler
+from ble.bletrace import trace_command
 from webserver.httpserver import BackgroundThreadedHTTPServer
 
 Logger.setLevel(LOG_LEVELS["debug"])
@@ -41,6 +43,11 @@ def ping():
     )
 
 
+def trace(command : bytes = b'dump', *_ : Any):
+    'Control the BLE trace: on, off, clear or dump'
+    CLIENT.send_message(b'/message', [trace_command(command.decode()).encode('utf8')])
+
+
 def send_date():
     'send date to the application'
     CLIENT.send_message(
@@ -48,16 +55,18 @@ def send_date():
         [asctime(localtime()).encode('utf8'), ],
     )
 
+import wsserver.asyncserver
 import wsserver.server
 
 class GenericServer:
     def __init__(self):
-        self.WSServer : Optional[wsserver.server.SyncWSServer] = None
+        self.WSServer : Optional[Union[wsserver.server.SyncWSServer, wsserver.asyncserver.AsyncWSServer]] = None
         self.httpserver : Optional[BackgroundThreadedHTTPServer] = None
         self.OscServer = OSCThreadServer()
         self.OscServer.listen('localhost', port=4000, default=True)
         self.OscServer.bind(b'/ping', ping)
         self.OscServer.bind(b'/stop', self.stop)
+        self.OscServer.bind(b'/trace', trace)
 
         self.StopEvent = threading.Event()
         self.thread = threading.Thread(target=self.dateserver, daemon=True)   
@@ -66,7 +75,10 @@ class GenericServer:
         
     def start(self):
         if self.WSServer is None:
-            self.WSServer = wsserver.server.SyncWSServer(Logger)
+            if os.environ.get('CAFEHUB_ASYNC_WS', '0') not in ('', '0'):
+                self.WSServer = wsserver.asyncserver.AsyncWSServer(Logger)
+            else:
+                self.WSServer = wsserver.server.SyncWSServer(Logger)
             self.thread.start()
 
         if self.httpserver is None:
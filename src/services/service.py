@@ -13,6 +13,7 @@ from jnius import autoclass # type: ignore
 from kivy.logger import Logger, LOG_LEVELS
 
 from ble.android.androidtypes import T_BLEService, T_BluetoothDevice, T_BuildVersion, T_Context, T_Drawable, T_Intent, T_Java_String, T_Native_Invocation_Handler, T_NotificationAction, T_NotificationBuilder, T_NotificationChannel, T_NotificationManager, T_PendingIntent, T_PowerManager, T_PythonActivity, T_PythonService
+from ble.bletrace import trace_command
 from webserver.httpserver import BackgroundThreadedHTTPServer
 Logger.setLevel(LOG_LEVELS["debug"])
 
@@ -151,11 +152,16 @@ def shutdown(*args : Any):
 def show_message(oscclient: OSCClient, message : str):
     oscclient.send_message(b"/message", [message])
 
+def trace(command : bytes = b'dump', *_ : Any):
+    'Control the BLE trace: on, off, clear or dump'
+    show_message(CLIENT, trace_command(command.decode(), "/sdcard/CafeHub/bletrace.bin"))
+
 if __name__ == '__main__':
     SERVER = OSCThreadServer()
     SERVER.listen('localhost', port=4000, default=True)
     SERVER.bind(b'/ping', ping)
     SERVER.bind(b'/shutdown', shutdown)
+    SERVER.bind(b'/trace', trace)
 
     setup_service_notify(u"CafeHub is proxying BLE", "Started: " + asctime(localtime()))
 
@@ -173,8 +179,12 @@ if __name__ == '__main__':
     # disabling for now.
     # Logger.addHandler(MsgHandler(oscclient=CLIENT))
 
-    import wsserver.server
-    server = wsserver.server.SyncWSServer(Logger, PythonService.mService)
+    if os.environ.get('CAFEHUB_ASYNC_WS', '0') not in ('', '0'):
+        import wsserver.asyncserver
+        server = wsserver.asyncserver.AsyncWSServer(Logger, PythonService.mService)
+    else:
+        import wsserver.server
+        server = wsserver.server.SyncWSServer(Logger, PythonService.mService)
 
     web_path = "/sdcard/CafeHub/web"
     if not os.path.exists(web_path + "/index.html"):
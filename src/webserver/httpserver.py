@@ -15,6 +15,9 @@ import socket
 import errno
 from typing import BinaryIO, List, Optional
 
+from ble.bletrace import get_BLETrace
+from ble.qopmetrics import get_QOpMetrics
+
 StrPath = str
 
 # This file started its life as: https://gist.github.com/pankajp/280596a5dabaeeceaaaa
@@ -39,6 +42,12 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         """ Overridden to handle HTTP Range requests. """
+        route = self.path.split('?',1)[0]
+        if route in ('/metrics', '/metrics.json'):
+            return self.send_metrics(route == '/metrics.json')
+        if route in ('/trace', '/trace.bin'):
+            return self.send_trace(route == '/trace.bin')
+
         print("Handler path: %s" % (self.translate_path(self.path),))
         self.range_from, self.range_to = self._get_range_header()
         if self.range_from is None:
@@ -146,6 +155,46 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def send_metrics(self, asjson : bool):
+        """
+        Serve the QOp metrics. /metrics is in the Prometheus text format, and
+        /metrics.json has the same data as JSON.
+        """
+        metrics = get_QOpMetrics()
+        if asjson:
+            body = metrics.toJSON().encode()
+            ctype = "application/json"
+        else:
+            body = metrics.toPrometheus().encode()
+            ctype = "text/plain; version=0.0.4; charset=utf-8"
+
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_trace(self, binary : bool):
+        """
+        Serve the BLE trace buffer. /trace is readable text, and /trace.bin is
+        the binary dump that ble.bletrace.decode() reads.
+        """
+        trace = get_BLETrace()
+        if binary:
+            body = trace.dump()
+            ctype = "application/octet-stream"
+        else:
+            body = trace.toText().encode()
+            ctype = "text/plain; charset=utf-8"
+
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
     def _make_literal(self, lit : str) -> bytes:
         return lit.encode()
 
@@ -0,0 +1,610 @@
+import asyncio
+import functools
+import logging
+import traceback
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Set, TypeVar, Union
+
+from ble.ble import BLE
+from ble.bleexceptions import BLEException, UnknownException
+from ble.bleops import QOpConcurrencyPolicy, QOpExecutorFactory
+from ble.deviceregistry import get_DeviceRegistry
+from ble.scansubscription import ScanMode
+from ble.uuidtype import CHAR_UUID
+from wsserver.binframes import FRAME_TYPES, SUBPROTOCOL, BinaryFrameError, ChannelTable, FrameType, pack_notify, pack_read_result, pack_write_result, unpack_request
+from wsserver.codecs import Codec, CodecError, JSONCodec, available_codecs
+from wsserver.notifybatch import DEFAULT_BATCH_MAX, NotifyBatcher
+from wsserver.opscript import NotifyTaps, ScriptRunner
+from wsserver.sendqueue import DEFAULT_HIGH_WATER, MessageClass, SendPolicy, SendQueue, classify
+from wsserver.jsondesc import *
+from wsserver.server import NoOpConverter
+from wsserver.sessions import KeyedLocks, NotifyKey, Sessions
+from wsserver.threadtools import get_WSAsyncLoop
+from wsserver.wsprotocol import WSClosed, WSConnection, server_handshake
+
+"""
+An asyncio implementation of the WebSocket JSON BLE API.
+
+Speaks exactly the same protocol as SyncWSServer (see jsondesc.py), but every
+client and every request is a task on one asyncio loop, rather than a thread.
+Requests await the async GATTClient API, so a request waiting on the BLE
+device costs a suspended coroutine instead of a blocked thread.
+"""
+
+T = TypeVar('T')
+
+
+def async_catch_exceptions_and_send_as_JSON(oldmethod : Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[Optional[T]]]:
+    """
+    catch_exceptions_and_send_as_JSON() for coroutines. Any exception in the
+    decorated method is sent to the client as a JSON ExecutionError update.
+    """
+    @functools.wraps(oldmethod)
+    async def wrapper(self : 'AsyncWSServer', client : WSConnection, uid : int, *args : Any, **kwargs : Any):
+        try:
+            return await oldmethod(self, client, uid, *args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except BLEException as pe:
+            result = make_execution_error(uid, pe.EID, getattr(pe, 'message', repr(pe)))
+            await self.sendJSON(client, result)
+        except WSClosed:
+            pass  # Nobody to tell
+        except:
+            tb = traceback.format_exc()
+            print(tb)
+            result = make_execution_error(uid, UnknownException.EID, repr(tb))
+            await self.sendJSON(client, result)
+
+    return wrapper
+
+
+class AsyncWSServer:
+    """
+    asyncio WebSocket server. Drop in replacement for SyncWSServer.
+
+    Runs on the GlobalWSAsyncThread loop (see threadtools.py), so it doesn't
+    need Kivy's loop, and is started by the constructor, like SyncWSServer.
+    BLE callbacks (notifies, scan results, connection changes) arrive on other
+    threads, and go straight onto the client's SendQueue, which a writer task
+    for the client empties.
+
+    Like SyncWSServer, any number of clients can share the BLE devices. See sessions.py.
+
+    Unlike SyncWSServer, clients can ask for binary mode, and get notifies,
+    reads and writes as binary frames (see binframes.py), and can pick the
+    codec for the other messages with the WebSocket subprotocol (see codecs.py).
+    """
+    def __init__(self, logger : logging.Logger, androidcontext : Any = None, qoppolicy : Optional[QOpConcurrencyPolicy] = None,
+                 host : str = '0.0.0.0', port : int = 8765,
+                 highwater : int = DEFAULT_HIGH_WATER, sendpolicies : Optional[Dict[MessageClass, SendPolicy]] = None):
+        """
+        qoppolicy decides how BLE operations for different devices may overlap.
+        The default runs one operation at a time in total. See bleops.py.
+
+        port can be 0, to pick a free port. self.Port is the one in use.
+
+        highwater and sendpolicies are for the clients' send queues. See sendqueue.py.
+        """
+        self.Logger = logger
+        self.SeenDevices : set[str] = set()
+        self.BLE = BLE(QOpExecutorFactory(qoppolicy), NoOpConverter(), androidcontext = androidcontext)
+        self.Parser = WSBLEParser()
+        self.Handlers = self.makeHandlers()
+        self.BatchHandlers = self.makeBatchHandlers()
+        self.Stop = False
+        self.Loop : asyncio.AbstractEventLoop = get_WSAsyncLoop()  # type: ignore
+        self.Sessions : Sessions[WSConnection] = Sessions()
+        self.MACLocks = KeyedLocks(asyncio.Lock)  # Connection and notify changes for a MAC happen one at a time
+        self.Tasks : Dict[WSConnection, Set['asyncio.Task[Any]']] = {}  # Requests in progress, for each client
+        self.Channels = ChannelTable()
+        self.ScriptTaps = NotifyTaps()
+        self.Binary : Set[WSConnection] = set()  # Clients in binary mode
+        self.JSON = JSONCodec()
+        self.Codecs : Dict[str, Codec] = {c.Name : c for c in available_codecs()}
+        self.ClientCodecs : Dict[WSConnection, Codec] = {}  # Clients not using JSON
+        self.Batchers : Dict[WSConnection, NotifyBatcher] = {}  # Clients that have batched notifies
+        self.HighWater = highwater
+        self.SendPolicies = sendpolicies
+        self.SendQueues : Dict[WSConnection, SendQueue] = {}
+        self.Host = host
+        self.Port = port
+        self.Server : Optional[asyncio.AbstractServer] = None
+        self.run()
+
+    def run(self) -> None:
+        """
+        Start listening. Returns once the server is up.
+        """
+        asyncio.run_coroutine_threadsafe(self._start(), self.Loop).result()
+
+    async def _start(self) -> None:
+        self.Server = await asyncio.start_server(self._serveClient, self.Host, self.Port)
+        self.Port = self.Server.sockets[0].getsockname()[1]
+        self.Logger.info("AsyncWS: listening on %s:%d" % (self.Host, self.Port))
+
+    def shutdown(self) -> None:
+        self.Stop = True
+        self.BLE.on_stop()
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.Loop).result(timeout=10)
+
+    async def _shutdown(self) -> None:
+        if self.Server is not None:
+            self.Server.close()
+            await self.Server.wait_closed()
+        for client, tasks in list(self.Tasks.items()):
+            for task in list(tasks):
+                task.cancel()
+            await client.close()
+
+    async def _serveClient(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        try:
+            client = await server_handshake(reader, writer, (SUBPROTOCOL,) + tuple(self.Codecs))
+        except WSClosed:
+            return
+
+        ready = asyncio.Event()
+        queue = SendQueue("%s:%d" % client.Address, lambda: self.Loop.call_soon_threadsafe(ready.set), self.HighWater, self.SendPolicies)
+        self.SendQueues[client] = queue
+        writer = self.Loop.create_task(self._writer(client, queue, ready))
+        self.Sessions.addClient(client, client)
+        self.Tasks[client] = set()
+        if client.Subprotocol == SUBPROTOCOL:
+            self.Binary.add(client)
+        elif client.Subprotocol in self.Codecs:
+            self.ClientCodecs[client] = self.Codecs[client.Subprotocol]
+        self.Logger.debug("AsyncWS: new client: %s, subprotocol %s" % (client.Address, client.Subprotocol))
+        try:
+            while True:
+                message = await client.recv()
+                self._messageReceived(client, message)
+        except WSClosed:
+            pass
+        finally:
+            self.Logger.debug("AsyncWS: client left: %s" % (client.Address,))
+            await client.close()  # In case something other than WSClosed got us here
+            for task in list(self.Tasks.pop(client)):
+                task.cancel()
+            self.Binary.discard(client)
+            self.ClientCodecs.pop(client, None)
+            self.SendQueues.pop(client, None)
+            queue.close()
+            writer.cancel()
+            batcher = self.Batchers.pop(client, None)
+            if batcher is not None:
+                batcher.close()
+            # Let go of devices and notifies only this client was using
+            unused, unwanted = self.Sessions.removeClient(client)
+            await self.releaseNotifies([nk for nk in unwanted if nk[0] not in unused])
+            await self.releaseConnections(unused)
+
+    async def _writer(self, client : WSConnection, queue : SendQueue, ready : asyncio.Event) -> None:
+        """
+        Sends what is put on the client's queue. Waiting for a slow client
+        holds up nothing but this.
+        """
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                while True:
+                    message = queue.pop()
+                    if message is None:
+                        break
+                    await client.send(message)
+        except WSClosed:
+            self.Logger.debug("AsyncWS: client has gone")
+
+    def _spawn(self, client : WSConnection, coroutine : Coroutine[Any, Any, Any]) -> None:
+        tasks = self.Tasks.get(client)
+        if tasks is None:
+            coroutine.close()  # The client has gone
+            return
+        task = self.Loop.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def _messageReceived(self, client : WSConnection, message : Union[str, bytes]) -> None:
+        """
+        Parse a message and start a task to do what it asks. Errors in the
+        message itself are answered straight away.
+        """
+        # binframes types are all below any MessagePack or CBOR map
+        if isinstance(message, bytes) and message and (message[0] in FRAME_TYPES):
+            self._binaryReceived(client, message)
+            return
+
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug("AsyncWS: new message: %s" % (message,))
+
+        cmd : Dict[str, Any] = {}
+        result = None
+        # noinspection PyBroadException
+        try:
+            # Text is always JSON. Binary messages are in the client's codec.
+            codec = self.ClientCodecs.get(client, self.JSON) if isinstance(message, bytes) else self.JSON
+            cmd = codec.decode(message)
+            self.parseCommand(client, cmd)
+        except CodecError as de:
+            result = make_execution_error(0, UnknownException.EID, repr(de))
+        except ParseException as pe:
+            uid = cmd.get('uid', 0)
+            result = make_execution_error(uid, UnknownException.EID, getattr(pe, 'message', repr(pe)))
+        except:
+            uid = cmd.get('uid', 0)
+            tb = traceback.format_exc()
+            result = make_execution_error(uid, UnknownException.EID, repr(tb))
+
+        if result is not None:
+            self._spawn(client, self.sendJSON(client, result))
+
+    def _binaryReceived(self, client : WSConnection, frame : bytes) -> None:
+        """
+        A READ or WRITE frame. Errors are answered as JSON, with the frame's
+        id if we got that far.
+        """
+        uid = 0
+        try:
+            request = unpack_request(frame)
+            uid = request.Id
+            if client not in self.Binary:
+                raise BinaryFrameError("Binary frame, but binary mode is off")
+            mac, char = self.Channels.lookup(request.Channel)
+        except BinaryFrameError as e:
+            self._spawn(client, self.sendJSON(client, make_execution_error(uid, UnknownException.EID, str(e))))
+            return
+
+        if request.Type == FrameType.READ:
+            self._spawn(client, self.do_read_binary(client, uid, request.Channel, mac, CHAR_UUID(char)))
+        else:
+            self._spawn(client, self.do_write_binary(client, uid, request.Channel, mac, CHAR_UUID(char), request.Data, request.RequireResponse))
+
+    def makeHandlers(self) -> Dict[str, Callable[[WSConnection, int, Dict[str, Any]], Coroutine[Any, Any, Any]]]:
+        """
+        The coroutine to run for each command, once the Parser has passed it.
+        """
+        def get_devices(client : WSConnection, uid : int, params : Dict[str, Any]):
+            maxage = params['MaxAge'] / 1000.0 if 'MaxAge' in params else None
+            return self.do_get_devices(client, uid, scan_filter_from_params(params), maxage)
+
+        return {
+            'GATTWrite' : lambda client, uid, params: self.do_write(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Data'], params['RR'], qop_options_from_params(params)),
+            'GATTRead' : lambda client, uid, params: self.do_read(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Len'], read_options_from_params(params)),
+            'Scan' : lambda client, uid, params: self.do_scan(client, uid, params['Timeout'], scan_filter_from_params(params)),
+            'GetDevices' : get_devices,
+            'GATTConnect' : lambda client, uid, params: self.do_connect(client, uid, params['MAC'], params.get('AutoReconnect', False)),
+            'GATTDisconnect' : lambda client, uid, params: self.do_disconnect(client, uid, params['MAC']),
+            'GATTSetNotify' : lambda client, uid, params: self.do_set_notify(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Enable'], params.get('BatchWindow'), params.get('BatchMax')),
+            'BinaryMode' : lambda client, uid, params: self.do_binary_mode(client, uid, params['Enable']),
+            'OpenChannel' : lambda client, uid, params: self.do_open_channel(client, uid, params['MAC'], params['Char']),
+            'Batch' : lambda client, uid, params: self.do_batch(client, uid, params['MAC'], params['Items'], params.get('StopOnError', True)),
+            'RunScript' : lambda client, uid, params: self.do_run_script(client, uid, params['MAC'], params['Steps'], params.get('Timeout', DEFAULT_SCRIPT_TIMEOUT), params.get('Progress', True)),
+        }
+
+    def makeBatchHandlers(self) -> Dict[str, Callable[[WSConnection, str, Dict[str, Any]], Awaitable[Dict[str, Any]]]]:
+        """
+        See SyncWSServer.makeBatchHandlers().
+        """
+        async def read(client : WSConnection, mac : str, params : Dict[str, Any]) -> Dict[str, Any]:
+            res = await self.BLE.getGATTClient(mac).async_char_read(CHAR_UUID(params['Char']), **read_options_from_params(params))
+            return {'Data' : bytes(res)}
+
+        async def write(client : WSConnection, mac : str, params : Dict[str, Any]) -> Dict[str, Any]:
+            await self.BLE.getGATTClient(mac).async_char_write(CHAR_UUID(params['Char']), data_from_param(params['Data']), params['RR'], **qop_options_from_params(params))
+            return {}
+
+        def set_notify(client : WSConnection, mac : str, params : Dict[str, Any]) -> Awaitable[Dict[str, Any]]:
+            return self.setNotify(client, mac, CHAR_UUID(params['Char']), params['Enable'], params.get('BatchWindow'), params.get('BatchMax'))
+
+        return {'GATTRead' : read, 'GATTWrite' : write, 'GATTSetNotify' : set_notify}
+
+    def parseCommand(self, client : WSConnection, cmd : Dict[str, Any]) -> Dict[str, Any]:
+        cmd = self.Parser.parse_obj(cmd)
+        if cmd['type'] == 'REQ':
+            self._spawn(client, self.Handlers[cmd['command']](client, cmd['id'], cmd['params']))
+        return cmd
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_scan(self, client : WSConnection, uid : int, timeout : float, scanfilter : Optional[ScanFilter] = None):
+        """
+        Scan for timeout seconds. Results are passed on as soon as the scan tool reports them.
+        If there is a scanfilter, only matching devices are passed on.
+        """
+        self.SeenDevices = set()
+        st = self.BLE.getBLEScanTool()
+        if st is not None:
+            # The scan tool calls back on the BLE thread, so hand the results to this loop
+            results : asyncio.Queue[Optional[BLEScanResult]] = asyncio.Queue()
+            with st.startSharedScan(lambda item: self.Loop.call_soon_threadsafe(results.put_nowait, item), scanfilter, timeout, ScanMode.LOW_LATENCY):
+                while True:
+                    try:
+                        # None means the scan is over. The timeout is in case the backend never says so.
+                        item = await asyncio.wait_for(results.get(), timeout + 5.0)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        break
+
+                    self.SeenDevices.add(item.MAC)
+                    self.Logger.info("Seen: %s" % (item,))
+                    await self.sendJSON(client, make_update_from_blescanresult(uid, item))
+
+        stopresult = BLEScanResult("", "", [], None, None)
+        await self.sendJSON(client, make_update_from_blescanresult(uid, stopresult))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_get_devices(self, client : WSConnection, uid : int, scanfilter : Optional[ScanFilter], maxage : Optional[float]) -> None:
+        """
+        Send what the device registry knows, without scanning.
+        """
+        records = get_DeviceRegistry().devices(scanfilter, maxage)
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, make_devices_from_records(records)))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_connect(self, client : WSConnection, uid : int, mac : str, autoreconnect : bool = False):
+        """
+        Connect to GATT Client. See SyncWSServer.do_connect().
+        """
+        gc = self.BLE.getGATTClient(mac)
+
+        def disc_callback(cstate : GATTCState):
+            for c, cuid in self.Sessions.connectionClients(mac):
+                self.sendJSONThreadsafe(c, make_ConnectionState(cuid, mac, cstate, []))
+
+        def supervised_callback(cstate : GATTCState):
+            uuids = gc.getCharacteristicsUUIDs() if cstate == GATTCState.CONNECTED else []
+            self.sendJSONToAllThreadsafe([c for c, _ in self.Sessions.connectionClients(mac)], make_ConnectionState(0, mac, cstate, uuids))
+
+        async with self.MACLocks.get(mac):
+            self.Sessions.addConnection(mac, client, uid)
+            if gc.is_connected():
+                result = GATTCState.CONNECTED
+            else:
+                if autoreconnect:
+                    gc.set_auto_reconnect(True, supervised_callback)
+                else:
+                    gc.set_auto_reconnect(False, disc_callback)
+
+                try:
+                    result = await gc.async_connect()
+                except BaseException:
+                    self.Sessions.removeConnection(mac, client)
+                    raise
+        await self.sendJSON(client, make_ConnectionState(uid, mac, result, gc.getCharacteristicsUUIDs()))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_set_notify(self, client : WSConnection, uid : int, mac : str, uuid : CHAR_UUID, enable : bool,
+                            batchwindow : Optional[int] = None, batchmax : Optional[int] = None) -> None:
+        results = await self.setNotify(client, mac, uuid, enable, batchwindow, batchmax)
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, results))
+
+    async def setNotify(self, client : WSConnection, mac : str, uuid : CHAR_UUID, enable : bool,
+                        batchwindow : Optional[int] = None, batchmax : Optional[int] = None) -> Dict[str, Any]:
+        """
+        See SyncWSServer.setNotify(). Binary mode clients get NOTIFY frames
+        straight away, whatever batchwindow is, and the results hold their Channel.
+        """
+        char = uuid.AsString
+        channel = self.Channels.open(mac, char)
+
+        def sendcallback(characteristic : CHAR_UUID, data : bytes):
+            self.ScriptTaps.feed(mac, char, data)
+            clients = self.Sessions.notifyClients(mac, char)
+            binary = [c for c in clients if c in self.Binary]
+            if binary:
+                frame = pack_notify(channel, bytes(data))
+                for c in binary:
+                    self._queue(c, frame, MessageClass.NOTIFY, (mac, char))
+            direct = []
+            for c in clients:
+                if c in self.Binary:
+                    continue
+                batcher = self.Batchers.get(c)
+                if (batcher is not None) and batcher.wants((mac, char)):
+                    batcher.add(mac, char, data)
+                else:
+                    direct.append(c)
+            if direct:
+                self.sendJSONToAllThreadsafe(direct, make_GATTNotify(mac, characteristic.AsString, data))
+
+        gc = self.BLE.getGATTClient(mac)
+        async with self.MACLocks.get(mac):
+            if enable:
+                if self.Sessions.addNotify(mac, char, client):
+                    try:
+                        await gc.async_set_notify(uuid, True, sendcallback)
+                    except BaseException:
+                        self.Sessions.removeNotify(mac, char, client)
+                        raise
+            else:
+                if self.Sessions.removeNotify(mac, char, client):
+                    await gc.async_set_notify(uuid, False, None)
+
+        if enable and batchwindow:
+            self.getBatcher(client).configure((mac, char), batchwindow, batchmax or DEFAULT_BATCH_MAX)
+        elif client in self.Batchers:
+            self.Batchers[client].flushNow()
+            self.Batchers[client].unconfigure((mac, char))
+        return {'Channel' : channel} if client in self.Binary else {}
+
+    def getBatcher(self, client : WSConnection) -> NotifyBatcher:
+        # Only called on our loop, so no lock needed
+        batcher = self.Batchers.get(client)
+        if batcher is None:
+            batcher = NotifyBatcher(lambda items: self.sendJSONToAllThreadsafe([client], make_GATTNotifyBatch(items)),
+                                    lambda delay, fn: self.Loop.call_soon_threadsafe(self.Loop.call_later, delay, fn))
+            self.Batchers[client] = batcher
+        return batcher
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_binary_mode(self, client : WSConnection, uid : int, enable : bool) -> None:
+        if enable:
+            self.Binary.add(client)
+        else:
+            self.Binary.discard(client)
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {'Enabled' : enable}))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_open_channel(self, client : WSConnection, uid : int, mac : str, char : str) -> None:
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {'Channel' : self.Channels.open(mac, char)}))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_disconnect(self, client : WSConnection, uid : int, mac : str) -> None:
+        """
+        Disconnect GATT Client, if no other client is using it. Either way,
+        this client is done with it.
+        """
+        gc = self.BLE.getGATTClient(mac)
+        async with self.MACLocks.get(mac):
+            last, unwanted = self.Sessions.removeConnection(mac, client)
+            if last:
+                result = await gc.async_disconnect()
+            else:
+                await self._disableNotifies(unwanted)
+                result = GATTCState.DISCONNECTED
+        await self.sendJSON(client, make_ConnectionState(uid, mac, result, []))
+
+    async def releaseNotifies(self, notifies : List[NotifyKey]) -> None:
+        """
+        Disable notifies nobody wants any more.
+        """
+        for nk in notifies:
+            async with self.MACLocks.get(nk[0]):
+                await self._disableNotifies([nk])
+
+    async def _disableNotifies(self, notifies : List[NotifyKey]) -> None:
+        # The caller holds the MAC's lock. asyncio.Lock isn't reentrant.
+        for mac, char in notifies:
+            gc = self.BLE.getGATTClient(mac)
+            try:
+                if gc.is_connected():
+                    await gc.async_set_notify(CHAR_UUID(char), False, None)
+            except BLEException:
+                self.Logger.debug("AsyncWS: Couldn't disable notify %s on %s: %s" % (char, mac, traceback.format_exc()))
+
+    async def releaseConnections(self, macs : List[str]) -> None:
+        """
+        Disconnect devices nobody is using any more.
+        """
+        for mac in macs:
+            async with self.MACLocks.get(mac):
+                gc = self.BLE.getGATTClient(mac)
+                try:
+                    if gc.is_connected():
+                        await gc.async_disconnect()
+                except BLEException:
+                    # We really can't do anything if a disconnect fails
+                    self.Logger.debug("AsyncWS: Couldn't disconnect %s: %s" % (mac, traceback.format_exc()))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_read(self, client : WSConnection, uid : int, mac : str, char : CHAR_UUID, rlen : int, qopoptions : Dict[str, Any]) -> None:
+        """
+        Read 'rlen' bytes from 'mac' characteristic 'char'.
+        """
+        gc = self.BLE.getGATTClient(mac)
+        res = await gc.async_char_read(char, **qopoptions)
+        # "Data:" is what SyncWSServer sends, and clients expect it
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {"Data:" : bytes(res)}))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_write(self, client : WSConnection, uid : int, mac : str, char : CHAR_UUID, wdata : bytes, requireresponse : bool, qopoptions : Dict[str, Any]):
+        """
+        Write 'wdata' to 'mac' characteristic 'char'.
+        """
+        gc = self.BLE.getGATTClient(mac)
+        await gc.async_char_write(char, data_from_param(wdata), requireresponse, **qopoptions)
+        await self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {}))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_batch(self, client : WSConnection, uid : int, mac : str, items : List[Dict[str, Any]], stoponerror : bool) -> None:
+        """
+        Run a Batch's items one after another, in this one task.
+        """
+        results = []
+        for item in items:
+            try:
+                res = await self.BatchHandlers[item['command']](client, mac, item['params'])
+                results.append(make_batch_result(make_error(0, ''), res))
+                continue
+            except BLEException as pe:
+                error = make_error(pe.EID, getattr(pe, 'message', repr(pe)))
+            except Exception as e:
+                self.Logger.debug("AsyncWS: EXCEPTION in batch item: %s" % (traceback.format_exc(),))
+                error = make_error(UnknownException.EID, repr(e))
+            results.append(make_batch_result(error, {}))
+            if stoponerror:
+                break
+        await self.sendJSON(client, make_resp(uid, make_error(0, ''), {'Results' : results}))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_run_script(self, client : WSConnection, uid : int, mac : str, steps : List[Dict[str, Any]], timeout : int, progress : bool) -> None:
+        """
+        Run a script in this task. It is cancelled with the client's other tasks if the client goes.
+        """
+        def sendprogress(step : int, op : str, data : Optional[bytes]):
+            self.sendJSONThreadsafe(client, make_ScriptProgress(uid, step, op, data))
+
+        runner = ScriptRunner(self.BLE.getGATTClient(mac), mac, steps, self.ScriptTaps,
+                              lambda uuid, enable: self.setNotify(client, mac, uuid, enable), sendprogress if progress else None)
+        results = await runner.run(timeout / 1000.0)
+        await self.sendJSON(client, make_resp(uid, make_error(0, ''), results))
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_read_binary(self, client : WSConnection, uid : int, channel : int, mac : str, char : CHAR_UUID) -> None:
+        """
+        A READ frame. The whole value comes back in a READ_RESULT frame.
+        """
+        gc = self.BLE.getGATTClient(mac)
+        res = await gc.async_char_read(char)
+        self._queue(client, pack_read_result(channel, uid, bytes(res)), MessageClass.RESPONSE)
+
+    @async_catch_exceptions_and_send_as_JSON
+    async def do_write_binary(self, client : WSConnection, uid : int, channel : int, mac : str, char : CHAR_UUID, wdata : bytes, requireresponse : bool) -> None:
+        """
+        A WRITE frame. Answered with a WRITE_RESULT frame once written.
+        """
+        gc = self.BLE.getGATTClient(mac)
+        await gc.async_char_write(char, wdata, requireresponse)
+        self._queue(client, pack_write_result(channel, uid), MessageClass.RESPONSE)
+
+    async def sendJSON(self, client : WSConnection, ob : Dict[str, Any]) -> None:
+        """
+        Internal. Queue message for the client, in its codec.
+        """
+        self.sendJSONToAllThreadsafe([client], ob)
+
+    def sendJSONThreadsafe(self, client : WSConnection, ob : Dict[str, Any]) -> None:
+        """
+        sendJSON() from another thread, eg. a BLE callback.
+        """
+        self.sendJSONToAllThreadsafe([client], ob)
+
+    def sendJSONToAllThreadsafe(self, clients : List[WSConnection], ob : Dict[str, Any]) -> None:
+        """
+        Queue a message for each of clients, from any thread. It is only
+        encoded once for each codec in use. Doesn't wait, and messages are
+        sent in the order this is called.
+        """
+        msgclass, key = classify(ob)
+        bycodec : Dict[Codec, List[WSConnection]] = {}
+        for client in clients:
+            bycodec.setdefault(self.ClientCodecs.get(client, self.JSON), []).append(client)
+        for codec, group in bycodec.items():
+            result = codec.encode(ob)
+            if self.Logger.isEnabledFor(logging.DEBUG):
+                self.Logger.debug("AsyncWS: >>> %d clients: %s" % (len(group), result))
+            for client in group:
+                self._queue(client, result, msgclass, key)
+
+        if (ob['type'] == "UPDATE") and (ob['update'] == "ExecutionError"):
+            self.Logger.debug("AsyncWS: Error: %s" % (ob['results']['errmsg'],))
+
+    def _queue(self, client : WSConnection, message : Union[str, bytes], msgclass : MessageClass, key : Any = None) -> None:
+        queue = self.SendQueues.get(client)
+        if queue is not None:  # Otherwise the client has gone
+            queue.put(message, msgclass, key)
+
+    def sendQueueStats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Depth, lag and drop counts of each client's send queue.
+        """
+        return { q.Label : q.stats() for q in list(self.SendQueues.values()) }
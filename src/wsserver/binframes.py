@@ -0,0 +1,156 @@
+"""
+Binary WebSocket frames for GATT data. See "Binary mode" in jsondesc.py.
+
+A GATTNotify as JSON is a couple of hundred bytes of text, mostly base64 and
+field names, for a 19 byte shot sample. As a binary frame it is the data and
+3 bytes of header. Each (MAC, characteristic) gets a 16 bit channel ID, which
+the client learns with OpenChannel (or from a GATTSetNotify response), and
+binary frames just carry that.
+
+All numbers are big endian:
+
+    NOTIFY        server -> client   type, channel, data
+    WRITE         client -> server   type, channel, id (U32), flags, data
+    READ          client -> server   type, channel, id (U32)
+    READ_RESULT   server -> client   type, channel, id (U32), data
+    WRITE_RESULT  server -> client   type, channel, id (U32)
+
+type is one byte and channel two. Bit 0 of a WRITE's flags asks for a write
+with response. Errors still come back as JSON ExecutionError updates with the
+request id.
+"""
+import enum
+import struct
+import threading
+from typing import Dict, Optional, Tuple
+
+from wsserver.jsondesc import MAX_ATTRIBUTE_LEN
+
+SUBPROTOCOL = "cafehub.binary.v1"
+
+
+class FrameType(enum.IntEnum):
+    NOTIFY = 1
+    WRITE = 2
+    READ = 3
+    READ_RESULT = 4
+    WRITE_RESULT = 5
+
+
+FRAME_TYPES = frozenset(int(t) for t in FrameType)
+
+FLAG_REQUIRE_RESPONSE = 0x01
+
+HEADER = struct.Struct('!BH')       # type, channel
+REQUEST = struct.Struct('!BHI')     # type, channel, id
+WRITE = struct.Struct('!BHIB')      # type, channel, id, flags
+
+
+class BinaryFrameError(Exception):
+    pass
+
+
+class BinaryRequest:
+    """
+    A READ or WRITE frame from a client.
+    """
+    __slots__ = ('Type', 'Channel', 'Id', 'RequireResponse', 'Data')
+
+    def __init__(self, ftype : FrameType, channel : int, rid : int, requireresponse : bool = False, data : bytes = b''):
+        self.Type = ftype
+        self.Channel = channel
+        self.Id = rid
+        self.RequireResponse = requireresponse
+        self.Data = data
+
+
+def pack_notify(channel : int, data : bytes) -> bytes:
+    return HEADER.pack(FrameType.NOTIFY, channel) + data
+
+
+def pack_read_result(channel : int, rid : int, data : bytes) -> bytes:
+    return REQUEST.pack(FrameType.READ_RESULT, channel, rid) + data
+
+
+def pack_write_result(channel : int, rid : int) -> bytes:
+    return REQUEST.pack(FrameType.WRITE_RESULT, channel, rid)
+
+
+def pack_write(channel : int, rid : int, data : bytes, requireresponse : bool) -> bytes:
+    return WRITE.pack(FrameType.WRITE, channel, rid, FLAG_REQUIRE_RESPONSE if requireresponse else 0) + data
+
+
+def pack_read(channel : int, rid : int) -> bytes:
+    return REQUEST.pack(FrameType.READ, channel, rid)
+
+
+def unpack_request(frame : bytes) -> BinaryRequest:
+    """
+    Parse a frame from a client. Raises BinaryFrameError if it isn't a READ
+    or WRITE, or is too short, or writes more than MAX_ATTRIBUTE_LEN bytes.
+    """
+    if len(frame) < 1:
+        raise BinaryFrameError("Empty binary frame")
+    ftype = frame[0]
+    if ftype == FrameType.READ:
+        if len(frame) != REQUEST.size:
+            raise BinaryFrameError("READ frame is %d bytes, not %d" % (len(frame), REQUEST.size))
+        _, channel, rid = REQUEST.unpack(frame)
+        return BinaryRequest(FrameType.READ, channel, rid)
+    if ftype == FrameType.WRITE:
+        if len(frame) < WRITE.size:
+            raise BinaryFrameError("WRITE frame is too short")
+        if len(frame) - WRITE.size > MAX_ATTRIBUTE_LEN:
+            raise BinaryFrameError("WRITE frame has %d bytes of data, more than %d" % (len(frame) - WRITE.size, MAX_ATTRIBUTE_LEN))
+        _, channel, rid, flags = WRITE.unpack_from(frame)
+        return BinaryRequest(FrameType.WRITE, channel, rid, bool(flags & FLAG_REQUIRE_RESPONSE), bytes(frame[WRITE.size:]))
+    raise BinaryFrameError("Unknown binary frame type %d" % (ftype,))
+
+
+def unpack_reply(frame : bytes) -> Tuple[FrameType, int, Optional[int], bytes]:
+    """
+    Parse a frame from the server: (type, channel, id, data). id is None for a NOTIFY.
+    """
+    ftype = FrameType(frame[0])
+    if ftype == FrameType.NOTIFY:
+        _, channel = HEADER.unpack_from(frame)
+        return ftype, channel, None, bytes(frame[HEADER.size:])
+    _, channel, rid = REQUEST.unpack_from(frame)
+    return ftype, channel, rid, bytes(frame[REQUEST.size:])
+
+
+class ChannelTable:
+    """
+    Hands out channel IDs for (MAC, characteristic UUID). IDs are shared by
+    every client and never reused, so a notification's frame can be built
+    once for all of them. 0 isn't used.
+    """
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.ByKey : Dict[Tuple[str, str], int] = {}
+        self.ByChannel : Dict[int, Tuple[str, str]] = {}
+
+    def open(self, mac : str, char : str) -> int:
+        key = (mac, char)
+        channel = self.ByKey.get(key)
+        if channel is not None:
+            return channel
+        with self.Lock:
+            channel = self.ByKey.get(key)
+            if channel is None:
+                channel = len(self.ByChannel) + 1
+                if channel > 0xFFFF:
+                    raise BinaryFrameError("Out of channels")
+                self.ByChannel[channel] = key
+                self.ByKey[key] = channel
+            return channel
+
+    def lookup(self, channel : int) -> Tuple[str, str]:
+        """
+        The (MAC, characteristic UUID) for channel. Raises BinaryFrameError if it hasn't been opened.
+        """
+        try:
+            return self.ByChannel[channel]
+        except KeyError:
+            raise BinaryFrameError("Channel %d hasn't been opened" % (channel,))
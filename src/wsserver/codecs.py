@@ -0,0 +1,126 @@
+"""
+How messages are turned into WebSocket frames and back.
+
+The make_* builders in jsondesc.py give plain dicts, lists, strings, numbers
+and bytes. A codec turns those into a message, and back again:
+
+    JSONCodec     text frames. bytes go as base64 strings, as jsondesc.py
+                  describes. What every client gets unless it asks.
+    MsgPackCodec  binary frames, bytes go as bytes. Needs msgpack.
+    CBORCodec     binary frames, bytes go as bytes. Needs cbor2.
+
+msgpack and cbor2 are optional. available_codecs() only lists the codecs
+that can be used here.
+
+A client picks its codec with the WebSocket subprotocol (the codec's Name)
+when it connects. Only AsyncWSServer can do that; SyncWSServer always uses
+JSONCodec.
+"""
+import abc
+import base64
+import json
+from typing import Any, Dict, List, Union
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2  # type: ignore
+except ImportError:
+    cbor2 = None
+
+
+class CodecError(Exception):
+    """
+    A message couldn't be decoded.
+    """
+
+
+class Codec(metaclass=abc.ABCMeta):
+    Name = ""  # Also the WebSocket subprotocol that asks for it
+    Binary = False  # Messages are bytes rather than str
+
+    @abc.abstractmethod
+    def encode(self, ob : Dict[str, Any]) -> Union[str, bytes]:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, message : Union[str, bytes]) -> Dict[str, Any]:
+        """
+        Raises CodecError if message can't be decoded, or isn't an object.
+        """
+        pass
+
+
+def _json_default(ob : Any) -> Any:
+    if isinstance(ob, (bytes, bytearray, memoryview)):
+        return base64.standard_b64encode(ob).decode('ascii')
+    raise TypeError("Can't turn %s into JSON" % (type(ob).__name__,))
+
+
+def _check_object(ob : Any) -> Dict[str, Any]:
+    if not isinstance(ob, dict):
+        raise CodecError("Message is a %s, not an object" % (type(ob).__name__,))
+    return ob
+
+
+class JSONCodec(Codec):
+    """
+    Compact JSON, without the spaces.
+    """
+    Name = "cafehub.json"
+
+    def __init__(self):
+        self.Encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+
+    def encode(self, ob : Dict[str, Any]) -> str:
+        return self.Encoder.encode(ob)
+
+    def decode(self, message : Union[str, bytes]) -> Dict[str, Any]:
+        try:
+            return _check_object(json.loads(message))
+        except ValueError as e:  # Includes JSONDecodeError and bad UTF-8
+            raise CodecError(repr(e)) from e
+
+
+class MsgPackCodec(Codec):
+    Name = "cafehub.msgpack"
+    Binary = True
+
+    def encode(self, ob : Dict[str, Any]) -> bytes:
+        return msgpack.packb(ob, use_bin_type=True)
+
+    def decode(self, message : Union[str, bytes]) -> Dict[str, Any]:
+        try:
+            return _check_object(msgpack.unpackb(message, raw=False))
+        except Exception as e:  # msgpack raises a handful of unrelated types
+            raise CodecError(repr(e)) from e
+
+
+class CBORCodec(Codec):
+    Name = "cafehub.cbor"
+    Binary = True
+
+    def encode(self, ob : Dict[str, Any]) -> bytes:
+        return cbor2.dumps(ob)
+
+    def decode(self, message : Union[str, bytes]) -> Dict[str, Any]:
+        try:
+            return _check_object(cbor2.loads(message))
+        except Exception as e:
+            raise CodecError(repr(e)) from e
+
+
+def available_codecs() -> List[Codec]:
+    """
+    One of each codec whose library is installed, JSON first.
+    """
+    codecs : List[Codec] = [JSONCodec()]
+    if msgpack is not None:
+        codecs.append(MsgPackCodec())
+    if cbor2 is not None:
+        codecs.append(CBORCodec())
+    return codecs
+
@@ -0,0 +1,205 @@
+"""
+Runs SyncWSServer's requests on a fixed number of threads.
+
+websocket_server reads each client's messages on that client's thread, so a
+request that runs there holds up everything else the client sends, and there
+is no limit on how many run at once across clients. The dispatcher takes the
+parsed requests instead, and hands them to a pool of workers:
+
+    - Requests with the same key (the device's MAC) run one at a time, in the
+      order they came. Requests for different devices run in parallel.
+    - Within one key, clients take turns, so one client with a long queue for
+      a device doesn't hold up another client's request for it.
+    - Keys with work also take turns for the workers.
+    - At most MaxQueued requests wait in total, and any one client has at
+      most MaxPerClient waiting or running. Past that, submit() says no, and
+      the server answers with an error rather than letting the queue grow.
+    - Requests submitted as longrunning (eg. scripts) get at most MaxLong of
+      the workers, so short requests always have one to run on.
+"""
+import collections
+import threading
+import traceback
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from kivy.logger import Logger
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_QUEUED = 1024
+DEFAULT_MAX_PER_CLIENT = 256
+
+Job = Tuple[Callable[..., Any], Tuple[Any, ...], bool]  # fn, args, longrunning
+
+
+class _KeyQueue:
+    """
+    The requests waiting for one key, a lane per client.
+    """
+    __slots__ = ('Lanes', 'Busy')
+
+    def __init__(self):
+        self.Lanes : 'collections.OrderedDict[Hashable, Deque[Job]]' = collections.OrderedDict()
+        self.Busy = False  # A worker is running one of our requests
+
+    def nextIsLong(self) -> bool:
+        return next(iter(self.Lanes.values()))[0][2]
+
+    def push(self, client : Hashable, job : Job) -> None:
+        lane = self.Lanes.get(client)
+        if lane is None:
+            lane = self.Lanes[client] = collections.deque()
+        lane.append(job)
+
+    def pop(self) -> Tuple[Hashable, Job]:
+        # The first client's next request, then that client goes to the back
+        client, lane = next(iter(self.Lanes.items()))
+        job = lane.popleft()
+        if lane:
+            self.Lanes.move_to_end(client)
+        else:
+            del self.Lanes[client]
+        return client, job
+
+
+class OrderedDispatcher:
+    """
+    A fixed pool of worker threads, and ordered queues of requests by key.
+    """
+
+    def __init__(self, workers : int = DEFAULT_WORKERS, maxqueued : int = DEFAULT_MAX_QUEUED,
+                 maxperclient : int = DEFAULT_MAX_PER_CLIENT, name : str = 'WSDispatch', maxlong : Optional[int] = None):
+        """
+        maxlong defaults to all the workers but one. With a single worker,
+        that one is shared.
+        """
+        if workers < 1:
+            raise ValueError("OrderedDispatcher needs at least one worker")
+        self.MaxQueued = maxqueued
+        self.MaxPerClient = maxperclient
+        self.MaxLong = maxlong if maxlong is not None else max(1, workers - 1)
+        self.LongRunning = 0
+        self.Lock = threading.Lock()
+        self.WorkReady = threading.Condition(self.Lock)
+        self.Queues : Dict[Hashable, _KeyQueue] = {}
+        self.ReadyKeys : Deque[Hashable] = collections.deque()  # Keys with work and no request running
+        self.Queued = 0
+        self.PerClient : Dict[Hashable, int] = {}  # Queued and running, by client
+        self.Running = True
+        self.Threads : List[threading.Thread] = []
+        for i in range(workers):
+            t = threading.Thread(name="%s-%d" % (name, i), daemon=True, target=self._worker)
+            t.start()
+            self.Threads.append(t)
+
+    def submit(self, key : Optional[Hashable], client : Hashable, fn : Callable[..., Any], *args : Any, longrunning : bool = False) -> bool:
+        """
+        Run fn(*args) on a worker, after the requests already waiting for key.
+        A key of None means fn doesn't need to wait for anything. longrunning
+        requests wait for one of the MaxLong workers they may use.
+
+        Returns False, and doesn't run fn, if the queue limits are reached.
+        """
+        if key is None:
+            key = object()
+        with self.Lock:
+            if not self.Running:
+                return False
+            if (self.Queued >= self.MaxQueued) or (self.PerClient.get(client, 0) >= self.MaxPerClient):
+                return False
+            self.Queued += 1
+            self.PerClient[client] = self.PerClient.get(client, 0) + 1
+
+            kq = self.Queues.get(key)
+            if kq is None:
+                kq = self.Queues[key] = _KeyQueue()
+            waswaiting = bool(kq.Lanes) or kq.Busy
+            kq.push(client, (fn, args, longrunning))
+            if not waswaiting:
+                self.ReadyKeys.append(key)
+                self.WorkReady.notify()
+        return True
+
+    def dropClient(self, client : Hashable) -> None:
+        """
+        Forget the waiting requests of a client that has gone. Ones already
+        running carry on.
+        """
+        with self.Lock:
+            for key, kq in list(self.Queues.items()):
+                lane = kq.Lanes.pop(client, None)
+                if lane is None:
+                    continue
+                self.Queued -= len(lane)
+                self._released(client, len(lane))
+                if not kq.Lanes and not kq.Busy:
+                    del self.Queues[key]
+                    self.ReadyKeys.remove(key)
+
+    def _released(self, client : Hashable, count : int) -> None:
+        # Call with Lock held
+        left = self.PerClient[client] - count
+        if left:
+            self.PerClient[client] = left
+        else:
+            del self.PerClient[client]
+
+    def queuedCount(self) -> int:
+        return self.Queued
+
+    def _nextReady(self) -> Optional[Hashable]:
+        """
+        Take the first ready key whose next request may run now. Call with Lock held.
+        """
+        for key in self.ReadyKeys:
+            if (self.LongRunning < self.MaxLong) or not self.Queues[key].nextIsLong():
+                self.ReadyKeys.remove(key)
+                return key
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            with self.Lock:
+                key = None
+                while self.Running:
+                    key = self._nextReady()
+                    if key is not None:
+                        break
+                    self.WorkReady.wait()
+                if not self.Running:
+                    return
+                kq = self.Queues[key]
+                client, (fn, args, longrunning) = kq.pop()
+                kq.Busy = True
+                self.Queued -= 1
+                if longrunning:
+                    self.LongRunning += 1
+
+            try:
+                fn(*args)
+            except Exception:
+                Logger.debug("WSServer: EXCEPTION in dispatched request: %s" % (traceback.format_exc(),))
+
+            with self.Lock:
+                kq.Busy = False
+                self._released(client, 1)
+                if longrunning:
+                    # A long request that was held back may go now
+                    self.LongRunning -= 1
+                    self.WorkReady.notify()
+                if kq.Lanes:
+                    # Back of the line, so other devices get a turn
+                    self.ReadyKeys.append(key)
+                    self.WorkReady.notify()
+                else:
+                    del self.Queues[key]
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers once they finish what they are running. Waiting requests are dropped.
+        """
+        with self.Lock:
+            self.Running = False
+            self.WorkReady.notify_all()
+        for t in self.Threads:
+            if t is not threading.current_thread():
+                t.join()
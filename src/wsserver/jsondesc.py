@@ -1,13 +1,18 @@
 import base64
 import json
 import os
+import re
 import sys
+import time
 
+from ble.bleops import QOpPriority
 from ble.gattclientinterface import GATTCState
 
 sys.path.insert(0, os.path.abspath(os.path.join(__file__, '../..')))
 from ble.blescanresult import BLEScanResult
-from typing import Dict, List, Literal, Any
+from ble.deviceregistry import DeviceRecord
+from ble.scansubscription import ScanFilter
+from typing import Callable, Dict, List, Literal, Any, Optional, Set, Tuple
 
 from pydantic import BaseModel
 
@@ -16,7 +21,8 @@ T_MsgType_RESP = Literal["RESP"]
 T_MsgType_UPDATE = Literal["UPDATE"]
 T_MsgType = Literal[T_MsgType_REQ, T_MsgType_RESP, T_MsgType_UPDATE]
 T_ConnectionState = Literal["INIT", "DISCONNECTED", "CONNECTED", "CANCELLED"]
-T_ReqCommand = Literal["Scan", "GATTConnect", "GATTDisconnect", "GATTRead", "GATTSetNotify", "GATTWrite"];
+T_ReqCommand = Literal["Scan", "GATTConnect", "GATTDisconnect", "GATTRead", "GATTSetNotify", "GATTWrite", "GetDevices", "BinaryMode", "OpenChannel", "Batch", "RunScript"];
+T_PRIORITIES = ("Interactive", "Bulk", "Background")
 
 class T_Request(BaseModel):
     type : T_MsgType_REQ = "REQ"
@@ -43,6 +49,11 @@ Requests follow the following general format:
     NB: Zero is a reserved id! It means "unknown id"
     NEVER USE 0 AS AN ID!
 
+    Messages are JSON text unless the client asked for another codec when it
+    connected (see codecs.py): MessagePack or CBOR, in binary frames. The
+    messages are the same either way, except that Base64Data is base64 only
+    in JSON. The other codecs carry the raw bytes.
+
 Responses:
     {
         type: "RESP", 
@@ -66,15 +77,65 @@ Request Commands:
     Scan(timeout : U32)
 
         Scan for up to 30 seconds.
+
+        Optional params, to only be sent the devices you are interested in:
+
+        ServiceUUIDs : ArrayOfString
+
+            Only devices advertising at least one of these services. 16 bit
+            UUIDs like "ffff" are fine.
+
+        NamePrefix : string
+
+            Only devices whose name starts with this.
+
+        MinRSSI : int
+
+            Only devices heard at this signal strength (dBm) or better.
+
+    GetDevices()
+
+        Every device the server has seen advertising, even in earlier runs,
+        most recently seen first. No scan is needed. Takes the same optional
+        params as Scan, where MinRSSI is checked against the smoothed RSSI, and:
+
+        MaxAge : int
+
+            Milliseconds. Only devices seen this recently.
+
+        The response results hold Devices, an array of
+        { MAC, Name, UUIDs, RSSI, LastSeen, Age }. RSSI is smoothed over recent
+        advertisements, and may be null. LastSeen is a Unix time in seconds.
+        Age is milliseconds since LastSeen.
         
     GATTConnect(MAC : string)
     
         Attempt to connect to MAC. Generates an update listing services once connected.
 
+        Optional param:
+
+        AutoReconnect : bool
+
+            If true, and the link later drops without a GATTDisconnect, the
+            server sends a ConnectionState of DISCONNECTED and then reconnects
+            by itself, backing off between attempts. Notifies that were enabled
+            are enabled again. When all of that is done, one ConnectionState of
+            CONNECTED (with id 0, and listing the characteristics) is sent.
+            There is no need to connect or send GATTSetNotify again.
+            GATTDisconnect stops reconnecting.
+
     GATTDisconnect(MAC : string)
     
         Attempt to disconnect MAC. Any outstanding operations will be cancelled.
 
+    Several clients can be connected to the server at once, and share the
+    devices. A GATTConnect to a device another client already has connected
+    just answers CONNECTED, and the device is only disconnected once every
+    client that connected it has sent GATTDisconnect or gone away. Likewise,
+    a notify stays enabled on the device until the last client that enabled
+    it disables it, and each notification is sent to every client that
+    enabled it.
+
     GATTRead(MAC : string, Char : string, Len : int)
 
         Response will come back later with the given id.
@@ -83,8 +144,154 @@ Request Commands:
 
         Will come back with error 0 (Okay) if it worked.
 
+        Optional params, to get notifications in batches:
+
+        BatchWindow : int
+
+            Milliseconds. Rather than a GATTNotify for each notification,
+            collect them and send GATTNotifyBatch updates. A batch goes when
+            its first notification has waited BatchWindow ms, or when it is
+            full. Every notify a client enables with BatchWindow shares the
+            client's batches.
+
+        BatchMax : int
+
+            How many notifications make a full batch. Defaults to 32.
+
     GATTWrite(MAC : string, Char : string, Data : Base64Data)
 
+    GATTRead and GATTWrite also take these optional params:
+
+        Priority : "Interactive" | "Bulk" | "Background"
+
+            The queue lane for the operation. Defaults to "Bulk". Use
+            "Interactive" for things the user is waiting on, like a state change.
+
+        Deadline : int
+
+            Milliseconds. If the operation hasn't been issued by then, it fails
+            with error 2 (BLEOperationTimedOut) without being sent to the device.
+
+    GATTRead also takes:
+
+        MaxStaleness : int
+
+            Milliseconds. If the server has seen a value for Char (from a read
+            or a notify, and with no write since) that is no older than this,
+            it answers with that value straight away, without going to the
+            device. 0 forces a real read.
+
+    GATTWrite also takes:
+
+        Coalesce : bool
+
+            If true, and an earlier write to the same MAC/Char is still waiting
+            to be sent, that write is replaced with this one. Only the newest
+            data is sent, and both requests get the same response. Handy for
+            sliders.
+
+    Batch(MAC : string, Items : ArrayOf{ command : string, params : { params } })
+
+        Run up to 128 GATTRead, GATTWrite and GATTSetNotify requests on MAC,
+        one after another, for a single round trip. Items are written like
+        requests, without the type and id, and without MAC in their params,
+        as they all use the Batch's. Each item takes the same params as its
+        request would.
+
+        Optional param:
+
+        StopOnError : bool
+
+            Defaults to true: an item that fails is the last one run. If
+            false, the rest are run anyway.
+
+        The response results hold Results, an array of
+        { error : { eid, errmsg }, results : { results } }, one for each item
+        that was run, in order. An item that failed doesn't fail the Batch,
+        so the Batch's own eid is 0 unless the Batch couldn't be run at all.
+        A GATTRead's results hold Data : Base64Data.
+
+    RunScript(MAC : string, Steps : ArrayOf{ Op : string, ... })
+
+        Run a short sequence of operations on MAC in the server, so that
+        exchanges like "write, wait for the notify that says it worked, then
+        write again" don't cross the network at every step. A script is only
+        data: these steps, and nothing else.
+
+        { Op : "Write", Char : string, Data : Base64Data, RR : bool }
+
+            RR is optional, and defaults to true.
+
+        { Op : "Read", Char : string }
+
+        { Op : "SetNotify", Char : string, Enable : bool }
+
+            Like GATTSetNotify from this client. A notify stays enabled
+            when the script ends.
+
+        { Op : "AwaitNotify", Char : string, Timeout : int, Offset : int, Equals : Base64Data, Mask : Base64Data }
+
+            Wait up to Timeout ms for a notification from Char that came
+            after the step before this one started, and that no earlier
+            AwaitNotify took. Only Char and Timeout are needed. With Equals,
+            the notification's bytes from Offset (default 0) must match it;
+            with Mask as well (the same length as Equals), only the bits set
+            in Mask are compared. The notify has to be enabled, by
+            GATTSetNotify or a SetNotify step. Fails with error 2
+            (BLEOperationTimedOut) if nothing matches in time.
+
+        { Op : "Delay", Ms : int }
+
+        { Op : "Loop", Count : int, Steps : ArrayOf{ step } }
+
+            Run Steps Count times.
+
+        A script can have up to 256 steps, Loops nested up to 4 deep, and can
+        run at most 10000 steps in total.
+
+        Optional params:
+
+        Timeout : int
+
+            Milliseconds the whole script may take. Defaults to 30000, and
+            can be at most 300000.
+
+        Progress : bool
+
+            Defaults to true: send a ScriptProgress update after each step.
+
+        If a step fails, the script stops there, and an ExecutionError with
+        the request's id says which step. Otherwise the response results hold
+        Steps (how many ran), Elapsed (ms), and Data : Base64Data from the last
+        Read or AwaitNotify, or null.
+
+Binary mode:
+
+    GATTNotify, GATTRead and GATTWrite carry raw bytes, and as JSON they are
+    mostly base64 and field names. In binary mode they can also travel as
+    binary WebSocket frames, with a 16 bit channel ID standing for the
+    MAC/Char pair. The frame layout is in binframes.py. Everything else stays
+    JSON, and JSON GATTRead/GATTWrite still work.
+
+    A client gets binary mode by offering the WebSocket subprotocol
+    "cafehub.binary.v1" when it connects, or by sending:
+
+    BinaryMode(Enable : bool)
+
+        The response results hold Enabled : bool. Only the asyncio server
+        (CAFEHUB_ASYNC_WS=1) can send binary frames; the other one answers
+        Enable = true with an ExecutionError.
+
+    OpenChannel(MAC : string, Char : string)
+
+        The response results hold Channel : int, the ID for MAC/Char. IDs are
+        the same for every client and don't change while the server runs.
+
+    Once in binary mode, the GATTSetNotify response also holds Channel, and
+    notifications for it arrive as NOTIFY frames instead of GATTNotify
+    updates. Errors for READ and WRITE frames come back as ExecutionError
+    updates with the frame's id.
+
 Updates:
 
     {
@@ -97,14 +304,26 @@ Updates:
     Updates are sent by the server to inform the clients if something important changes. 
     Because they can be unsolicited, they do not always have an id. The type of update is in "update".
 
-    ScanResult(MAC : string, Name : string, UUIDS : ArrayOfString)
+    ScanResult(MAC : string, Name : string, UUIDS : ArrayOfString, RSSI : int)
     
-        A result from an ongoing BLE scan
+        A result from an ongoing BLE scan. RSSI is null if the platform doesn't report it.
         
     GATTNotify(MAC : string, Char : string, Data : Base64Data)
 
         A notify that we subscribed to has delivered some data
 
+    GATTNotifyBatch(Items : ArrayOf{ MAC : string, Char : string, Data : Base64Data, Time : number })
+
+        Notifications for notifies enabled with BatchWindow, oldest first.
+        Time is when the server got each one, as a Unix time in seconds.
+        Binary mode NOTIFY frames aren't batched.
+
+    ScriptProgress(id : int, Step : int, Op : string, Data : Base64Data)
+
+        A step of the RunScript request id has finished. Step counts the
+        steps run so far, from 1. Data is only there for Read and
+        AwaitNotify steps.
+
     ConnectionState(id: int, MAC : string, state : str)
 
         Notification of a connection or disconnection. If id != 0, then this connection
@@ -121,7 +340,291 @@ class ParseException(Exception):
     pass
 
 
+# Request params, and how each is checked. A check is given the value and the
+# param name, and raises ParseException if the value won't do. They are meant
+# to be cheap: a type check, a range, or a character set check.
+#
+# "Every character is in chars" is written as not value.strip(chars), which
+# is done in C and is a lot quicker than a regex.
+
+Check = Callable[[Any, str], None]
+
+MAX_ATTRIBUTE_LEN = 512  # The most a GATT characteristic value can hold
+
+_HEX = '0123456789abcdefABCDEF'
+_BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+# 16 and 32 bit short forms of UUIDs
+_SHORT_UUID_RE = re.compile(r'[0-9A-Fa-f]{4}(?:[0-9A-Fa-f]{4})?')
+
+# A session uses the same few MACs and UUIDs over and over, so remember the good ones
+_KNOWN_GOOD_MAX = 1024
+_GoodMACs : Set[str] = set()
+_GoodUUIDs : Set[str] = set()
+
+
+def _remember(known : Set[str], value : str) -> None:
+    if len(known) >= _KNOWN_GOOD_MAX:
+        known.clear()
+    known.add(value)
+
+
+def _is_UUID(value : str) -> bool:
+    if len(value) == 36:
+        return ((value[8] == '-') and (value[13] == '-') and (value[18] == '-') and (value[23] == '-')
+                and (value.count('-') == 4) and not value.strip(_HEX + '-'))
+    return _SHORT_UUID_RE.fullmatch(value) is not None
+
+
+def check_int(value : Any, name : str) -> None:
+    # bool is an int in Python, but not in JSON
+    if (type(value) is not int):
+        raise ParseException("%s is not an integer" % (name,))
+
+
+def int_in_range(low : int, high : Optional[int] = None) -> Check:
+    def check(value : Any, name : str) -> None:
+        if (type(value) is not int) or (value < low) or ((high is not None) and (value > high)):
+            if high is None:
+                raise ParseException("%s must be an integer, at least %d" % (name, low))
+            raise ParseException("%s must be an integer from %d to %d" % (name, low, high))
+    return check
+
+
+def check_bool(value : Any, name : str) -> None:
+    if not isinstance(value, bool):
+        raise ParseException("%s is not a boolean" % (name,))
+
+
+def check_str(value : Any, name : str) -> None:
+    if not isinstance(value, str):
+        raise ParseException("%s is not a string" % (name,))
+
+
+def check_MAC(value : Any, name : str) -> None:
+    """
+    AA:BB:CC:DD:EE:FF, or a UUID, which is how macOS names devices.
+    """
+    if not isinstance(value, str):
+        raise ParseException("%s is not a MAC address: %r" % (name, value))
+    if value in _GoodMACs:
+        return
+    if len(value) == 17:
+        good = (value.count(':') == 5) and (value[2::3] == ':::::') and not value.strip(_HEX + ':')
+    else:
+        good = _is_UUID(value)
+    if not good:
+        raise ParseException("%s is not a MAC address: %r" % (name, value))
+    _remember(_GoodMACs, value)
+
+
+def check_UUID(value : Any, name : str) -> None:
+    if not isinstance(value, str):
+        raise ParseException("%s is not a UUID: %r" % (name, value))
+    if value in _GoodUUIDs:
+        return
+    if not _is_UUID(value):
+        raise ParseException("%s is not a UUID: %r" % (name, value))
+    _remember(_GoodUUIDs, value)
+
+
+def check_UUID_list(value : Any, name : str) -> None:
+    if not isinstance(value, list):
+        raise ParseException("%s is not an array of strings" % (name,))
+    for u in value:
+        check_UUID(u, name)
+
+
+def check_Data(value : Any, name : str) -> None:
+    """
+    Base64Data: base64 in JSON, bytes from the binary codecs. At most MAX_ATTRIBUTE_LEN bytes.
+    """
+    if isinstance(value, str):
+        body = value.rstrip('=')
+        if (len(value) % 4) or (len(value) - len(body) > 2) or body.strip(_BASE64):
+            raise ParseException("%s is not base64" % (name,))
+        size = len(value) // 4 * 3 - (len(value) - len(body))
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+    else:
+        raise ParseException("%s is not base64" % (name,))
+    if size > MAX_ATTRIBUTE_LEN:
+        raise ParseException("%s is %d bytes. The most is %d." % (name, size, MAX_ATTRIBUTE_LEN))
+
+
+def check_batch_items(value : Any, name : str) -> None:
+    if not (isinstance(value, list) and (0 < len(value) <= MAX_BATCH_ITEMS)):
+        raise ParseException("%s must be an array of 1 to %d requests" % (name, MAX_BATCH_ITEMS))
+    for item in value:
+        if not isinstance(item, dict):
+            raise ParseException("%s must be an array of requests" % (name,))
+        try:
+            command = BATCH_ITEMS[item['command']]
+        except (KeyError, TypeError):
+            raise ParseException("A Batch can't run %r" % (item.get('command'),)) from None
+        params = item.get('params')
+        if not isinstance(params, dict):
+            raise ParseException("%s item params is not an object" % (item['command'],))
+        command.check(params)
+
+
+def check_no_MAC(value : Any, name : str) -> None:
+    raise ParseException("Batch items use the Batch's MAC")
+
+
+def _script_size(steps : Any, depth : int) -> Tuple[int, int]:
+    """
+    Check a RunScript's Steps, and those of its Loops. Returns how many steps
+    are written, and how many will run.
+    """
+    if not (isinstance(steps, list) and steps):
+        raise ParseException("Steps must be an array of steps")
+    if depth > MAX_SCRIPT_DEPTH:
+        raise ParseException("Loops can only be nested %d deep" % (MAX_SCRIPT_DEPTH,))
+    written = run = 0
+    for step in steps:
+        if not isinstance(step, dict):
+            raise ParseException("Steps must be an array of steps")
+        try:
+            op = SCRIPT_OPS[step['Op']]
+        except (KeyError, TypeError):
+            raise ParseException("Unknown script Op: %r" % (step.get('Op'),)) from None
+        op.check(step)
+        if op.Name == 'Loop':
+            w, r = _script_size(step.get('Steps'), depth + 1)
+            written += w + 1
+            run += r * step['Count']
+            continue
+        if op.Name == 'AwaitNotify':
+            if 'Equals' in step:
+                length = len(data_from_param(step['Equals']))
+                if ('Mask' in step) and (len(data_from_param(step['Mask'])) != length):
+                    raise ParseException("Mask must be as long as Equals")
+                if step.get('Offset', 0) + length > MAX_ATTRIBUTE_LEN:
+                    raise ParseException("Offset and Equals go past the end of any value")
+            elif 'Mask' in step:
+                raise ParseException("Mask needs Equals")
+        written += 1
+        run += 1
+    return written, run
+
+
+def check_script_steps(value : Any, name : str) -> None:
+    written, run = _script_size(value, 0)
+    if written > MAX_SCRIPT_STEPS:
+        raise ParseException("A script can have at most %d steps" % (MAX_SCRIPT_STEPS,))
+    if run > MAX_SCRIPT_RUN:
+        raise ParseException("A script can run at most %d steps" % (MAX_SCRIPT_RUN,))
+
+
+def one_of(choices : Tuple[str, ...]) -> Check:
+    def check(value : Any, name : str) -> None:
+        if value not in choices:
+            raise ParseException('%s must be one of %s' % (name, ', '.join(choices)))
+    return check
+
+
+MAX_BATCH_ITEMS = 128
+BATCH_COMMANDS = ('GATTRead', 'GATTWrite', 'GATTSetNotify')
+
+MAX_SCRIPT_STEPS = 256
+MAX_SCRIPT_DEPTH = 4
+MAX_SCRIPT_RUN = 10000
+MAX_LOOP_COUNT = 10000
+DEFAULT_SCRIPT_TIMEOUT = 30000  # ms
+MAX_SCRIPT_TIMEOUT = 300000
+
+QOP_OPTIONS : Dict[str, Check] = {
+    'Priority' : one_of(T_PRIORITIES),
+    'Deadline' : int_in_range(0),
+    'Coalesce' : check_bool,
+}
+
+SCAN_FILTER : Dict[str, Check] = {
+    'ServiceUUIDs' : check_UUID_list,
+    'NamePrefix' : check_str,
+    'MinRSSI' : check_int,
+}
+
+MAC_CHAR : Dict[str, Check] = {
+    'MAC' : check_MAC,
+    'Char' : check_UUID,
+}
+
+# command : (required params, optional params). Other params are ignored.
+REQUEST_SCHEMA : Dict[str, Tuple[Dict[str, Check], Dict[str, Check]]] = {
+    'Scan'           : ({'Timeout' : int_in_range(0, 1 << 32)}, SCAN_FILTER),
+    'GetDevices'     : ({}, dict(SCAN_FILTER, MaxAge=int_in_range(0))),
+    'GATTConnect'    : ({'MAC' : check_MAC}, {'AutoReconnect' : check_bool}),
+    'GATTDisconnect' : ({'MAC' : check_MAC}, {}),
+    'GATTRead'       : (dict(MAC_CHAR, Len=int_in_range(0, MAX_ATTRIBUTE_LEN)), dict(QOP_OPTIONS, MaxStaleness=int_in_range(0))),
+    'GATTWrite'      : (dict(MAC_CHAR, Data=check_Data, RR=check_bool), QOP_OPTIONS),
+    'GATTSetNotify'  : (dict(MAC_CHAR, Enable=check_bool), {'BatchWindow' : int_in_range(1), 'BatchMax' : int_in_range(1)}),
+    'BinaryMode'     : ({'Enable' : check_bool}, {}),
+    'OpenChannel'    : (MAC_CHAR, {}),
+    'Batch'          : ({'MAC' : check_MAC, 'Items' : check_batch_items}, {'StopOnError' : check_bool}),
+    'RunScript'      : ({'MAC' : check_MAC, 'Steps' : check_script_steps},
+                        {'Timeout' : int_in_range(1, MAX_SCRIPT_TIMEOUT), 'Progress' : check_bool}),
+}
+
+# RunScript steps, by Op. Loop's Steps are checked by _script_size().
+SCRIPT_SCHEMA : Dict[str, Tuple[Dict[str, Check], Dict[str, Check]]] = {
+    'Write'       : ({'Char' : check_UUID, 'Data' : check_Data}, {'RR' : check_bool}),
+    'Read'        : ({'Char' : check_UUID}, {}),
+    'SetNotify'   : ({'Char' : check_UUID, 'Enable' : check_bool}, {}),
+    'AwaitNotify' : ({'Char' : check_UUID, 'Timeout' : int_in_range(1, MAX_SCRIPT_TIMEOUT)},
+                     {'Offset' : int_in_range(0, MAX_ATTRIBUTE_LEN), 'Equals' : check_Data, 'Mask' : check_Data}),
+    'Delay'       : ({'Ms' : int_in_range(0, MAX_SCRIPT_TIMEOUT)}, {}),
+    'Loop'        : ({'Count' : int_in_range(1, MAX_LOOP_COUNT)}, {}),
+}
+
+
+class CompiledCommand:
+    """
+    A REQUEST_SCHEMA entry, as tuples to walk.
+    """
+    __slots__ = ('Name', 'Required', 'Optional', 'RequiredCount')
+
+    def __init__(self, name : str, required : Dict[str, Check], optional : Dict[str, Check]):
+        self.Name = name
+        self.Required = tuple(required.items())
+        self.Optional = tuple(optional.items())
+        self.RequiredCount = len(self.Required)
+
+    def check(self, params : Dict[str, Any]) -> None:
+        for name, check in self.Required:
+            try:
+                value = params[name]
+            except KeyError:
+                raise ParseException('No %s in %s request params' % (name, self.Name)) from None
+            check(value, name)
+        # Optional params can only be there if there is more than the required ones
+        if len(params) > self.RequiredCount:
+            for name, check in self.Optional:
+                if name in params:
+                    check(params[name], name)
+
+
+# What a Batch can run: the requests' own checks, but the MAC comes from the Batch
+BATCH_ITEMS : Dict[str, CompiledCommand] = {
+    name : CompiledCommand(name,
+                           {k : c for k, c in REQUEST_SCHEMA[name][0].items() if k != 'MAC'},
+                           dict(REQUEST_SCHEMA[name][1], MAC=check_no_MAC))
+    for name in BATCH_COMMANDS}
+
+
+SCRIPT_OPS : Dict[str, CompiledCommand] = {
+    name : CompiledCommand(name, required, optional) for name, (required, optional) in SCRIPT_SCHEMA.items()}
+
+
 class WSBLEParser:
+    """
+    Checks messages from clients against REQUEST_SCHEMA, so that bad input
+    is turned away before it gets near the BLE stack.
+    """
+    def __init__(self):
+        self.Commands : Dict[str, CompiledCommand] = {
+            name : CompiledCommand(name, required, optional) for name, (required, optional) in REQUEST_SCHEMA.items()}
+
     def parse_obj(self, obj : Dict[str, Any]) -> Dict[str, Any]:
         """
         Parses objects sent to the server by the client.
@@ -165,7 +668,7 @@ class WSBLEParser:
         error = resp['error']
         # res = resp['results']
 
-        if len(error) > 2:
+        if not isinstance(error, dict) or len(error) > 2:
             raise ParseException('Too many fields in error')
 
         self.check_exists(['eid', 'errmsg'], error, "Could not find '%s' field in error")
@@ -185,92 +688,43 @@ class WSBLEParser:
         if len(obj) > 4:
             raise ParseException('Too many fields in request')
 
-        self.check_exists(['id', 'command', 'params'], obj, "Could not find '%s' field")
-        if obj['command'] not in ('Scan', 'GATTRead', 'GATTSetNotify', 'GATTWrite', 'GATTConnect', 'GATTDisconnect'):
-            raise ParseException('Unrecognized command: %s' % (obj['command'],))
-
-        if obj['id'] == 0:
+        try:
+            rid = obj['id']
+            params = obj['params']
+            cname = obj['command']
+        except KeyError as e:
+            raise ParseException("Could not find '%s' field" % (e.args[0],)) from None
+        try:
+            command = self.Commands[cname]
+        except (KeyError, TypeError):  # TypeError if it isn't even hashable
+            raise ParseException('Unrecognized command: %r' % (cname,)) from None
+
+        if (type(rid) is not int) or not (0 <= rid < (1 << 32)):
+            raise ParseException('id must be a U32')
+        if rid == 0:
             raise ParseException('ID cannot be zero in a request. It means "Unknown ID".')
+        if not isinstance(params, dict):
+            raise ParseException('params is not an object')
 
-        params = obj['params']
-
-        if obj['command'] == 'Scan':
-            # Scan(Timeout : int)
-            self.check_exists(['Timeout'], params, 'No %s in Scan request params')
-            self.parse_Timeout(params['Timeout'], "Timeout is not an integer")
-            return obj
-        
-        if obj['command'] == 'GATTRead':
-            # GATTRead(MAC : string, Characteristic : string, Len : int)
-            self.check_exists(['MAC', 'Char', 'Len'], params, 'No %s in GATTRead request params')
-
-            self.parse_MAC(params['MAC'])
-            self.parse_Char(params['Char'])
-            self.parse_Len(params['Len'])
-            return obj
-
-        if obj['command'] == 'GATTSetNotify':
-            # GATTSetNotify(MAC: string, Char: string, Enable: bool)
-            self.check_exists(['MAC', 'Char', 'Enable'], params, 'No %s in GATTSetNotify request params')
-
-            self.parse_MAC(params['MAC'])
-            self.parse_Char(params['Char'])
-            self.parse_Bool(params['Enable'])
-            return obj
-
-        if obj['command'] == 'GATTWrite':
-            # GATTWrite(MAC: string: Char: string, Data: Base64Data)
-            self.check_exists(['MAC', 'Char', 'Data', 'RR'], params, 'No %s in GATTWrite request params')
-
-            self.parse_MAC(params['MAC'])
-            self.parse_Char(params['Char'])
-            self.parse_Data(params['Data'])
-            return obj
-
-        if obj['command'] == 'GATTConnect':
-            # GATTConnect(MAC: string)
-            self.check_exists(['MAC'], params, 'No %s in GATTConnect request params')
-
-            self.parse_MAC(params['MAC'])
-            return obj
-
-        if obj['command'] == 'GATTDisconnect':
-            # GATTDisconnect(MAC: string)
-            self.check_exists(['MAC'], params, 'No %s in GATTConnect request params')
-
-            self.parse_MAC(params['MAC'])
-            return obj
-
+        command.check(params)
         return obj
 
-    def parse_int(self, num : Any, msg : str):
-        if not isinstance(num, int):
-            raise ParseException(msg)
-
-    def parse_Timeout(self, num : Any, msg : str):
-        self.parse_int(num, msg)
-        if num > (1 << 32):
-            raise ParseException("Timeout is too large")
+    # The checks on their own, for anyone that wants them
 
     def parse_MAC(self, mac : Any):
-        # TODO: Do a basic check of MAC. Nothing too slow or complex.
-        pass
+        check_MAC(mac, 'MAC')
 
-    def parse_Char(self, char: Any):
-        # TODO: Do a basic check of Char UUID. Nothing too slow or complex.
-        pass
+    def parse_Char(self, char : Any):
+        check_UUID(char, 'Char')
 
-    def parse_Bool(self, boolval: Any):
-        # TODO: Do a basic check of boolval. Nothing too slow or complex.
-        pass
+    def parse_Bool(self, boolval : Any):
+        check_bool(boolval, 'Value')
 
-    def parse_Data(self, data: Any):
-        # TODO: Do a basic check of Data. Nothing too slow or complex.
-        pass
+    def parse_Data(self, data : Any):
+        check_Data(data, 'Data')
 
-    def parse_Len(self, rlen: Any):
-        # TODO: Do a basic check of Length
-        pass
+    def parse_Len(self, rlen : Any):
+        int_in_range(0, MAX_ATTRIBUTE_LEN)(rlen, 'Len')
 
 
 def make_req(command : str, rid : int, params : Dict[str, Any]) -> Dict[str, Any]:
@@ -282,6 +736,42 @@ def make_req(command : str, rid : int, params : Dict[str, Any]) -> Dict[str, Any
     }
 
 
+def qop_options_from_params(params : Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Turn the optional Priority, Deadline and Coalesce params of a parsed
+    request into QOp options for a GATTClient call.
+    """
+    options : Dict[str, Any] = {}
+    if 'Priority' in params:
+        options['priority'] = QOpPriority[params['Priority'].upper()]
+    if 'Deadline' in params:
+        options['deadline'] = params['Deadline'] / 1000.0
+    if params.get('Coalesce', False):
+        options['coalesce'] = True
+    return options
+
+
+def read_options_from_params(params : Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Like qop_options_from_params(), but also turns the optional MaxStaleness
+    param of a parsed GATTRead into the maxstaleness option of char_read().
+    """
+    options = qop_options_from_params(params)
+    if 'MaxStaleness' in params:
+        options['maxstaleness'] = params['MaxStaleness'] / 1000.0
+    return options
+
+
+def scan_filter_from_params(params : Dict[str, Any]) -> Optional[ScanFilter]:
+    """
+    Turn the optional ServiceUUIDs, NamePrefix and MinRSSI params of a parsed
+    Scan or GetDevices into a ScanFilter. None if there aren't any.
+    """
+    if not any(k in params for k in ('ServiceUUIDs', 'NamePrefix', 'MinRSSI')):
+        return None
+    return ScanFilter(params.get('ServiceUUIDs'), params.get('NamePrefix'), params.get('MinRSSI'))
+
+
 def make_error(eid : int, errmsg : str) -> Dict[str, Any]:
     return {
         'eid' : eid,
@@ -289,7 +779,7 @@ def make_error(eid : int, errmsg : str) -> Dict[str, Any]:
     }
 
 
-def make_resp(rid : int, error : Dict[str, Any], results : Dict[str, str]) -> Dict[str, Any]:
+def make_resp(rid : int, error : Dict[str, Any], results : Dict[str, Any]) -> Dict[str, Any]:
     return {
         'type'    : 'RESP',
         'id'      : rid,
@@ -356,13 +846,138 @@ def make_GATTRead_as_JSON(rid : int, mac : str, char : str, rlen : int):
     return json.dumps(make_GATTRead(rid, mac, char, rlen))
 
 
-def make_GATTConnect(rid : int, mac : str) -> Dict[str, Any]:
-    params = {
+def make_GATTConnect(rid : int, mac : str, autoreconnect : bool = False) -> Dict[str, Any]:
+    params : Dict[str, Any] = {
         'MAC' : mac,
     }
+    if autoreconnect:
+        params['AutoReconnect'] = True
     return make_req('GATTConnect', rid, params)
 
 
+def make_GetDevices(rid : int, maxage : Optional[int] = None) -> Dict[str, Any]:
+    params : Dict[str, Any] = {}
+    if maxage is not None:
+        params['MaxAge'] = maxage
+    return make_req('GetDevices', rid, params)
+
+
+def make_devices_from_records(records : List[DeviceRecord]) -> Dict[str, Any]:
+    # GetDevices results
+    now = time.time()
+    return {
+        'Devices' : [{
+            'MAC'      : r.MAC,
+            'Name'     : r.Name,
+            'UUIDs'    : r.UUIDs,
+            'RSSI'     : round(r.RSSI) if r.RSSI is not None else None,
+            'LastSeen' : r.LastSeen,
+            'Age'      : max(0, int((now - r.LastSeen) * 1000)),
+        } for r in records]
+    }
+
+
+def make_BinaryMode(rid : int, enable : bool = True) -> Dict[str, Any]:
+    params = {
+        'Enable' : enable,
+    }
+    return make_req('BinaryMode', rid, params)
+
+
+def make_OpenChannel(rid : int, mac : str, char : str) -> Dict[str, Any]:
+    params = {
+        'MAC' : mac,
+        'Char' : char,
+    }
+    return make_req('OpenChannel', rid, params)
+
+
+def make_batch_item(command : str, params : Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'command' : command,
+        'params'  : params
+    }
+
+
+def make_Batch(rid : int, mac : str, items : List[Dict[str, Any]], stoponerror : bool = True) -> Dict[str, Any]:
+    """
+    items are from make_batch_item().
+    """
+    return make_req('Batch', rid, {'MAC' : mac, 'Items' : items, 'StopOnError' : stoponerror})
+
+
+def make_batch_result(error : Dict[str, Any], results : Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'error'   : error,
+        'results' : results
+    }
+
+
+def make_script_step(op : str, **params : Any) -> Dict[str, Any]:
+    return dict(params, Op=op)
+
+
+def make_RunScript(rid : int, mac : str, steps : List[Dict[str, Any]], timeout : Optional[int] = None, progress : bool = True) -> Dict[str, Any]:
+    """
+    steps are from make_script_step().
+    """
+    params : Dict[str, Any] = {'MAC' : mac, 'Steps' : steps, 'Progress' : progress}
+    if timeout is not None:
+        params['Timeout'] = timeout
+    return make_req('RunScript', rid, params)
+
+
+def make_ScriptProgress(uid : int, step : int, op : str, data : Optional[bytes] = None) -> Dict[str, Any]:
+    results : Dict[str, Any] = {'Step' : step, 'Op' : op}
+    if data is not None:
+        results['Data'] = data
+    return make_update(uid, 'ScriptProgress', results)
+
+
+def make_GATTNotify(mac : str, char : str, data : bytes) -> Dict[str, Any]:
+    results = {
+        'MAC'  : mac,
+        'Char' : char,
+        'Data' : bytes(data),
+    }
+    return make_update(0, 'GATTNotify', results)
+
+
+def make_GATTNotifyBatch(items : List[Tuple[str, str, bytes, float]]) -> Dict[str, Any]:
+    # items are (MAC, Char, data, time), as NotifyBatcher collects them
+    results = {
+        'Items' : [{
+            'MAC'  : mac,
+            'Char' : char,
+            'Data' : data,
+            'Time' : t,
+        } for mac, char, data, t in items]
+    }
+    return make_update(0, 'GATTNotifyBatch', results)
+
+
+def make_GATTSetNotify(rid : int, mac : str, char : str, enable : bool, batchwindow : Optional[int] = None, batchmax : Optional[int] = None) -> Dict[str, Any]:
+    params : Dict[str, Any] = {
+        'MAC'    : mac,
+        'Char'   : char,
+        'Enable' : enable,
+    }
+    if batchwindow is not None:
+        params['BatchWindow'] = batchwindow
+    if batchmax is not None:
+        params['BatchMax'] = batchmax
+    return make_req('GATTSetNotify', rid, params)
+
+
+def data_from_param(data : Any) -> bytes:
+    """
+    A Base64Data param: base64 from JSON, bytes from the binary codecs.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return base64.b64decode(data)
+
+
 def make_GATTDisconnect(rid : int, mac : str) -> Dict[str, Any]:
     params = {
         'MAC' : mac,
@@ -371,11 +986,12 @@ def make_GATTDisconnect(rid : int, mac : str) -> Dict[str, Any]:
 
 
 def make_update_from_blescanresult(uid : int, scanresult : BLEScanResult) -> Dict[str, Any]:
-    # ScanResult(MAC : string, Name : string, UUIDS : List[str])
+    # ScanResult(MAC : string, Name : string, UUIDS : List[str], RSSI : int)
     results = {
         'MAC'   : scanresult.MAC,
         'Name'  : scanresult.name,
-        'UUIDs' : scanresult.uuids
+        'UUIDs' : scanresult.uuids,
+        'RSSI'  : scanresult.rssi
     }
     return make_update(uid, 'ScanResult', results)
 
@@ -0,0 +1,103 @@
+"""
+Batching of notifications for one WebSocket client.
+
+A client that enables a notify with BatchWindow gets GATTNotifyBatch updates
+rather than a GATTNotify per notification. A batch is sent once its oldest
+notification has waited BatchWindow ms, or it holds BatchMax of them,
+whichever comes first, so latency stays bounded. Several characteristics
+that notify at once (eg. the DE1 during a shot) share one message, one frame
+and one send.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from wsserver.sessions import NotifyKey
+
+DEFAULT_BATCH_MAX = 32
+
+
+class NotifyBatcher:
+    """
+    Collects one client's batched notifications, and hands them to flush()
+    as a list of (MAC, Char, data, Unix time) when a batch is due.
+
+    schedule(delay, fn) must call fn() after delay seconds, on any thread.
+    add() is called from BLE callbacks, so everything is under a lock. flush()
+    is called with the lock held too, so batches go out in order.
+    """
+
+    def __init__(self, flush : Callable[[List[Tuple[str, str, bytes, float]]], Any], schedule : Callable[[float, Callable[[], None]], Any]):
+        self.Lock = threading.Lock()
+        self.Flush = flush
+        self.Schedule = schedule
+        self.Settings : Dict[NotifyKey, Tuple[float, int]] = {}  # (window in seconds, max items)
+        self.Items : List[Tuple[str, str, bytes, float]] = []
+        self.Deadline : Optional[float] = None  # When the current batch must go
+        self.Generation = 0  # Bumped on every flush, so timers for sent batches do nothing
+
+    def configure(self, nk : NotifyKey, windowms : int, maxitems : int = DEFAULT_BATCH_MAX) -> None:
+        with self.Lock:
+            self.Settings[nk] = (windowms / 1000.0, maxitems)
+
+    def unconfigure(self, nk : NotifyKey) -> None:
+        with self.Lock:
+            self.Settings.pop(nk, None)
+
+    def wants(self, nk : NotifyKey) -> bool:
+        return nk in self.Settings
+
+    def add(self, mac : str, char : str, data : bytes) -> None:
+        """
+        Add a notification for a configured notify.
+        """
+        now = time.time()
+        with self.Lock:
+            window, maxitems = self.Settings.get((mac, char), (0.0, 1))
+            self.Items.append((mac, char, bytes(data), now))
+            if len(self.Items) >= maxitems:
+                self._flush()
+            elif (self.Deadline is None) or (now + window < self.Deadline):
+                self.Deadline = now + window
+                generation = self.Generation
+                self.Schedule(window, lambda: self._due(generation))
+
+    def _due(self, generation : int) -> None:
+        with self.Lock:
+            if generation == self.Generation:
+                self._flush()
+
+    def _flush(self) -> None:
+        # The caller holds the lock
+        batch = self.Items
+        self.Items = []
+        self.Deadline = None
+        self.Generation += 1
+        if batch:
+            self.Flush(batch)
+
+    def flushNow(self) -> None:
+        """
+        Send whatever is waiting, eg. before the notify is disabled.
+        """
+        with self.Lock:
+            self._flush()
+
+    def close(self) -> None:
+        """
+        The client has gone. Drop everything, and make pending timers do nothing.
+        """
+        with self.Lock:
+            self.Settings.clear()
+            self.Items = []
+            self.Deadline = None
+            self.Generation += 1
+
+
+def start_timer(delay : float, fn : Callable[[], None]) -> None:
+    """
+    A schedule() for NotifyBatcher that doesn't need a loop.
+    """
+    timer = threading.Timer(delay, fn)
+    timer.daemon = True
+    timer.start()
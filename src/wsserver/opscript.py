@@ -0,0 +1,218 @@
+"""
+Runs RunScript requests: short sequences of reads, writes, waits for a
+notification and delays, run in the server against one device so that a
+client doesn't pay a network round trip for each step. See jsondesc.py for
+the format.
+
+A script is only data, and the Parser has checked it (and its limits) before
+it gets here, so ScriptRunner trusts it.
+
+Scripts see notifications through a NotifyTap, which keeps the recent
+notifications for the characteristics the script waits on. The servers hand
+every notification to NotifyTaps.feed(), which is next to free when no script
+is running.
+"""
+import asyncio
+import collections
+import threading
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from ble.bleexceptions import BLEException, BLEOperationTimedOut
+from ble.gattclientinterface import GATTClientInterface
+from ble.uuidtype import CHAR_UUID
+from wsserver.jsondesc import data_from_param
+
+DEFAULT_TAP_KEEP = 64
+
+_BASE_UUID_TAIL = '-0000-1000-8000-00805f9b34fb'
+
+
+def full_UUID(uuid : str) -> str:
+    """
+    The 128 bit form of a UUID in lower case, so short and long forms compare equal.
+    """
+    uuid = uuid.lower()
+    if len(uuid) == 4:
+        return '0000' + uuid + _BASE_UUID_TAIL
+    if len(uuid) == 8:
+        return uuid + _BASE_UUID_TAIL
+    return uuid
+
+
+def notify_predicate(step : Dict[str, Any]) -> Callable[[bytes], bool]:
+    """
+    What an AwaitNotify step is waiting for.
+    """
+    if 'Equals' not in step:
+        return lambda data: True
+    offset = step.get('Offset', 0)
+    equals = data_from_param(step['Equals'])
+    end = offset + len(equals)
+    if 'Mask' not in step:
+        return lambda data: data[offset:end] == equals
+    mask = data_from_param(step['Mask'])
+    want = bytes(e & m for e, m in zip(equals, mask))
+    return lambda data: (len(data) >= end) and (bytes(d & m for d, m in zip(data[offset:end], mask)) == want)
+
+
+def awaited_chars(steps : List[Dict[str, Any]]) -> Set[str]:
+    chars : Set[str] = set()
+    for step in steps:
+        if step['Op'] == 'AwaitNotify':
+            chars.add(full_UUID(step['Char']))
+        elif step['Op'] == 'Loop':
+            chars |= awaited_chars(step['Steps'])
+    return chars
+
+
+class NotifyTap:
+    """
+    A running script's recent notifications, numbered in the order they came.
+    feed() is called on BLE threads; wait() on the script's loop.
+    """
+
+    def __init__(self, loop : asyncio.AbstractEventLoop, chars : FrozenSet[str], keep : int = DEFAULT_TAP_KEEP):
+        self.Loop = loop
+        self.Chars = chars
+        self.Lock = threading.Lock()
+        self.Seq = 0  # The number of the last notification
+        self.Items : Deque[Tuple[int, str, bytes]] = collections.deque(maxlen=keep)
+        self.Changed = asyncio.Event()
+
+    def feed(self, char : str, data : bytes) -> None:
+        char = full_UUID(char)
+        if char not in self.Chars:
+            return
+        with self.Lock:
+            self.Seq += 1
+            self.Items.append((self.Seq, char, bytes(data)))
+        self.Loop.call_soon_threadsafe(self.Changed.set)
+
+    async def wait(self, char : str, predicate : Callable[[bytes], bool], since : int, timeout : float) -> Tuple[int, bytes]:
+        """
+        The first notification from char after number since that predicate
+        likes, and its number. Raises BLEOperationTimedOut after timeout seconds.
+        """
+        char = full_UUID(char)
+        deadline = self.Loop.time() + timeout
+        while True:
+            self.Changed.clear()
+            with self.Lock:
+                items = list(self.Items)
+            for seq, c, data in items:
+                if (seq > since) and (c == char) and predicate(data):
+                    return seq, data
+            remaining = deadline - self.Loop.time()
+            if remaining <= 0:
+                raise BLEOperationTimedOut("No matching notification from %s" % (char,))
+            try:
+                await asyncio.wait_for(self.Changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass  # One last look, then give up
+
+
+class NotifyTaps:
+    """
+    The NotifyTaps of the scripts running, by MAC.
+    """
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.ByMAC : Dict[str, Tuple[NotifyTap, ...]] = {}
+
+    def add(self, mac : str, tap : NotifyTap) -> None:
+        with self.Lock:
+            self.ByMAC[mac.upper()] = self.ByMAC.get(mac.upper(), ()) + (tap,)
+
+    def remove(self, mac : str, tap : NotifyTap) -> None:
+        with self.Lock:
+            taps = tuple(t for t in self.ByMAC.get(mac.upper(), ()) if t is not tap)
+            if taps:
+                self.ByMAC[mac.upper()] = taps
+            else:
+                self.ByMAC.pop(mac.upper(), None)
+
+    def feed(self, mac : str, char : str, data : bytes) -> None:
+        if not self.ByMAC:
+            return
+        for tap in self.ByMAC.get(mac.upper(), ()):
+            tap.feed(char, data)
+
+
+class ScriptRunner:
+    """
+    Runs one parsed script against a GATTClient, on the loop that awaits run().
+
+    setnotify(uuid, enable) turns a notify on or off for the client that sent
+    the script. progress(step, op, data), if given, is called after each step.
+    """
+
+    def __init__(self, gc : GATTClientInterface, mac : str, steps : List[Dict[str, Any]], taps : NotifyTaps,
+                 setnotify : Callable[[CHAR_UUID, bool], Awaitable[Any]],
+                 progress : Optional[Callable[[int, str, Optional[bytes]], Any]] = None):
+        self.GC = gc
+        self.MAC = mac
+        self.Steps = steps
+        self.Taps = taps
+        self.SetNotify = setnotify
+        self.Progress = progress
+        self.Tap : Optional[NotifyTap] = None
+        self.Count = 0  # Steps run so far
+        self.Data : Optional[bytes] = None  # From the last Read or AwaitNotify
+        self.Since = 0  # Notifications up to this number are too old for the next AwaitNotify
+
+    async def run(self, timeout : float) -> Dict[str, Any]:
+        """
+        Run the script. Returns the RunScript response results.
+        """
+        start = time.monotonic()
+        chars = awaited_chars(self.Steps)
+        if chars:
+            self.Tap = NotifyTap(asyncio.get_running_loop(), frozenset(chars))
+            self.Taps.add(self.MAC, self.Tap)
+        try:
+            await asyncio.wait_for(self._runSteps(self.Steps), timeout)
+        except asyncio.TimeoutError:
+            raise BLEOperationTimedOut("Script took more than %d ms, and was stopped after step %d" % (timeout * 1000, self.Count)) from None
+        finally:
+            if self.Tap is not None:
+                self.Taps.remove(self.MAC, self.Tap)
+        return {'Steps' : self.Count, 'Elapsed' : int((time.monotonic() - start) * 1000), 'Data' : self.Data}
+
+    async def _runSteps(self, steps : List[Dict[str, Any]]) -> None:
+        for step in steps:
+            op = step['Op']
+            if op == 'Loop':
+                for _ in range(step['Count']):
+                    await self._runSteps(step['Steps'])
+                continue
+
+            started = self.Tap.Seq if self.Tap is not None else 0
+            try:
+                data = await self._runStep(op, step)
+            except BLEException as pe:
+                raise type(pe)("Step %d (%s) failed: %s" % (self.Count + 1, op, getattr(pe, 'message', str(pe)))) from pe
+            # The next AwaitNotify only wants notifications from this step on
+            self.Since = max(self.Since, started)
+            self.Count += 1
+            if data is not None:
+                self.Data = data
+            if self.Progress is not None:
+                self.Progress(self.Count, op, data)
+
+    async def _runStep(self, op : str, step : Dict[str, Any]) -> Optional[bytes]:
+        if op == 'Write':
+            await self.GC.async_char_write(CHAR_UUID(step['Char']), data_from_param(step['Data']), step.get('RR', True))
+        elif op == 'Read':
+            return bytes(await self.GC.async_char_read(CHAR_UUID(step['Char'])))
+        elif op == 'SetNotify':
+            await self.SetNotify(CHAR_UUID(step['Char']), step['Enable'])
+        elif op == 'AwaitNotify':
+            assert self.Tap is not None
+            seq, data = await self.Tap.wait(step['Char'], notify_predicate(step), self.Since, step['Timeout'] / 1000.0)
+            self.Since = seq  # So the next AwaitNotify can't have it too
+            return data
+        elif op == 'Delay':
+            await asyncio.sleep(step['Ms'] / 1000.0)
+        return None
@@ -0,0 +1,200 @@
+"""
+A queue of outgoing messages for each WebSocket client.
+
+Whatever produces a message (a request, or a BLE callback) just puts it on
+the client's SendQueue and carries on. A writer for the client (a thread in
+SyncWSServer, a task in AsyncWSServer) takes messages off and sends them, so
+a client on bad Wi-Fi only slows down its own writer.
+
+Once a client has HighWater messages waiting, new ones are handled by their
+class's SendPolicy:
+
+    KEEP    queued anyway. Always used for responses and connection states,
+            which clients can't do without.
+    DROP    thrown away.
+    LATEST  replaces the waiting message with the same key (eg. the last
+            notification from the same MAC/Char), keeping its place in the
+            queue. Thrown away if there isn't one.
+
+Each queue keeps counts and lag (how long messages wait) for the metrics.
+See QOpMetrics.watchSendQueue().
+"""
+import collections
+import enum
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from ble.qopmetrics import get_QOpMetrics
+
+DEFAULT_HIGH_WATER = 256
+
+
+class MessageClass(enum.IntEnum):
+    RESPONSE = 0  # RESP, and ExecutionError
+    STATE = 1     # ConnectionState, and anything else unsolicited
+    NOTIFY = 2    # GATTNotify, GATTNotifyBatch and binary NOTIFY frames
+    SCAN = 3      # ScanResult
+
+
+class SendPolicy(enum.Enum):
+    KEEP = 0
+    DROP = 1
+    LATEST = 2
+
+
+DEFAULT_POLICIES : Dict[MessageClass, SendPolicy] = {
+    MessageClass.RESPONSE : SendPolicy.KEEP,
+    MessageClass.STATE : SendPolicy.KEEP,
+    MessageClass.NOTIFY : SendPolicy.LATEST,
+    MessageClass.SCAN : SendPolicy.DROP,
+}
+
+
+def classify(ob : Dict[str, Any]) -> Tuple[MessageClass, Optional[Hashable]]:
+    """
+    The class of a message, and its key for LATEST.
+    """
+    if ob['type'] == 'RESP':
+        return MessageClass.RESPONSE, None
+    update = ob.get('update')
+    if update == 'GATTNotify':
+        return MessageClass.NOTIFY, (ob['results']['MAC'], ob['results']['Char'])
+    if update == 'GATTNotifyBatch':
+        return MessageClass.NOTIFY, None
+    if update == 'ScanResult':
+        return MessageClass.SCAN, ob['results']['MAC']
+    if update == 'ExecutionError':
+        return MessageClass.RESPONSE, None
+    return MessageClass.STATE, None
+
+
+class SendQueue:
+    """
+    Thread safe. wakeup() is called when the queue goes from empty to not
+    empty, from whichever thread put the message there.
+    """
+
+    def __init__(self, label : str, wakeup : Callable[[], Any], highwater : int = DEFAULT_HIGH_WATER,
+                 policies : Optional[Dict[MessageClass, SendPolicy]] = None):
+        self.Label = label
+        self.Wakeup = wakeup
+        self.HighWater = highwater
+        self.Policies = dict(DEFAULT_POLICIES)
+        self.Policies.update(policies or {})
+        for mc in (MessageClass.RESPONSE, MessageClass.STATE):
+            if self.Policies[mc] != SendPolicy.KEEP:
+                raise ValueError("%s messages can't be dropped" % (mc.name,))
+
+        self.Lock = threading.Lock()
+        self.Items : Deque[List[Any]] = collections.deque()  # [message, time queued, key]
+        self.Latest : Dict[Hashable, List[Any]] = {}  # Waiting LATEST messages, by key
+        self.Closed = False
+        self.Sent = 0
+        self.Dropped = 0
+        self.Merged = 0
+        self.MaxQueued = 0
+        self.MaxLag = 0.0
+        get_QOpMetrics().watchSendQueue(self)
+
+    def put(self, message : Any, msgclass : MessageClass, key : Optional[Hashable] = None) -> bool:
+        """
+        Returns False if the message was dropped.
+        """
+        with self.Lock:
+            if self.Closed:
+                return False
+            policy = self.Policies[msgclass]
+            if len(self.Items) >= self.HighWater:
+                if policy == SendPolicy.LATEST:
+                    waiting = self.Latest.get(key) if key is not None else None
+                    if waiting is not None:
+                        waiting[0] = message
+                        self.Merged += 1
+                        return True
+                if policy != SendPolicy.KEEP:
+                    self.Dropped += 1
+                    return False
+
+            entry = [message, time.perf_counter(), key]
+            self.Items.append(entry)
+            if (policy == SendPolicy.LATEST) and (key is not None):
+                self.Latest[key] = entry
+            self.MaxQueued = max(self.MaxQueued, len(self.Items))
+            wake = len(self.Items) == 1
+        if wake:
+            self.Wakeup()
+        return True
+
+    def pop(self) -> Optional[Any]:
+        """
+        The next message to send, or None if there isn't one.
+        """
+        with self.Lock:
+            if not self.Items:
+                return None
+            message, queued, key = entry = self.Items.popleft()
+            if (key is not None) and (self.Latest.get(key) is entry):
+                del self.Latest[key]
+            self.Sent += 1
+            self.MaxLag = max(self.MaxLag, time.perf_counter() - queued)
+            return message
+
+    def queuedCount(self) -> int:
+        return len(self.Items)
+
+    def lag(self) -> float:
+        """
+        Seconds the oldest waiting message has waited.
+        """
+        with self.Lock:
+            return time.perf_counter() - self.Items[0][1] if self.Items else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued' : self.queuedCount(),
+            'max_queued' : self.MaxQueued,
+            'lag_s' : self.lag(),
+            'max_lag_s' : self.MaxLag,
+            'sent' : self.Sent,
+            'dropped' : self.Dropped,
+            'merged' : self.Merged,
+        }
+
+    def close(self) -> None:
+        """
+        The client has gone. Waiting messages are thrown away, and put() does nothing.
+        """
+        with self.Lock:
+            self.Closed = True
+            self.Items.clear()
+            self.Latest.clear()
+        self.Wakeup()
+
+
+class SendQueueWriter:
+    """
+    A thread that sends a SendQueue's messages with send(), for servers
+    without a loop.
+    """
+
+    def __init__(self, label : str, send : Callable[[Any], Any], highwater : int = DEFAULT_HIGH_WATER,
+                 policies : Optional[Dict[MessageClass, SendPolicy]] = None):
+        self.Send = send
+        self.Ready = threading.Event()
+        self.Queue = SendQueue(label, self.Ready.set, highwater, policies)
+        self.Thread = threading.Thread(name="WSSend-%s" % (label,), daemon=True, target=self._run)
+        self.Thread.start()
+
+    def _run(self) -> None:
+        while not self.Queue.Closed:
+            self.Ready.wait()
+            self.Ready.clear()
+            while True:
+                message = self.Queue.pop()
+                if message is None:
+                    break
+                self.Send(message)
+
+    def close(self) -> None:
+        self.Queue.close()
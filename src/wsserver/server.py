@@ -1,16 +1,25 @@
+import concurrent.futures
 import functools
 import threading
 import traceback
 import logging
-from time import sleep
-from typing import Callable, Optional, Set, Tuple, TypeVar, TypedDict
+from typing import Callable, List, Optional, Set, Tuple, TypeVar, TypedDict
 
 from ble.ble import BLE
-from ble.bleexceptions import BLEException, UnknownException
-from ble.bleops import ContextConverter, QOpExecutorFactory, synchronized_with_lock
+from ble.bleexceptions import BLEException, BLEOperationNotIssued, UnknownException
+from ble.bleops import ContextConverter, QOpConcurrencyPolicy, QOpExecutorFactory
+from ble.deviceregistry import get_DeviceRegistry
+from ble.scansubscription import ScanMode, ScanSubscription
 from ble.uuidtype import CHAR_UUID
 from websocket_server.websocket_server import WebSocketHandler
+from wsserver.codecs import CodecError, JSONCodec
+from wsserver.dispatcher import DEFAULT_MAX_PER_CLIENT, DEFAULT_MAX_QUEUED, DEFAULT_WORKERS, OrderedDispatcher
+from wsserver.notifybatch import DEFAULT_BATCH_MAX, NotifyBatcher, start_timer
+from wsserver.opscript import NotifyTaps, ScriptRunner
+from wsserver.sendqueue import DEFAULT_HIGH_WATER, MessageClass, SendPolicy, SendQueueWriter, classify
 from wsserver.jsondesc import *
+from wsserver.sessions import KeyedLocks, NotifyKey, Sessions
+from wsserver.threadtools import get_WSAsyncLoop, run_coroutine_threadsafe
 
 class T_WebsocketClient(TypedDict):
     id : int
@@ -81,175 +90,383 @@ class SyncWSServer:
 
     Async server was not playing well with Kivy. There are timeouts and things I
     can't interrupt.
+
+    Any number of clients can share the BLE devices. See sessions.py.
     """
-    def __init__(self, logger : logging.Logger, androidcontext : Any = None):
+    def __init__(self, logger : logging.Logger, androidcontext : Any = None, qoppolicy : Optional[QOpConcurrencyPolicy] = None,
+                 host : str = '0.0.0.0', port : int = 8765, workers : int = DEFAULT_WORKERS,
+                 maxqueued : int = DEFAULT_MAX_QUEUED, maxperclient : int = DEFAULT_MAX_PER_CLIENT,
+                 highwater : int = DEFAULT_HIGH_WATER, sendpolicies : Optional[Dict[MessageClass, SendPolicy]] = None):
+        """
+        qoppolicy decides how BLE operations for different devices may overlap.
+        The default runs one operation at a time in total. See bleops.py.
+
+        Requests run on workers threads, in order for each device, with at
+        most maxqueued waiting and maxperclient from one client. See dispatcher.py.
+
+        Messages to each client go through its own queue and thread. Past
+        highwater waiting messages, sendpolicies decide what is dropped. See sendqueue.py.
+
+        See asyncserver.py for an asyncio version of this server.
+        """
         self.Logger = logger
+        self.Host = host
+        self.Port = port
         self.SeenDevices : set[str] = set()
-        self.BLE = BLE(QOpExecutorFactory(), NoOpConverter(), androidcontext = androidcontext)
+        self.BLE = BLE(QOpExecutorFactory(qoppolicy), NoOpConverter(), androidcontext = androidcontext)
 
         # Can't call this from a service. :-/
         #   self.BLE.requestBLEEnableIfRequired()
         # Copied the important bits into main.py instead()
         
         self.Parser = WSBLEParser()
-        self.run()
+        self.Handlers = self.makeHandlers()
+        self.BatchHandlers = self.makeBatchHandlers()
+        self.Codec = JSONCodec()  # websocket_server only does text frames, and no subprotocols
         self.Stop = False
-        self.ConnLock = threading.RLock()
-        self.ConnSet : set[int] = set()
-
-    @synchronized_with_lock("ConnLock")
-    def addConn(self, clientid : int) -> None:
-        self.ConnSet.add(clientid)
-
-    @synchronized_with_lock("ConnLock")
-    def remConn(self, clientid : int) -> None:
-        self.ConnSet.discard(clientid)
-
-    @synchronized_with_lock("ConnLock")
-    def getConnSet(self) -> Set[int]:
-        return self.ConnSet
+        self.Sessions : Sessions[T_WebsocketClient] = Sessions()
+        self.MACLocks = KeyedLocks()  # Connection and notify changes for a MAC happen one at a time
+        self.BatchersLock = threading.Lock()
+        self.Batchers : Dict[int, NotifyBatcher] = {}  # Clients that have batched notifies, by id
+        self.Dispatcher = OrderedDispatcher(workers, maxqueued, maxperclient)
+        self.HighWater = highwater
+        self.SendPolicies = sendpolicies
+        self.Writers : Dict[int, SendQueueWriter] = {}  # By client id
+        self.ScriptTaps = NotifyTaps()
+        self.ScriptsLock = threading.Lock()
+        self.Scripts : Dict[int, Set['concurrent.futures.Future[Dict[str, Any]]']] = {}  # Running, by client id
+        self.ScansLock = threading.Lock()
+        self.Scans : Dict[int, Set[ScanSubscription]] = {}  # Running, by client id
+        self.run()
 
     def shutdown(self) -> None:
         self.Stop = True
         self.BLE.on_stop()
         if self.Server:
             self.Server.shutdown_gracefully()
+        self.Dispatcher.shutdown()
 
     @catch_exceptions_and_send_as_JSON
-    def do_scan(self, client: T_WebsocketClient, uid : int, timeout : float):
+    def do_scan(self, client: T_WebsocketClient, uid : int, timeout : float, scanfilter : Optional[ScanFilter] = None):
         """
-        Scan for timeout seconds. Check for results 4 times per second and pass them on.
+        Scan for timeout seconds. Results are passed on as soon as the scan tool reports them.
+        If there is a scanfilter, only matching devices are passed on.
+
+        This is a shared scan, so it doesn't get in the way of anyone else scanning.
+        It is run from the scan tool's callbacks, so it doesn't need a Dispatcher
+        worker, and this returns straight away. The scan is closed if the
+        client leaves before it ends.
         """
         self.SeenDevices : set[str] = set()
-        self.BLE.scanForDevices(timeout)
         st = self.BLE.getBLEScanTool()
-        if st is not None:
-            while st.isScanning():
-                if self.Stop:
-                    self.Logger.debug("WSServer: Stop is set")
-                    st.stopScanning()
-                    return
-                entries = st.getSeenEntries()
-                for i in entries:
-                    if i not in self.SeenDevices:
-                        self.SeenDevices.add(i)
-                        self.Logger.info(f"UI: ble_scan_check: {i} : {entries[i]}")
-                        item = entries[i]
-                        self.Logger.info("Seen: %s" % (item,))
-                        update = make_update_from_blescanresult(uid, item)
-                        self.sendJSON(client, update)
-
-                sleep(0.25)
-
-        stopresult = BLEScanResult("", "", [], None, None)
-        update = make_update_from_blescanresult(uid, stopresult)
-        self.sendJSON(client, update)
+        if st is None:
+            self.sendJSON(client, make_update_from_blescanresult(uid, BLEScanResult("", "", [], None, None)))
+            return
+
+        subs : List[ScanSubscription] = []  # This scan's, once startSharedScan() returns
+
+        def found(item : Optional[BLEScanResult]):
+            # On the BLE thread, but sending only queues the message
+            if item is None:
+                # The scan is over
+                with self.ScansLock:
+                    running = self.Scans.get(client['id'])
+                    if running is not None:
+                        running.difference_update(subs)
+                        if not running:
+                            del self.Scans[client['id']]
+                self.sendJSON(client, make_update_from_blescanresult(uid, BLEScanResult("", "", [], None, None)))
+                return
+            if self.Stop:
+                return
+
+            self.SeenDevices.add(item.MAC)
+            self.Logger.info("Seen: %s" % (item,))
+            self.sendJSON(client, make_update_from_blescanresult(uid, item))
+
+        sub = st.startSharedScan(found, scanfilter, timeout, ScanMode.LOW_LATENCY)
+        with self.ScansLock:
+            subs.append(sub)
+            if sub.Active:
+                self.Scans.setdefault(client['id'], set()).add(sub)
 
     @catch_exceptions_and_send_as_JSON
-    def do_connect(self, client: T_WebsocketClient, uid : int, mac : str):
+    def do_get_devices(self, client: T_WebsocketClient, uid : int, scanfilter : Optional[ScanFilter], maxage : Optional[float]) -> None:
+        """
+        Send what the device registry knows, without scanning.
+        """
+        records = get_DeviceRegistry().devices(scanfilter, maxage)
+        resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, make_devices_from_records(records))
+        self.sendJSON(client, resp)
+
+    @catch_exceptions_and_send_as_JSON
+    def do_connect(self, client: T_WebsocketClient, uid : int, mac : str, autoreconnect : bool = False):
         """
         Connect to GATT Client
+
+        With autoreconnect, the GATT client puts the link back together by
+        itself if it drops, and we send one update when it is done.
+
+        If another client already has the device connected, we just join in.
+        Connection changes go to every client using the device.
         """
         gc = self.BLE.getGATTClient(mac)
 
         def disc_callback(cstate : GATTCState):
-            upd = make_ConnectionState(uid, mac, cstate, []) 
-            self.sendJSON(client, upd)
-
-        gc.set_disc_callback(disc_callback)
-
-        # This call blocks, but we're running in our own thread anyway
-        result = gc.connect()
-        print("do_connect: got result", result)
+            for c, cuid in self.Sessions.connectionClients(mac):
+                self.sendJSON(c, make_ConnectionState(cuid, mac, cstate, []))
+
+        def supervised_callback(cstate : GATTCState):
+            uuids = gc.getCharacteristicsUUIDs() if cstate == GATTCState.CONNECTED else []
+            self.sendJSONToAll([c for c, _ in self.Sessions.connectionClients(mac)], make_ConnectionState(0, mac, cstate, uuids))
+
+        with self.MACLocks.get(mac):
+            self.Sessions.addConnection(mac, client['id'], uid)
+            if gc.is_connected():
+                result = GATTCState.CONNECTED
+            else:
+                if autoreconnect:
+                    gc.set_auto_reconnect(True, supervised_callback)
+                else:
+                    gc.set_auto_reconnect(False, disc_callback)
+
+                # This call blocks, but we're running in our own thread anyway
+                try:
+                    result = gc.connect()
+                except:
+                    self.Sessions.removeConnection(mac, client['id'])
+                    raise
+                print("do_connect: got result", result)
         update = make_ConnectionState(uid, mac, result, gc.getCharacteristicsUUIDs())
         self.sendJSON(client, update)
 
     @catch_exceptions_and_send_as_JSON
-    def do_set_notify(self, client: T_WebsocketClient, uid : int, mac : str, uuid : CHAR_UUID, enable : bool) -> None:
+    def do_set_notify(self, client: T_WebsocketClient, uid : int, mac : str, uuid : CHAR_UUID, enable : bool,
+                      batchwindow : Optional[int] = None, batchmax : Optional[int] = None) -> None:
+        self.setNotify(client, mac, uuid, enable, batchwindow, batchmax)
+        resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {})
+        self.sendJSON(client, resp)
+
+    def setNotify(self, client: T_WebsocketClient, mac : str, uuid : CHAR_UUID, enable : bool,
+                  batchwindow : Optional[int] = None, batchmax : Optional[int] = None) -> None:
+        """
+        The device's notify is enabled for the first client that wants it, and
+        disabled when the last one is done. Each notification is turned into
+        JSON once, and sent to every client that wants it.
+
+        Clients that asked for a batchwindow get it in their next GATTNotifyBatch instead.
+        """
+        char = uuid.AsString
+
         def sendcallback(characteristic : CHAR_UUID, data : bytes):
-            results = {
-                "MAC"  : mac,
-                "Char" : characteristic.AsString,
-                "Data" : str(base64.b64encode(data), "utf-8")
-            }
-            upd = make_update(0, "GATTNotify", results)
-            self.sendJSON(client, upd)
+            self.ScriptTaps.feed(mac, char, data)
+            direct = []
+            for c in self.Sessions.notifyClients(mac, char):
+                batcher = self.Batchers.get(c['id'])
+                if (batcher is not None) and batcher.wants((mac, char)):
+                    batcher.add(mac, char, data)
+                else:
+                    direct.append(c)
+            if direct:
+                self.sendJSONToAll(direct, make_GATTNotify(mac, characteristic.AsString, data))
 
         gc = self.BLE.getGATTClient(mac)
-        gc.set_notify(uuid, enable, sendcallback)
-        resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {})
-        self.sendJSON(client, resp)
+        with self.MACLocks.get(mac):
+            if enable:
+                if self.Sessions.addNotify(mac, char, client['id']):
+                    try:
+                        gc.set_notify(uuid, True, sendcallback)
+                    except:
+                        self.Sessions.removeNotify(mac, char, client['id'])
+                        raise
+            else:
+                if self.Sessions.removeNotify(mac, char, client['id']):
+                    gc.set_notify(uuid, False, None)
+
+        if enable and batchwindow:
+            self.getBatcher(client).configure((mac, char), batchwindow, batchmax or DEFAULT_BATCH_MAX)
+        elif client['id'] in self.Batchers:
+            self.Batchers[client['id']].flushNow()
+            self.Batchers[client['id']].unconfigure((mac, char))
+
+    def getBatcher(self, client: T_WebsocketClient) -> NotifyBatcher:
+        with self.BatchersLock:
+            batcher = self.Batchers.get(client['id'])
+            if batcher is None:
+                batcher = NotifyBatcher(lambda items: self.sendJSON(client, make_GATTNotifyBatch(items)), start_timer)
+                self.Batchers[client['id']] = batcher
+            return batcher
 
     @catch_exceptions_and_send_as_JSON
     def do_disconnect(self, client: T_WebsocketClient, uid : int, mac : str) -> None:
         """
-        Disconnect GATT Client
+        Disconnect GATT Client, if no other client is using it. Either way,
+        this client is done with it.
         """
         gc = self.BLE.getGATTClient(mac)
-        result = gc.disconnect()
+        with self.MACLocks.get(mac):
+            last, unwanted = self.Sessions.removeConnection(mac, client['id'])
+            if last:
+                result = gc.disconnect()
+            else:
+                self.releaseNotifies(unwanted)
+                result = GATTCState.DISCONNECTED
         update = make_ConnectionState(uid, mac, result, [])
         self.sendJSON(client, update)
 
+    def releaseNotifies(self, notifies : List[NotifyKey]) -> None:
+        """
+        Disable notifies nobody wants any more.
+        """
+        for mac, char in notifies:
+            with self.MACLocks.get(mac):
+                gc = self.BLE.getGATTClient(mac)
+                try:
+                    if gc.is_connected():
+                        gc.set_notify(CHAR_UUID(char), False, None)
+                except BLEException:
+                    self.Logger.debug("WSServer: Couldn't disable notify %s on %s: %s" % (char, mac, traceback.format_exc()))
+
+    def releaseConnections(self, macs : List[str]) -> None:
+        """
+        Disconnect devices nobody is using any more.
+        """
+        for mac in macs:
+            with self.MACLocks.get(mac):
+                gc = self.BLE.getGATTClient(mac)
+                try:
+                    if gc.is_connected():
+                        gc.disconnect()
+                except BLEException:
+                    # We really can't do anything if a disconnect fails
+                    self.Logger.debug("WSServer: Couldn't disconnect %s: %s" % (mac, traceback.format_exc()))
+
     @catch_exceptions_and_send_as_JSON
-    def do_read(self, client: T_WebsocketClient, uid : int, mac : str, char : CHAR_UUID, rlen : int) -> None:
+    def do_read(self, client: T_WebsocketClient, uid : int, mac : str, char : CHAR_UUID, rlen : int, qopoptions : Dict[str, Any]) -> None:
         """
         Read 'rlen' bytes from 'mac' characteristic 'char'.
         """
         gc = self.BLE.getGATTClient(mac)
-        res = gc.char_read(char)
-        resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {"Data:" : base64.standard_b64encode(res).decode('ascii')})
-        print(resp)
+        res = gc.char_read(char, **qopoptions)
+        resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {"Data:" : bytes(res)})
         self.sendJSON(client, resp)
 
     @catch_exceptions_and_send_as_JSON
-    def do_write(self, client: T_WebsocketClient, uid : int, mac : str, char : CHAR_UUID, wdata : bytes, requireresponse : bool):
+    def do_write(self, client: T_WebsocketClient, uid : int, mac : str, char : CHAR_UUID, wdata : bytes, requireresponse : bool, qopoptions : Dict[str, Any]):
         """
         Write 'wdata' to 'mac' characteristic 'char'.
         """
         gc = self.BLE.getGATTClient(mac)
-        decodedata = base64.b64decode(wdata)
-        gc.char_write(char, decodedata, requireresponse)
+        decodedata = data_from_param(wdata)
+        gc.char_write(char, decodedata, requireresponse, **qopoptions)
         resp = make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {})
         self.sendJSON(client, resp)
 
+    @catch_exceptions_and_send_as_JSON
+    def do_batch(self, client: T_WebsocketClient, uid : int, mac : str, items : List[Dict[str, Any]], stoponerror : bool) -> None:
+        """
+        Run a Batch's items one after another. It is dispatched like any other
+        request for mac, so nothing else for mac gets in between.
+        """
+        results = []
+        for item in items:
+            try:
+                res = self.BatchHandlers[item['command']](client, mac, item['params'])
+                results.append(make_batch_result(make_error(0, ''), res))
+                continue
+            except BLEException as pe:
+                error = make_error(pe.EID, getattr(pe, 'message', repr(pe)))
+            except Exception as e:
+                self.Logger.debug("WSServer: EXCEPTION in batch item: %s" % (traceback.format_exc(),))
+                error = make_error(UnknownException.EID, repr(e))
+            results.append(make_batch_result(error, {}))
+            if stoponerror:
+                break
+        self.sendJSON(client, make_resp(uid, make_error(0, ''), {'Results' : results}))
+
+    @catch_exceptions_and_send_as_JSON
+    def do_run_script(self, client: T_WebsocketClient, uid : int, mac : str, steps : List[Dict[str, Any]], timeout : int, progress : bool) -> None:
+        """
+        The script runs on the GlobalWSAsyncThread loop while this worker
+        waits for it, so other requests for mac wait for the script too.
+        """
+        def setnotify(uuid : CHAR_UUID, enable : bool):
+            return get_WSAsyncLoop().run_in_executor(None, self.setNotify, client, mac, uuid, enable)
+
+        def sendprogress(step : int, op : str, data : Optional[bytes]):
+            self.sendJSON(client, make_ScriptProgress(uid, step, op, data))
+
+        runner = ScriptRunner(self.BLE.getGATTClient(mac), mac, steps, self.ScriptTaps, setnotify, sendprogress if progress else None)
+        future = run_coroutine_threadsafe(runner.run(timeout / 1000.0))
+        with self.ScriptsLock:
+            self.Scripts.setdefault(client['id'], set()).add(future)
+        try:
+            results = future.result()
+        except concurrent.futures.CancelledError:
+            return  # The client has gone
+        finally:
+            with self.ScriptsLock:
+                running = self.Scripts.get(client['id'])
+                if running is not None:
+                    running.discard(future)
+                    if not running:
+                        del self.Scripts[client['id']]
+        self.sendJSON(client, make_resp(uid, make_error(0, ''), results))
+
+    @catch_exceptions_and_send_as_JSON
+    def do_binary_mode(self, client: T_WebsocketClient, uid : int, enable : bool) -> None:
+        """
+        websocket_server can't send or receive binary frames, so binary mode
+        (see jsondesc.py) is only offered by AsyncWSServer.
+        """
+        if enable:
+            self.sendJSON(client, make_execution_error(uid, UnknownException.EID, "Binary mode needs the asyncio server (CAFEHUB_ASYNC_WS=1)"))
+        else:
+            self.sendJSON(client, make_resp(uid, {'eid' : 0, 'errmsg' : ''}, {'Enabled' : False}))
+
     def _cb_NewClient(self, client: T_WebsocketClient, server : WebsocketServer):
         """
         Called when a new client connects
         """
-        # We only allow 1 connection at a time.
-        # Disable any further connections
         if client is None:
             return
 
-        self.Server.deny_new_connections()
-        self.addConn(client['id'])
+        self.Writers[client['id']] = SendQueueWriter("%s:%d" % tuple(client['address'][:2]), functools.partial(self._send, client),
+                                                     self.HighWater, self.SendPolicies)
+        self.Sessions.addClient(client['id'], client)
         self.Logger.debug("SyncWS: new client: %s" % client)
 
     def _cb_ClientLeft(self, client: T_WebsocketClient, server : WebsocketServer):
         """
         Called when a client leaves.
 
-        Seems to be called more than once sometimes, hence the use of sets instead
-        of a counter. Can also be called with None? No idea why.
+        Seems to be called more than once sometimes, which Sessions doesn't
+        mind. Can also be called with None? No idea why.
+
+        Devices and notifies only this client was using are let go.
         """
         if client is None:
             return
 
-        self.Server.deny_new_connections()
-        self.remConn(client['id'])
-
-        connset = self.getConnSet()
-        if len(connset) == 0:
-            # We only allow 1 connection at a time.
-            # Disconnect any BLE devices
-            try:
-                self.BLE.disconnectAllClients()
-            except:
-                # We really can't do anything if a disconnect fails
-                pass
-
-            # If we have zero clients, allow connections again.
-            self.Server.allow_new_connections()
+        self.Dispatcher.dropClient(client['id'])
+        with self.ScriptsLock:
+            scripts = self.Scripts.pop(client['id'], set())
+        for future in scripts:
+            future.cancel()
+        with self.ScansLock:
+            scans = self.Scans.pop(client['id'], set())
+        for sub in scans:
+            sub.close()
+        writer = self.Writers.pop(client['id'], None)
+        if writer is not None:
+            writer.close()
+        unused, unwanted = self.Sessions.removeClient(client['id'])
+        with self.BatchersLock:
+            batcher = self.Batchers.pop(client['id'], None)
+        if batcher is not None:
+            batcher.close()
+        self.releaseNotifies([nk for nk in unwanted if nk[0] not in unused])
+        self.releaseConnections(unused)
 
         self.Logger.debug("SyncWS: client left: %s" % client)
 
@@ -257,7 +474,8 @@ class SyncWSServer:
         """
         Called when a client sends information
 
-        Each call is in a new thread, so blocking operations in a thread are fine
+        Called on the client's thread, which reads its messages, so requests
+        are handed to the Dispatcher rather than run here.
         """
         self.Logger.debug("SyncWS: new message: %s" % message)
 
@@ -266,9 +484,9 @@ class SyncWSServer:
         result = None
         # noinspection PyBroadException
         try:
-            cmd = json.loads(message)
+            cmd = self.Codec.decode(message)
             cmd = self.parseCommand(client, cmd)
-        except json.decoder.JSONDecodeError as de:
+        except CodecError as de:
             result = make_execution_error(0, UnknownException.EID, repr(de))
         except ParseException as pe:
             uid = cmd.get('uid', 0) # type: ignore
@@ -281,56 +499,113 @@ class SyncWSServer:
         if result is not None:
             self.sendJSON(client, result)
 
-    def parseCommand(self, client: T_WebsocketClient, cmd : Dict[str, Any]) -> Dict[str, Any]:
-        cmd = self.Parser.parse_obj(cmd)
-        params = cmd['params']
-        uid = cmd['id']
-        if cmd['type'] == 'REQ':
-            if cmd['command'] == 'GATTWrite':
-                self.do_write(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Data'], params['RR'])
-
-            if cmd['command'] == 'GATTRead':
-                self.do_read(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Len'])
-
-            if cmd['command'] == 'Scan':
-                self.do_scan(client, uid, params['Timeout'])
+    def makeHandlers(self) -> Dict[str, Callable[[T_WebsocketClient, int, Dict[str, Any]], Any]]:
+        """
+        What to do with each command, once the Parser has passed it.
+        """
+        def get_devices(client : T_WebsocketClient, uid : int, params : Dict[str, Any]):
+            maxage = params['MaxAge'] / 1000.0 if 'MaxAge' in params else None
+            self.dispatch(client, uid, None, self.do_get_devices, scan_filter_from_params(params), maxage)
+
+        return {
+            'GATTWrite' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_write, params['MAC'], CHAR_UUID(params['Char']), params['Data'], params['RR'], qop_options_from_params(params)),
+            'GATTRead' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_read, params['MAC'], CHAR_UUID(params['Char']), params['Len'], read_options_from_params(params)),
+            'Scan' : lambda client, uid, params: self.do_scan(client, uid, params['Timeout'], scan_filter_from_params(params)),
+            'GetDevices' : get_devices,
+            'GATTConnect' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_connect, params['MAC'], params.get('AutoReconnect', False)),
+            'GATTDisconnect' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_disconnect, params['MAC']),
+            'GATTSetNotify' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_set_notify, params['MAC'], CHAR_UUID(params['Char']), params['Enable'], params.get('BatchWindow'), params.get('BatchMax')),
+            'BinaryMode' : lambda client, uid, params: self.do_binary_mode(client, uid, params['Enable']),
+            'OpenChannel' : lambda client, uid, params: self.do_binary_mode(client, uid, True),
+            'Batch' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_batch, params['MAC'], params['Items'], params.get('StopOnError', True)),
+            'RunScript' : lambda client, uid, params: self.dispatch(client, uid, params['MAC'], self.do_run_script, params['MAC'], params['Steps'], params.get('Timeout', DEFAULT_SCRIPT_TIMEOUT), params.get('Progress', True), longrunning=True),
+        }
+
+    def makeBatchHandlers(self) -> Dict[str, Callable[[T_WebsocketClient, str, Dict[str, Any]], Dict[str, Any]]]:
+        """
+        What to do with each item of a Batch. Each returns the item's results.
+        """
+        def read(client : T_WebsocketClient, mac : str, params : Dict[str, Any]) -> Dict[str, Any]:
+            res = self.BLE.getGATTClient(mac).char_read(CHAR_UUID(params['Char']), **read_options_from_params(params))
+            return {'Data' : bytes(res)}
 
-            if cmd['command'] == 'GATTConnect':
-                self.do_connect(client, uid, params['MAC'])
+        def write(client : T_WebsocketClient, mac : str, params : Dict[str, Any]) -> Dict[str, Any]:
+            self.BLE.getGATTClient(mac).char_write(CHAR_UUID(params['Char']), data_from_param(params['Data']), params['RR'], **qop_options_from_params(params))
+            return {}
 
-            if cmd['command'] == 'GATTDisconnect':
-                self.do_disconnect(client, uid, params['MAC'])
+        def set_notify(client : T_WebsocketClient, mac : str, params : Dict[str, Any]) -> Dict[str, Any]:
+            self.setNotify(client, mac, CHAR_UUID(params['Char']), params['Enable'], params.get('BatchWindow'), params.get('BatchMax'))
+            return {}
 
-            if cmd['command'] == 'GATTSetNotify':
-                self.do_set_notify(client, uid, params['MAC'], CHAR_UUID(params['Char']), params['Enable'])
+        return {'GATTRead' : read, 'GATTWrite' : write, 'GATTSetNotify' : set_notify}
 
+    def parseCommand(self, client: T_WebsocketClient, cmd : Dict[str, Any]) -> Dict[str, Any]:
+        cmd = self.Parser.parse_obj(cmd)
+        if cmd['type'] == 'REQ':
+            self.Handlers[cmd['command']](client, cmd['id'], cmd['params'])
         return cmd
 
-    # Do I need a lock here? It would make sense that Server.send_message is multithreaded, as
-    # server is multithreaded.
-    # Okay, checking the source for send_message, it runs with a lock, so we're good.
+    def dispatch(self, client: T_WebsocketClient, uid : int, mac : Optional[str], method : Callable[..., Any], *args : Any, longrunning : bool = False) -> None:
+        """
+        Run method(client, uid, *args) on the Dispatcher, after earlier
+        requests for mac. If the queues are full, the client gets an error
+        straight away. longrunning requests can't take every worker.
+        """
+        if not self.Dispatcher.submit(mac, client['id'], method, client, uid, *args, longrunning=longrunning):
+            self.sendJSON(client, make_execution_error(uid, BLEOperationNotIssued.EID, "Too many requests waiting, try again later"))
+
     def sendJSON(self, client: T_WebsocketClient, ob : Dict[str, Any]):
         """
         Internal. Send message to the client
         """
-        self.Logger.debug("WSServer: sendJSON %s" % (ob,))
-        result = json.dumps(ob, indent=2)
-        try:
-            self.Server.send_message(client, result)
-        except BrokenPipeError:
-            self.Logger.debug("WSServer: sendJSON: Broken Pipe")
-            
+        self.sendJSONToAll([client], ob)
+
+    def sendJSONToAll(self, clients : List[T_WebsocketClient], ob : Dict[str, Any]):
+        """
+        Internal. Queue message for each of clients. It is only encoded once.
+        Doesn't wait for anything to be sent.
+        """
+        result = self.Codec.encode(ob)
+        msgclass, key = classify(ob)
+        for client in clients:
+            writer = self.Writers.get(client['id'])
+            if writer is not None:  # Otherwise the client has gone
+                writer.Queue.put(result, msgclass, key)
+
         self.Logger.debug("WSServer: >>> %s" % (result,))
         if (ob['type'] == "UPDATE") and (ob['update'] == "ExecutionError"):
             self.Logger.debug("WSServer: Error: %s" % (ob,))
             err = ob['results']['errmsg']
             self.Logger.debug("WSServer: sendJSON: %s" % (err.encode('latin-1', 'backslashreplace').decode('unicode-escape'),))
 
+    # Do I need a lock here? It would make sense that Server.send_message is multithreaded, as
+    # server is multithreaded.
+    # Okay, checking the source for send_message, it runs with a lock, so we're good.
+    def _send(self, client: T_WebsocketClient, message : str):
+        """
+        Called on the client's SendQueueWriter thread. If the socket has
+        failed, the rest of the client's queue is thrown away.
+        """
+        try:
+            self.Server.send_message(client, message)
+        except OSError as e:
+            self.Logger.debug("WSServer: sendJSON: %r" % (e,))
+            writer = self.Writers.get(client['id'])
+            if writer is not None:
+                writer.close()
+
+    def sendQueueStats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Depth, lag and drop counts of each client's send queue.
+        """
+        return { w.Queue.Label : w.Queue.stats() for w in list(self.Writers.values()) }
+
     def run(self):
         """
         Run the server in its own thread
         """
-        self.Server = WebsocketServer(host='0.0.0.0', port=8765, loglevel=logging.INFO)
+        self.Server = WebsocketServer(host=self.Host, port=self.Port, loglevel=logging.INFO)
+        self.Port = self.Server.port
 
         # Set up callbacks
         # Every message callback is called in a newly created thread.
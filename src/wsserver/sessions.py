@@ -0,0 +1,138 @@
+"""
+Book keeping for several WebSocket clients sharing the BLE devices.
+
+A device stays connected while any client that connected it is still
+interested, and a notify stays enabled while any client wants it. The
+servers ask Sessions what changed, and only touch the BLE device for the
+first client in and the last client out.
+"""
+import threading
+from typing import Any, Dict, Generic, Hashable, List, Optional, Set, Tuple, TypeVar
+
+C = TypeVar('C')  # A server's client object
+
+NotifyKey = Tuple[str, str]  # (MAC, characteristic UUID)
+
+
+class Sessions(Generic[C]):
+    """
+    Which clients are using which connections and notifies. Clients are
+    identified by a hashable key, and the client object is kept so messages
+    can be sent to it.
+
+    Thread safe. Nothing here talks to BLE, so nothing blocks for long.
+    """
+
+    def __init__(self):
+        self.Lock = threading.RLock()
+        self.Clients : Dict[Hashable, C] = {}
+        self.Connections : Dict[str, Dict[Hashable, int]] = {}  # MAC -> client key -> id of its GATTConnect
+        self.Notifies : Dict[NotifyKey, Set[Hashable]] = {}
+
+    def addClient(self, key : Hashable, client : C) -> None:
+        with self.Lock:
+            self.Clients[key] = client
+
+    def clientCount(self) -> int:
+        with self.Lock:
+            return len(self.Clients)
+
+    def removeClient(self, key : Hashable) -> Tuple[List[str], List[NotifyKey]]:
+        """
+        Forget a client. Returns the MACs and notifies nobody wants any more.
+        """
+        with self.Lock:
+            self.Clients.pop(key, None)
+            notifies = [nk for nk, keys in self.Notifies.items() if key in keys]
+            unwanted = [nk for nk in notifies if self._dropNotify(nk, key)]
+            macs = [mac for mac, keys in self.Connections.items() if key in keys]
+            unused = [mac for mac in macs if self._dropConnection(mac, key)]
+            return unused, unwanted
+
+    def addConnection(self, mac : str, key : Hashable, uid : int) -> bool:
+        """
+        Returns True if this is the first client for mac.
+        """
+        with self.Lock:
+            keys = self.Connections.setdefault(mac, {})
+            keys[key] = uid
+            return len(keys) == 1
+
+    def removeConnection(self, mac : str, key : Hashable) -> Tuple[bool, List[NotifyKey]]:
+        """
+        The client is done with mac, and with its notifies on mac. Returns True
+        if nobody else is using mac, and the notifies nobody wants any more.
+        """
+        with self.Lock:
+            notifies = [nk for nk, keys in self.Notifies.items() if (nk[0] == mac) and (key in keys)]
+            unwanted = [nk for nk in notifies if self._dropNotify(nk, key)]
+            if key not in self.Connections.get(mac, {}):
+                return False, unwanted
+            return self._dropConnection(mac, key), unwanted
+
+    def _dropConnection(self, mac : str, key : Hashable) -> bool:
+        keys = self.Connections[mac]
+        del keys[key]
+        if keys:
+            return False
+        del self.Connections[mac]
+        return True
+
+    def connectionClients(self, mac : str) -> List[Tuple[C, int]]:
+        """
+        The clients using mac, and the id of their GATTConnect.
+        """
+        with self.Lock:
+            return [(self.Clients[k], uid) for k, uid in self.Connections.get(mac, {}).items() if k in self.Clients]
+
+    def addNotify(self, mac : str, char : str, key : Hashable) -> bool:
+        """
+        Returns True if this is the first client to want the notify. A client
+        asking again for a notify it has doesn't count.
+        """
+        with self.Lock:
+            keys = self.Notifies.setdefault((mac, char), set())
+            if key in keys:
+                return False
+            keys.add(key)
+            return len(keys) == 1
+
+    def removeNotify(self, mac : str, char : str, key : Hashable) -> bool:
+        """
+        Returns True if the client was the last one that wanted the notify.
+        """
+        with self.Lock:
+            if key not in self.Notifies.get((mac, char), set()):
+                return False
+            return self._dropNotify((mac, char), key)
+
+    def _dropNotify(self, nk : NotifyKey, key : Hashable) -> bool:
+        keys = self.Notifies[nk]
+        keys.discard(key)
+        if keys:
+            return False
+        del self.Notifies[nk]
+        return True
+
+    def notifyClients(self, mac : str, char : str) -> List[C]:
+        with self.Lock:
+            return [self.Clients[k] for k in self.Notifies.get((mac, char), ()) if k in self.Clients]
+
+
+class KeyedLocks:
+    """
+    A lock per key (eg. per MAC), made when first asked for, so changes to
+    one device's connection or notifies happen one at a time.
+    """
+
+    def __init__(self, factory : Any = threading.RLock):
+        self.Lock = threading.Lock()
+        self.Factory = factory
+        self.Locks : Dict[Hashable, Any] = {}
+
+    def get(self, key : Hashable) -> Any:
+        with self.Lock:
+            lock : Optional[Any] = self.Locks.get(key)
+            if lock is None:
+                lock = self.Locks[key] = self.Factory()
+            return lock
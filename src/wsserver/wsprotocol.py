@@ -0,0 +1,247 @@
+"""
+Just enough RFC 6455 WebSockets on asyncio streams for AsyncWSServer, and a
+client for tests and benchmarks.
+
+Handles the HTTP upgrade (including picking a subprotocol), masking,
+fragmented messages, ping/pong and close. No extensions, so no compression.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT         = 0x1
+OPCODE_BINARY       = 0x2
+OPCODE_CLOSE_CONN   = 0x8
+OPCODE_PING         = 0x9
+OPCODE_PONG         = 0xA
+
+CLOSE_STATUS_NORMAL = 1000
+CLOSE_STATUS_PROTOCOL_ERROR = 1002
+CLOSE_STATUS_BAD_DATA = 1007  # eg. A text message that isn't UTF-8
+CLOSE_STATUS_TOO_BIG = 1009
+
+MAX_MESSAGE = 1 << 20  # Nothing in the protocol comes close
+
+
+class WSClosed(Exception):
+    """
+    The other end closed the connection, or it broke.
+    """
+
+
+def accept_key(key : str) -> str:
+    return base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+
+
+async def read_http_headers(reader : asyncio.StreamReader) -> Tuple[str, Dict[str, str]]:
+    """
+    Returns the request or status line, and the headers with lower case names.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        raise WSClosed("Bad HTTP header") from e
+    lines = head.decode('latin-1').split('\r\n')
+    headers : Dict[str, str] = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def split_header(value : Optional[str]) -> Sequence[str]:
+    return [v.strip() for v in value.split(',') if v.strip()] if value else []
+
+
+async def server_handshake(reader : asyncio.StreamReader, writer : asyncio.StreamWriter, subprotocols : Sequence[str] = ()) -> 'WSConnection':
+    """
+    Answer a client's upgrade request. Raises WSClosed if it isn't one.
+
+    The first subprotocol the client offers that is in subprotocols is
+    accepted, and ends up in WSConnection.Subprotocol.
+    """
+    _, headers = await read_http_headers(reader)
+    key = headers.get('sec-websocket-key')
+    if (key is None) or (headers.get('upgrade', '').lower() != 'websocket'):
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+        writer.close()
+        raise WSClosed("Not a WebSocket upgrade")
+
+    chosen = next((p for p in split_header(headers.get('sec-websocket-protocol')) if p in subprotocols), None)
+    writer.write((
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "%s"
+        "Sec-WebSocket-Accept: %s\r\n\r\n" % ("Sec-WebSocket-Protocol: %s\r\n" % (chosen,) if chosen else "", accept_key(key))).encode())
+    await writer.drain()
+    return WSConnection(reader, writer, False, chosen)
+
+
+async def connect(host : str, port : int, path : str = '/', subprotocols : Sequence[str] = ()) -> 'WSConnection':
+    """
+    Open a client connection, offering subprotocols.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((
+        "GET %s HTTP/1.1\r\n"
+        "Host: %s:%d\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "%s"
+        "Sec-WebSocket-Key: %s\r\n"
+        "Sec-WebSocket-Version: 13\r\n\r\n" % (path, host, port,
+            "Sec-WebSocket-Protocol: %s\r\n" % (', '.join(subprotocols),) if subprotocols else "", key)).encode())
+    await writer.drain()
+    status, headers = await read_http_headers(reader)
+    if (' 101 ' not in status + ' ') or (headers.get('sec-websocket-accept') != accept_key(key)):
+        writer.close()
+        raise WSClosed("Upgrade refused: %s" % (status,))
+    return WSConnection(reader, writer, True, headers.get('sec-websocket-protocol'))
+
+
+class WSConnection:
+    """
+    One end of a WebSocket. Clients mask what they send, servers don't.
+
+    recv() should only be called from one task. send() can be called from
+    any task in the same loop.
+    """
+
+    def __init__(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter, isclient : bool, subprotocol : Optional[str] = None):
+        self.Reader = reader
+        self.Writer = writer
+        self.IsClient = isclient
+        self.Subprotocol = subprotocol
+        self.Closed = False
+        peer = writer.get_extra_info('peername')
+        self.Address : Tuple[str, int] = tuple(peer[:2]) if peer else ('', 0)  # type: ignore
+
+    async def _read_frame(self) -> Tuple[bool, int, bytes]:
+        try:
+            b1, b2 = await self.Reader.readexactly(2)
+            length = b2 & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await self.Reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.Reader.readexactly(8))
+            if length > MAX_MESSAGE:
+                await self.close(CLOSE_STATUS_TOO_BIG)
+                raise WSClosed("Frame too big")
+            mask = await self.Reader.readexactly(4) if b2 & 0x80 else None
+            payload = await self.Reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.Closed = True
+            raise WSClosed("Connection lost") from e
+
+        if mask is not None:
+            payload = unmask(payload, mask)
+        return bool(b1 & 0x80), b1 & 0x0f, payload
+
+    async def recv(self) -> Union[str, bytes]:
+        """
+        The next message: a str for text, bytes for binary. Answers pings on
+        the way. Raises WSClosed when the connection closes.
+        """
+        message = bytearray()
+        msgopcode : Optional[int] = None
+        while True:
+            fin, opcode, payload = await self._read_frame()
+            if opcode == OPCODE_CLOSE_CONN:
+                await self.close()
+                raise WSClosed("Closed by peer")
+            if opcode == OPCODE_PING:
+                await self._send_frame(OPCODE_PONG, payload)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode != OPCODE_CONTINUATION:
+                msgopcode = opcode
+            elif msgopcode is None:
+                await self.close(CLOSE_STATUS_PROTOCOL_ERROR)
+                raise WSClosed("Continuation without a message")
+
+            message += payload
+            if len(message) > MAX_MESSAGE:
+                await self.close(CLOSE_STATUS_TOO_BIG)
+                raise WSClosed("Message too big")
+            if fin:
+                if msgopcode != OPCODE_TEXT:
+                    return bytes(message)
+                try:
+                    return message.decode('utf-8')
+                except UnicodeDecodeError:
+                    await self.close(CLOSE_STATUS_BAD_DATA)
+                    raise WSClosed("Text message isn't UTF-8") from None
+
+    async def send(self, message : Union[str, bytes]) -> None:
+        if isinstance(message, str):
+            await self._send_frame(OPCODE_TEXT, message.encode('utf-8'))
+        else:
+            await self._send_frame(OPCODE_BINARY, message)
+
+    def write(self, message : Union[str, bytes]) -> None:
+        """
+        send() without waiting for the data to go. Messages written one after
+        another go in that order. Nothing happens if the connection is closed.
+        """
+        if self.Closed:
+            return
+        if isinstance(message, str):
+            self.Writer.write(self._frame(OPCODE_TEXT, message.encode('utf-8')))
+        else:
+            self.Writer.write(self._frame(OPCODE_BINARY, message))
+
+    async def _send_frame(self, opcode : int, payload : bytes) -> None:
+        if self.Closed:
+            raise WSClosed("Connection is closed")
+        try:
+            self.Writer.write(self._frame(opcode, payload))
+            await self.Writer.drain()
+        except ConnectionError as e:
+            self.Closed = True
+            raise WSClosed("Connection lost") from e
+
+    def _frame(self, opcode : int, payload : bytes) -> bytes:
+        maskbit = 0x80 if self.IsClient else 0
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, maskbit | length)
+        elif length < (1 << 16):
+            header = struct.pack('!BBH', 0x80 | opcode, maskbit | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, maskbit | 127, length)
+        if self.IsClient:
+            mask = os.urandom(4)
+            header += mask
+            payload = unmask(payload, mask)
+        return header + payload
+
+    async def close(self, status : int = CLOSE_STATUS_NORMAL) -> None:
+        if self.Closed:
+            return
+        try:
+            await self._send_frame(OPCODE_CLOSE_CONN, struct.pack('!H', status))
+        except WSClosed:
+            pass
+        self.Closed = True
+        self.Writer.close()
+
+
+def unmask(payload : bytes, mask : bytes) -> bytes:
+    """
+    XOR payload with the 4 byte mask. Also masks, of course.
+    """
+    if not payload:
+        return b''
+    # One big int XOR is a lot faster than a byte at a time in Python
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(repeated, 'little')).to_bytes(len(payload), 'little')
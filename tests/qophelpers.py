@@ -0,0 +1,32 @@
+"""
+Helpers for the QOpManager and QOpScheduler tests.
+"""
+from typing import Any, Callable, List, Optional
+
+from ble.bleops import QOp, QOpManager, QOpScheduler
+
+
+class RecordingScheduler(QOpScheduler):
+    """
+    Collects submitted work instead of running it, so tests can step through it.
+    """
+    def __init__(self):
+        self.Pending : List[Callable[..., Any]] = []
+        super().__init__(submit=self.Pending.append)
+
+    def runOne(self):
+        self.Pending.pop(0)()
+
+    def runAll(self):
+        while self.Pending:
+            self.runOne()
+
+
+def make_op(log : List[str], name : str, **kwargs : Any) -> QOp[str]:
+    """
+    An op that adds name to log when it runs.
+    """
+    def op(manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> str:
+        log.append(name)
+        return name
+    return QOp(op, **kwargs)
@@ -0,0 +1,100 @@
+import ast
+import os
+
+import pytest
+
+from ble.bleops import OpResult
+from ble.uuidtype import CHAR_UUID, DESC_UUID
+
+SOURCE = os.path.abspath(os.path.join(__file__, '../../src/ble/android/gattclient.py'))
+
+
+def qop_decorators():
+    """
+    The wrap_into_QOp() decorators on each GATTClient method, by method name.
+    """
+    with open(SOURCE) as f:
+        tree = ast.parse(f.read())
+    gattclient = next(n for n in tree.body if isinstance(n, ast.ClassDef) and n.name == 'GATTClient')
+    decorators = {}
+    for node in gattclient.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            decorators[node.name] = [d.args[0].id for d in node.decorator_list
+                                     if isinstance(d, ast.Call) and getattr(d.func, 'id', None) == 'wrap_into_QOp']
+    return decorators
+
+
+def test_each_method_is_wrapped_into_one_QOp():
+    decorators = qop_decorators()
+    assert decorators['descriptor_write'] == ['_desc_write']
+    assert decorators['restore_notifies'] == ['_restore_notifies']
+    assert all(len(d) <= 1 for d in decorators.values())
+
+
+class RecordingManager:
+    """
+    Runs nothing. Records the op and answers straight away.
+    """
+    CoalesceAlways = frozenset()
+
+    def __init__(self):
+        self.Ops = []
+
+    def addFIFOOp(self, op):
+        self.Ops.append(op)
+        result = OpResult()
+        result.setResult(None)
+        op.Callback(result)
+        return op
+
+
+def test_descriptor_write_queues_a_QOp():
+    gattclient = pytest.importorskip("ble.android.gattclient", exc_type=ImportError)  # Needs jnius, so Android
+
+    class Executor:
+        Manager = RecordingManager()
+
+    gc = gattclient.GATTClient.__new__(gattclient.GATTClient)
+    gc.QOpExecutor = Executor()
+    gc.QOpTimeout = 1.0
+    gc.NativeQueue = None
+    char, desc = CHAR_UUID("0000a00d-0000-1000-8000-00805f9b34fb"), DESC_UUID("00002902-0000-1000-8000-00805f9b34fb")
+    gc.descriptor_write(char, desc, b'\x01\x00')
+
+    [op] = Executor.Manager.Ops
+    assert op.Op is gattclient.GATTClient._desc_write
+    assert op.Args == (gc, char, desc, b'\x01\x00')
+
+
+def test_failed_deferred_discovery_forgets_table_and_drops_link():
+    gattclient = pytest.importorskip("ble.android.gattclient", exc_type=ImportError)
+
+    class Cache:
+        Forgotten = []
+
+        def forget(self, mac):
+            self.Forgotten.append(mac)
+
+    class Manager:
+        Ops = []
+
+        def addLIFOOp(self, op):
+            self.Ops.append(op)
+
+    class Executor:
+        def getManager(self):
+            return Manager()
+
+    gc = gattclient.GATTClient.__new__(gattclient.GATTClient)
+    gc.MAC = "00:00:00:00:00:05"
+    gc.CachedTable = {"0000a000-0000-1000-8000-00805f9b34fb" : []}
+    gc.DiscoveryCache = Cache()
+    gc.QOpExecutor = Executor()
+    result = OpResult()
+    result.setException(gattclient.BLECouldntDiscoverServices("No"))
+    gc._deferred_discover_done(result)
+
+    assert gc.CachedTable is None
+    assert Cache.Forgotten == [gc.MAC]
+    [op] = Manager.Ops
+    assert op.Op == gc._drop_link
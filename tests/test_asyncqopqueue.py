@@ -0,0 +1,59 @@
+import asyncio
+import time
+from typing import Any, List, Optional
+
+import pytest
+
+from ble.bleexceptions import BLEOperationTimedOut
+from ble.bleops import AsyncQOpQueue, OpResult, QOpManager, async_wrap_async_into_QOp, wrap_into_QOp
+
+
+class NativeClient:
+    """
+    Just enough of a Bleak GATTClient in nativeasync mode.
+    """
+    def __init__(self):
+        self.NativeQueue = AsyncQOpQueue()
+        self.QOpTimeout = 1
+        self.Log : List[str] = []
+
+    async def _op(self, name : str, delay : float = 0, manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> str:
+        self.Log.append("start " + name)
+        await asyncio.sleep(delay)
+        self.Log.append("end " + name)
+        return name
+
+    @async_wrap_async_into_QOp(_op)
+    async def async_op(self, name : str, delay : float = 0) -> None:
+        pass
+
+    @wrap_into_QOp(_op)
+    def op(self, name : str) -> None:
+        pass
+
+
+def test_native_ops_run_one_at_a_time_in_order():
+    client = NativeClient()
+
+    async def run():
+        return await asyncio.gather(*(client.async_op(n, 0.01) for n in "abc"))
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+    assert client.Log == ["start a", "end a", "start b", "end b", "start c", "end c"]
+    assert client.op("d") == "d"
+
+
+def test_native_timeout_withdraws_waiting_op():
+    client = NativeClient()
+    results : List[OpResult[Any]] = []
+    client.NativeQueue.submitWithCallback(NativeClient._op, client, ("slow", 0.3), results.append)
+
+    async def run():
+        await client.async_op("late", timeout=0.05)
+
+    with pytest.raises(BLEOperationTimedOut, match="withdrawn"):
+        asyncio.run(run())
+
+    time.sleep(0.4)
+    assert client.Log == ["start slow", "end slow"]
+    assert results[0].getResult() == "slow"
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import struct
+
+import pytest
+
+from ble.bleexceptions import BLEConnectionError, UnknownException
+from ble.discoverycache import DiscoveryCache
+from wsserver.asyncserver import AsyncWSServer
+from wsserver.binframes import SUBPROTOCOL, FrameType, pack_read, pack_write, unpack_reply
+from wsserver.jsondesc import make_Batch, make_batch_item, make_BinaryMode, make_GATTConnect, make_GATTDisconnect, make_GATTRead, make_OpenChannel, make_req, make_RunScript, make_script_step
+from wsserver.wsprotocol import OPCODE_CONTINUATION, OPCODE_PING, OPCODE_TEXT, WSClosed, WSConnection, connect, unmask
+
+MAC = "00:00:00:00:00:01"
+UUID = "0000a002-0000-1000-8000-00805f9b34fb"
+
+
+class FakeBleakClient:
+    def __init__(self, address):
+        self.address = address
+        self.Connected = False
+        self.Notifies = {}
+        self.Calls = []
+        self.Writes = []
+        self.FailWrites = False
+        self.Echo = False  # Send each write back as a notification
+
+    async def connect(self, **kwargs):
+        self.Calls.append("connect")
+        self.Connected = True
+        return True
+
+    async def disconnect(self):
+        self.Calls.append("disconnect")
+        self.Connected = False
+        return True
+
+    def set_disconnected_callback(self, callback):
+        pass
+
+    async def start_notify(self, uuid, callback):
+        self.Calls.append("start_notify")
+        self.Notifies[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self.Calls.append("stop_notify")
+        del self.Notifies[uuid]
+
+    async def read_gatt_char(self, uuid):
+        await asyncio.sleep(0.01)
+        return bytearray(b'\x01\x02')
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        if self.FailWrites:
+            raise BLEConnectionError("Not connected")
+        if self.Echo and (uuid in self.Notifies):
+            self.Notifies[uuid](0, bytearray(data))
+        self.Writes.append((uuid, bytes(data), response))
+
+    def is_connected(self):
+        return self.Connected
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = AsyncWSServer(logging.getLogger("test"), host='127.0.0.1', port=0)
+    gc = server.BLE.getGATTClient(MAC)
+    gc.BleakClient = FakeBleakClient(MAC)
+    gc.DiscoveryCache = DiscoveryCache(str(tmp_path))
+    yield server
+    server.shutdown()
+
+
+async def expect(ws, kind):
+    """
+    The next message of a type (RESP) or update (eg. GATTNotify).
+    """
+    while True:
+        msg = json.loads(await ws.recv())
+        if kind in (msg['type'], msg.get('update')):
+            return msg
+
+
+def test_unmask_round_trips():
+    data = bytes(range(256)) * 3 + b'xyz'
+    assert unmask(unmask(data, b'\x01\x80\xff\x10'), b'\x01\x80\xff\x10') == data
+    assert unmask(b'\x00\x00\x00\x00\x00', b'\x01\x02\x03\x04') == b'\x01\x02\x03\x04\x01'
+
+
+def test_fragmented_message_and_ping():
+    class Writer:
+        def __init__(self):
+            self.Sent = b''
+        def get_extra_info(self, name):
+            return None
+        def write(self, data):
+            self.Sent += data
+        async def drain(self):
+            pass
+
+    async def run():
+        reader = asyncio.StreamReader()
+        mask = b'\x11\x22\x33\x44'
+        for fin, opcode, payload in ((0, OPCODE_TEXT, b'hel'), (1, OPCODE_PING, b'p'), (1, OPCODE_CONTINUATION, b'lo')):
+            reader.feed_data(struct.pack('!BB', (fin << 7) | opcode, 0x80 | len(payload)) + mask + unmask(payload, mask))
+        reader.feed_eof()
+        writer = Writer()
+        conn = WSConnection(reader, writer, False)  # type: ignore
+        message = await conn.recv()
+        with pytest.raises(WSClosed):
+            await conn.recv()
+        return message, writer.Sent
+
+    message, sent = asyncio.run(run())
+    assert message == 'hello'
+    assert sent == b'\x8a\x01p'  # The pong, unmasked from the server
+
+
+def test_bad_utf8_closes_the_connection(server):
+    async def run():
+        ws = await connect('127.0.0.1', server.Port)
+        await ws._send_frame(OPCODE_TEXT, b'{"\xff\xfe"}')
+        with pytest.raises(WSClosed, match="Closed by peer"):
+            await ws.recv()
+        ok = await connect('127.0.0.1', server.Port)  # The server carries on
+        await ok.send(json.dumps(make_GATTConnect(1, MAC)))
+        state = await expect(ok, 'ConnectionState')
+        await ok.close()
+        return state
+
+    assert asyncio.run(asyncio.wait_for(run(), 10))['results']['CState'] == 'CONNECTED'
+
+
+def test_concurrent_reads_and_errors(server):
+    async def run():
+        ws = await connect('127.0.0.1', server.Port)
+        for rid in range(1, 21):
+            await ws.send(json.dumps(make_GATTRead(rid, MAC, UUID, 2)))
+        await ws.send("{not json")
+        replies = [json.loads(await ws.recv()) for _ in range(21)]
+        await ws.close()
+        return replies
+
+    replies = asyncio.run(asyncio.wait_for(run(), 10))
+    resps = [r for r in replies if r['type'] == 'RESP']
+    assert sorted(r['id'] for r in resps) == list(range(1, 21))
+    assert all(r['results'] == {"Data:" : "AQI="} for r in resps)
+    errors = [r for r in replies if r['type'] == 'UPDATE']
+    assert [e['update'] for e in errors] == ['ExecutionError']
+
+
+def test_clients_share_connections_and_notifies(server):
+    fake = server.BLE.getGATTClient(MAC).BleakClient
+
+    def notify(enable, rid):
+        return json.dumps(make_req('GATTSetNotify', rid, {'MAC' : MAC, 'Char' : UUID, 'Enable' : enable}))
+
+    async def run():
+        first = await connect('127.0.0.1', server.Port)
+        second = await connect('127.0.0.1', server.Port)
+        for ws in (first, second):
+            await ws.send(json.dumps(make_GATTConnect(1, MAC)))
+            assert (await expect(ws, 'ConnectionState'))['results']['CState'] == 'CONNECTED'
+            await ws.send(notify(True, 2))
+            await expect(ws, 'RESP')
+        assert fake.Calls == ["connect", "start_notify"]
+
+        # One notification, to both
+        await asyncio.get_running_loop().run_in_executor(None, fake.Notifies[UUID], 0, bytearray(b'\x05'))
+        for ws in (first, second):
+            assert (await expect(ws, 'GATTNotify'))['results']['Data'] == 'BQ=='
+
+        await first.send(notify(False, 3))
+        await expect(first, 'RESP')
+        await first.close()
+        await asyncio.sleep(0.1)
+        assert fake.Calls == ["connect", "start_notify"]  # Still wanted by second
+
+        await second.send(json.dumps(make_GATTDisconnect(4, MAC)))
+        assert (await expect(second, 'ConnectionState'))['results']['CState'] == 'DISCONNECTED'
+        await second.close()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert fake.Calls == ["connect", "start_notify", "disconnect"]
+
+
+def test_binary_mode(server):
+    fake = server.BLE.getGATTClient(MAC).BleakClient
+
+    async def run():
+        binary = await connect('127.0.0.1', server.Port, subprotocols=(SUBPROTOCOL,))
+        assert binary.Subprotocol == SUBPROTOCOL
+        text = await connect('127.0.0.1', server.Port)
+        assert text.Subprotocol is None
+
+        await binary.send(json.dumps(make_GATTConnect(1, MAC)))
+        await expect(binary, 'ConnectionState')
+        await binary.send(json.dumps(make_req('GATTSetNotify', 2, {'MAC' : MAC, 'Char' : UUID, 'Enable' : True})))
+        channel = (await expect(binary, 'RESP'))['results']['Channel']
+
+        # A text client joins in with the handshake command instead
+        await text.send(json.dumps(make_OpenChannel(3, MAC, UUID)))
+        assert (await expect(text, 'RESP'))['results']['Channel'] == channel
+        await text.send(json.dumps(make_BinaryMode(4, False)))
+        assert (await expect(text, 'RESP'))['results'] == {'Enabled' : False}
+        await text.send(pack_read(channel, 5))
+        assert (await expect(text, 'ExecutionError'))['id'] == 5
+
+        await asyncio.get_running_loop().run_in_executor(None, fake.Notifies[UUID], 0, bytearray(b'\x05\x06'))
+        assert unpack_reply(await binary.recv()) == (FrameType.NOTIFY, channel, None, b'\x05\x06')
+
+        await binary.send(pack_read(channel, 7))
+        assert unpack_reply(await binary.recv()) == (FrameType.READ_RESULT, channel, 7, b'\x01\x02')
+        await binary.send(pack_write(channel, 8, b'\xff', True))
+        assert unpack_reply(await binary.recv()) == (FrameType.WRITE_RESULT, channel, 8, b'')
+        await binary.send(pack_read(channel + 1, 9))
+        assert (await expect(binary, 'ExecutionError'))['id'] == 9
+
+        await binary.close()
+        await text.close()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert fake.Writes == [(UUID, b'\xff', True)]
+
+
+def test_batch(server):
+    fake = server.BLE.getGATTClient(MAC).BleakClient
+    items = [
+        make_batch_item('GATTWrite', {'Char' : UUID, 'Data' : 'AQI=', 'RR' : True}),
+        make_batch_item('GATTRead', {'Char' : UUID, 'Len' : 2}),
+        make_batch_item('GATTSetNotify', {'Char' : UUID, 'Enable' : True}),
+    ]
+
+    async def run():
+        ws = await connect('127.0.0.1', server.Port)
+        await ws.send(json.dumps(make_Batch(1, MAC, items)))
+        ok = await expect(ws, 'RESP')
+        fake.FailWrites = True
+        await ws.send(json.dumps(make_Batch(2, MAC, items)))
+        stopped = await expect(ws, 'RESP')
+        await ws.send(json.dumps(make_Batch(3, MAC, items, stoponerror=False)))
+        carried_on = await expect(ws, 'RESP')
+        await ws.close()
+        return ok, stopped, carried_on
+
+    ok, stopped, carried_on = asyncio.run(asyncio.wait_for(run(), 10))
+    assert ok['error']['eid'] == 0
+    assert [r['error']['eid'] for r in ok['results']['Results']] == [0, 0, 0]
+    assert ok['results']['Results'][1]['results'] == {'Data' : 'AQI='}
+    assert fake.Writes == [(UUID, b'\x01\x02', True)]
+    assert "start_notify" in fake.Calls
+
+    assert stopped['error']['eid'] == 0
+    assert [r['error']['eid'] for r in stopped['results']['Results']] == [BLEConnectionError.EID]
+    assert [r['error']['eid'] for r in carried_on['results']['Results']] == [BLEConnectionError.EID, 0, 0]
+
+
+def test_batch_item_with_non_BLE_error(server):
+    async def broken(client, mac, params):
+        raise KeyError("Not a BLE error")
+    server.BatchHandlers['GATTRead'] = broken
+    items = [
+        make_batch_item('GATTRead', {'Char' : UUID, 'Len' : 2}),
+        make_batch_item('GATTWrite', {'Char' : UUID, 'Data' : 'AQI=', 'RR' : True}),
+    ]
+
+    async def run():
+        ws = await connect('127.0.0.1', server.Port)
+        await ws.send(json.dumps(make_Batch(1, MAC, items)))
+        stopped = await expect(ws, 'RESP')
+        await ws.send(json.dumps(make_Batch(2, MAC, items, stoponerror=False)))
+        carried_on = await expect(ws, 'RESP')
+        await ws.close()
+        return stopped, carried_on
+
+    stopped, carried_on = asyncio.run(asyncio.wait_for(run(), 10))
+    assert [r['error']['eid'] for r in stopped['results']['Results']] == [UnknownException.EID]
+    assert "Not a BLE error" in stopped['results']['Results'][0]['error']['errmsg']
+    assert [r['error']['eid'] for r in carried_on['results']['Results']] == [UnknownException.EID, 0]
+
+
+def test_run_script(server):
+    fake = server.BLE.getGATTClient(MAC).BleakClient
+    fake.Echo = True
+    steps = [
+        make_script_step('SetNotify', Char=UUID, Enable=True),
+        make_script_step('Write', Char=UUID, Data='AQI='),
+        make_script_step('AwaitNotify', Char=UUID, Timeout=2000, Equals='AQ=='),
+        make_script_step('Loop', Count=2, Steps=[make_script_step('Read', Char=UUID)]),
+    ]
+
+    async def run():
+        ws = await connect('127.0.0.1', server.Port)
+        await ws.send(json.dumps(make_RunScript(1, MAC, steps)))
+        progress = [await expect(ws, 'ScriptProgress') for _ in range(5)]
+        resp = await expect(ws, 'RESP')
+        await ws.send(json.dumps(make_RunScript(2, MAC, [make_script_step('AwaitNotify', Char=UUID, Timeout=50)], progress=False)))
+        error = await expect(ws, 'ExecutionError')
+        await ws.close()
+        return progress, resp, error
+
+    progress, resp, error = asyncio.run(asyncio.wait_for(run(), 10))
+    assert [(p['id'], p['results']['Step'], p['results']['Op']) for p in progress] == [
+        (1, 1, 'SetNotify'), (1, 2, 'Write'), (1, 3, 'AwaitNotify'), (1, 4, 'Read'), (1, 5, 'Read')]
+    assert progress[2]['results']['Data'] == 'AQI='
+    assert resp['id'] == 1
+    assert resp['results']['Steps'] == 5
+    assert resp['results']['Data'] == 'AQI='
+    assert error['id'] == 2
+    assert error['results']['eid'] == 2  # BLEOperationTimedOut
@@ -0,0 +1,34 @@
+import pytest
+
+from wsserver.binframes import BinaryFrameError, ChannelTable, FrameType, pack_notify, pack_read, pack_read_result, pack_write, unpack_reply, unpack_request
+from wsserver.jsondesc import MAX_ATTRIBUTE_LEN
+
+
+def test_frames_round_trip():
+    assert pack_notify(0x0102, b'\x05') == b'\x01\x01\x02\x05'
+    assert unpack_reply(pack_notify(3, b'abc')) == (FrameType.NOTIFY, 3, None, b'abc')
+    assert unpack_reply(pack_read_result(3, 70000, b'x')) == (FrameType.READ_RESULT, 3, 70000, b'x')
+
+    request = unpack_request(pack_write(9, 42, b'\x00\x01', True))
+    assert (request.Type, request.Channel, request.Id, request.RequireResponse, request.Data) == (FrameType.WRITE, 9, 42, True, b'\x00\x01')
+    request = unpack_request(pack_read(9, 43))
+    assert (request.Type, request.Channel, request.Id) == (FrameType.READ, 9, 43)
+    assert len(unpack_request(pack_write(9, 44, bytes(MAX_ATTRIBUTE_LEN), False)).Data) == MAX_ATTRIBUTE_LEN
+
+
+@pytest.mark.parametrize("frame", [b'', b'\x03\x00', pack_read(1, 1) + b'x', b'\x02\x00\x01', pack_notify(1, b'x'),
+                                   pack_write(1, 1, bytes(MAX_ATTRIBUTE_LEN + 1), True)])
+def test_bad_requests(frame):
+    with pytest.raises(BinaryFrameError):
+        unpack_request(frame)
+
+
+def test_channels_are_shared_and_stable():
+    table = ChannelTable()
+    first = table.open("00:00:00:00:00:01", "a002")
+    second = table.open("00:00:00:00:00:01", "a003")
+    assert first != second
+    assert table.open("00:00:00:00:00:01", "a002") == first
+    assert table.lookup(second) == ("00:00:00:00:00:01", "a003")
+    with pytest.raises(BinaryFrameError):
+        table.lookup(99)
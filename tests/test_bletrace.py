@@ -0,0 +1,52 @@
+from typing import Any, List, Optional
+
+from ble.bleops import QOp, QOpExecutor, QOpManager, QOpScheduler
+from ble.bletrace import BLETrace, TraceEvent, decode, get_BLETrace, head
+
+
+def test_ring_buffer_keeps_newest_records():
+    trace = BLETrace(capacity=4)
+    for i in range(10):
+        trace.record(TraceEvent.CHAR_WRITE, trace.intern("uuid%d" % (i % 2,)), i, i)
+    recs = trace.records()
+    assert [r.B for r in recs] == [6, 7, 8, 9]
+    assert [trace.Strings[r.A] for r in recs] == ["uuid0", "uuid1", "uuid0", "uuid1"]
+
+
+def test_dump_round_trips():
+    trace = BLETrace(capacity=8)
+    trace.record(TraceEvent.NOTIFY, trace.intern("a002"), head(b'\x01\x02'), 2)
+    recs, strings = decode(trace.dump())
+    assert len(recs) == 1
+    assert recs[0].Event == TraceEvent.NOTIFY
+    assert strings[recs[0].A] == "a002"
+    assert (recs[0].B, recs[0].Small) == (0x0201, 2)
+    assert "NOTIFY" in trace.toText()
+
+
+def test_qop_lifecycle_is_traced_only_when_enabled():
+    trace = get_BLETrace()
+    pending : List[Any] = []
+    manager = QOpManager()
+    QOpExecutor(manager, QOpScheduler(submit=pending.append)).startBackgroundProcessing()
+
+    def _char_read(manager : Optional[QOpManager] = None) -> bytes:
+        return b'1'
+
+    def run():
+        manager.addFIFOOp(QOp(_char_read))
+        while pending:
+            pending.pop(0)()
+
+    trace.clear()
+    run()
+    assert trace.records() == []
+
+    trace.enable()
+    try:
+        run()
+    finally:
+        trace.enable(False)
+    events = [r.Event for r in trace.records() if r.Event in (TraceEvent.OP_QUEUED, TraceEvent.OP_DO, TraceEvent.OP_DELIVER, TraceEvent.OP_DONE)]
+    assert events == [TraceEvent.OP_QUEUED, TraceEvent.OP_DO, TraceEvent.OP_DELIVER, TraceEvent.OP_DONE]
+    trace.clear()
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from wsserver.codecs import CBORCodec, CodecError, JSONCodec, MsgPackCodec
+from wsserver.jsondesc import data_from_param, make_GATTNotify, make_GATTWrite
+
+MAC = "00:00:00:00:00:01"
+UUID = "0000a002-0000-1000-8000-00805f9b34fb"
+
+
+def test_json_is_compact_and_base64s_bytes():
+    codec = JSONCodec()
+    text = codec.encode(make_GATTNotify(MAC, UUID, b'\x05\x06'))
+    assert ' ' not in text
+    assert json.loads(text)['results']['Data'] == 'BQY='
+
+    params = codec.decode(codec.encode(make_GATTWrite(1, MAC, UUID, b'\xff', True)))['params']
+    assert data_from_param(params['Data']) == b'\xff'
+
+
+@pytest.mark.parametrize("message", ["{not json", "[1, 2]", b'\xff\xfe'])
+def test_json_decode_errors(message):
+    with pytest.raises(CodecError):
+        JSONCodec().decode(message)
+
+
+@pytest.mark.parametrize("codec, module", [(MsgPackCodec, "msgpack"), (CBORCodec, "cbor2")])
+def test_binary_codecs_carry_raw_bytes(codec, module):
+    pytest.importorskip(module)
+    ob = make_GATTNotify(MAC, UUID, b'\x05\x06')
+    message = codec().encode(ob)
+    assert isinstance(message, bytes) and b'\x05\x06' in message
+    assert codec().decode(message) == ob
+    assert data_from_param(codec().decode(message)['results']['Data']) == b'\x05\x06'
+    with pytest.raises(CodecError):
+        codec().decode(b'\x01')
@@ -0,0 +1,170 @@
+import random
+import threading
+
+from ble.bleak.gattclient import GATTClient
+from ble.bleexceptions import BLEConnectionError
+from ble.bleops import ContextConverter, QOpExecutorFactory
+from ble.connsupervisor import ConnectionSupervisor, ReconnectBackoff
+from ble.gattclientinterface import GATTCState
+from ble.uuidtype import CHAR_UUID
+
+UUID1 = CHAR_UUID("0000a001-0000-1000-8000-00805f9b34fb")
+UUID2 = CHAR_UUID("0000a002-0000-1000-8000-00805f9b34fb")
+
+
+class PassThrough(ContextConverter):
+    def convert(self, callback):
+        return callback
+
+
+class FlakyGATTClient:
+    """
+    Fails to connect a few times before it works.
+    """
+    MAC = "00:00:00:00:00:03"
+
+    def __init__(self, failures, error=BLEConnectionError, restorefailures=0):
+        self.Failures = failures
+        self.Error = error
+        self.RestoreFailures = restorefailures
+        self.Connects = 0
+        self.Restores = 0
+        self.Disconnects = 0
+        self.Connected = False
+        self.DiscCallback = None
+        self.OnConnect = None
+
+    def set_disc_callback(self, callback):
+        self.DiscCallback = callback
+
+    def connect(self):
+        self.Connects += 1
+        if self.Connects <= self.Failures:
+            raise self.Error("Not there")
+        self.Connected = True
+        if self.OnConnect is not None:
+            self.OnConnect()
+        return GATTCState.CONNECTED
+
+    def disconnect(self):
+        self.Disconnects += 1
+        self.Connected = False
+
+    def is_connected(self):
+        return self.Connected
+
+    def restore_notifies(self):
+        self.Restores += 1
+        if self.Restores <= self.RestoreFailures:
+            raise OSError("Notify failed")
+
+
+def test_backoff_is_jittered_and_capped():
+    backoff = ReconnectBackoff(initial=0.5, maximum=4.0, rng=random.Random(1))
+    assert [backoff.ceiling(n) for n in range(5)] == [0.5, 1.0, 2.0, 4.0, 4.0]
+    delays = [backoff.delay(10) for _ in range(100)]
+    assert all(0 <= d <= 4.0 for d in delays)
+    assert len(set(delays)) > 90
+
+
+def test_supervisor_reconnects_and_reports_once():
+    gc = FlakyGATTClient(failures=3)
+    states = []
+    done = threading.Event()
+
+    def callback(state):
+        states.append(state)
+        if state == GATTCState.CONNECTED:
+            done.set()
+
+    sup = ConnectionSupervisor(gc, callback, ReconnectBackoff(initial=0.001, maximum=0.01))
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    gc.DiscCallback(GATTCState.DISCONNECTED)  # A second report doesn't start a second reconnect
+    assert done.wait(5)
+    sup.Thread.join(5)
+
+    assert gc.Connects == 4
+    assert gc.Restores == 1
+    assert states == [GATTCState.DISCONNECTED, GATTCState.DISCONNECTED, GATTCState.CONNECTED]
+
+
+def test_stop_ends_reconnecting():
+    gc = FlakyGATTClient(failures=1000)
+    sup = ConnectionSupervisor(gc, None, ReconnectBackoff(initial=0.001, maximum=0.001))
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    sup.stop()
+    sup.Thread.join(5)
+    assert not sup.Thread.is_alive()
+
+
+def test_supervisor_survives_non_BLE_errors():
+    gc = FlakyGATTClient(failures=2, error=OSError)
+    done = threading.Event()
+    sup = ConnectionSupervisor(gc, lambda state: done.set() if state == GATTCState.CONNECTED else None,
+                               ReconnectBackoff(initial=0.001, maximum=0.01))
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    assert done.wait(5)
+    assert gc.Connects == 3
+
+
+def test_supervisor_reports_giving_up():
+    gc = FlakyGATTClient(failures=1000, error=TimeoutError)
+    states = []
+    sup = ConnectionSupervisor(gc, states.append, ReconnectBackoff(initial=0.001, maximum=0.001), maxattempts=3)
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    sup.Thread.join(5)
+    assert gc.Connects == 3
+    assert states == [GATTCState.DISCONNECTED, GATTCState.DISCONNECTED]
+
+
+def test_failed_restore_only_retries_restore():
+    gc = FlakyGATTClient(failures=0, restorefailures=2)
+    done = threading.Event()
+    sup = ConnectionSupervisor(gc, lambda state: done.set() if state == GATTCState.CONNECTED else None,
+                               ReconnectBackoff(initial=0.001, maximum=0.01))
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    assert done.wait(5)
+    assert (gc.Connects, gc.Restores, gc.Disconnects) == (1, 3, 0)
+
+
+def test_stop_after_connecting_disconnects():
+    gc = FlakyGATTClient(failures=0)
+    states = []
+    sup = ConnectionSupervisor(gc, states.append, ReconnectBackoff(initial=0.001, maximum=0.001))
+    gc.OnConnect = sup.stop  # The user disconnects just as the link comes back
+    sup.start()
+    gc.DiscCallback(GATTCState.DISCONNECTED)
+    sup.Thread.join(5)
+    assert (gc.Connects, gc.Restores, gc.Disconnects) == (1, 0, 1)
+    assert states == [GATTCState.DISCONNECTED]
+
+
+class NotifyBleakClient:
+    def __init__(self):
+        self.Started = []
+
+    async def start_notify(self, uuid, callback):
+        self.Started.append(uuid)
+
+    async def stop_notify(self, uuid):
+        pass
+
+
+def test_bleak_restore_notifies_rearms_enabled_notifies():
+    gc = GATTClient("00:00:00:00:00:04", QOpExecutorFactory().makeExecutor(), PassThrough())
+    gc.BleakClient = NotifyBleakClient()
+    try:
+        gc.set_notify(UUID1, True, lambda uuid, data: None)
+        gc.set_notify(UUID2, True, lambda uuid, data: None)
+        gc.set_notify(UUID2, False, None)
+        gc.BleakClient.Started = []
+
+        gc.restore_notifies()
+        assert gc.BleakClient.Started == [UUID1.AsString]
+    finally:
+        gc.shutdown()
@@ -0,0 +1,44 @@
+import json
+
+from ble.discoverycache import DiscoveryCache, table_hash, table_uuids
+
+MAC = "00:11:22:33:44:55"
+TABLE = {
+    "0000a000-0000-1000-8000-00805f9b34fb" : [
+        ["0000a001-0000-1000-8000-00805f9b34fb", 11, ["notify", "read"]],
+        ["0000a002-0000-1000-8000-00805f9b34fb", 14, ["write"]],
+    ],
+}
+
+
+def test_store_and_load(tmp_path):
+    cache = DiscoveryCache(str(tmp_path))
+    assert cache.load(MAC) is None
+    assert cache.store(MAC, TABLE)
+    assert not cache.store(MAC, TABLE)  # Unchanged, so not written again
+    assert DiscoveryCache(str(tmp_path)).load(MAC.lower()) == TABLE
+    assert table_uuids(TABLE) == ["0000a001-0000-1000-8000-00805f9b34fb", "0000a002-0000-1000-8000-00805f9b34fb"]
+
+    changed = { k : v[:1] for k, v in TABLE.items() }
+    assert cache.store(MAC, changed)
+    assert cache.load(MAC) == changed
+
+    cache.forget(MAC)
+    assert cache.load(MAC) is None
+
+
+def test_corrupt_entries_are_ignored(tmp_path):
+    cache = DiscoveryCache(str(tmp_path))
+    cache.store(MAC, TABLE)
+    path = tmp_path / "001122334455.json"
+
+    entry = json.loads(path.read_text())
+    entry['Table']["0000a000-0000-1000-8000-00805f9b34fb"].pop()
+    path.write_text(json.dumps(entry))
+    assert entry['Hash'] != table_hash(entry['Table'])
+    assert cache.load(MAC) is None
+
+    path.write_text("{ not json")
+    assert cache.load(MAC) is None
+    assert cache.store(MAC, TABLE)
+    assert cache.load(MAC) == TABLE
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from wsserver.dispatcher import OrderedDispatcher
+
+
+def test_order_per_key_and_parallel_keys():
+    dispatcher = OrderedDispatcher(workers=4)
+    done = []
+    lock = threading.Lock()
+    overlapping = threading.Barrier(2, timeout=5)
+
+    def job(key, i):
+        if i == 0:
+            overlapping.wait()  # Both keys' first jobs run at once, or this times out
+        time.sleep(0.001)
+        with lock:
+            done.append((key, i))
+
+    for i in range(20):
+        for key in ("A", "B"):
+            assert dispatcher.submit(key, "client", job, key, i)
+    while dispatcher.queuedCount() or len(done) < 40:
+        time.sleep(0.01)
+    dispatcher.shutdown()
+    for key in ("A", "B"):
+        assert [i for k, i in done if k == key] == list(range(20))
+
+
+def test_limits_and_fairness():
+    dispatcher = OrderedDispatcher(workers=1, maxqueued=4, maxperclient=3)
+    gate = threading.Event()
+    order = []
+    assert dispatcher.submit("A", "first", gate.wait)  # Holds the only worker
+    time.sleep(0.05)
+    for i in range(3):
+        assert dispatcher.submit("A", "first", order.append, ("first", i)) == (i < 2)
+    assert dispatcher.submit("A", "second", order.append, ("second", 0))
+    assert dispatcher.submit("A", "third", order.append, ("third", 0))
+    assert not dispatcher.submit("A", "fourth", order.append, ("fourth", 0))  # maxqueued
+
+    dispatcher.dropClient("third")
+    gate.set()
+    while len(order) < 3:
+        time.sleep(0.01)
+    dispatcher.shutdown()
+    assert order == [("first", 0), ("second", 0), ("first", 1)]
+
+
+def test_long_requests_leave_a_worker_for_short_ones():
+    dispatcher = OrderedDispatcher(workers=3)
+    gate = threading.Event()
+    started = []
+    for key in ("A", "B", "C"):
+        assert dispatcher.submit(key, "client", lambda key=key: (started.append(key), gate.wait()), longrunning=True)
+    short = threading.Event()
+    assert dispatcher.submit("D", "client", short.set)
+    assert short.wait(5)
+    while len(started) < 2:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert sorted(started) == ["A", "B"]  # The third one waits for one of those
+
+    gate.set()
+    while dispatcher.queuedCount() or len(started) < 3:
+        time.sleep(0.01)
+    dispatcher.shutdown()
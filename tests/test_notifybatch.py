@@ -0,0 +1,57 @@
+import pytest
+
+from wsserver.jsondesc import ParseException, WSBLEParser, make_GATTNotifyBatch, make_GATTSetNotify
+from wsserver.notifybatch import NotifyBatcher
+
+MAC = "00:00:00:00:00:01"
+A = "0000a00d-0000-1000-8000-00805f9b34fb"
+B = "0000a00e-0000-1000-8000-00805f9b34fb"
+
+
+def make_batcher():
+    sent = []
+    timers = []
+    batcher = NotifyBatcher(sent.append, lambda delay, fn: timers.append((delay, fn)))
+    return batcher, sent, timers
+
+
+def test_batch_goes_when_window_ends():
+    batcher, sent, timers = make_batcher()
+    batcher.configure((MAC, A), 100)
+    batcher.configure((MAC, B), 20)
+    batcher.add(MAC, A, b'\x01')
+    batcher.add(MAC, B, b'\x02')  # Shorter window, so an earlier timer
+    assert [delay for delay, _ in timers] == [0.1, 0.02]
+    assert sent == []
+
+    timers[1][1]()
+    assert [[(m, c, d) for m, c, d, _ in batch] for batch in sent] == [[(MAC, A, b'\x01'), (MAC, B, b'\x02')]]
+    timers[0][1]()  # Belongs to the batch already sent
+    assert len(sent) == 1
+
+
+def test_full_batch_goes_at_once():
+    batcher, sent, timers = make_batcher()
+    batcher.configure((MAC, A), 1000, 3)
+    for i in range(7):
+        batcher.add(MAC, A, bytes([i]))
+    assert [len(batch) for batch in sent] == [3, 3]
+    batcher.flushNow()
+    assert [len(batch) for batch in sent] == [3, 3, 1]
+    times = [t for batch in sent for _, _, _, t in batch]
+    assert times == sorted(times)
+
+    batcher.add(MAC, A, b'\x09')
+    batcher.close()
+    timers[-1][1]()
+    assert len(sent) == 3
+
+
+def test_batch_params_and_update():
+    parser = WSBLEParser()
+    parser.parse_obj(make_GATTSetNotify(1, MAC, A, True, 50, 8))
+    with pytest.raises(ParseException):
+        parser.parse_obj(make_GATTSetNotify(1, MAC, A, True, 0))
+    update = make_GATTNotifyBatch([(MAC, A, b'\x01', 12.5)])
+    assert update['update'] == 'GATTNotifyBatch'
+    assert update['results']['Items'] == [{'MAC' : MAC, 'Char' : A, 'Data' : b'\x01', 'Time' : 12.5}]
@@ -0,0 +1,69 @@
+import threading
+from typing import List
+
+from ble.notifydispatch import NotifyDispatcher, NotifyOverflow, NotifySubscription
+from ble.uuidtype import CHAR_UUID
+
+UUID = CHAR_UUID("0000a00d-0000-1000-8000-00805f9b34fb")
+
+
+def blocked_subscription(policy : NotifyOverflow, capacity : int = 2):
+    """
+    A subscription whose callback is stuck on its first notification until released.
+    """
+    release = threading.Event()
+    started = threading.Event()
+    got : List[bytes] = []
+
+    def cb(uuid : CHAR_UUID, data : bytes):
+        started.set()
+        release.wait(5)
+        got.append(data)
+
+    sub = NotifySubscription(UUID, cb, capacity, policy)
+    sub.push(UUID, b'0')
+    assert started.wait(5)
+    for i in range(1, 5):
+        sub.push(UUID, bytes([ord('0') + i]))
+    return sub, release, got
+
+
+def drain(sub : NotifySubscription, release : threading.Event, got : List[bytes], count : int):
+    release.set()
+    for _ in range(500):
+        if len(got) >= count:
+            break
+        threading.Event().wait(0.01)
+    sub.close()
+
+
+def test_drop_oldest_keeps_newest_notifies():
+    sub, release, got = blocked_subscription(NotifyOverflow.DROP_OLDEST)
+    assert sub.stats()['Dropped'] == 2
+    drain(sub, release, got, 3)
+    assert got == [b'0', b'3', b'4']
+
+
+def test_drop_newest_keeps_oldest_notifies():
+    sub, release, got = blocked_subscription(NotifyOverflow.DROP_NEWEST)
+    drain(sub, release, got, 3)
+    assert got == [b'0', b'1', b'2']
+    assert sub.stats()['Dropped'] == 2
+
+
+def test_keep_latest_only_holds_one():
+    sub, release, got = blocked_subscription(NotifyOverflow.KEEP_LATEST, capacity=10)
+    drain(sub, release, got, 2)
+    assert got == [b'0', b'4']
+    stats = sub.stats()
+    assert (stats['Received'], stats['Delivered'], stats['Dropped']) == (5, 2, 3)
+
+
+def test_dispatcher_uses_configured_policy():
+    d = NotifyDispatcher()
+    d.configure(UUID, 1, NotifyOverflow.DROP_NEWEST)
+    push = d.subscribe(UUID, lambda uuid, data: None)
+    push(UUID, b'x')
+    assert UUID.AsString in d.stats()
+    d.unsubscribe(UUID)
+    assert d.stats() == {}
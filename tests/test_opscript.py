@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+import pytest
+
+from ble.bleexceptions import BLEOperationTimedOut
+from wsserver.jsondesc import make_script_step
+from wsserver.opscript import NotifyTaps, ScriptRunner, full_UUID, notify_predicate
+
+MAC = "00:00:00:00:00:01"
+UUID = "0000a00d-0000-1000-8000-00805f9b34fb"
+
+
+class EchoGATTClient:
+    """
+    Each write comes back as a notification, from another thread, like a device acknowledging it.
+    """
+    def __init__(self, taps):
+        self.Taps = taps
+        self.Writes = []
+
+    async def async_char_write(self, uuid, data, requireresponse):
+        self.Writes.append(data)
+        threading.Thread(target=self.Taps.feed, args=(MAC, UUID, data)).start()
+
+    async def async_char_read(self, uuid):
+        return bytearray(b'\x09')
+
+
+async def no_notify(uuid, enable):
+    pass
+
+
+def run(steps, timeout=2.0):
+    taps = NotifyTaps()
+    gc = EchoGATTClient(taps)
+    progress = []
+    runner = ScriptRunner(gc, MAC, steps, taps, no_notify, lambda step, op, data: progress.append((step, op, data)))
+    results = asyncio.run(runner.run(timeout))
+    assert not taps.ByMAC
+    return results, progress, gc
+
+
+def test_full_UUID():
+    assert full_UUID("A00D") == UUID
+    assert full_UUID("0000A00D") == UUID
+    assert full_UUID(UUID.upper()) == UUID
+
+
+def test_notify_predicate():
+    assert notify_predicate({})(b'')
+    equals = notify_predicate({'Offset' : 1, 'Equals' : 'AgM='})  # 02 03
+    assert equals(b'\x01\x02\x03\x04') and not equals(b'\x02\x03') and not equals(b'\x01\x02')
+    masked = notify_predicate({'Equals' : 'EA==', 'Mask' : '8A=='})  # High nibble is 1
+    assert masked(b'\x1f') and not masked(b'\x2f') and not masked(b'')
+
+
+def test_write_await_loop():
+    steps = [
+        make_script_step('Write', Char=UUID, Data='AQ=='),
+        make_script_step('AwaitNotify', Char='a00d', Timeout=1000, Equals='AQ=='),
+        make_script_step('Loop', Count=3, Steps=[make_script_step('Read', Char=UUID), make_script_step('Delay', Ms=1)]),
+    ]
+    results, progress, gc = run(steps)
+    assert results['Steps'] == 8
+    assert results['Data'] == b'\x09'
+    assert [p[0] for p in progress] == list(range(1, 9))
+    assert progress[1] == (2, 'AwaitNotify', b'\x01')
+    assert gc.Writes == [b'\x01']
+
+
+def test_await_notify_only_sees_new_notifications():
+    steps = [
+        make_script_step('Write', Char=UUID, Data='Ag=='),
+        make_script_step('Delay', Ms=50),
+        make_script_step('Write', Char=UUID, Data='Aw=='),
+        make_script_step('AwaitNotify', Char=UUID, Timeout=100, Equals='Ag=='),  # Came before the step before
+    ]
+    with pytest.raises(BLEOperationTimedOut, match="Step 4"):
+        run(steps)
+
+    # And a notification can only be awaited once
+    steps = [
+        make_script_step('Write', Char=UUID, Data='Ag=='),
+        make_script_step('AwaitNotify', Char=UUID, Timeout=1000),
+        make_script_step('AwaitNotify', Char=UUID, Timeout=100),
+    ]
+    with pytest.raises(BLEOperationTimedOut, match="Step 3"):
+        run(steps)
+
+
+def test_script_timeout():
+    with pytest.raises(BLEOperationTimedOut, match="after step 1"):
+        run([make_script_step('Delay', Ms=1), make_script_step('Delay', Ms=1000)], timeout=0.2)
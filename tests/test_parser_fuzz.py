@@ -0,0 +1,134 @@
+import copy
+import json
+import random
+
+import pytest
+
+from wsserver.jsondesc import (MAX_ATTRIBUTE_LEN, MAX_BATCH_ITEMS, MAX_SCRIPT_STEPS, ParseException, WSBLEParser,
+                               make_Batch, make_batch_item, make_GATTConnect, make_GATTRead, make_GATTSetNotify,
+                               make_GATTWrite_as_JSON, make_req, make_RunScript, make_script_step)
+
+MAC = "D9:B2:48:AA:BB:CC"
+UUID = "0000a00d-0000-1000-8000-00805f9b34fb"
+
+GOOD = [
+    json.loads(make_GATTWrite_as_JSON(1, MAC, UUID, bytes(range(19)), True)),
+    make_GATTRead(2, MAC, UUID, 20),
+    make_GATTSetNotify(3, MAC, "a00d", True, batchwindow=50),
+    make_req('Scan', 4, {'Timeout' : 10, 'ServiceUUIDs' : ["0000a000"], 'MinRSSI' : -80}),
+    make_GATTConnect(5, "5A0B2B9C-6E1F-4F07-8D2C-1B2A3C4D5E6F"),
+    make_Batch(6, MAC, [make_batch_item('GATTRead', {'Char' : UUID, 'Len' : 4})]),
+    make_RunScript(7, MAC, [make_script_step('Write', Char=UUID, Data='AQ=='),
+                            make_script_step('AwaitNotify', Char=UUID, Timeout=100, Offset=1, Equals='AQ==', Mask='Dw=='),
+                            make_script_step('Loop', Count=3, Steps=[make_script_step('Delay', Ms=5)])]),
+]
+
+# Values that are wrong for most params, in the ways clients get them wrong
+JUNK = [None, True, 0, -1, 1 << 40, 1.5, "", "zz", "D9:B2:48:AA:BB", "====", "QUJD=", [], [1], {}, {"a" : 1},
+        "A" * 700, "0000a00d-0000-1000-8000-00805f9b34fg"]
+
+
+def mutate(rnd : random.Random, ob):
+    ob = copy.deepcopy(ob)
+    target = ob if rnd.random() < 0.3 else ob['params']
+    action = rnd.random()
+    if (action < 0.2) and target:
+        del target[rnd.choice(list(target))]
+    elif (action < 0.4) or not target:
+        target[rnd.choice(['MAC', 'Char', 'Len', 'Data', 'extra', 'id', 'command'])] = rnd.choice(JUNK)
+    else:
+        target[rnd.choice(list(target))] = rnd.choice(JUNK)
+    return ob
+
+
+@pytest.mark.parametrize("ob", GOOD)
+def test_good_requests_pass(ob):
+    assert WSBLEParser().parse_obj(copy.deepcopy(ob))['id'] == ob['id']
+
+
+def test_fuzzed_requests_only_raise_ParseException():
+    parser = WSBLEParser()
+    rnd = random.Random(1234)
+    rejected = 0
+    for _ in range(5000):
+        ob = mutate(rnd, rnd.choice(GOOD))
+        try:
+            parser.parse_obj(ob)
+        except ParseException:
+            rejected += 1
+    assert rejected > 2500
+
+
+@pytest.mark.parametrize("params", [
+    {'MAC' : "D9:B2:48:AA:BB:CG", 'Char' : UUID, 'Len' : 1},
+    {'MAC' : "D9-B2-48-AA-BB-CC", 'Char' : UUID, 'Len' : 1},
+    {'MAC' : ["D9:B2:48:AA:BB:CC"], 'Char' : UUID, 'Len' : 1},
+    {'MAC' : MAC, 'Char' : "a00", 'Len' : 1},
+    {'MAC' : MAC, 'Char' : "0000a00d-0000-1000-8000+00805f9b34fb", 'Len' : 1},
+    {'MAC' : MAC, 'Char' : UUID, 'Len' : MAX_ATTRIBUTE_LEN + 1},
+    {'MAC' : MAC, 'Char' : UUID, 'Len' : True},
+    {'MAC' : MAC, 'Char' : UUID, 'Len' : 1, 'Priority' : 'Urgent'},
+    {'MAC' : MAC, 'Char' : UUID},
+])
+def test_bad_reads(params):
+    with pytest.raises(ParseException):
+        WSBLEParser().parse_obj(make_req('GATTRead', 1, params))
+
+
+@pytest.mark.parametrize("data", ["QUJD=", "QU=D", "QUJ=====", "QUJD!", "A" * (4 * (MAX_ATTRIBUTE_LEN // 3 + 1)), 5])
+def test_bad_write_data(data):
+    with pytest.raises(ParseException):
+        WSBLEParser().parse_obj(make_req('GATTWrite', 1, {'MAC' : MAC, 'Char' : UUID, 'Data' : data, 'RR' : True}))
+
+
+@pytest.mark.parametrize("ob", [
+    make_req('Nope', 1, {}),
+    make_req(['GATTRead'], 1, {}),
+    make_req('Scan', 0, {'Timeout' : 1}),
+    make_req('Scan', True, {'Timeout' : 1}),
+    make_req('Scan', 1, [1]),
+    {'type' : 'REQ', 'id' : 1, 'command' : 'Scan'},
+])
+def test_bad_envelopes(ob):
+    with pytest.raises(ParseException):
+        WSBLEParser().parse_obj(ob)
+
+
+@pytest.mark.parametrize("items", [
+    [],
+    [make_batch_item('GATTRead', {'Char' : UUID, 'Len' : 4})] * (MAX_BATCH_ITEMS + 1),
+    [make_batch_item('Scan', {'Timeout' : 1})],
+    [make_batch_item('GATTRead', {'MAC' : MAC, 'Char' : UUID, 'Len' : 4})],
+    [make_batch_item('GATTRead', {'Char' : UUID, 'Len' : 4}), make_batch_item('GATTWrite', {'Char' : UUID, 'Data' : "QU=D", 'RR' : True})],
+    [{'command' : 'GATTRead'}],
+    ["GATTRead"],
+])
+def test_bad_batches(items):
+    with pytest.raises(ParseException):
+        WSBLEParser().parse_obj(make_Batch(1, MAC, items))
+
+
+def nested(depth):
+    steps = [make_script_step('Delay', Ms=1)]
+    for _ in range(depth):
+        steps = [make_script_step('Loop', Count=2, Steps=steps)]
+    return steps
+
+
+@pytest.mark.parametrize("steps", [
+    [],
+    [make_script_step('Exec', Code='import os')],
+    [make_script_step('Write', Char=UUID)],
+    [make_script_step('AwaitNotify', Char=UUID, Timeout=100, Mask='AQ==')],
+    [make_script_step('AwaitNotify', Char=UUID, Timeout=100, Equals='AQ==', Mask='AQI=')],
+    [make_script_step('AwaitNotify', Char=UUID, Timeout=100, Offset=MAX_ATTRIBUTE_LEN, Equals='AQ==')],
+    [make_script_step('Loop', Count=2, Steps=[])],
+    [make_script_step('Loop', Count=10000, Steps=[make_script_step('Delay', Ms=1)] * 2)],
+    [make_script_step('Delay', Ms=1)] * (MAX_SCRIPT_STEPS + 1),
+    nested(5),
+    ["Delay"],
+])
+def test_bad_scripts(steps):
+    WSBLEParser().parse_obj(make_RunScript(1, MAC, nested(4)))
+    with pytest.raises(ParseException):
+        WSBLEParser().parse_obj(make_RunScript(1, MAC, steps))
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import pytest
+
+from ble.bleexceptions import BLEOperationTimedOut
+from ble.bleops import (OpResult, QOp, QOpExecutor, QOpHandle, QOpManager, QOpPriority, QOpScheduler, async_wrap_async_into_QOp,
+                        coalesce_key, make_wrapped_QOp, wrap_into_QOp)
+from qophelpers import RecordingScheduler, make_op
+
+
+def make_manager():
+    sched = RecordingScheduler()
+    exe = QOpExecutor(QOpManager(), sched)
+    return sched, exe
+
+
+def test_interactive_lane_goes_first():
+    sched, exe = make_manager()
+    log : List[str] = []
+    for i in range(3):
+        exe.Manager.addFIFOOp(make_op(log, "bulk%d" % i))
+    exe.Manager.addFIFOOp(make_op(log, "bg", priority=QOpPriority.BACKGROUND))
+    exe.Manager.addFIFOOp(make_op(log, "stop", priority=QOpPriority.INTERACTIVE))
+    exe.startBackgroundProcessing()
+    sched.runAll()
+    assert log == ["stop", "bulk0", "bulk1", "bulk2", "bg"]
+
+
+def test_bulk_lane_is_not_starved():
+    sched, exe = make_manager()
+    log : List[str] = []
+    exe.Manager.addFIFOOp(make_op(log, "bulk"))
+    for i in range(10):
+        exe.Manager.addFIFOOp(make_op(log, "i%d" % i, priority=QOpPriority.INTERACTIVE))
+    exe.startBackgroundProcessing()
+    sched.runAll()
+    assert log.index("bulk") == QOpManager.StarvationLimit
+
+
+def test_lifo_op_goes_before_a_starved_lane():
+    sched, exe = make_manager()
+    log : List[str] = []
+    exe.Manager.addFIFOOp(make_op(log, "bulk"))
+    for i in range(QOpManager.StarvationLimit):
+        exe.Manager.addFIFOOp(make_op(log, "i%d" % i, priority=QOpPriority.INTERACTIVE))
+    exe.startBackgroundProcessing()
+    for _ in range(QOpManager.StarvationLimit):
+        sched.runOne()
+    assert log == ["i%d" % i for i in range(QOpManager.StarvationLimit)]  # The bulk lane is due now...
+
+    exe.Manager.addLIFOOp(make_op(log, "discover"))
+    sched.runAll()
+    assert log[4:] == ["discover", "bulk"]  # ...but the LIFO op still goes first
+
+
+def test_expired_op_fails_without_running():
+    sched, exe = make_manager()
+    log : List[str] = []
+    results : List[OpResult[str]] = []
+    exe.Manager.addFIFOOp(make_op(log, "late", deadline=0.0, callback=results.append))
+    exe.Manager.addFIFOOp(make_op(log, "ontime", callback=results.append))
+    time.sleep(0.01)
+    exe.startBackgroundProcessing()
+    sched.runAll()
+
+    assert log == ["ontime"]
+    with pytest.raises(BLEOperationTimedOut):
+        results[0].getResult()
+    assert results[1].getResult() == "ontime"
+
+
+class SimClient:
+    """
+    Just enough of a GATTClient to use the QOp wrappers.
+    """
+    def __init__(self, sched : QOpScheduler):
+        self.QOpExecutor = QOpExecutor(QOpManager(), sched)
+        self.QOpTimeout = 5
+        self.Written : List[bytes] = []
+
+    def _char_write(self, uuid : str, data : bytes, manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> bytes:
+        self.Written.append(data)
+        return data
+
+
+def test_coalesced_write_replaces_queued_write():
+    sched, exe = make_manager()
+    client = SimClient(sched)
+    results : List[OpResult[bytes]] = []
+
+    for i in range(3):
+        client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("setpoint", bytes([i])), {}, results.append, {'coalesce' : True}))
+    client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("other", b"x"), {}, results.append, {'coalesce' : True}))
+
+    client.QOpExecutor.startBackgroundProcessing()
+    while sched.Pending:
+        sched.runOne()
+
+    assert client.Written == [bytes([2]), b"x"]
+    assert [r.getResult() for r in results] == [bytes([2])] * 3 + [b"x"]
+
+
+def test_coalescing_enabled_per_key():
+    sched, exe = make_manager()
+    client = SimClient(sched)
+    client.QOpExecutor.Manager.setCoalescing(coalesce_key(SimClient._char_write, "setpoint"), True)
+
+    for i in range(3):
+        client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("setpoint", bytes([i])), {}, lambda opr: None, {}))
+
+    client.QOpExecutor.startBackgroundProcessing()
+    while sched.Pending:
+        sched.runOne()
+
+    assert client.Written == [bytes([2])]
+
+
+def test_withdrawing_coalesced_write_still_writes_newer_data():
+    sched, exe = make_manager()
+    client = SimClient(sched)
+    results : List[OpResult[bytes]] = []
+    first = client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("setpoint", b"\x01"), {}, lambda opr: results.append(("first", opr)), {'coalesce' : True}))
+    second = client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("setpoint", b"\x02"), {}, lambda opr: results.append(("second", opr)), {'coalesce' : True}))
+    client.QOpExecutor.Manager.addFIFOOp(make_wrapped_QOp(SimClient._char_write, client, ("setpoint", b"\x03"), {}, None, {'coalesce' : True}))
+
+    assert first.cancel()
+    assert not first.cancel()  # Already withdrawn, so the merged callers keep theirs
+    assert not second.cancel()  # Merged, so it runs anyway
+    assert client.QOpExecutor.Manager.queuedCount() == 1
+
+    client.QOpExecutor.startBackgroundProcessing()
+    while sched.Pending:
+        sched.runOne()
+
+    assert client.Written == [b"\x03"]
+    assert [(who, r.getResult()) for who, r in results] == [("second", b"\x03")]
+
+
+class WrappedClient(SimClient):
+    @wrap_into_QOp(SimClient._char_write)
+    def char_write(self, uuid : str, data : bytes) -> None:
+        pass
+
+    @async_wrap_async_into_QOp(SimClient._char_write)
+    async def async_char_write(self, uuid : str, data : bytes) -> None:
+        pass
+
+
+def test_handle_cancel_withdraws_queued_op():
+    sched, exe = make_manager()
+    log : List[str] = []
+    handle = exe.Manager.addFIFOOp(make_op(log, "a", callback=lambda opr: log.append("callback")))
+    exe.Manager.addFIFOOp(make_op(log, "b"))
+    assert handle.cancel()
+    assert not handle.cancel()
+    assert exe.Manager.queuedCount() == 1
+    exe.startBackgroundProcessing()
+    sched.runAll()
+    assert log == ["b"]
+
+
+def test_handle_cancel_after_start_fails():
+    sched, exe = make_manager()
+    log : List[str] = []
+    handles : List[QOpHandle] = []
+
+    def op(manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> None:
+        log.append("ran")
+        assert handles[0].isStarted()
+        assert not handles[0].cancel()
+
+    handles.append(exe.Manager.addFIFOOp(QOp(op)))
+    exe.startBackgroundProcessing()
+    sched.runAll()
+    assert log == ["ran"]
+
+
+def test_sync_timeout_withdraws_op():
+    sched = RecordingScheduler()
+    client = WrappedClient(sched)
+    client.QOpExecutor.startBackgroundProcessing()
+
+    with pytest.raises(BLEOperationTimedOut, match="withdrawn"):
+        client.char_write("setpoint", b"1", timeout=0.05)
+
+    assert client.QOpExecutor.Manager.queuedCount() == 0
+    sched.runAll()
+    assert client.Written == []
+
+
+def test_async_timeout_withdraws_op():
+    sched = RecordingScheduler()
+    client = WrappedClient(sched)
+    client.QOpExecutor.startBackgroundProcessing()
+
+    with pytest.raises(BLEOperationTimedOut, match="withdrawn"):
+        asyncio.run(client.async_char_write("setpoint", b"1", timeout=0.05))
+
+    sched.runAll()
+    assert client.Written == []
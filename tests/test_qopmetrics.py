@@ -0,0 +1,62 @@
+from typing import Any, List, Optional
+
+from ble.bleops import QOp, QOpExecutor, QOpManager, QOpScheduler
+from ble.qopmetrics import LatencyHistogram, get_QOpMetrics
+
+
+def test_histogram_percentiles_are_close():
+    h = LatencyHistogram()
+    for v in range(1, 10001):
+        h.record(v)
+    assert h.Count == 10000
+    assert abs(h.percentile(0.5) - 5000) <= 5000 * 0.035
+    assert abs(h.percentile(0.99) - 9900) <= 9900 * 0.035
+    assert h.percentile(1.0) == 10000
+
+
+def test_ops_are_recorded_per_mac_and_stage():
+    metrics = get_QOpMetrics()
+    metrics.reset()
+    metrics.enable()
+    try:
+        pending : List[Any] = []
+        manager = QOpManager()
+        manager.Label = "AA:BB"
+        QOpExecutor(manager, QOpScheduler(submit=pending.append)).startBackgroundProcessing()
+
+        def _char_read(manager : Optional[QOpManager] = None) -> bytes:
+            return b'1'
+
+        manager.addFIFOOp(QOp(_char_read))
+        manager.addFIFOOp(QOp(_char_read)).cancel()
+        while pending:
+            pending.pop(0)()
+
+        snap = metrics.snapshot()
+        stages = { l['stage'] : l['count'] for l in snap['latencies'] if l['mac'] == "AA:BB" }
+        assert stages == { 'queue' : 1, 'backend' : 1, 'delivery' : 1, 'total' : 1 }
+        outcomes = { o['outcome'] : o['count'] for o in snap['outcomes'] if o['mac'] == "AA:BB" }
+        assert outcomes == { 'ok' : 1, 'withdrawn' : 1 }
+        assert snap['queues']["AA:BB"] == { 'queued' : 0, 'in_flight' : 0 }
+
+        text = metrics.toPrometheus()
+        assert 'cafehub_qop_latency_seconds_count{mac="AA:BB",op="char_read",stage="backend"} 1' in text
+        assert 'cafehub_qop_queue_depth{mac="AA:BB"} 0' in text
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = get_QOpMetrics()
+    assert not metrics.Enabled
+    pending : List[Any] = []
+    manager = QOpManager()
+    manager.Label = "CC:DD"
+    QOpExecutor(manager, QOpScheduler(submit=pending.append)).startBackgroundProcessing()
+    op : QOp[None] = QOp(lambda manager=None: None)
+    manager.addFIFOOp(op)
+    while pending:
+        pending.pop(0)()
+    assert op.TEnqueued is None
+    assert metrics.snapshot()['latencies'] == []
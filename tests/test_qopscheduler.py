@@ -0,0 +1,93 @@
+import threading
+from typing import List, Optional
+
+from ble.bleops import OpResult, QOp, QOpExecutor, QOpManager
+from qophelpers import RecordingScheduler, make_op
+
+
+def test_nothing_submitted_while_idle():
+    sched = RecordingScheduler()
+    QOpExecutor(QOpManager(), sched).startBackgroundProcessing()
+    assert sched.Pending == []
+
+
+def test_one_op_in_flight_per_manager():
+    sched = RecordingScheduler()
+    exe = QOpExecutor(QOpManager(), sched)
+    exe.startBackgroundProcessing()
+    log : List[str] = []
+
+    for name in ("a", "b", "c"):
+        exe.Manager.addFIFOOp(make_op(log, name))
+
+    assert len(sched.Pending) == 1
+    sched.runOne()
+    assert log == ["a"]
+    assert len(sched.Pending) == 1
+    sched.runOne()
+    sched.runOne()
+    assert log == ["a", "b", "c"]
+    assert sched.Pending == []
+
+
+def test_ops_queued_before_start_run_after_start():
+    sched = RecordingScheduler()
+    exe = QOpExecutor(QOpManager(), sched)
+    log : List[str] = []
+    exe.Manager.addFIFOOp(make_op(log, "a"))
+    assert sched.Pending == []
+    exe.startBackgroundProcessing()
+    sched.runOne()
+    assert log == ["a"]
+
+
+def test_lifo_op_jumps_queue():
+    sched = RecordingScheduler()
+    exe = QOpExecutor(QOpManager(), sched)
+    log : List[str] = []
+    exe.Manager.addFIFOOp(make_op(log, "a"))
+    exe.Manager.addFIFOOp(make_op(log, "b"))
+    exe.Manager.addLIFOOp(make_op(log, "first"))
+    exe.startBackgroundProcessing()
+    while sched.Pending:
+        sched.runOne()
+    assert log == ["first", "a", "b"]
+
+
+def test_default_scheduler_runs_callbacks():
+    exe = QOpExecutor(QOpManager())
+    exe.startBackgroundProcessing()
+    done = threading.Event()
+    results : List[OpResult[str]] = []
+
+    def cb(opr : OpResult[str]):
+        results.append(opr)
+        done.set()
+
+    def op(manager : Optional[QOpManager] = None, reason : Optional[str] = None) -> str:
+        return "ok"
+
+    exe.Manager.addFIFOOp(QOp(op, callback=cb))
+    assert done.wait(5)
+    assert results[0].getResult() == "ok"
+    exe.shutdown()
+
+
+def test_maxinflight_shares_slots_in_turn():
+    sched = RecordingScheduler()
+    sched.MaxInFlight = 1
+    log : List[str] = []
+    execs = [QOpExecutor(QOpManager(), sched) for _ in range(2)]
+    for i, exe in enumerate(execs):
+        exe.startBackgroundProcessing()
+        exe.Manager.addFIFOOp(make_op(log, "%d-a" % i))
+        exe.Manager.addFIFOOp(make_op(log, "%d-b" % i))
+
+    # Only one op can be handed over at a time
+    assert len(sched.Pending) == 1
+    while sched.Pending:
+        sched.runOne()
+        assert len(sched.Pending) <= 1
+
+    assert log == ["0-a", "1-a", "0-b", "1-b"]
+    assert sched.InFlight == 0
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from ble.bleak.gattclient import GATTClient
+from ble.bleops import ContextConverter, QOpExecutorFactory
+from ble.readcache import GATTReadCache
+from ble.uuidtype import CHAR_UUID
+
+UUID = CHAR_UUID("0000a001-0000-1000-8000-00805f9b34fb")
+
+
+class PassThrough(ContextConverter):
+    def convert(self, callback):
+        return callback
+
+
+class CountingBleakClient:
+    def __init__(self):
+        self.Reads = 0
+        self.Value = b'\x01'
+
+    async def read_gatt_char(self, uuid):
+        self.Reads += 1
+        return bytearray(self.Value)
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        self.Value = bytes(data)
+
+
+def make_client():
+    gc = GATTClient("00:00:00:00:00:02", QOpExecutorFactory().makeExecutor(), PassThrough())
+    gc.BleakClient = CountingBleakClient()
+    return gc
+
+
+def test_ttl_and_maxstaleness():
+    cache = GATTReadCache()
+    cache.update(UUID, b'x')
+    assert cache.get(UUID) is None  # No TTL, so no hits
+    assert cache.get(UUID, maxstaleness=10) == b'x'
+    cache.setTTL(UUID, 10)
+    assert cache.get(UUID) == b'x'
+    assert cache.get(UUID, maxstaleness=0) is None
+    time.sleep(0.02)
+    assert cache.get(UUID, maxstaleness=0.01) is None
+    cache.invalidate(UUID)
+    assert cache.get(UUID) is None
+
+
+def test_cache_hits_skip_the_device_and_writes_invalidate():
+    gc = make_client()
+    gc.set_read_cache(UUID, 60)
+    try:
+        assert gc.char_read(UUID) == b'\x01'
+        assert gc.char_read(UUID) == b'\x01'
+        assert asyncio.run(gc.async_char_read(UUID)) == b'\x01'
+        assert gc.BleakClient.Reads == 1
+
+        gc.char_write(UUID, b'\x02', True)
+        assert gc.char_read(UUID) == b'\x02'
+        assert gc.BleakClient.Reads == 2
+
+        assert gc.char_read(UUID, maxstaleness=0) == b'\x02'
+        assert gc.BleakClient.Reads == 3
+    finally:
+        gc.shutdown()
@@ -0,0 +1,194 @@
+import asyncio
+import queue
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import ble.bleak.blescanner as blescanner
+from ble.blescanresult import BLEScanResult
+from ble.deviceregistry import DeviceRegistry
+from ble.scansubscription import ScanFilter, ScanMode, ScanPublisher
+
+
+class FakeBleakScanner:
+    """
+    Reports two devices as soon as it starts, the first one twice.
+    """
+    Starts = 0
+    Passive = []
+
+    def __init__(self, scanning_mode="active"):
+        FakeBleakScanner.Passive.append(scanning_mode == "passive")
+
+    def register_detection_callback(self, callback):
+        self.Callback = callback
+
+    async def start(self):
+        FakeBleakScanner.Starts += 1
+        for address, name, rssi in (("00:00:00:00:00:01", "DE1", -60), ("00:00:00:00:00:01", "DE1", -70), ("00:00:00:00:00:02", None, -90)):
+            self.Callback(SimpleNamespace(address=address, name=name), SimpleNamespace(service_uuids=["ffff"], rssi=rssi))
+
+    async def stop(self):
+        pass
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    reg = DeviceRegistry(str(tmp_path / "devices.json"))
+    monkeypatch.setattr(blescanner, "get_DeviceRegistry", lambda: reg)
+    monkeypatch.setattr(blescanner, "BleakScanner", FakeBleakScanner)
+    monkeypatch.setattr(FakeBleakScanner, "Starts", 0)
+    monkeypatch.setattr(FakeBleakScanner, "Passive", [])
+    return reg
+
+
+def test_publisher_only_sends_new_and_changed_results():
+    pub = ScanPublisher()
+    got = []
+    sub = pub.subscribe(got.append)
+    pub.begin()
+    pub.publish(BLEScanResult("A", None, [], None, None))
+    pub.publish(BLEScanResult("A", None, [], None, None))
+    pub.publish(BLEScanResult("A", "DE1", [], None, None))
+    pub.finish()
+    sub.close()
+    pub.publish(BLEScanResult("B", None, [], None, None))
+    assert [r.name if r else r for r in got] == [None, "DE1", None]
+
+
+def test_bleak_scan_pushes_results_and_ends_on_time(registry):
+    tool = blescanner.BLEScanTool()
+    results = queue.SimpleQueue()
+    start = time.monotonic()
+    with tool.subscribe(results.put):
+        tool.startScan(0.3)
+        macs = []
+        while True:
+            item = results.get(timeout=5)
+            if item is None:
+                break
+            macs.append(item.MAC)
+    assert macs == ["00:00:00:00:00:01", "00:00:00:00:00:02"]
+    assert 0.25 < time.monotonic() - start < 2
+    assert not tool.isScanning()
+
+
+def test_bleak_scan_async_iterator_and_early_stop(registry):
+    tool = blescanner.BLEScanTool()
+
+    async def scan():
+        results = tool.results()
+        tool.startScan(30)
+        macs = []
+        async for result in results:
+            macs.append(result.MAC)
+            if len(macs) == 2:
+                tool.stopScanning()
+        return macs
+
+    start = time.monotonic()
+    assert asyncio.run(scan()) == ["00:00:00:00:00:01", "00:00:00:00:00:02"]
+    assert time.monotonic() - start < 5
+
+
+def test_filters_and_registry(registry):
+    tool = blescanner.BLEScanTool()
+    results = queue.SimpleQueue()
+    with tool.subscribe(results.put, ScanFilter(["0000FFFF-0000-1000-8000-00805f9b34fb"], "DE", -80)):
+        tool.startScan(0.1)
+        assert results.get(timeout=5).MAC == "00:00:00:00:00:01"
+        assert results.get(timeout=5) is None
+
+    rec = registry.get("00:00:00:00:00:01")
+    assert (rec.Name, rec.Adverts, rec.UUIDs) == ("DE1", 2, ["0000ffff-0000-1000-8000-00805f9b34fb"])
+    assert rec.RSSI == pytest.approx(-62.5)  # -60, then a quarter of the way to -70
+    assert [r.MAC for r in registry.devices(ScanFilter(minrssi=-80))] == ["00:00:00:00:00:01"]
+
+    registry.save()
+    assert DeviceRegistry(registry.Path).get("00:00:00:00:00:02").RSSI == -90
+
+
+def test_registry_saves_during_a_long_scan(tmp_path):
+    path = str(tmp_path / "devices.json")
+    reg = DeviceRegistry(path, saveinterval=3600)
+    reg.observe(BLEScanResult("00:00:00:00:00:01", "DE1", [], -60, None))
+    reg.LastSave -= 3600  # As if the scan had been running an hour
+    reg.observe(BLEScanResult("00:00:00:00:00:02", None, [], -90, None))
+    deadline = time.monotonic() + 5
+    while (DeviceRegistry(path).get("00:00:00:00:00:02") is None) and (time.monotonic() < deadline):
+        time.sleep(0.01)
+    assert sorted(r.MAC for r in DeviceRegistry(path).devices()) == ["00:00:00:00:00:01", "00:00:00:00:00:02"]
+
+
+def test_publisher_radio_settings():
+    pub = ScanPublisher()
+    pub.subscribe(print)
+    assert pub.radioSettings() is None
+    slow = pub.demand(print, mode=ScanMode.LOW_POWER, passive=True)
+    assert pub.radioSettings() == (ScanMode.LOW_POWER, True)
+    fast = pub.demand(print, mode=ScanMode.BALANCED, timeout=0)
+    assert pub.radioSettings() == (ScanMode.BALANCED, False)
+    assert pub.expire(time.monotonic()) is None
+    assert not fast.Active
+    assert pub.radioSettings() == (ScanMode.LOW_POWER, True)
+    slow.close()
+    assert pub.radioSettings() is None
+
+
+def test_shared_scans_use_one_radio(registry):
+    tool = blescanner.BLEScanTool()
+    short, long = queue.SimpleQueue(), queue.SimpleQueue()
+    tool.startSharedScan(short.put, ScanFilter(nameprefix="DE"), 0.2, ScanMode.LOW_LATENCY)
+    sub = tool.startSharedScan(long.put, None, None, ScanMode.LOW_LATENCY, passive=True)
+
+    assert short.get(timeout=5).MAC == "00:00:00:00:00:01"
+    assert short.get(timeout=5) is None  # Its own timeout
+    assert tool.isScanning()
+    assert [long.get(timeout=5).MAC for _ in range(2)] == ["00:00:00:00:00:01", "00:00:00:00:00:02"]
+
+    sub.close()
+    for _ in range(50):
+        if not tool.isScanning():
+            break
+        time.sleep(0.05)
+    assert not tool.isScanning()
+    assert FakeBleakScanner.Passive == [False, True]  # Passive once the active one had gone
+
+
+def test_low_power_scan_duty_cycles(registry, monkeypatch):
+    monkeypatch.setitem(blescanner.DUTY_CYCLES, ScanMode.LOW_POWER, (0.05, 0.1))
+    tool = blescanner.BLEScanTool()
+    results = queue.SimpleQueue()
+    tool.startSharedScan(results.put, None, 0.5, ScanMode.LOW_POWER)
+    assert results.get(timeout=5).MAC == "00:00:00:00:00:01"
+    assert results.get(timeout=5).MAC == "00:00:00:00:00:02"
+    assert results.get(timeout=5) is None  # Devices aren't reported again each window
+    assert 3 <= FakeBleakScanner.Starts <= 6
+
+
+def test_android_mode_change_doesnt_end_listeners(registry, monkeypatch):
+    androidscanner = pytest.importorskip("ble.android.blescanner", exc_type=ImportError)  # Needs jnius, so Android
+    monkeypatch.setattr(androidscanner, "get_DeviceRegistry", lambda: registry)
+    tool = androidscanner.BLEScanTool(None)
+    scans = []
+
+    def androidscan(mode):
+        scans.append(mode)
+        tool.RadioMode = mode
+        tool.Scanning = True
+    monkeypatch.setattr(tool, "_androidScan", androidscan)
+    tool.BLEScanner = SimpleNamespace(stopScan=lambda callback: scans.append("stop"))
+    tool.ScanCallback = None
+
+    got = []
+    tool.subscribe(got.append)
+    slow = tool.startSharedScan(lambda r: None, None, None, ScanMode.LOW_POWER)
+    fast = tool.startSharedScan(lambda r: None, None, None, ScanMode.LOW_LATENCY)
+    assert scans == [ScanMode.LOW_POWER, "stop", ScanMode.LOW_LATENCY]
+    assert got == []  # Still the same scan to the listener
+
+    fast.close()
+    slow.close()
+    assert scans[-1] == "stop"
+    assert got == [None]
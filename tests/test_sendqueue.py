@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ble.qopmetrics import get_QOpMetrics
+from wsserver.jsondesc import make_GATTNotify, make_resp
+from wsserver.sendqueue import MessageClass, SendPolicy, SendQueue, SendQueueWriter, classify
+
+MAC = "00:00:00:00:00:01"
+A = "0000a00d-0000-1000-8000-00805f9b34fb"
+B = "0000a00e-0000-1000-8000-00805f9b34fb"
+
+
+def test_policies_past_high_water():
+    wakeups = []
+    queue = SendQueue("test", lambda: wakeups.append(1), highwater=2)
+    assert queue.put("a1", MessageClass.NOTIFY, (MAC, A))
+    assert queue.put("b1", MessageClass.NOTIFY, (MAC, B))
+    assert wakeups == [1]  # Only when it stopped being empty
+
+    assert queue.put("a2", MessageClass.NOTIFY, (MAC, A))  # Merged into a1's place
+    assert not queue.put("scan", MessageClass.SCAN, MAC)
+    assert queue.put("resp", MessageClass.RESPONSE)  # Never dropped
+    assert [queue.pop() for _ in range(4)] == ["a2", "b1", "resp", None]
+
+    stats = queue.stats()
+    assert (stats['sent'], stats['dropped'], stats['merged'], stats['max_queued']) == (3, 1, 1, 3)
+    assert "test" in get_QOpMetrics().sendQueues()
+
+    with pytest.raises(ValueError):
+        SendQueue("bad", lambda: None, policies={MessageClass.STATE : SendPolicy.DROP})
+
+
+def test_classify():
+    assert classify(make_GATTNotify(MAC, A, b'\x01')) == (MessageClass.NOTIFY, (MAC, A))
+    assert classify(make_resp(1, {'eid' : 0, 'errmsg' : ''}, {})) == (MessageClass.RESPONSE, None)
+
+
+def test_slow_client_doesnt_hold_up_producer():
+    sent = []
+    release = threading.Event()
+
+    def send(message):
+        release.wait()
+        sent.append(message)
+
+    writer = SendQueueWriter("slow", send, highwater=10)
+    start = time.perf_counter()
+    for i in range(100):
+        writer.Queue.put(i, MessageClass.NOTIFY, (MAC, A))
+    assert time.perf_counter() - start < 0.5
+    assert writer.Queue.lag() > 0
+
+    release.set()
+    while writer.Queue.queuedCount():
+        time.sleep(0.01)
+    time.sleep(0.05)
+    writer.close()
+    # The first went to send() straight away, then the queue filled up and
+    # kept replacing its last notification with the newest.
+    assert sent[-1] == 99 and len(sent) <= 12
+
+
+def test_sync_server_closes_queue_when_socket_fails():
+    from wsserver.server import SyncWSServer
+    tries = []
+
+    def send_message(client, message):
+        tries.append(message)
+        raise ConnectionResetError("Gone")
+
+    server = SimpleNamespace(Server=SimpleNamespace(send_message=send_message), Logger=logging.getLogger("test"), Writers={})
+    server.Writers[1] = SendQueueWriter("reset", lambda message: SyncWSServer._send(server, {'id' : 1}, message))
+    for i in range(3):
+        server.Writers[1].Queue.put(i, MessageClass.RESPONSE, None)
+    server.Writers[1].Thread.join(5)
+    assert tries == [0]
+    assert not server.Writers[1].Queue.put(3, MessageClass.RESPONSE, None)
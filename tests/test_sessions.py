@@ -0,0 +1,26 @@
+from wsserver.sessions import Sessions
+
+MAC = "00:00:00:00:00:01"
+
+
+def test_first_in_last_out():
+    s = Sessions()
+    s.addClient("a", "client a")
+    s.addClient("b", "client b")
+    assert s.addConnection(MAC, "a", 1)
+    assert not s.addConnection(MAC, "b", 7)
+    assert sorted(s.connectionClients(MAC)) == [("client a", 1), ("client b", 7)]
+
+    assert s.addNotify(MAC, "x", "a")
+    assert not s.addNotify(MAC, "x", "a")  # Asking again doesn't count
+    assert not s.addNotify(MAC, "x", "b")
+    assert s.addNotify(MAC, "y", "a")
+    assert sorted(s.notifyClients(MAC, "x")) == ["client a", "client b"]
+
+    assert not s.removeNotify(MAC, "x", "b")
+    assert not s.removeNotify(MAC, "x", "b")  # Twice doesn't count
+    assert s.removeConnection(MAC, "b") == (False, [])
+
+    assert s.removeClient("a") == ([MAC], [(MAC, "x"), (MAC, "y")])
+    assert s.clientCount() == 1
+    assert s.notifyClients(MAC, "x") == []
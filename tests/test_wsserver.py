@@ -0,0 +1,38 @@
+import logging
+import time
+
+import pytest
+
+from ble.scansubscription import ScanPublisher
+from wsserver.server import SyncWSServer
+
+
+class FakeScanTool:
+    def __init__(self):
+        self.Publisher = ScanPublisher()
+
+    def startSharedScan(self, callback, scanfilter=None, timeout=None, mode=None, passive=False):
+        return self.Publisher.demand(callback, scanfilter, mode, timeout, passive)
+
+
+@pytest.fixture
+def server():
+    server = SyncWSServer(logging.getLogger("test"), host='127.0.0.1', port=0)
+    yield server
+    server.shutdown()
+
+
+def test_scan_is_closed_when_client_leaves(server):
+    tool = FakeScanTool()
+    server.BLE.getBLEScanTool = lambda: tool
+    client = {'id' : 7, 'address' : ('127.0.0.1', 1000)}
+    server._cb_NewClient(client, server.Server)
+    server.do_scan(client, 1, 1)
+    server.do_scan(client, 2, 1 << 32)
+    server.do_scan(client, 3, 1 << 32)
+    tool.Publisher.expire(time.monotonic() + 2)  # The first one ends by itself
+    assert len(server.Scans[7]) == len(tool.Publisher.Subscriptions) == 2
+
+    server._cb_ClientLeft(client, server.Server)
+    assert tool.Publisher.Subscriptions == []
+    assert server.Scans == {}